@@ -34,6 +34,7 @@ from chip import WithTimer
 from chip import makeChipImage
 from Exposure import filterToLetter
 from Focalplane import *
+import InstanceCatalog
 #import lsst.pex.policy as pexPolicy
 #import lsst.pex.logging as pexLog
 #import lsst.pex.exceptions as pexExcept
@@ -61,22 +62,19 @@ def ReadExtraidFile(extraidFile):
     return extraid, centid
 
 
-def ReadObshistidAndFilt(trimfile):
-    """Reads obshistid and filter number from trimfile.
+def ReadObshistidAndFilt(trimfileName, cache=False):
+    """Reads obshistid and filter number from the trimfile header.
 
     Args:
-      trimfile:  trimfile file pointer
+      trimfileName:  Name of trimfile
+      cache:         Use the InstanceCatalog sidecar header cache.
 
     Returns:
       obshistid, filterNum
     """
-    filterNum = ''
-    obshistid = ''
-    for line in trimfile:
-        if line.startswith('Opsim_filter'):
-            name, filterNum = line.split()
-        elif line.startswith('Opsim_obshistid'):
-            name, obshistid = line.split()
+    header = InstanceCatalog.ReadHeader(trimfileName, cache=cache)
+    filterNum = header.get('Opsim_filter', '')
+    obshistid = header.get('Opsim_obshistid', '')
     assert filterNum
     assert obshistid
     return obshistid, filterNum
@@ -135,6 +133,18 @@ class AllChipsScriptGenerator:
         self.useSharedSEDs = self.policy.getboolean('general','useSharedSEDs')
         self.debugLevel = self.policy.getint('general','debuglevel')
         self.regenAtmoscreens = self.policy.getboolean('general','regenAtmoscreens')
+        if self.policy.has_option('general', 'trimfileHeaderCache'):
+            self.trimfileHeaderCache = self.policy.getboolean('general', 'trimfileHeaderCache')
+        else:
+            self.trimfileHeaderCache = False
+        if self.policy.has_option('general', 'preprocProcessors'):
+            self.preprocProcessors = self.policy.getint('general', 'preprocProcessors')
+        else:
+            self.preprocProcessors = 1
+        if self.policy.has_option('general', 'footprintFilter'):
+            self.footprintFilter = self.policy.getboolean('general', 'footprintFilter')
+        else:
+            self.footprintFilter = False
 
         # Sets self.obshistid, self.filterNum, self.extraid, self.centid:
         self._loadFocalplaneNames(extraidFile, extraid, centid)
@@ -161,7 +171,10 @@ class AllChipsScriptGenerator:
         # NOTE: This might not be in the right location, but I never ran with self.centid==1.
         self.centroidPath = os.path.join(self.stagePath, 'imSim/PT1.2/centroid/v%s-f%s' %(self.obshistid, self.filterName))
 
-        self.focalplane = Focalplane(self.obshistid, self.filterName)
+        self.focalplane = Focalplane(self.obshistid, self.filterName,
+                                     nproc=self.preprocProcessors,
+                                     headerCache=self.trimfileHeaderCache,
+                                     footprintFilter=self.footprintFilter)
         _d = self.focalplane.parsDictionary
         # Parameter File Names
         self.obsCatFile        = _d['objectcatalog']
@@ -183,8 +196,8 @@ class AllChipsScriptGenerator:
         and self.trimfile by reading self.trimfile and extraidFile.
         """
         #Get obshistid and filter ID from trimfile
-        with file(self.trimfile, 'r') as trimf:
-            self.obshistid, self.filterNum = ReadObshistidAndFilt(trimf)
+        self.obshistid, self.filterNum = ReadObshistidAndFilt(
+            self.trimfile, cache=self.trimfileHeaderCache)
         self.filterName = filterToLetter(self.filterNum)
 
         # Get non-default commands & extra ID
@@ -271,27 +284,15 @@ class AllChipsScriptGenerator:
         for chip in self.cidList:
             cid = chip[0]
             trimCatFile = 'trimcatalog_%s_%s.pars' %(self.obshistid, cid)
-            # The minimum length of trimCatFile at this stage is 2 lines.
-            # (trim puts 1 line in there, and generateTrimCatalog() appended
-            # a second line. Therefore, the number of sources in the trimCatFile
-            # is its length - 2.
-            with open(trimCatFile) as f:
-                nTrimCatSources = len(f.readlines()) - 2
+            # Count the sources and, if there are enough of them, write
+            # sedlist_*.txt and gzip trimCatFile, all in a single pass.
+            # The SED list is useful for platforms where we stage only the
+            # needed SED files.
+            nTrimCatSources, trimCatFile = self.focalplane.compressTrimCatalog(
+                trimCatFile, cid)
             print 'nTrimCatSources:', nTrimCatSources
             print 'minsource', self.focalplane.minsource
             if nTrimCatSources >= self.focalplane.minsource:
-
-                # Figure out which SED files are needed for this chip and store
-                # in sedlist_*.txt.  This information is useful for platforms
-                # where we stage only the needed SED files.
-                self.focalplane.writeSedManifest(trimCatFile, cid)
-                # Now that we are done reading from trimCatFile, gzip it since
-                # these files get rather large
-                cmd = 'gzip %s' %trimCatFile
-                sys.stdout.write('Gzipping %s...' %trimCatFile)
-                subprocess.check_call(cmd, shell=True)
-                sys.stdout.write('Done.\n')
-                trimCatFile += '.gz'
                 devtype = chip[1]
                 devvalue = chip[2]
                 if devtype == 'CCD':
@@ -325,13 +326,7 @@ class AllChipsScriptGenerator:
                     seedchip = int(self.focalplane.simseed) + cc*1000 + ex
                     cc += 1
                     chipParFile = parNames.chip(id)
-                    if os.path.isfile(chipParFile):
-                        os.remove(chipParFile)
-                    shutil.copyfile('data/focal_plane/sta_misalignments/offsets/pars_%s' %(cid), chipParFile)
-                    with file(chipParFile, 'a') as parFile:
-                        #TODO: parFile.write('flatdir 1 \n')
-                        parFile.write('chipid %s \n' %(cid))
-                        parFile.write('chipheightfile ../data/focal_plane/sta_misalignments/height_maps/%s.fits.gz \n' %(cid))
+                    self.focalplane.generateChipParams(cid, chipParFile)
                     # GENERATE THE RAYTRACE PARS
                     print 'Generating raytrace pars.'
                     raytraceParFile = parNames.raytrace(id)
@@ -431,7 +426,9 @@ class AllChipsScriptGenerator:
         cmd = ('tar %s %s ancillary/trim/trim ancillary/Add_Background/*'
                ' ancillary/cosmic_rays/* ancillary/e2adc/e2adc raytrace/lsst'
                ' raytrace/*.txt raytrace/version pbs/distributeFiles.py'
-               ' Exposure.py Focalplane.py verifyFiles.py chip.py'
+               ' Exposure.py FitsUtil.py Focalplane.py FocalplaneGeometry.py FootprintFilter.py'
+               ' InstanceCatalog.py'
+               ' verifyFiles.py chip.py'
                % (tarCommand, nodeFilesTar))
         subprocess.check_call(cmd, shell=True)
         return
@@ -1,9 +1,48 @@
 #!/usr/bin/python2.6
 import os
+import re
+import subprocess
 import unittest
 from AllChipsScriptGenerator import *
 from optparse import OptionParser
 
+_IMPORT_RE = re.compile(r'^\s*(?:from\s+(\w+)\s+import|import\s+([\w, ]+))')
+
+def captureTarCommand(func, *args):
+  """Runs func with subprocess.check_call stubbed out and returns the command."""
+  cmds = []
+  saved = subprocess.check_call
+  subprocess.check_call = lambda cmd, **kwargs: cmds.append(cmd)
+  try:
+    func(*args)
+  finally:
+    subprocess.check_call = saved
+  return cmds[0]
+
+def missingLocalImports(tarCmd):
+  """Returns the local modules imported by the .py files in tarCmd but not in it.
+
+  Only modules that live next to this file are considered, so stdlib and
+  phosim-distribution imports are ignored.
+  """
+  baseDir = os.path.dirname(os.path.abspath(__file__))
+  shipped = set(os.path.splitext(w)[0] for w in tarCmd.split()
+                if w.endswith('.py') and '/' not in w)
+  missing = set()
+  for module in shipped:
+    for line in open(os.path.join(baseDir, module + '.py')):
+      m = _IMPORT_RE.match(line)
+      if not m:
+        continue
+      names = [m.group(1)] if m.group(1) else m.group(2).split(',')
+      for name in names:
+        name = name.strip()
+        if (os.path.isfile(os.path.join(baseDir, name + '.py')) and
+            name not in shipped):
+          missing.add((module, name))
+  return sorted(missing)
+
+
 class MockAllChipsScriptGenerator(AllChipsScriptGenerator):
   def _loadFocalplaneNames(self, extraidFile, extraid, centid):
     self.obshistid = '1234560'
@@ -85,5 +124,12 @@ class TestAllChipsScriptGenerator(unittest.TestCase):
       raise
     self.assertEquals(s.trackingParFile, 'tracking_1234560.pars')
 
+  def test_tarExecFilesShipsImports(self):
+    """Every local module imported on the node must be in the exec tarball."""
+    self._SetupWorkstation()
+    s = MockAllChipsScriptGenerator('mockTrimFile', self.policy, self.extraidFile)
+    cmd = captureTarCommand(s._tarExecFiles, 'nodeFiles.tar')
+    self.assertEquals(missingLocalImports(cmd), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -22,6 +22,7 @@ import getpass   # for getting username
 import datetime
 from SingleVisitScriptGenerator import *
 from Exposure import filterToLetter, filterToNumber
+import InstanceCatalog
 
 class AllVisitsScriptGenerator:
     """
@@ -145,13 +146,11 @@ class AllVisitsScriptGenerator:
         trimfilePath = os.path.dirname(trimfileName)
         #basename, extension = os.path.splitext(trimfileName)
 
-        for line in open(trimfileName).readlines():
-            if line.startswith('Opsim_filter'):
-                name, filterNum = line.split()
-                print 'Opsim_filter:', filterNum
-            if line.startswith('Opsim_obshistid'):
-                name, obshistid = line.split()
-                print 'Opsim_obshistid:', obshistid
+        header = InstanceCatalog.ReadHeader(trimfileName)
+        filterNum = header['Opsim_filter']
+        print 'Opsim_filter:', filterNum
+        obshistid = header['Opsim_obshistid']
+        print 'Opsim_obshistid:', obshistid
 
         ono = list(obshistid)
         if len(ono) > 8:
@@ -275,7 +274,8 @@ class AllVisitsScriptGenerator:
 
         cmd =  'tar czvf %s ' % os.path.join(self.tmpdir, self.controlFileTgzName)
         cmd += ' chip.py fullFocalplane.py AbstractScriptGenerator.py AllChipsScriptGenerator.py'
-        cmd += ' SingleChipScriptGenerator.py Focalplane.py Exposure.py verifyFiles.py %s %s' %(self.imsimConfigFile, self.extraIdFile)
+        cmd += ' SingleChipScriptGenerator.py Focalplane.py FitsUtil.py FocalplaneGeometry.py FootprintFilter.py InstanceCatalog.py Exposure.py verifyFiles.py'
+        cmd += ' CostModel.py PhosimManager.py PhosimUtil.py PhosimVerifier.py ScriptWriter.py %s %s' %(self.imsimConfigFile, self.extraIdFile)
 
         print 'Tarring control and param files that will be copied to the execution node(s).'
         subprocess.check_call(cmd, shell=True)
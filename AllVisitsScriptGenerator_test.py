@@ -2,6 +2,7 @@
 import os
 import unittest
 from AllVisitsScriptGenerator import *
+from AllChipsScriptGenerator_test import captureTarCommand, missingLocalImports
 from optparse import OptionParser
 
 
@@ -72,5 +73,14 @@ class TestAllVisitsScriptGenerator(unittest.TestCase):
     except:
       raise
 
+  def test_tarControlFilesShipsImports(self):
+    """Every local module imported on the node must be in the control tarball."""
+    self._SetupWorkstation()
+    s = MockAllVisitsScriptGenerator('mockTrimFile', self.policy, self.imsimConfigFile,
+                                     self.extraidFile)
+    s.scriptInvocationPath = os.getcwd()
+    cmd = captureTarCommand(s.tarControlFiles)
+    self.assertEquals(missingLocalImports(cmd), [])
+
 if __name__ == '__main__':
     unittest.main()
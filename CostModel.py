@@ -0,0 +1,340 @@
+#!/usr/bin/python
+
+"""Predicts raytrace runtimes from per-fid trim catalog statistics.
+
+Raytrace runtimes of the chips of one visit vary by more than 10x, mostly
+with the number and brightness of the sources on the chip.  This module
+  - extracts features for each fid during preprocessing (source count,
+    magnitude histogram, total flux, SED types and exposure time; see
+    ExtractFeatures()) and records them in the manifest as
+      feature,<cid>_<eid>,<name>=<value> <name>=<value> ...
+  - fits a linear regression of recorded wall times (e.g. the stats file
+    of LocalExecutor.py) on these features, and
+  - predicts runtimes, which are used to dispatch longest-first and to
+    set walltimes (LocalExecutor.py --cost_model, the PBS script
+    writers).
+
+Usage:
+  CostModel.py fit <model file> <stats.csv> <manifest.txt> [...]
+  CostModel.py predict <model file> <manifest.txt>
+"""
+
+from __future__ import with_statement
+import csv
+import gzip
+import logging
+import math
+import os
+import sys
+
+import PhosimUtil
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+MAG_BIN_EDGES = (12, 14, 16, 18, 20, 22, 24)
+SED_TYPES = ('star', 'galaxy', 'ssm', 'agn', 'flat', 'sky')
+# Flux of a source of magnitude m, relative to magnitude FLUX_ZEROPOINT.
+FLUX_ZEROPOINT = 20.0
+
+_features_memo = {}
+
+
+def MagBinName(mag):
+  """Returns the name of the magnitude histogram bin that mag falls into."""
+  if mag < MAG_BIN_EDGES[0]:
+    return 'mag_lt%d' % MAG_BIN_EDGES[0]
+  for lo, hi in zip(MAG_BIN_EDGES[:-1], MAG_BIN_EDGES[1:]):
+    if mag < hi:
+      return 'mag_%d_%d' % (lo, hi)
+  return 'mag_ge%d' % MAG_BIN_EDGES[-1]
+
+def SedType(sed):
+  for sed_type in SED_TYPES:
+    if sed.startswith(sed_type) or ('/%s' % sed_type) in sed:
+      return sed_type
+  return 'other'
+
+def _OpenPars(fn):
+  if fn.endswith('.gz'):
+    return gzip.open(fn, 'rb')
+  return open(fn, 'r')
+
+def ScanParsFile(fn):
+  """Accumulates features from the 'object' and 'exptime' lines of fn.
+
+  fn may be a trimcatalog or raytrace .pars file, optionally gzipped.
+  The result is memoized by (fn, size, mtime), since all exposures of a
+  chip share one trim catalog.
+
+  Returns:
+    Dict of feature name -> value.
+  """
+  st = os.stat(fn)
+  key = (fn, st.st_size, st.st_mtime)
+  if key in _features_memo:
+    return dict(_features_memo[key])
+  features = {'nsources': 0, 'flux': 0.0}
+  f = _OpenPars(fn)
+  try:
+    for line in f:
+      if line.startswith('object'):
+        fields = line.split()
+        features['nsources'] += 1
+        try:
+          mag = float(fields[4])
+        except (IndexError, ValueError):
+          continue
+        features['flux'] += 10 ** (-0.4 * (mag - FLUX_ZEROPOINT))
+        name = MagBinName(mag)
+        features[name] = features.get(name, 0) + 1
+        name = 'sed_%s' % SedType(fields[5] if len(fields) > 5 else '')
+        features[name] = features.get(name, 0) + 1
+      elif line.startswith('exptime'):
+        features['exptime'] = float(line.split()[1])
+  finally:
+    f.close()
+  _features_memo[key] = features
+  return dict(features)
+
+def ExtractFeatures(work_dir, observation_id, cid, eid):
+  """Extracts the features of one fid from the preprocessing output.
+
+  Sources are taken from raytrace_<fid>.pars or, if it has none, from
+  the chip's trimcatalog_<observation_id>_<cid>.pars[.gz].
+
+  Returns:
+    Dict of feature name -> value ({} if there are no pars files).
+  """
+  features = {}
+  raytrace_fn = os.path.join(work_dir, 'raytrace_%s_%s_%s.pars' %
+                             (observation_id, cid, eid))
+  if os.path.exists(raytrace_fn):
+    features = ScanParsFile(raytrace_fn)
+  if not features.get('nsources'):
+    trimcat_fn = os.path.join(work_dir, 'trimcatalog_%s_%s.pars' %
+                              (observation_id, cid))
+    for fn in (trimcat_fn, trimcat_fn + '.gz'):
+      if os.path.exists(fn):
+        exptime = features.get('exptime')
+        features = ScanParsFile(fn)
+        if exptime is not None:
+          features['exptime'] = exptime
+        break
+  return features
+
+def FormatFeatures(features):
+  return ' '.join('%s=%s' % (name, features[name]) for name in sorted(features))
+
+def ParseFeatures(value):
+  features = {}
+  for item in value.split():
+    name, feature = item.split('=', 1)
+    features[name] = float(feature)
+  return features
+
+def WriteFeatures(parser, features_by_exposure):
+  """Appends 'feature' rows to a manifest.
+
+  Args:
+    parser:               ManifestParser open for writing.
+    features_by_exposure: Dict of <cid>_<eid> -> features.
+  """
+  parser.Append([('feature', exposure_id,
+                  FormatFeatures(features_by_exposure[exposure_id]))
+                 for exposure_id in sorted(features_by_exposure)])
+
+def ReadFeatures(parser):
+  """Returns {<cid>_<eid>: features} from a manifest parser after Read()."""
+  return dict(parser.GetByMatcher(
+    lambda row: (row[1], ParseFeatures(row[2])) if row[0] == 'feature' else None))
+
+def ReadManifestFeatures(manifest_fn, manifest_parser_class=PhosimUtil.ManifestParser):
+  """Returns {fid: features} from an observation's manifest.txt."""
+  with manifest_parser_class(manifest_fn, 'r') as parser:
+    parser.Read()
+    observation_id = parser.GetLastByTags('param', 'observation_id')
+    return dict(('%s_%s' % (observation_id, exposure_id), features)
+                for exposure_id, features in ReadFeatures(parser).iteritems())
+
+def ReadTimings(stats_fn):
+  """Reads wall times of successful runs from a LocalExecutor stats file.
+
+  Returns:
+    Dict of fid -> wall time in seconds (of the last successful attempt).
+  """
+  timings = {}
+  with open(stats_fn, 'r') as f:
+    for row in csv.DictReader(f):
+      if row.get('exit_status') in ('0', None):
+        timings[row['fid']] = float(row['wall_s'])
+  return timings
+
+def Walltime(seconds, margin=1.5, minimum_s=600):
+  """Returns a PBS walltime 'H:MM:SS' for a job predicted to take seconds."""
+  total = int(math.ceil(max(seconds * margin, minimum_s)))
+  return '%d:%02d:%02d' % (total // 3600, (total // 60) % 60, total % 60)
+
+def LongestFirst(fids, predictions):
+  """Returns fids ordered by descending predicted runtime (stable; unknown last)."""
+  return sorted(fids, key=lambda fid: -predictions.get(fid, -1.0))
+
+def Makespan(runtimes, slots):
+  """Returns the time to run runtimes longest-first on slots parallel slots."""
+  loads = [0.0] * max(slots, 1)
+  for runtime in sorted(runtimes, reverse=True):
+    loads[loads.index(min(loads))] += runtime
+  return max(loads)
+
+def _Solve(a, b):
+  """Solves a x = b by Gaussian elimination with partial pivoting."""
+  n = len(b)
+  m = [list(row) + [rhs] for row, rhs in zip(a, b)]
+  for col in range(n):
+    pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+    m[col], m[pivot] = m[pivot], m[col]
+    if abs(m[col][col]) < 1e-12:
+      continue
+    for r in range(n):
+      if r != col:
+        factor = m[r][col] / m[col][col]
+        for c in range(col, n + 1):
+          m[r][c] -= factor * m[col][c]
+  return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+class CostModel(object):
+  """Linear regression of runtime on fid features."""
+
+  def __init__(self, names=None, coefficients=None, intercept=0.0,
+               min_runtime_s=1.0):
+    """Constructor.
+
+    Args:
+      names:          Feature names.
+      coefficients:   One coefficient per name (seconds per unit).
+      intercept:      Seconds.
+      min_runtime_s:  Predictions are at least this.
+    """
+    self.names = list(names or [])
+    self.coefficients = list(coefficients or [0.0] * len(self.names))
+    self.intercept = intercept
+    self.min_runtime_s = min_runtime_s
+
+  def _Vector(self, features):
+    vector = [float(features.get(name, 0.0)) for name in self.names]
+    if 'photons' in self.names:
+      vector[self.names.index('photons')] = (features.get('flux', 0.0) *
+                                             features.get('exptime', 1.0))
+    return vector
+
+  def Fit(self, samples, ridge=1e-6):
+    """Fits the model.
+
+    Args:
+      samples:  List of (features, runtime in seconds).
+      ridge:    Regularization, relative to the standardized features.
+    """
+    if not self.names:
+      names = set(['photons'])
+      for features, runtime in samples:
+        names.update(features)
+      self.names = sorted(names)
+    rows = [self._Vector(features) for features, runtime in samples]
+    y = [runtime for features, runtime in samples]
+    n = len(self.names)
+    # Standardize, so that features of very different scale are well
+    # conditioned.
+    means = [sum(row[i] for row in rows) / len(rows) for i in range(n)]
+    scales = [math.sqrt(sum((row[i] - means[i]) ** 2 for row in rows) / len(rows))
+              or 1.0 for i in range(n)]
+    z = [[(row[i] - means[i]) / scales[i] for i in range(n)] for row in rows]
+    y_mean = sum(y) / len(y)
+    a = [[sum(zr[i] * zr[j] for zr in z) + (ridge * len(z) if i == j else 0.0)
+          for j in range(n)] for i in range(n)]
+    b = [sum(zr[i] * (yr - y_mean) for zr, yr in zip(z, y)) for i in range(n)]
+    beta = _Solve(a, b)
+    self.coefficients = [beta[i] / scales[i] for i in range(n)]
+    self.intercept = y_mean - sum(c * m for c, m in zip(self.coefficients, means))
+    logger.info('Fitted cost model on %d samples: %s', len(samples), self)
+
+  def Predict(self, features):
+    """Returns the predicted runtime in seconds."""
+    runtime = self.intercept + sum(c * v for c, v in
+                                   zip(self.coefficients, self._Vector(features)))
+    return max(runtime, self.min_runtime_s)
+
+  def PredictAll(self, features_by_fid):
+    """Returns {fid: predicted runtime} for {fid: features}."""
+    return dict((fid, self.Predict(features))
+                for fid, features in features_by_fid.iteritems())
+
+  def Save(self, fn):
+    with open(fn, 'w') as f:
+      f.write('intercept %r\n' % self.intercept)
+      f.write('min_runtime_s %r\n' % self.min_runtime_s)
+      for name, coefficient in zip(self.names, self.coefficients):
+        f.write('coefficient %s %r\n' % (name, coefficient))
+
+  @classmethod
+  def Load(cls, fn):
+    model = cls()
+    with open(fn, 'r') as f:
+      for line in f:
+        fields = line.split()
+        if not fields:
+          continue
+        if fields[0] == 'intercept':
+          model.intercept = float(fields[1])
+        elif fields[0] == 'min_runtime_s':
+          model.min_runtime_s = float(fields[1])
+        elif fields[0] == 'coefficient':
+          model.names.append(fields[1])
+          model.coefficients.append(float(fields[2]))
+    return model
+
+  def __str__(self):
+    return 'intercept=%.3g %s' % (self.intercept, ' '.join(
+      '%s=%.3g' % (name, c) for name, c in zip(self.names, self.coefficients)))
+
+
+def FitFromFiles(stats_fns, manifest_fns):
+  """Fits a CostModel on the timings in stats_fns of the fids in manifest_fns."""
+  timings = {}
+  for fn in stats_fns:
+    timings.update(ReadTimings(fn))
+  features = {}
+  for fn in manifest_fns:
+    features.update(ReadManifestFeatures(fn))
+  samples = [(features[fid], timings[fid]) for fid in sorted(features)
+             if fid in timings]
+  if not samples:
+    raise ValueError('No fids with both features and timings.')
+  model = CostModel()
+  model.Fit(samples)
+  return model
+
+
+if __name__ == '__main__':
+  usage = ('usage: %s fit <model file> <stats.csv> <manifest.txt> [...]\n'
+           '       %s predict <model file> <manifest.txt>' %
+           (sys.argv[0], sys.argv[0]))
+  args = sys.argv[1:]
+  if (len(args) < 3 or args[0] not in ('fit', 'predict') or
+      (args[0] == 'fit' and len(args) < 4)):
+    print 'Incorrect number of arguments.'
+    print usage
+    quit()
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s:%(name)s:  %(message)s')
+  if args[0] == 'fit':
+    model = FitFromFiles([args[2]], args[3:])
+    model.Save(args[1])
+    print model
+  else:
+    model = CostModel.Load(args[1])
+    predictions = model.PredictAll(ReadManifestFeatures(args[2]))
+    for fid in LongestFirst(predictions.keys(), predictions):
+      print '%s %.0f' % (fid, predictions[fid])
+  sys.exit(0)
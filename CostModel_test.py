@@ -0,0 +1,102 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import CostModel
+import PhosimUtil
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+
+class CostModelTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testExtractFeatures(self):
+    trimcat = gzip.open(os.path.join(self.tmpdir, 'trimcatalog_1234_R22_S11.pars.gz'),
+                        'wb')
+    try:
+      trimcat.write('object 1 0.0 0.0 20.0 starSED/kurucz/km10.gz 0 0 0\n'
+                    'object 2 0.0 0.0 25.0 galaxySED/Exp.40E09.gz 0.5 0 0\n'
+                    'object 3 0.0 0.0 10.0 ../sky/sed_flat.txt 0 0 0\n')
+    finally:
+      trimcat.close()
+    with open(os.path.join(self.tmpdir, 'raytrace_1234_R22_S11_E000.pars'), 'w') as f:
+      f.write('obshistid 1234\nexptime 15.0\n')
+    features = CostModel.ExtractFeatures(self.tmpdir, '1234', 'R22_S11', 'E000')
+    self.assertEqual(features['nsources'], 3)
+    self.assertEqual(features['exptime'], 15.0)
+    self.assertAlmostEqual(features['flux'], 1.0 + 0.01 + 1e4)
+    self.assertEqual((features['mag_lt12'], features['mag_20_22'],
+                      features['mag_ge24']), (1, 1, 1))
+    self.assertFalse('mag_18_20' in features)
+    self.assertEqual((features['sed_star'], features['sed_galaxy'],
+                      features['sed_sky']), (1, 1, 1))
+    # Exposures without a raytrace pars file still get the chip's sources.
+    features = CostModel.ExtractFeatures(self.tmpdir, '1234', 'R22_S11', 'E001')
+    self.assertEqual(features['nsources'], 3)
+    self.assertFalse('exptime' in features)
+    self.assertEqual(CostModel.ExtractFeatures(self.tmpdir, '1234', 'R01_S00', 'E000'),
+                     {})
+
+  def testManifestFeatures(self):
+    manifest_fn = os.path.join(self.tmpdir, 'manifest.txt')
+    features = {'R22_S11_E000': {'nsources': 3, 'flux': 1.5},
+                'R22_S11_E001': {'nsources': 0, 'flux': 0.0, 'exptime': 15.0}}
+    with PhosimUtil.ManifestParser(manifest_fn, 'w') as parser:
+      parser.Write([('param', 'observation_id', '1234')])
+      CostModel.WriteFeatures(parser, features)
+    self.assertEqual(CostModel.ReadManifestFeatures(manifest_fn),
+                     {'1234_R22_S11_E000': {'nsources': 3.0, 'flux': 1.5},
+                      '1234_R22_S11_E001': {'nsources': 0.0, 'flux': 0.0,
+                                            'exptime': 15.0}})
+
+  def testFitAndPredict(self):
+    samples = []
+    for nsources in (10, 200, 3000, 40000):
+      for flux in (0.5, 8.0, 100.0):
+        features = {'nsources': nsources, 'flux': flux, 'exptime': 15.0}
+        samples.append((features, 30.0 + 0.01 * nsources + 2.0 * flux * 15.0))
+    model = CostModel.CostModel()
+    model.Fit(samples)
+    for features, runtime in samples:
+      self.assertAlmostEqual(model.Predict(features), runtime, 2)
+    model_fn = os.path.join(self.tmpdir, 'model.txt')
+    model.Save(model_fn)
+    loaded = CostModel.CostModel.Load(model_fn)
+    self.assertEqual(loaded.names, model.names)
+    self.assertAlmostEqual(loaded.Predict(samples[5][0]), samples[5][1], 2)
+    self.assertEqual(loaded.Predict({'nsources': -1e9}), 1.0)
+
+  def testFitFromFiles(self):
+    manifest_fn = os.path.join(self.tmpdir, 'manifest.txt')
+    with PhosimUtil.ManifestParser(manifest_fn, 'w') as parser:
+      parser.Write([('param', 'observation_id', '1234')])
+      CostModel.WriteFeatures(parser, dict(
+        ('R22_S11_E%03d' % i, {'nsources': 100 * i}) for i in range(4)))
+    stats_fn = os.path.join(self.tmpdir, 'stats.csv')
+    with open(stats_fn, 'w') as f:
+      f.write('fid,attempt,exit_status,wall_s\n'
+              '1234_R22_S11_E000,1,0,10.0\n1234_R22_S11_E001,1,0,20.0\n'
+              '1234_R22_S11_E002,1,1,5.0\n1234_R22_S11_E002,2,0,30.0\n')
+    model = CostModel.FitFromFiles([stats_fn], [manifest_fn])
+    self.assertAlmostEqual(model.Predict({'nsources': 300}), 40.0, 3)
+
+  def testScheduling(self):
+    self.assertEqual(CostModel.LongestFirst(['a', 'b', 'c', 'd'],
+                                            {'a': 1.0, 'b': 30.0, 'd': 2.0}),
+                     ['b', 'd', 'a', 'c'])
+    self.assertEqual(CostModel.Makespan([5, 4, 3, 3, 3], 2), 10)
+    self.assertEqual(CostModel.Walltime(3600), '1:30:00')
+    self.assertEqual(CostModel.Walltime(1), '0:10:00')
+
+
+if __name__ == '__main__':
+  unittest.main()
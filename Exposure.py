@@ -15,7 +15,8 @@ Notation: For naming the rafts, sensors, amplifiers, and exposures, we
 """
 from __future__ import with_statement
 import os, re, sys
-import subprocess
+import FitsUtil
+import FocalplaneGeometry
 
 
 def filterToLetter(filterIdNum):
@@ -91,7 +92,74 @@ def readAmpList(ampFile, cid):
     return ampList
 
 
-def verifyFileExistence(missingList, path, filename):
+class MetadataCallCounter(object):
+    """Counts filesystem metadata calls (stat, listdir, ...) made while
+    verifying files."""
+    def __init__(self):
+        self.count = 0
+
+    def add(self, n=1):
+        self.count += n
+
+
+class DirectorySnapshot(object):
+    """The names in a directory, read with a single listdir().
+
+    Existence queries are answered from the snapshot, so they cost no
+    metadata round trips on a shared filesystem.  Note that a directory
+    entry counts as a file, and that files created after the snapshot
+    was taken are not seen.
+    """
+    def __init__(self, path, counter=None, listdir=os.listdir):
+        self.path = path
+        if counter:
+            counter.add()
+        try:
+            self.names = frozenset(listdir(path))
+        except OSError:
+            self.names = frozenset()
+
+    def contains(self, filename):
+        return filename in self.names
+
+    def findVariant(self, filename):
+        """Returns filename, filename with '.gz' stripped, or filename +
+        '.gz', whichever is in the directory first, or None."""
+        candidates = [filename, '%s.gz' % filename]
+        if filename.endswith('.gz'):
+            candidates.insert(1, filename[:-len('.gz')])
+        for name in candidates:
+            if name in self.names:
+                return name
+        return None
+
+
+class DirectorySnapshots(object):
+    """Takes a DirectorySnapshot of each directory the first time it is
+    queried.
+
+    Use a new instance for each verification pass.
+    """
+    def __init__(self, counter=None, listdir=os.listdir):
+        if counter is None:
+            counter = MetadataCallCounter()
+        self.counter = counter
+        self.listdir = listdir
+        self.snapshots = {}
+
+    def get(self, path):
+        key = os.path.normpath(path)
+        if key not in self.snapshots:
+            self.snapshots[key] = DirectorySnapshot(path, self.counter,
+                                                    self.listdir)
+        return self.snapshots[key]
+
+    def isfile(self, fullpath):
+        dirname, filename = os.path.split(fullpath)
+        return self.get(dirname).contains(filename)
+
+
+def verifyFileExistence(missingList, path, filename, snapshots=None):
     """Verifies the existing of 'path/filename'.
 
     Args:
@@ -99,45 +167,51 @@ def verifyFileExistence(missingList, path, filename):
                     be appended if missing.
       path:         File path not including name.
       filename:     File name.
+      snapshots:    If a DirectorySnapshots, look the file up in its
+                    snapshot of the directory instead of stat'ing it.
 
     Returns:
       True if file exists, false otherwise.
     """
     fullpath = os.path.join(path, filename)
-    if not os.path.isfile(fullpath):
+    if snapshots is not None:
+        exists = snapshots.isfile(fullpath)
+    else:
+        exists = os.path.isfile(fullpath)
+    if not exists:
         missingList.append(fullpath)
         return False
     return True
 
 
 def verifyFitsContents(corruptList, path, filename):
-    """Runs fitsverify on a FITS file to verify contents.
+    """Verifies the contents of a FITS file with FitsUtil.VerifyFile().
 
     Args:
-      corruptList:  A lits of corrupt files to which this file will
+      corruptList:  A lits of corrupt files to which (file, errors) will
                     be appended if corrupt.
       path:         File path not including name.
       filename:     File name.
 
     Returns:
-      True if fitsverify returns OK, false otherwise.
+      True if the file is OK, false otherwise.
     """
-    fullpath = os.path.join(path, filename)
-    # If the fitsverify executable is in the cwd, use that. Otherwise,
-    # use the copy in the path.  This is necessary in case the cwd
-    # is not in the path.
-    if os.path.isfile("fitsverify"):
-        cmd = "./fitsverify"
-    else:
-        cmd = "fitsverify"
-    p = subprocess.Popen("%s -q -e %s"%(cmd, fullpath), shell=True,
-                         stdout=subprocess.PIPE, close_fds=True)
-    output = p.stdout.readlines()[0]
-    p.stdout.close()
-    if output.startswith("verification OK"):
-        return True
-    corruptList.append((fullpath, output))
-    return False
+    return _appendCorrupt(corruptList,
+                          [FitsUtil.VerifyFile(os.path.join(path, filename))])
+
+
+def _appendCorrupt(corruptList, results):
+    """Appends (file, errors) of the failed FitsVerifyResults to corruptList.
+
+    Returns:
+      True if all results are OK, false otherwise.
+    """
+    ok = True
+    for result in results:
+        if not result.IsOk():
+            corruptList.append((result.fn, '  '.join(result.errors)))
+            ok = False
+    return ok
 
 
 class Exposure(object):
@@ -181,28 +255,42 @@ class Exposure(object):
 
     def _loadAmpList(self):
         if not self.ampList:
-            with open(findSourceFile('lsst/segmentation.txt'), 'r') as ampFile:
-                self.ampList = readAmpList(ampFile, self.cid)
+            instrDir = os.path.dirname(findSourceFile('lsst/segmentation.txt'))
+            self.ampList = FocalplaneGeometry.GetGeometry(instrDir).AmpList(self.cid)
         assert self.ampList
         return
 
-    def verifyExecFiles(self, outputDir):
+    def verifyExecFiles(self, outputDir, counter=None, nthreads=4,
+                        useFitsverify=False):
+        """Verifies the existence and FITS contents of the raytrace output.
+
+        The contents of the files found are verified together with
+        FitsUtil.VerifyFiles() on nthreads threads, by batched fitsverify
+        calls if useFitsverify.
+
+        Returns:
+          (missingList, corruptList), where corruptList has (file, errors).
+        """
         missingList = []
         corruptList = []
-        name = self.generateEimageExecName()
-        if verifyFileExistence(missingList, outputDir, name):
-            verifyFitsContents(corruptList, outputDir, name)
-        names = self.generateRawExecNames()
-        for name in names:
-            if verifyFileExistence(missingList, outputDir, name):
-                verifyFitsContents(corruptList, outputDir, name)
+        snapshots = DirectorySnapshots(counter)
+        found = []
+        for name in [self.generateEimageExecName()] + self.generateRawExecNames():
+            if verifyFileExistence(missingList, outputDir, name, snapshots):
+                found.append(os.path.join(outputDir, name))
+        _appendCorrupt(corruptList,
+                       FitsUtil.VerifyFiles(found, nthreads=nthreads,
+                                            use_fitsverify=useFitsverify))
         return missingList, corruptList
 
-    def verifyOutputFiles(self, outputPath):
+    def verifyOutputFiles(self, outputPath, counter=None):
         missingList = []
+        snapshots = DirectorySnapshots(counter)
         path, name = self.generateEimageOutputName()
-        verifyFileExistence(missingList, os.path.join(outputPath, path), name)
+        verifyFileExistence(missingList, os.path.join(outputPath, path), name,
+                            snapshots)
         path, names = self.generateRawOutputNames()
         for name in names:
-            verifyFileExistence(missingList, os.path.join(outputPath, path), name)
+            verifyFileExistence(missingList, os.path.join(outputPath, path),
+                                name, snapshots)
         return missingList
@@ -1,7 +1,11 @@
 #!/usr/bin/python2.6
+from __future__ import with_statement
 import os
+import shutil
+import tempfile
 import unittest
 from Exposure import *
+import FitsUtil_test
 
 class MockExposure(Exposure):
   def _loadAmpList(self):
@@ -41,5 +45,64 @@ class TestExposure(unittest.TestCase):
     self.assertEqual(path, 'raw/v12345678-fr/E000/R01/S00')
     return
 
+
+class TestDirectorySnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    for fn in ['a.fits', 'b.fits.gz', 'c.pars']:
+      open(os.path.join(self.tmpdir, fn), 'w').close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_findVariant(self):
+    counter = MetadataCallCounter()
+    snapshot = DirectorySnapshot(self.tmpdir, counter)
+    self.assertEqual(counter.count, 1)
+    self.assertTrue(snapshot.contains('c.pars'))
+    self.assertFalse(snapshot.contains('c.pars.gz'))
+    self.assertEqual(snapshot.findVariant('a.fits'), 'a.fits')
+    self.assertEqual(snapshot.findVariant('a.fits.gz'), 'a.fits')
+    self.assertEqual(snapshot.findVariant('b.fits'), 'b.fits.gz')
+    self.assertEqual(snapshot.findVariant('d.fits'), None)
+    missing = DirectorySnapshot(os.path.join(self.tmpdir, 'nonexistent'), counter)
+    self.assertEqual(missing.names, frozenset())
+    self.assertEqual(counter.count, 2)
+    return
+
+  def test_verifyFileExistence(self):
+    counter = MetadataCallCounter()
+    snapshots = DirectorySnapshots(counter)
+    missingList = []
+    for fn in ['a.fits', 'b.fits.gz', 'c.pars', 'd.pars']:
+      verifyFileExistence(missingList, self.tmpdir, fn, snapshots)
+    self.assertTrue(verifyFileExistence(missingList, self.tmpdir + '/', 'a.fits',
+                                        snapshots))
+    self.assertEqual(missingList, [os.path.join(self.tmpdir, 'd.pars')])
+    self.assertEqual(counter.count, 1)
+    # A snapshot does not see files created after it was taken.
+    open(os.path.join(self.tmpdir, 'd.pars'), 'w').close()
+    self.assertFalse(verifyFileExistence([], self.tmpdir, 'd.pars', snapshots))
+    self.assertTrue(verifyFileExistence([], self.tmpdir, 'd.pars'))
+    return
+
+  def test_verifyExecFiles(self):
+    e = MockExposure('12345678', 'r', 'R01_S00_E000')
+    eimage = os.path.join(self.tmpdir, e.generateEimageExecName())
+    FitsUtil_test.WriteAmpFile(eimage, 1)
+    raw = os.path.join(self.tmpdir, e.generateRawExecNames()[0])
+    with open(raw, 'w') as f:
+      f.write('not a FITS file')
+    missingList, corruptList = e.verifyExecFiles(self.tmpdir, nthreads=2)
+    self.assertEqual(missingList, [])
+    self.assertEqual([fn for fn, errors in corruptList], [raw])
+    os.remove(raw)
+    missingList, corruptList = e.verifyExecFiles(self.tmpdir)
+    self.assertEqual((missingList, corruptList), ([raw], []))
+    self.assertTrue(verifyFitsContents(corruptList, self.tmpdir,
+                                       e.generateEimageExecName()))
+    return
+
 if __name__ == '__main__':
     unittest.main()
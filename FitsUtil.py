@@ -0,0 +1,653 @@
+#!/usr/bin/python
+
+"""Minimal FITS header handling for consolidating per-amp raw output.
+
+e2adc writes one single-HDU FITS file per amplifier.  MergeAmpFiles()
+copies these into a single multi-extension FITS (MEF) file per chip
+exposure, one IMAGE extension per amp, and ExtractAmpFiles() recreates
+the per-amp files for consumers that need them.  Data units are copied
+byte for byte; only the headers are touched:
+  - 'SIMPLE' becomes "XTENSION= 'IMAGE'", PCOUNT and GCOUNT are added
+    after the NAXISn cards, and the original SIMPLE and EXTEND cards are
+    kept as ZSIMPLE and ZEXTEND.
+  - EXTNAME is set to the amp name and FILENAME to the name of the
+    per-amp file.
+  - CHECKSUM, if present, is recomputed from the unchanged DATASUM, so
+    extracted files are identical to the originals.
+The primary HDU has no data.  Its header indexes the extensions:
+  NEXTEND  = number of extensions
+  EXTNMnnn = EXTNAME of extension nnn (1-based)
+  EXTOFnnn = byte offset of extension nnn in the uncompressed file
+
+Usage (extract per-amp files from MEF files):
+  FitsUtil.py [-d dest_dir] mef_file [mef_file ...]
+
+VerifyFiles() checks the structure (and CHECKSUM/DATASUM, if present) of
+FITS files in-process on a pool of threads, so that verifying raytrace
+output does not need a fitsverify process per file.  It can also run
+fitsverify itself on batches of files.
+  FitsUtil.py --verify [--fitsverify] fits_file [fits_file ...]
+
+Only the parts of the FITS standard that e2adc output uses are
+implemented, so there is no dependency on pyfits.
+"""
+
+from __future__ import with_statement
+import array
+import gzip
+import logging
+import os
+import Queue
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+from optparse import OptionParser
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+INDEX_NAME_KEY = 'EXTNM%03d'
+INDEX_OFFSET_KEY = 'EXTOF%03d'
+
+
+def OpenFits(fn, mode='rb'):
+  """Opens a FITS file, (de)compressing if it ends in .gz."""
+  if fn.endswith('.gz'):
+    return gzip.open(fn, mode)
+  return open(fn, mode)
+
+def Card(key, value, comment=None):
+  """Formats a fixed-format header card.
+
+  Args:
+    key:     Keyword (up to 8 characters).
+    value:   bool, int, or str.
+    comment: Optional comment.
+  """
+  if isinstance(value, bool):
+    value_str = ('T' if value else 'F').rjust(20)
+  elif isinstance(value, (int, long)):
+    value_str = str(value).rjust(20)
+  else:
+    value_str = ("'%s'" % value.replace("'", "''").ljust(8)).ljust(20)
+  card = '%-8s= %s' % (key, value_str)
+  if comment:
+    card += ' / %s' % comment
+  return card[:CARD_SIZE].ljust(CARD_SIZE)
+
+def CardKey(card):
+  return card[:8].strip()
+
+def CardValue(card):
+  """Returns the value of a fixed-format card as bool, int, or str."""
+  value = card[10:]
+  if value.lstrip().startswith("'"):
+    value = value.lstrip()[1:]
+    end = 0
+    while True:
+      end = value.index("'", end)
+      if value[end + 1:end + 2] == "'":
+        end += 2
+        continue
+      return value[:end].replace("''", "'").rstrip()
+  value = value.split('/', 1)[0].strip()
+  if value in ('T', 'F'):
+    return value == 'T'
+  return int(value)
+
+def GetValue(cards, key, default=None):
+  for card in cards:
+    if CardKey(card) == key:
+      return CardValue(card)
+  return default
+
+def ReadHeader(f):
+  """Reads a header from f.
+
+  Returns:
+    List of cards, not including END, or None at end of file.
+
+  Raises:
+    IOError if the file ends within the header.
+  """
+  return _ReadHeaderBlocks(f)[0]
+
+def _ReadHeaderBlocks(f):
+  """Like ReadHeader(), but returns (cards, header blocks as read)."""
+  cards = []
+  blocks = []
+  while True:
+    block = f.read(BLOCK_SIZE)
+    if not block and not cards:
+      return None, ''
+    if len(block) != BLOCK_SIZE:
+      raise IOError('Truncated FITS header in %s.' % getattr(f, 'name', f))
+    blocks.append(block)
+    for i in range(0, BLOCK_SIZE, CARD_SIZE):
+      card = block[i:i + CARD_SIZE]
+      if CardKey(card) == 'END':
+        # Drop the blank cards that pad out the header.
+        while cards and not cards[-1].strip():
+          cards.pop()
+        return cards, ''.join(blocks)
+      cards.append(card)
+
+def HeaderBytes(cards):
+  """Returns the header cards plus END, padded to a whole number of blocks."""
+  header = ''.join(cards) + 'END'.ljust(CARD_SIZE)
+  return header + ' ' * (-len(header) % BLOCK_SIZE)
+
+def DataSize(cards):
+  """Returns the size of the data unit described by cards, including padding."""
+  naxis = GetValue(cards, 'NAXIS', 0)
+  if not naxis:
+    return 0
+  nelements = 1
+  for i in range(1, naxis + 1):
+    nelements *= GetValue(cards, 'NAXIS%d' % i)
+  nbytes = (abs(GetValue(cards, 'BITPIX')) // 8 * GetValue(cards, 'GCOUNT', 1) *
+            (GetValue(cards, 'PCOUNT', 0) + nelements))
+  return nbytes + (-nbytes % BLOCK_SIZE)
+
+def _CopyData(f_in, f_out, nbytes):
+  while nbytes:
+    block = f_in.read(min(nbytes, 1 << 20))
+    if not block:
+      raise IOError('Truncated FITS data unit in %s.' % getattr(f_in, 'name', f_in))
+    f_out.write(block)
+    nbytes -= len(block)
+
+def _LastAxisIndex(cards):
+  """Index of the last of the BITPIX, NAXIS, NAXISn cards."""
+  last = [i for i, card in enumerate(cards) if CardKey(card) == 'NAXIS'][0]
+  while last + 1 < len(cards) and CardKey(cards[last + 1]).startswith('NAXIS'):
+    last += 1
+  return last
+
+def _RenameCard(card, key):
+  """Returns card with its keyword replaced by key, value and comment intact."""
+  return '%-8s' % key + card[8:]
+
+def _UpdateChecksum(cards):
+  """Recomputes CHECKSUM, if there is one, after the header was edited.
+
+  The data unit is copied unchanged, so DATASUM still holds and the new
+  CHECKSUM follows from it and the header alone.  The CHECKSUM card keeps
+  its place and comment.  Without a DATASUM it cannot be recomputed and is
+  dropped instead.
+  """
+  keys = [CardKey(card) for card in cards]
+  if 'CHECKSUM' not in keys:
+    return cards
+  i = keys.index('CHECKSUM')
+  try:
+    datasum = int(GetValue(cards, 'DATASUM'))
+  except (TypeError, ValueError):
+    return cards[:i] + cards[i + 1:]
+  cards = list(cards)
+  card = cards[i]
+  if card[10] != "'" or card[27] != "'":
+    card = Card('CHECKSUM', '0' * 16, 'HDU checksum')
+  cards[i] = card[:11] + '0' * 16 + card[27:]
+  checksum = _OnesComplementAdd(datasum, HeaderBytes(cards))
+  cards[i] = card[:11] + EncodeChecksum(checksum) + card[27:]
+  return cards
+
+def PrimaryToExtension(cards, extname, filename):
+  """Converts a primary header into an IMAGE extension header.
+
+  As in the tiled image compression convention, the SIMPLE and EXTEND
+  cards are kept as ZSIMPLE and ZEXTEND so that ExtensionToPrimary() can
+  restore the original header.
+  """
+  if CardKey(cards[0]) != 'SIMPLE':
+    raise ValueError('%s is not a primary header.' % filename)
+  drop = ('PCOUNT', 'GCOUNT', 'EXTNAME', 'FILENAME')
+  ext = [Card('XTENSION', 'IMAGE', 'Image extension')]
+  for card in cards[1:]:
+    if CardKey(card) == 'EXTEND':
+      ext.append(_RenameCard(card, 'ZEXTEND'))
+    elif CardKey(card) not in drop:
+      ext.append(card)
+  last = _LastAxisIndex(ext)
+  ext[last + 1:last + 1] = [Card('PCOUNT', 0), Card('GCOUNT', 1)]
+  ext.append(_RenameCard(cards[0], 'ZSIMPLE'))
+  ext.append(Card('EXTNAME', extname, 'Amplifier'))
+  ext.append(Card('FILENAME', filename, 'Name of single-amp file'))
+  return _UpdateChecksum(ext)
+
+def ExtensionToPrimary(cards):
+  """Converts an IMAGE extension header written by PrimaryToExtension() back."""
+  simple = Card('SIMPLE', True, 'file does conform to FITS standard')
+  primary = [None]
+  for card in cards[1:]:
+    key = CardKey(card)
+    if key == 'ZSIMPLE':
+      simple = _RenameCard(card, 'SIMPLE')
+    elif key == 'ZEXTEND':
+      primary.append(_RenameCard(card, 'EXTEND'))
+    elif key not in ('PCOUNT', 'GCOUNT', 'EXTNAME', 'FILENAME'):
+      primary.append(card)
+  primary[0] = simple
+  return _UpdateChecksum(primary)
+
+def MergeAmpFiles(amp_files, extnames, mef_fn, filenames=None,
+                  compresslevel=6):
+  """Writes the single-HDU FITS files amp_files as extensions of mef_fn.
+
+  Args:
+    amp_files:  List of (possibly gzipped) single-amp FITS files.
+    extnames:   EXTNAME of each extension (e.g. the amp IDs).
+    mef_fn:     Output file.  Gzipped if it ends in .gz.
+    filenames:  FILENAME of each extension, i.e. the name ExtractAmpFiles()
+                will give it (default: base names of amp_files).
+  """
+  assert len(amp_files) == len(extnames)
+  if filenames is None:
+    filenames = [os.path.basename(fn) for fn in amp_files]
+  headers = []
+  for fn, filename in zip(amp_files, filenames):
+    f_in = OpenFits(fn)
+    try:
+      cards = ReadHeader(f_in)
+    finally:
+      f_in.close()
+    if cards is None:
+      raise IOError('%s is empty.' % fn)
+    headers.append(PrimaryToExtension(cards, extnames[len(headers)], filename))
+  primary = [Card('SIMPLE', True, 'file does conform to FITS standard'),
+             Card('BITPIX', 8), Card('NAXIS', 0), Card('EXTEND', True),
+             Card('NEXTEND', len(amp_files), 'Number of extensions')]
+  # Every card is 80 bytes, so the header size does not depend on the offsets.
+  offset = len(HeaderBytes(primary + [' ' * CARD_SIZE] * 2 * len(headers)))
+  for i, cards in enumerate(headers):
+    primary.append(Card(INDEX_NAME_KEY % (i + 1), extnames[i]))
+    primary.append(Card(INDEX_OFFSET_KEY % (i + 1), offset))
+    offset += len(HeaderBytes(cards)) + DataSize(cards)
+  if mef_fn.endswith('.gz'):
+    f_out = gzip.open(mef_fn, 'wb', compresslevel)
+  else:
+    f_out = open(mef_fn, 'wb')
+  try:
+    f_out.write(HeaderBytes(primary))
+    for fn, cards in zip(amp_files, headers):
+      f_in = OpenFits(fn)
+      try:
+        ReadHeader(f_in)
+        f_out.write(HeaderBytes(cards))
+        _CopyData(f_in, f_out, DataSize(cards))
+      finally:
+        f_in.close()
+  finally:
+    f_out.close()
+  logger.info('Merged %d amp files into %s.', len(amp_files), mef_fn)
+
+def ReadIndex(mef_fn):
+  """Returns [(EXTNAME, offset), ...] from the primary header of mef_fn."""
+  f = OpenFits(mef_fn)
+  try:
+    cards = ReadHeader(f)
+  finally:
+    f.close()
+  if cards is None:
+    raise IOError('%s is empty.' % mef_fn)
+  return [(GetValue(cards, INDEX_NAME_KEY % i), GetValue(cards, INDEX_OFFSET_KEY % i))
+          for i in range(1, GetValue(cards, 'NEXTEND', 0) + 1)]
+
+def ExtractAmpFiles(mef_fn, dest_dir, extnames=None):
+  """Recreates the single-amp files in mef_fn in dest_dir.
+
+  Args:
+    mef_fn:    File written by MergeAmpFiles().
+    dest_dir:  Directory in which to write the files, named by FILENAME.
+    extnames:  Only extract these extensions (default: all).
+
+  Returns:
+    List of the files that were written.
+  """
+  written = []
+  f_in = OpenFits(mef_fn)
+  try:
+    primary = ReadHeader(f_in)
+    _CopyData(f_in, NullFile(), DataSize(primary))
+    while True:
+      cards = ReadHeader(f_in)
+      if cards is None:
+        break
+      nbytes = DataSize(cards)
+      if extnames is not None and GetValue(cards, 'EXTNAME') not in extnames:
+        _CopyData(f_in, NullFile(), nbytes)
+        continue
+      fn = os.path.join(dest_dir, os.path.basename(GetValue(cards, 'FILENAME')))
+      f_out = OpenFits(fn, 'wb')
+      try:
+        f_out.write(HeaderBytes(ExtensionToPrimary(cards)))
+        _CopyData(f_in, f_out, nbytes)
+      finally:
+        f_out.close()
+      written.append(fn)
+  finally:
+    f_in.close()
+  logger.info('Extracted %d amp files from %s to %s.', len(written), mef_fn,
+              dest_dir)
+  return written
+
+class NullFile(object):
+  def write(self, data):
+    pass
+
+
+#
+# VERIFICATION
+#
+
+VALID_BITPIX = (8, 16, 32, 64, -32, -64)
+# Data units are read in chunks of this many bytes (a multiple of 4 and
+# of BLOCK_SIZE) when verifying.
+_VERIFY_CHUNK_SIZE = 360 * BLOCK_SIZE
+
+
+class FitsVerifyResult(object):
+  """Outcome of verifying one FITS file.
+
+  Attributes:
+    fn:      File name.
+    errors:  List of error messages.  Empty if the file is OK.
+    nhdus:   Number of HDUs read.
+    method:  'python' or 'fitsverify'.
+  """
+  def __init__(self, fn, method='python'):
+    self.fn = fn
+    self.errors = []
+    self.nhdus = 0
+    self.method = method
+
+  def IsOk(self):
+    return not self.errors
+
+  def __repr__(self):
+    return 'FitsVerifyResult(%r, ok=%s, nhdus=%d, errors=%r)' % (
+      self.fn, self.IsOk(), self.nhdus, self.errors)
+
+
+def _OnesComplementAdd(total, data):
+  """Adds the big-endian 32-bit words of data to total, 1's complement."""
+  if len(data) % 4:
+    data += '\0' * (-len(data) % 4)
+  words = array.array('I', data)
+  if words.itemsize != 4:
+    words = struct.unpack('>%dI' % (len(data) // 4), data)
+  elif sys.byteorder == 'little':
+    words.byteswap()
+  total += sum(words)
+  while total >> 32:
+    total = (total & 0xffffffff) + (total >> 32)
+  return total
+
+def EncodeChecksum(value):
+  """Encodes the 1's complement of value as a 16-character CHECKSUM string.
+
+  This is the ASCII encoding of the FITS checksum convention, under which
+  the 1's complement sum of a correctly checksummed HDU is -0 (0xffffffff).
+  """
+  value = ~value & 0xffffffff
+  exclude = range(0x3a, 0x41) + range(0x5b, 0x61)
+  asc = [None] * 16
+  for i in range(4):
+    byte = (value >> (24 - 8 * i)) & 0xff
+    ch = [byte // 4 + 0x30] * 4
+    ch[0] += byte % 4
+    # Shift pairs of characters out of the punctuation ranges, which
+    # leaves their sum (and so the checksum) unchanged.
+    for j in (0, 2):
+      while ch[j] in exclude or ch[j + 1] in exclude:
+        ch[j] += 1
+        ch[j + 1] -= 1
+    for j in range(4):
+      asc[4 * j + i] = chr(ch[j])
+  return ''.join(asc[15:] + asc[:15])
+
+def AddChecksum(cards, data):
+  """Returns cards with DATASUM and CHECKSUM set for an HDU with data.
+
+  Args:
+    cards:  Header cards (not including END).
+    data:   The data unit, including padding.
+  """
+  datasum = _OnesComplementAdd(0, data)
+  cards = [card for card in cards if CardKey(card) not in ('CHECKSUM', 'DATASUM')]
+  cards.append(Card('CHECKSUM', '0' * 16, 'HDU checksum'))
+  cards.append(Card('DATASUM', str(datasum), 'data unit checksum'))
+  checksum = _OnesComplementAdd(datasum, HeaderBytes(cards))
+  cards[-2] = Card('CHECKSUM', EncodeChecksum(checksum), 'HDU checksum')
+  return cards
+
+def _CheckMandatoryKeywords(cards, primary, errors):
+  """Appends problems with the mandatory keywords of a header to errors."""
+  expected = [('XTENSION', 'SIMPLE')[primary], 'BITPIX', 'NAXIS']
+  try:
+    naxis = GetValue(cards, 'NAXIS')
+    if not isinstance(naxis, int) or isinstance(naxis, bool) or not 0 <= naxis <= 999:
+      errors.append('Bad NAXIS value %r.' % (naxis,))
+      return
+    expected.extend(['NAXIS%d' % i for i in range(1, naxis + 1)])
+    if not primary:
+      expected.extend(['PCOUNT', 'GCOUNT'])
+    keys = [CardKey(card) for card in cards[:len(expected)]]
+    if keys != expected:
+      errors.append('Mandatory keywords out of order: expected %s, found %s.' %
+                    (expected, keys))
+      return
+    if primary and GetValue(cards, 'SIMPLE') is not True:
+      errors.append('SIMPLE is not T.')
+    if GetValue(cards, 'BITPIX') not in VALID_BITPIX:
+      errors.append('Bad BITPIX value %r.' % (GetValue(cards, 'BITPIX'),))
+    for key in expected[3:]:
+      value = GetValue(cards, key)
+      if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        errors.append('Bad %s value %r.' % (key, value))
+  except ValueError, e:
+    errors.append('Unparseable mandatory keyword: %s' % e)
+
+def _CheckHeaderText(header, errors):
+  for c in set(header):
+    if not ' ' <= c <= '~':
+      errors.append('Header contains non-ASCII-text character %r.' % c)
+      return
+
+def VerifyFile(fn, check_sums=True):
+  """Verifies the structure of a (possibly gzipped) FITS file in-process.
+
+  Checks that each HDU has a header of whole 2880-byte blocks with END
+  and the mandatory keywords in order, that each data unit is as long as
+  BITPIX, NAXISn, PCOUNT, and GCOUNT say, and that DATASUM and CHECKSUM,
+  if present, are correct.  The file is streamed, not read into memory.
+
+  Args:
+    fn:          File name.
+    check_sums:  Verify DATASUM and CHECKSUM when present?
+
+  Returns:
+    FitsVerifyResult.
+  """
+  result = FitsVerifyResult(fn)
+  try:
+    f = OpenFits(fn)
+    try:
+      while True:
+        cards, header = _ReadHeaderBlocks(f)
+        if cards is None:
+          if not result.nhdus:
+            result.errors.append('File is empty.')
+          break
+        hdu = result.nhdus
+        result.nhdus += 1
+        errors = []
+        _CheckHeaderText(header, errors)
+        _CheckMandatoryKeywords(cards, hdu == 0, errors)
+        if errors:
+          # Without a sane header the data length is unknown.
+          result.errors.extend(['HDU %d: %s' % (hdu, e) for e in errors])
+          break
+        nbytes = DataSize(cards)
+        datasum = 0
+        remaining = nbytes
+        while remaining:
+          chunk = f.read(min(remaining, _VERIFY_CHUNK_SIZE))
+          if not chunk:
+            break
+          if check_sums:
+            datasum = _OnesComplementAdd(datasum, chunk)
+          remaining -= len(chunk)
+        if remaining:
+          result.errors.append('HDU %d: Data unit truncated: expected %d bytes,'
+                               ' found %d.' % (hdu, nbytes, nbytes - remaining))
+          break
+        if check_sums:
+          _CheckSums(cards, header, datasum, hdu, result.errors)
+    finally:
+      f.close()
+  except (IOError, EOFError, zlib.error, struct.error), e:
+    result.errors.append('Could not read file: %s' % e)
+  return result
+
+def _CheckSums(cards, header, datasum, hdu, errors):
+  expected = GetValue(cards, 'DATASUM')
+  if expected is not None:
+    try:
+      if int(expected) != datasum:
+        errors.append('HDU %d: DATASUM is %s, computed %d.' % (hdu, expected, datasum))
+    except ValueError:
+      errors.append('HDU %d: Bad DATASUM value %r.' % (hdu, expected))
+  if GetValue(cards, 'CHECKSUM') is not None:
+    if _OnesComplementAdd(datasum, header) != 0xffffffff:
+      errors.append('HDU %d: CHECKSUM does not match.' % hdu)
+
+def FindFitsverify():
+  """Returns the fitsverify command, preferring one in the cwd."""
+  if os.path.isfile('fitsverify'):
+    return os.path.abspath('fitsverify')
+  return 'fitsverify'
+
+def RunFitsverify(fns, cmd=None):
+  """Verifies several files with a single fitsverify invocation.
+
+  Returns:
+    List of FitsVerifyResults, one per file in fns.
+  """
+  cmd = cmd or FindFitsverify()
+  results = [FitsVerifyResult(fn, method='fitsverify') for fn in fns]
+  try:
+    p = subprocess.Popen([cmd, '-q', '-e'] + list(fns), stdout=subprocess.PIPE,
+                         close_fds=True)
+    output = p.communicate()[0]
+  except OSError, e:
+    for result in results:
+      result.errors.append('Could not run %s: %s' % (cmd, e))
+    return results
+  # With -q, fitsverify prints one 'verification OK/FAILED' line per file.
+  lines = [line.strip() for line in output.splitlines()
+           if line.startswith('verification ')]
+  for i, result in enumerate(results):
+    result.nhdus = None
+    if i >= len(lines):
+      result.errors.append('No output from %s.' % cmd)
+    elif not lines[i].startswith('verification OK'):
+      result.errors.append(lines[i])
+  return results
+
+def VerifyFiles(fns, nthreads=4, use_fitsverify=False, fitsverify_cmd=None,
+                batch_size=32):
+  """Verifies many FITS files concurrently.
+
+  Args:
+    fns:             List of file names.
+    nthreads:        Number of files (or fitsverify batches) to verify at
+                     a time.
+    use_fitsverify:  Run fitsverify, batch_size files per invocation,
+                     instead of VerifyFile().
+    fitsverify_cmd:  fitsverify executable (default: FindFitsverify()).
+
+  Returns:
+    List of FitsVerifyResults in the order of fns.
+  """
+  if use_fitsverify:
+    batches = [fns[i:i + batch_size] for i in range(0, len(fns), batch_size)]
+    results = []
+    for batch_results in _MapInThreads(
+        lambda batch: RunFitsverify(batch, fitsverify_cmd), batches, nthreads):
+      results.extend(batch_results)
+    return results
+  return _MapInThreads(VerifyFile, fns, nthreads)
+
+def _MapInThreads(func, items, nthreads):
+  """Returns map(func, items), evaluated by up to nthreads threads."""
+  results = [None] * len(items)
+  if nthreads <= 1 or len(items) <= 1:
+    return map(func, items)
+  work = Queue.Queue()
+  for i, item in enumerate(items):
+    work.put((i, item))
+  errors = []
+  def Worker():
+    while True:
+      try:
+        i, item = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = func(item)
+      except Exception, e:
+        errors.append(e)
+  threads = [threading.Thread(target=Worker) for _ in range(min(nthreads, len(items)))]
+  for thread in threads:
+    thread.setDaemon(True)
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  return results
+
+
+if __name__ == '__main__':
+  usage = ('usage: %prog [options] mef_file [mef_file ...]\n'
+           '       %prog --verify [options] fits_file [fits_file ...]')
+  parser = OptionParser(usage=usage)
+  parser.add_option('-d', '--dest_dir', dest='dest_dir', default='.',
+                    help='Directory in which to write the per-amp files.')
+  parser.add_option('-e', '--extname', dest='extnames', action='append',
+                    default=None, help='Only extract this amp (may be repeated).')
+  parser.add_option('-v', '--verify', dest='verify', action='store_true',
+                    default=False, help='Verify the files instead of extracting.')
+  parser.add_option('-t', '--threads', dest='nthreads', type='int', default=4,
+                    help='Number of files to verify at a time.')
+  parser.add_option('--fitsverify', dest='use_fitsverify', action='store_true',
+                    default=False, help='Verify with the fitsverify executable.')
+  (options, args) = parser.parse_args()
+  if not args:
+    print 'Incorrect number of arguments.  Use -h or --help for help.'
+    print usage
+    quit()
+  logging.basicConfig(level=logging.INFO)
+  if options.verify:
+    nfailed = 0
+    for result in VerifyFiles(args, nthreads=options.nthreads,
+                              use_fitsverify=options.use_fitsverify):
+      if result.IsOk():
+        print 'verification OK: %s' % result.fn
+      else:
+        nfailed += 1
+        print 'verification FAILED: %s: %s' % (result.fn, '  '.join(result.errors))
+    sys.exit(1 if nfailed else 0)
+  if not os.path.isdir(options.dest_dir):
+    os.makedirs(options.dest_dir)
+  for mef_fn in args:
+    for fn in ExtractAmpFiles(mef_fn, options.dest_dir, options.extnames):
+      print fn
+  sys.exit(0)
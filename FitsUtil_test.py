@@ -0,0 +1,243 @@
+#!/usr/bin/python2.6
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import FitsUtil
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+def WriteAmpFile(fn, value, nx=5, ny=3):
+  """Writes a single-HDU 16-bit image like e2adc output."""
+  cards = [FitsUtil.Card('SIMPLE', True), FitsUtil.Card('BITPIX', 16),
+           FitsUtil.Card('NAXIS', 2), FitsUtil.Card('NAXIS1', nx),
+           FitsUtil.Card('NAXIS2', ny), FitsUtil.Card('EXTEND', True),
+           FitsUtil.Card('OBSID', "99999999 'test'", 'Observation')]
+  data = struct.pack('>%dh' % (nx * ny), *([value] * (nx * ny)))
+  data += '\0' * (-len(data) % FitsUtil.BLOCK_SIZE)
+  f = FitsUtil.OpenFits(fn, 'wb')
+  try:
+    f.write(FitsUtil.HeaderBytes(cards) + data)
+  finally:
+    f.close()
+  return cards
+
+
+class FitsUtilTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.amps = ['R22_S11_C00', 'R22_S11_C01', 'R22_S11_C02']
+    self.amp_files = []
+    for i, amp in enumerate(self.amps):
+      fn = os.path.join(self.tmpdir, 'imsim_99999999_f2_%s_E000.fits.gz' % amp)
+      self.header = WriteAmpFile(fn, i + 1)
+      self.amp_files.append(fn)
+    self.dest_fns = ['imsim_99999999_%s_E000.fits.gz' % amp for amp in self.amps]
+    self.mef_fn = os.path.join(self.tmpdir, 'imsim_99999999_R22_S11_E000.fits.gz')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testCard(self):
+    card = FitsUtil.Card('OBSID', "it's", 'comment')
+    self.assertEqual(len(card), FitsUtil.CARD_SIZE)
+    self.assertEqual(FitsUtil.CardKey(card), 'OBSID')
+    self.assertEqual(FitsUtil.CardValue(card), "it's")
+    self.assertEqual(FitsUtil.CardValue(FitsUtil.Card('NAXIS1', 4000)), 4000)
+    self.assertEqual(FitsUtil.CardValue(FitsUtil.Card('EXTEND', False)), False)
+
+  def testMergeAndIndex(self):
+    FitsUtil.MergeAmpFiles(self.amp_files, self.amps, self.mef_fn,
+                           filenames=self.dest_fns)
+    index = FitsUtil.ReadIndex(self.mef_fn)
+    self.assertEqual([extname for extname, offset in index], self.amps)
+    f = gzip.open(self.mef_fn, 'rb')
+    try:
+      contents = f.read()
+    finally:
+      f.close()
+    self.assertEqual(len(contents) % FitsUtil.BLOCK_SIZE, 0)
+    for i, (extname, offset) in enumerate(index):
+      self.assertEqual(contents[offset:offset + 20], "XTENSION= 'IMAGE   '")
+      f = gzip.open(self.amp_files[i], 'rb')
+      try:
+        data = f.read()[FitsUtil.BLOCK_SIZE:]
+      finally:
+        f.close()
+      # Each extension header fits in one block.
+      start = offset + FitsUtil.BLOCK_SIZE
+      self.assertEqual(contents[start:start + len(data)], data)
+
+  def testExtractAmpFiles(self):
+    FitsUtil.MergeAmpFiles(self.amp_files, self.amps, self.mef_fn,
+                           filenames=self.dest_fns)
+    dest_dir = os.path.join(self.tmpdir, 'extracted')
+    os.mkdir(dest_dir)
+    written = FitsUtil.ExtractAmpFiles(self.mef_fn, dest_dir)
+    self.assertEqual(written, [os.path.join(dest_dir, fn) for fn in self.dest_fns])
+    for src, dest in zip(self.amp_files, written):
+      f_src, f_dest = gzip.open(src, 'rb'), gzip.open(dest, 'rb')
+      try:
+        src_cards = FitsUtil.ReadHeader(f_src)
+        dest_cards = FitsUtil.ReadHeader(f_dest)
+        self.assertEqual(f_dest.read(), f_src.read())
+      finally:
+        f_src.close()
+        f_dest.close()
+      self.assertEqual(
+        [(FitsUtil.CardKey(card), FitsUtil.CardValue(card)) for card in dest_cards],
+        [(FitsUtil.CardKey(card), FitsUtil.CardValue(card)) for card in src_cards])
+    shutil.rmtree(dest_dir)
+    os.mkdir(dest_dir)
+    written = FitsUtil.ExtractAmpFiles(self.mef_fn, dest_dir, [self.amps[1]])
+    self.assertEqual(written, [os.path.join(dest_dir, self.dest_fns[1])])
+    self.assertEqual(os.listdir(dest_dir), [self.dest_fns[1]])
+
+  def testChecksummedRoundTrip(self):
+    # One input has CHECKSUM/DATASUM and EXTEND, the other neither EXTEND
+    # nor a comment on SIMPLE.
+    data = struct.pack('>15h', *([3] * 15))
+    data += '\0' * (-len(data) % FitsUtil.BLOCK_SIZE)
+    with_extend = FitsUtil.AddChecksum(self.header, data)
+    without_extend = FitsUtil.AddChecksum(
+      [card for card in self.header if FitsUtil.CardKey(card) != 'EXTEND'], data)
+    originals = []
+    for fn, cards in zip(self.amp_files[:2], [with_extend, without_extend]):
+      originals.append(FitsUtil.HeaderBytes(cards) + data)
+      f = gzip.open(fn, 'wb')
+      try:
+        f.write(originals[-1])
+      finally:
+        f.close()
+      self.assertTrue(FitsUtil.VerifyFile(fn).IsOk())
+    FitsUtil.MergeAmpFiles(self.amp_files[:2], self.amps[:2], self.mef_fn,
+                           filenames=self.dest_fns[:2])
+    self.assertEqual(FitsUtil.VerifyFile(self.mef_fn).errors, [])
+    dest_dir = os.path.join(self.tmpdir, 'extracted')
+    os.mkdir(dest_dir)
+    written = FitsUtil.ExtractAmpFiles(self.mef_fn, dest_dir)
+    for original, fn in zip(originals, written):
+      self.assertEqual(FitsUtil.VerifyFile(fn).errors, [])
+      f = gzip.open(fn, 'rb')
+      try:
+        self.assertEqual(f.read(), original)
+      finally:
+        f.close()
+
+  def testTruncatedInput(self):
+    f = gzip.open(self.amp_files[1], 'wb')
+    try:
+      f.write(FitsUtil.HeaderBytes(self.header))
+    finally:
+      f.close()
+    self.assertRaises(IOError, FitsUtil.MergeAmpFiles, self.amp_files,
+                      self.amps, self.mef_fn)
+
+
+
+class VerifyTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.good_fn = os.path.join(self.tmpdir, 'good.fits.gz')
+    self.header = WriteAmpFile(self.good_fn, 7)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _WriteFile(self, fn, contents):
+    f = FitsUtil.OpenFits(fn, 'wb')
+    try:
+      f.write(contents)
+    finally:
+      f.close()
+    return fn
+
+  def _Data(self, value):
+    data = struct.pack('>15h', *([value] * 15))
+    return data + '\0' * (-len(data) % FitsUtil.BLOCK_SIZE)
+
+  def testEncodeChecksum(self):
+    # Example from the FITS checksum convention.
+    self.assertEqual(FitsUtil.EncodeChecksum(868229149), 'hcHjjc9ghcEghc9g')
+
+  def testGoodFiles(self):
+    mef_fn = os.path.join(self.tmpdir, 'mef.fits')
+    FitsUtil.MergeAmpFiles([self.good_fn, self.good_fn], ['A', 'B'], mef_fn)
+    results = FitsUtil.VerifyFiles([self.good_fn, mef_fn], nthreads=2)
+    self.assertEqual([result.fn for result in results], [self.good_fn, mef_fn])
+    self.assertEqual([result.errors for result in results], [[], []])
+    self.assertEqual([result.nhdus for result in results], [1, 3])
+
+  def testChecksum(self):
+    data = self._Data(3)
+    cards = FitsUtil.AddChecksum(self.header, data)
+    fn = self._WriteFile(os.path.join(self.tmpdir, 'sum.fits'),
+                         FitsUtil.HeaderBytes(cards) + data)
+    self.assertTrue(FitsUtil.VerifyFile(fn).IsOk())
+    bad_fn = self._WriteFile(os.path.join(self.tmpdir, 'badsum.fits'),
+                             FitsUtil.HeaderBytes(cards) + self._Data(4))
+    result = FitsUtil.VerifyFile(bad_fn)
+    self.assertEqual(len(result.errors), 2)
+    self.assertTrue('DATASUM' in result.errors[0])
+    self.assertTrue('CHECKSUM' in result.errors[1])
+    self.assertTrue(FitsUtil.VerifyFile(bad_fn, check_sums=False).IsOk())
+
+  def testBadFiles(self):
+    header = FitsUtil.HeaderBytes(self.header)
+    data = self._Data(1)
+    fns = [
+      self._WriteFile(os.path.join(self.tmpdir, 'truncated_data.fits'),
+                      header + data[:-FitsUtil.BLOCK_SIZE // 2]),
+      self._WriteFile(os.path.join(self.tmpdir, 'truncated_header.fits'),
+                      header[:-1]),
+      self._WriteFile(os.path.join(self.tmpdir, 'order.fits'),
+                      FitsUtil.HeaderBytes([self.header[0], self.header[2],
+                                            self.header[1]] + self.header[3:]) + data),
+      self._WriteFile(os.path.join(self.tmpdir, 'bitpix.fits'),
+                      FitsUtil.HeaderBytes([self.header[0],
+                                            FitsUtil.Card('BITPIX', 12)] +
+                                           self.header[2:]) + data),
+      self._WriteFile(os.path.join(self.tmpdir, 'empty.fits'), ''),
+      self._WriteFile(os.path.join(self.tmpdir, 'garbage.fits'),
+                      header + data + 'x' * FitsUtil.BLOCK_SIZE),
+      os.path.join(self.tmpdir, 'missing.fits'),
+      ]
+    results = FitsUtil.VerifyFiles(fns, nthreads=3)
+    for fn, result in zip(fns, results):
+      self.assertEqual(result.fn, fn)
+      self.assertFalse(result.IsOk(), fn)
+    self.assertTrue('truncated' in results[0].errors[0])
+    self.assertTrue('BITPIX' in results[3].errors[0])
+
+  def testRunFitsverify(self):
+    # A stand-in for fitsverify that fails files whose names contain 'bad'.
+    cmd = os.path.join(self.tmpdir, 'fitsverify')
+    f = open(cmd, 'w')
+    try:
+      f.write('#!/bin/sh\n'
+              'shift 2\n'
+              'for fn in "$@"; do\n'
+              '  case "$fn" in\n'
+              '    *bad*) echo "verification FAILED: $fn, 0 warnings and 1 errors" ;;\n'
+              '    *) echo "verification OK: $fn" ;;\n'
+              '  esac\n'
+              'done\n')
+    finally:
+      f.close()
+    os.chmod(cmd, 0755)
+    fns = ['a.fits', 'bad.fits', 'c.fits', 'd.fits', 'bad2.fits']
+    results = FitsUtil.VerifyFiles(fns, nthreads=2, use_fitsverify=True,
+                                   fitsverify_cmd=cmd, batch_size=2)
+    self.assertEqual([result.fn for result in results], fns)
+    self.assertEqual([result.IsOk() for result in results],
+                     [True, False, True, True, False])
+    self.assertEqual(results[1].method, 'fitsverify')
+    results = FitsUtil.RunFitsverify(fns, os.path.join(self.tmpdir, 'nonexistent'))
+    self.assertFalse([result for result in results if result.IsOk()])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,13 +5,21 @@ Classes that manage a single ImSim full focal plane
 
 from __future__ import with_statement
 import datetime
+import errno
+import gzip
 import logging
 import math
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import os, re, sys
+import FocalplaneGeometry
+import FootprintFilter
+import InstanceCatalog
 from Exposure import verifyFileExistence
+from Exposure import DirectorySnapshots
 from Exposure import idStringsFromFilename
 from Exposure import filterToLetter
 from Exposure import findSourceFile
@@ -34,6 +42,104 @@ def readCidList(camstr, fplFile):
             cidList.append( (c[0],c[6],float(c[7])) )
     return cidList
 
+def scanTrimCatalog(trimCatFile, gzFile=None, blockSize=1<<20, minLines=0):
+    """Count lines and collect SED names from a trimcatalog in one pass.
+
+    Equivalent to 'wc -l' plus
+      egrep 'starSED|galaxySED|ssmSED|agnSED|flatSED|sky' | awk '{print $6}' | sort | uniq
+    (in the C locale), optionally gzipping the file at the same time.
+    The file is read in blocks so memory use does not depend on its size.
+
+    Args:
+      trimCatFile:  Name of trimcatalog file.
+      gzFile:       If supplied, also write a gzipped copy of trimCatFile here.
+      blockSize:    Read size in bytes.
+      minLines:     Only start the gzipped copy once this many lines have
+                    been counted.  The blocks read until then are held in
+                    memory.  gzFile is not written if the file is shorter.
+
+    Returns:
+      (number of lines, sorted list of distinct SED names)
+    """
+    sedPattern = re.compile('starSED|galaxySED|ssmSED|agnSED|flatSED|sky')
+    nlines = 0
+    seds = set()
+    partial = ''
+    gz = None
+    gzOut = None
+    pending = []  # Blocks read before the gzipped copy was started
+
+    def startGzip():
+        gzOut = open(gzFile, 'wb')
+        gz = gzip.GzipFile(trimCatFile, 'wb', 6, gzOut)
+        for block in pending:
+            gz.write(block)
+        del pending[:]
+        return gz, gzOut
+
+    try:
+        with open(trimCatFile, 'rb') as f:
+            while True:
+                block = f.read(blockSize)
+                if not block:
+                    break
+                if gz:
+                    gz.write(block)
+                elif gzFile:
+                    pending.append(block)
+                lines = (partial + block).split('\n')
+                partial = lines.pop()
+                nlines += len(lines)
+                for line in lines:
+                    if sedPattern.search(line):
+                        fields = line.split()
+                        seds.add(len(fields) > 5 and fields[5] or '')
+                if gzFile and not gz and nlines >= minLines:
+                    gz, gzOut = startGzip()
+        if partial:
+            nlines += 1
+            if sedPattern.search(partial):
+                fields = partial.split()
+                seds.add(len(fields) > 5 and fields[5] or '')
+        if gzFile and not gz and nlines >= minLines:
+            gz, gzOut = startGzip()
+    finally:
+        if gz:
+            gz.close()
+            gzOut.close()
+    return nlines, sorted(seds)
+
+# Trimfile header keys and the Focalplane attributes they are stored in.
+# 'Slalib_date' and 'Opsim_obshistid' are handled separately.
+TRIMFILE_ATTRS = (
+    ('SIM_SEED',             'simseed'),
+    ('Unrefracted_RA',       'pra'),
+    ('Unrefracted_Dec',      'pdec'),
+    ('Opsim_moonra',         'mra'),
+    ('Opsim_moondec',        'mdec'),
+    ('Opsim_rotskypos',      'prot'),
+    ('Opsim_rottelpos',      'spid'),
+    ('Opsim_filter',         'filterNum'),
+    ('Unrefracted_Altitude', 'alt'),
+    ('Unrefracted_Azimuth',  'az'),
+    ('Opsim_rawseeing',      'rawseeing'),
+    ('Opsim_sunalt',         'sunalt'),
+    ('Opsim_moonalt',        'moonalt'),
+    ('Opsim_dist2moon',      'moondist'),
+    ('Opsim_moonphase',      'moonphase'),
+    ('Opsim_expmjd',         'tai'),
+    # if SIM_MINSOURCE = 0 - images will be generated for
+    # chips with zero stars on them (background images)
+    ('SIM_MINSOURCE',        'minsource'),
+    ('SIM_TELCONFIG',        'telconfig'),
+    ('SIM_CAMCONFIG',        'camconfig'),
+    ('SIM_VISTIME',          'vistime'),
+    ('SIM_NSNAP',            'nsnap'),
+    ('isDithered',           'isDithered'),
+    ('ditherRaOffset',       'ditherRaOffset'),
+    ('ditherDecOffset',      'ditherDecOffset'),
+    )
+
 def generateRaytraceJobManifestFilename(obshistid, filter):
   return '%s-f%s-Jobs.lis' %(obshistid, filter)
 
@@ -131,9 +237,256 @@ class WithTimer:
       logging.info('TIMER[%s]: wall: %f sec\n', name, self.interval[1])
 
 
+def checkCallRusage(cmd, cwd=None):
+    """Like subprocess.check_call(cmd, shell=True), but returns the rusage
+    of the command (and the descendants it waited for).
+
+    Unlike resource.getrusage(RUSAGE_CHILDREN), this is not affected by
+    other threads running commands at the same time.
+    """
+    p = subprocess.Popen(cmd, shell=True, cwd=cwd)
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return rusage
+
+def runAncillaryJob(job):
+    """Run one ancillary program (turb2d, cloud, trim) and move its outputs.
+
+    This is a module-level function so that it can be run in a worker
+    thread (see Focalplane._runAncillaryJobs).  If 'isolate' is set, the command is run in a
+    private temporary directory created next to 'srcDir' (so relative
+    paths such as '../../data' still resolve) that contains symlinks
+    to everything in 'srcDir' except 'outputs' (stale copies of which
+    would otherwise be written through, or be taken for new output).
+    This keeps concurrent layers from stepping on each other's scratch
+    files.
+
+    Args:
+      job:  (name, srcDir, cmd, outputs, destDir, isolate) tuple.
+              name:    Label for the timing report.
+              srcDir:  Directory holding the executable.
+              cmd:     Shell command to run.
+              outputs: List of files written by cmd to move to destDir.
+                       Missing outputs are skipped.
+              destDir: Absolute path of the destination directory.
+              isolate: Run in a private copy of srcDir.
+
+    Returns:
+      (name, wall, cpu) where cpu is the user+sys time of the child processes.
+    """
+    name, srcDir, cmd, outputs, destDir, isolate = job
+    if isolate:
+        workDir = tempfile.mkdtemp(prefix='%s_' %os.path.basename(srcDir),
+                                   dir=os.path.dirname(srcDir))
+        for entry in os.listdir(srcDir):
+            if entry in outputs:
+                continue
+            os.symlink(os.path.join(srcDir, entry), os.path.join(workDir, entry))
+    else:
+        workDir = srcDir
+    try:
+        sys.stderr.write('Running: %s\n'% cmd)
+        with WithTimer() as t:
+            r = checkCallRusage(cmd, cwd=workDir)
+        if os.path.abspath(workDir) != os.path.abspath(destDir):
+            for output in outputs:
+                # Outputs the program did not write (e.g. the trimcatalog
+                # of a chip that trim skipped) are left missing, just as
+                # when running in place.
+                src = os.path.join(workDir, output)
+                if not os.path.exists(src) or os.path.islink(src):
+                    continue
+                dest = os.path.join(destDir, output)
+                if os.path.exists(dest):
+                    os.remove(dest)
+                shutil.move(src, dest)
+    finally:
+        if isolate:
+            shutil.rmtree(workDir, ignore_errors=True)
+    cpu = r.ru_utime + r.ru_stime
+    return name, t.interval[1], cpu
+
+
+class ParsFragmentCache(object):
+    """In-memory cache of pars files that are shared by many exposures.
+
+    The per-exposure pars files are concatenations of a handful of
+    visit-invariant files (obs, atmosphereraytrace, optics, cloudraytrace,
+    the per-chip offsets and readout pars, the extraid file).  Reading each
+    of those once per visit instead of once per exposure (and without
+    spawning 'cat' or 'grep') removes most of the cost of generating the
+    per-exposure files.
+
+    Entries are never invalidated automatically; call clear() whenever
+    one of the cached files may have changed.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._contents = {}
+        self._lines = {}
+
+    def read(self, filename):
+        """Returns the contents of filename as a string."""
+        if filename not in self._contents:
+            with open(filename, 'rb') as f:
+                self._contents[filename] = f.read()
+        return self._contents[filename]
+
+    def lines(self, filename):
+        """Returns the lines of filename, each terminated by a newline."""
+        if filename not in self._lines:
+            self._lines[filename] = [line.rstrip('\n') + '\n' for line in
+                                     self.read(filename).splitlines(True)]
+        return self._lines[filename]
+
+
+class TaskGraph(object):
+    """A small dependency-graph executor.
+
+    Each step declares the files it reads and writes.  A step depends on
+    every earlier-declared step that writes one of its inputs (read after
+    write), writes one of its outputs (write after write) or reads one of
+    its outputs (write after read), so the declaration order is the serial
+    order and any schedule the graph allows produces the same files.
+    Independent steps are run concurrently in threads.  Steps must not
+    change the working directory.
+    """
+    def __init__(self):
+        self.steps = []
+        self.deps = {}
+        self.funcs = {}
+        self.results = {}
+        self.durations = {}
+
+    def addStep(self, name, func, inputs=(), outputs=()):
+        """Declare a step.
+
+        Args:
+          name:     Unique step name.
+          func:     Callable taking no arguments.  Its return value is
+                    stored in self.results[name].
+          inputs:   Files (or other named resources) the step reads.
+          outputs:  Files the step writes or appends to.
+        """
+        assert name not in self.funcs
+        inputs = set(inputs)
+        outputs = set(outputs)
+        deps = set()
+        for prev, prevInputs, prevOutputs in self.steps:
+            if (inputs & prevOutputs or outputs & prevOutputs or
+                outputs & prevInputs):
+                deps.add(prev)
+        self.steps.append((name, inputs, outputs))
+        self.deps[name] = deps
+        self.funcs[name] = func
+        return
+
+    def run(self, nthreads=1):
+        """Run all steps, at most nthreads at a time.
+
+        With nthreads == 1 steps run in declaration order in the calling
+        thread.  If a step raises, no new steps are started and the first
+        exception is re-raised once the running steps have finished.
+
+        Returns:
+          Dictionary of step name -> return value.
+        """
+        order = [step[0] for step in self.steps]
+        if nthreads <= 1:
+            for name in order:
+                self._runStep(name)
+            return self.results
+        cond = threading.Condition()
+        state = {'done': set(), 'running': set(), 'error': None}
+
+        def worker(name):
+            try:
+                self._runStep(name)
+            except:
+                with cond:
+                    if state['error'] is None:
+                        state['error'] = sys.exc_info()
+            with cond:
+                state['running'].discard(name)
+                state['done'].add(name)
+                cond.notify()
+
+        pending = list(order)
+        with cond:
+            while pending or state['running']:
+                if state['error'] is None:
+                    for name in list(pending):
+                        if len(state['running']) >= nthreads:
+                            break
+                        if self.deps[name] <= state['done']:
+                            pending.remove(name)
+                            state['running'].add(name)
+                            thread = threading.Thread(target=worker, args=(name,))
+                            thread.start()
+                elif not state['running']:
+                    break
+                cond.wait()
+        if state['error'] is not None:
+            raise state['error'][0], state['error'][1], state['error'][2]
+        return self.results
+
+    def _runStep(self, name):
+        start = time.time()
+        self.results[name] = self.funcs[name]()
+        self.durations[name] = time.time() - start
+        return
+
+    def criticalPath(self):
+        """Returns the longest chain of dependent steps by measured wall time.
+
+        Returns:
+          (list of step names, total wall time in seconds)
+        """
+        finish = {}
+        prevStep = {}
+        for name, inputs, outputs in self.steps:
+            start = 0.0
+            prevStep[name] = None
+            for dep in self.deps[name]:
+                if finish[dep] > start:
+                    start = finish[dep]
+                    prevStep[name] = dep
+            finish[name] = start + self.durations.get(name, 0.0)
+        if not finish:
+            return [], 0.0
+        last = max(finish, key=lambda name: finish[name])
+        path = []
+        name = last
+        while name is not None:
+            path.insert(0, name)
+            name = prevStep[name]
+        return path, finish[last]
+
+    def printCriticalPath(self, stream):
+        path, total = self.criticalPath()
+        stream.write('Critical path (%f sec wall):\n' %total)
+        for name in path:
+            stream.write('  %-32s %f sec\n' %(name, self.durations.get(name, 0.0)))
+        return
+
+
 class Focalplane(object):
 
-    def __init__(self, obshistid, filterName):
+    def __init__(self, obshistid, filterName, nproc=1, headerCache=False,
+                 footprintFilter=False):
         """Constructor.
 
         NOTE: obsid = <obshistid>-f<filterName>
@@ -141,9 +494,23 @@ class Focalplane(object):
         Args:
           obshistid:  obshistid
           filterName: Alphabetic filter ID
+          nproc:      Maximum number of processes to use for the
+                      independent preprocessing steps (e.g. the
+                      atmosphere and cloud screen layers).  1 = serial.
+          headerCache: Use the InstanceCatalog sidecar header cache when
+                      reading trimfiles.
+          footprintFilter: Leave chips that cannot reach minsource out of
+                      trim (see filterCidListByFootprint).
         """
         self.obshistid = obshistid
         self.filterName = filterName
+        self.nproc = max(1, int(nproc))
+        # Bounds the ancillary programs running at once across all of the
+        # concurrent preprocessing steps (see _runAncillaryJobs).  Created
+        # here, before any step threads start.
+        self.ancillarySlots = threading.BoundedSemaphore(self.nproc)
+        self.headerCache = headerCache
+        self.footprintFilter = footprintFilter
         self.obsid = '%s-f%s' %(self.obshistid, self.filterName)
         self.trimfileName = None
 
@@ -161,8 +528,11 @@ class Focalplane(object):
         _d['track']          = 'track_%s.pars' %(self.obshistid)
         self.parsDictionary = _d
         self.cidList = []
+        # Chips dropped from cidList by filterCidListByFootprint().
+        self.footprintSkipped = []
         self.camstr = ''
         self.idonly = ''
+        self.fragments = ParsFragmentCache()
         # Parameter file names for compatability with Nicole's functions
         self.obsCatFile        = _d['objectcatalog']
         self.obsParFile        = _d['obs']
@@ -195,7 +565,8 @@ class Focalplane(object):
         return self.cidList
 
     def _loadCidList(self, camstr, idonly):
-        if self.cidList:
+        # cidList may have been emptied by the footprint filter.
+        if self.cidList or self.footprintSkipped:
             return
         if idonly:
             self.idonly = idonly
@@ -204,19 +575,21 @@ class Focalplane(object):
             self.cidList = ('R%s_S%s' %(raftid, sensorid),
                             'CCD', 3.0)
         else:
-            fplFilename = findSourceFile('lsst/focalplanelayout.txt')
-            with open(fplFilename, 'r') as f:
-                self.cidList = readCidList(camstr, f)
+            instrDir = os.path.dirname(findSourceFile('lsst/focalplanelayout.txt'))
+            geometry = FocalplaneGeometry.GetGeometry(instrDir)
+            self.cidList = geometry.CidList(camstr)
         return
 
-    def idListFromExecFiles(self, paramPath, in_id_list):
+    def idListFromExecFiles(self, paramPath, in_id_list, all_files=None):
         """
         Generates a list of exposure IDs for each exec_* file in
         stagePath2. If the input _exp_list is not empty,
         it will restrict this search to just those exposure IDs given
-        in in_id_list.
+        in in_id_list.  all_files is the contents of paramPath, if it
+        has already been listed.
         """
-        all_files = os.listdir(paramPath)
+        if all_files is None:
+            all_files = os.listdir(paramPath)
         id_list = []
         for filename in all_files:
             if filename.split("_")[0] != 'exec':
@@ -234,29 +607,41 @@ class Focalplane(object):
                 id_list.append(id)
         return id_list
 
-    def verifyInputFiles(self, stagePathRoot, idlist=""):
+    def verifyInputFiles(self, stagePathRoot, idlist="", counter=None):
+        """Verifies the staged input files.
+
+        Each directory is listed once and the files are looked up in
+        that listing rather than stat'ed one by one.
+
+        Args:
+          stagePathRoot:  Stage path (without obsid).
+          idlist:         Only verify these exposure IDs.
+          counter:        MetadataCallCounter to which to add the number
+                          of filesystem metadata calls made.
+
+        Returns:
+          List of missing files.
+        """
         missingList = []
+        snapshots = DirectorySnapshots(counter)
         stagePath = os.path.join(stagePathRoot, self.obsid)
         nodeFilesTgz = 'nodeFiles%s.tar.gz' %self.obshistid
-        verifyFileExistence(missingList, stagePath, nodeFilesTgz)
+        verifyFileExistence(missingList, stagePath, nodeFilesTgz, snapshots)
         paramPath = os.path.join(stagePath, 'run%s' %self.obshistid)
         for k,v in self.parsDictionary.iteritems():
-            verifyFileExistence(missingList, paramPath, v)
-        idsToVerify = self.idListFromExecFiles(paramPath, idlist)
+            verifyFileExistence(missingList, paramPath, v, snapshots)
+        idsToVerify = self.idListFromExecFiles(
+            paramPath, idlist, all_files=snapshots.get(paramPath).names)
         pfn = ParsFilenames(self.obshistid)
         for id in idsToVerify:
             if idlist:
                 print 'Checking files for id=%s' %id
             Rxx, Sxx, expid = id.split('_')
             cid = '%s_%s' %(Rxx, Sxx)
-            verifyFileExistence(missingList, paramPath, pfn.time(expid))
-            verifyFileExistence(missingList, paramPath, pfn.chip(id))
-            verifyFileExistence(missingList, paramPath, pfn.raytrace(id))
-            verifyFileExistence(missingList, paramPath, pfn.background(id))
-            verifyFileExistence(missingList, paramPath, pfn.cosmic(id))
-            verifyFileExistence(missingList, paramPath, pfn.e2adc(id))
-            verifyFileExistence(missingList, paramPath, pfn.sedlist(cid))
-            verifyFileExistence(missingList, paramPath, pfn.trimcatalog(id))
+            for filename in (pfn.time(expid), pfn.chip(id), pfn.raytrace(id),
+                             pfn.background(id), pfn.cosmic(id), pfn.e2adc(id),
+                             pfn.sedlist(cid), pfn.trimcatalog(id)):
+                verifyFileExistence(missingList, paramPath, filename, snapshots)
         return missingList
 
     def loadTrimfile(self, trimfileName):
@@ -271,12 +656,10 @@ class Focalplane(object):
         # values with the actual trimfile
         print 'Using instance catalog: default_instcat',
         print '***'
-        with open('default_instcat','r') as trimfile:
-            self._readTrimfile(trimfile)
+        self._readTrimfile('default_instcat')
         print 'Using instance catalog: ', trimfileName
         print '***'
-        with open(trimfileName,'r') as trimfile:
-            self._readTrimfile(trimfile)
+        self._readTrimfile(trimfileName, cache=self.headerCache)
         self._calculateParams()
         self.trimfileName = trimfileName
         return
@@ -332,100 +715,35 @@ class Focalplane(object):
             raise RuntimeError, "SIM_CAMCONFIG=%d is not valid." % self.camconfig
         return
 
-    def _readTrimfile(self, trimfile):
+    def _readTrimfile(self, trimfileName, cache=False):
+        """Sets the attributes in TRIMFILE_ATTRS from the trimfile header.
+
+        Only the header is read; see InstanceCatalog.ReadHeader().
+        """
         print 'Initializing Opsim and Instance Catalog Parameters.'
-        for line in trimfile:
-            if line.startswith('SIM_SEED'):
-                name, self.simseed = line.split()
-                print 'SIM_SEED:', self.simseed
-            elif line.startswith('Unrefracted_RA'):
-                name, self.pra = line.split()
-                print 'Unrefracted_RA:', self.pra
-            elif line.startswith('Unrefracted_Dec'):
-                name, self.pdec = line.split()
-                print 'Unrefracted_Dec:', self.pdec
-            elif line.startswith('Opsim_moonra'):
-                name, self.mra = line.split()
-                print 'Opsim_moonra:', self.mra
-            elif line.startswith('Opsim_moondec'):
-                name, self.mdec = line.split()
-                print 'Opsim_moondec:', self.mdec
-            elif line.startswith('Opsim_rotskypos'):
-                name, self.prot = line.split()
-                print 'Opsim_rotskypos:', self.prot
-            elif line.startswith('Opsim_rottelpos'):
-                name, self.spid = line.split()
-                print 'Opsim_rottelpos:', self.spid
-            elif line.startswith('Opsim_filter'):
-                name, self.filterNum = line.split()
-                print 'Opsim_filter:', self.filterNum
-            elif line.startswith('Unrefracted_Altitude'):
-                name, self.alt = line.split()
-                print 'Unrefracted_Altitude:', self.alt
-            elif line.startswith('Unrefracted_Azimuth'):
-                name, self.az = line.split()
-                print 'Unrefracted_Azimuth:', self.az
-            elif line.startswith('Opsim_rawseeing'):
-                name, self.rawseeing = line.split()
-                print 'Opsim_rawseeing:', self.rawseeing
-            elif line.startswith('Opsim_sunalt'):
-                name, self.sunalt = line.split()
-                print 'Opsim_sunalt:', self.sunalt
-            elif line.startswith('Opsim_moonalt'):
-                name, self.moonalt = line.split()
-                print 'Opsim_moonalt:', self.moonalt
-            elif line.startswith('Opsim_dist2moon'):
-                name, self.moondist = line.split()
-                print 'Opsim_dist2moon:', self.moondist
-            elif line.startswith('Opsim_moonphase'):
-                name, self.moonphase = line.split()
-                print 'Opsim_moonphase:', self.moonphase
-            elif line.startswith('Slalib_date'):
-                name, stringDate = line.split()
-                year, self.month, day, time = stringDate.split('/')
-                print 'Slalib_date:', self.month
-            elif line.startswith('Opsim_obshistid'):
-                name, obshistid = line.split()
-                print 'Opsim_obshistid: ', obshistid
-                # Don't reload self.obshistid since it won't have extraid in it.
-                # obshistid == 9999 in default_instcat
-                assert obshistid == '9999' or obshistid in self.obshistid
-            elif line.startswith('Opsim_expmjd'):
-                name, self.tai = line.split()
-                print 'Opsim_expmjd: ', self.tai
-            elif line.startswith('SIM_MINSOURCE'):
-                name, self.minsource = line.split()
-                # if SIM_MINSOURCE = 0 - images will be generated for
-                # chips with zero stars on them (background images)
-                print 'Sim_Minsource: ', self.minsource
-            elif line.startswith('SIM_TELCONFIG'):
-                name, self.telconfig = line.split()
-                print 'Sim_Telconfig: ', self.telconfig
-            elif line.startswith('SIM_CAMCONFIG'):
-                self.camconfig = int(line.split()[1])
-                print 'Sim_Camconfig: ', self.camconfig
-            elif line.startswith('SIM_VISTIME'):
-                self.vistime = float(line.split()[1])
-                print 'Sim_Vistime: ', self.vistime
-            elif line.startswith('SIM_NSNAP'):
-                self.nsnap = int(line.split()[1])
-                print 'Sim_Nsnap: ', self.nsnap
-            elif line.startswith('isDithered'):
-                self.isDithered = int(line.split()[1])
-                print 'isDithered: ', self.isDithered
-            elif line.startswith('ditherRaOffset'):
-                self.ditherRaOffset = float(line.split()[1])
-                print 'ditherRaOffset: ', self.ditherRaOffset
-            elif line.startswith('ditherDecOffset'):
-                self.ditherDecOffset = float(line.split()[1])
-                print 'ditherDecOffset: ', self.ditherDecOffset
+        header = InstanceCatalog.ReadHeader(trimfileName, cache=cache)
+        for key, attr in TRIMFILE_ATTRS:
+            if key in header:
+                setattr(self, attr, header[key])
+                print '%s: %s' %(key, header[key])
+        if 'Slalib_date' in header:
+            year, self.month, day, time = header['Slalib_date'].split('/')
+            print 'Slalib_date:', self.month
+        if 'Opsim_obshistid' in header:
+            obshistid = header['Opsim_obshistid']
+            print 'Opsim_obshistid: ', obshistid
+            # Don't reload self.obshistid since it won't have extraid in it.
+            # obshistid == 9999 in default_instcat
+            assert obshistid == '9999' or obshistid in self.obshistid
         return
 
     def runPreprocessingCommands(self, trimfile=None, camstr='', idonly=''):
         """Perform all preprocessing steps that are common to entire focalplane.
 
-        This is the main worker routine.  It just goes through and calls
-        all of Nicole's original functions.
+        This is the main worker routine.  It calls all of Nicole's original
+        functions through a TaskGraph so that independent steps (e.g. the
+        screens, optics, tracking and trim) run concurrently when
+        self.nproc > 1.  The critical path is written to stderr.
 
         Args:
           trimfile:  Name of trimfile.  Only required If trimfile has not been
@@ -445,16 +763,41 @@ class Focalplane(object):
             raise RuntimeError('"trimfile" must be supplied if it has not been loaded')
           self.loadTrimfile(trimfile)
           assert self.trimfileName == trimfile
-        self.writeObsCatParams()
-        self.generateAtmosphericParams()
-        wav = self.generateAtmosphericScreen()
-        self.generateCloudScreen()
-        self.generateControlParams()
-        self.generateTrackingParams()
         # cidlist required in generateTrimCatalog
         self.generateCidList(camstr, idonly)
-        self.generateTrimCatalog()
-        return wav
+        if self.footprintFilter:
+            self.filterCidListByFootprint()
+        atmoScreens = ['atmospherescreen_%s_%s' %(self.obshistid, screen)
+                       for screen in range(7)]
+        cloudScreens = ['cloudscreen_%s_%s' %(self.obshistid, screen)
+                        for screen in (0, 3)]
+        trimCatalogs = ['trimcatalog_%s_%s.pars' %(self.obshistid, elt[0])
+                        for elt in self.cidList]
+        graph = TaskGraph()
+        graph.addStep('writeObsCatParams', self.writeObsCatParams,
+                      inputs=[self.trimfileName],
+                      outputs=[self.obsCatFile, self.catListFile, self.obsParFile])
+        graph.addStep('generateAtmosphericParams', self.generateAtmosphericParams,
+                      outputs=[self.atmoParFile, self.atmoRaytraceFile])
+        graph.addStep('generateAtmosphericScreen',
+                      lambda: self.generateAtmosphericScreen(appendPars=False),
+                      inputs=[self.atmoRaytraceFile], outputs=atmoScreens)
+        graph.addStep('generateCloudScreen', self.generateCloudScreen,
+                      inputs=[self.atmoRaytraceFile],
+                      outputs=[self.cloudRaytraceFile] + cloudScreens)
+        graph.addStep('appendAtmosphereFiles', self.appendAtmosphereFiles,
+                      inputs=atmoScreens, outputs=[self.atmoRaytraceFile])
+        graph.addStep('generateControlParams', self.generateControlParams,
+                      outputs=[self.controlParFile, self.opticsParFile])
+        graph.addStep('generateTrackingParams', self.generateTrackingParams,
+                      outputs=[self.trackParFile, self.trackingParFile])
+        graph.addStep('generateTrimCatalog', self.generateTrimCatalog,
+                      inputs=[self.catListFile], outputs=trimCatalogs)
+        results = graph.run(self.nproc)
+        graph.printCriticalPath(sys.stderr)
+        # The shared pars files have changed, so drop anything cached.
+        self.fragments.clear()
+        return results['generateAtmosphericScreen']
 
     def writeObsCatParams(self):
         """
@@ -466,77 +809,13 @@ class Focalplane(object):
         """
         assert self.trimfileName is not None
         print 'Writing the ObsCat Parameters File.'
-        objectTestFile = 'objecttest_%s.pars' %(self.obshistid)
-        includeObjFile = 'includeobj_%s.pars' %(self.obshistid)
-
-        if os.path.isfile(self.catListFile):
-            try:
-                os.remove(self.catListFile)
-            except OSError:
-                pass
-        if os.path.isfile(self.obsCatFile):
-            try:
-                os.remove(self.obsCatFile)
-            except OSError:
-                pass
-        if os.path.isfile(objectTestFile):
-            try:
-                os.remove(objectTestFile)
-            except OSError:
-                pass
-
-        with file(objectTestFile, 'a') as parFile:
-            parFile.write('object \n')
-
-        cmd = 'grep object %s %s >> %s' %(self.trimfileName, objectTestFile, self.obsCatFile)
-        subprocess.check_call(cmd, shell=True)
-
-        numlines = len(open(self.obsCatFile).readlines())
-        print 'numlines', numlines
-        if numlines > 1:
-            try:
-                os.remove(self.obsCatFile)
-            except:
-                #print 'WARNING: No file %s to remove!' %(self.obsCatFile)
-                pass
-            cmd = 'grep object %s >> %s' %(self.trimfileName, self.obsCatFile)
-            subprocess.check_call(cmd, shell=True)
-
-            with file(self.catListFile, 'a') as parFile:
-                parFile.write('catalog %s ../../%s \n' %(self.ncat, self.obsCatFile))
-            self.ncat = 1
-
-        try:
-            os.remove(includeObjFile)
-        except:
-            #print 'WARNING: No file %s to remove!' %(includeObjFile)
-            pass
-
-        with file(includeObjFile, 'a') as parFile:
-            parFile.write('includeobj \n')
-
-        cmd = ('grep includeobj %s %s' %(self.trimfileName, includeObjFile))
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, close_fds=True)
-        results = p.stdout.readlines()
-        p.stdout.close()
-        nincobj = len(results)
-
-        if nincobj > 1:
-            cmd = ('grep includeobj %s | awk -v x=%i \'{print "catalog",x,"../../"$2};{x+=1}\' >> %s' %(self.trimfileName, self.ncat, self.catListFile))
-            subprocess.check_call(cmd, shell=True)
-            self.ncat = len(open(self.catListFile).readlines())
-
-        try:
-            os.remove(includeObjFile)
-        except:
-            #print 'WARNING: No file %s to remove - final!' %(includeObjFile)
-            pass
-
-        try:
-            os.remove(objectTestFile)
-        except:
-            #print 'WARNING: No file %s to remove - final!' %(objectTestFile)
-            pass
+        for parsFile in (self.catListFile, self.obsCatFile):
+            if os.path.isfile(parsFile):
+                try:
+                    os.remove(parsFile)
+                except OSError:
+                    pass
+        self.ncat = self._splitTrimfile()
 
         try:
             os.remove(self.obsParFile)
@@ -561,6 +840,51 @@ class Focalplane(object):
             parFile.write('ditherdec %s\n' %self.ditherDecOffset)
         return
 
+    def _splitTrimfile(self):
+        """Writes the object catalog and catalog list in one pass over the trimfile.
+
+        This reproduces the original grep/awk implementation:
+          - Every line containing 'object' goes to the object catalog.
+            If there are none, the object catalog instead holds the line
+            '<objecttest file>:object ' that 'grep object <trimfile>
+            <objecttest file>' left behind, and no catalog entry is made.
+          - Otherwise the catalog list starts with 'catalog 0 ../../<obscat>'.
+          - Every line containing 'includeobj' adds 'catalog <n> ../../<2nd field>'.
+
+        Returns:
+          Number of entries in the catalog list (ncat).
+        """
+        objectTestFile = 'objecttest_%s.pars' %(self.obshistid)
+        nobject = 0
+        includeObjs = []
+        with file(self.obsCatFile, 'w') as obsCat:
+            trimfile = InstanceCatalog.OpenCatalog(self.trimfileName)
+            try:
+                for line in trimfile:
+                    if 'object' in line:
+                        if not line.endswith('\n'):
+                            line += '\n'
+                        obsCat.write(line)
+                        nobject += 1
+                    if 'includeobj' in line:
+                        fields = line.split()
+                        includeObjs.append(len(fields) > 1 and fields[1] or '')
+            finally:
+                trimfile.close()
+            if not nobject:
+                obsCat.write('%s:object \n' %(objectTestFile))
+        print 'numlines', nobject + 1
+        ncat = 0
+        if nobject or includeObjs:
+            with file(self.catListFile, 'a') as parFile:
+                if nobject:
+                    parFile.write('catalog %s ../../%s \n' %(ncat, self.obsCatFile))
+                    ncat = 1
+                for includeObj in includeObjs:
+                    parFile.write('catalog %s ../../%s\n' %(ncat, includeObj))
+                    ncat += 1
+        return ncat
+
     def generateAtmosphericParams(self):
         """
         (2) Create the files containing the atmosphere parameters.
@@ -579,66 +903,77 @@ class Focalplane(object):
             parFile.write('constrainseeing %s \n' %(self.sigmarawseeing))
             parFile.write('seed %s \n'%(self.simseed))
             parFile.write('createatmosphere\n')
-        os.chdir('ancillary/atmosphere_parameters')
+        ancDir = 'ancillary/atmosphere_parameters'
         cmd = 'time ./create_atmosphere < ../../%s' %(self.atmoParFile)
         sys.stderr.write('Running: %s\n'% cmd)
         with WithTimer() as t:
-          subprocess.check_call(cmd, shell=True)
+          subprocess.check_call(cmd, shell=True, cwd=ancDir)
         t.PrintWall('create_atmosphere', sys.stderr)
         # Do a copy then remove, since shutil.copy() overwrites.
-        shutil.copy('%s' %(self.atmoRaytraceFile), '../../')
-        os.remove(self.atmoRaytraceFile)
-        os.chdir('../../')
+        shutil.copy(os.path.join(ancDir, self.atmoRaytraceFile), '.')
+        os.remove(os.path.join(ancDir, self.atmoRaytraceFile))
         return
 
-    def generateAtmosphericScreen(self):
+    def generateAtmosphericScreen(self, appendPars=True):
         """
         (3) Create the atmosphere screens.
+
+        Args:
+          appendPars:  Append the atmospherefile lines to the
+                       atmosphereraytrace file.  If False, the caller must
+                       call appendAtmosphereFiles() afterwards.
         """
         assert self.trimfileName is not None
         print 'Generating the Atmospheric Screens.'
-        os.chdir('ancillary/atmosphere')
+        srcDir = os.path.abspath('ancillary/atmosphere')
+        destDir = os.getcwd()
+        atmoLines = open(self.atmoRaytraceFile).readlines()
+        if self.filterNum == '0':
+            wav = 0.36
+        elif self.filterNum == '1':
+            wav = 0.48
+        elif self.filterNum == '2':
+            wav = 0.62
+        elif self.filterNum == '3':
+            wav = 0.76
+        elif self.filterNum == '4':
+            wav = 0.87
+        else:
+            wav = 0.97
         screenNumber = [0,1,2,3,4,5,6]
+        jobs = []
         for screen in screenNumber:
-            for line in open('../../%s' %(self.atmoRaytraceFile)).readlines():
+            for line in atmoLines:
                 if line.startswith('outerscale %s' %(screen)):
                     name, num, out = line.split()
             print 'Outerscale: ', out
             low = float(out)*100.0
             print 'Low', low
-            if self.filterNum == '0':
-                wav = 0.36
-            elif self.filterNum == '1':
-                wav = 0.48
-            elif self.filterNum == '2':
-                wav = 0.62
-            elif self.filterNum == '3':
-                wav = 0.76
-            elif self.filterNum == '4':
-                wav = 0.87
-            else:
-                wav = 0.97
             atmoScreen = 'atmospherescreen_%s_%s' %(self.obshistid, screen)
             cmd = 'time ./turb2d -seed %s%s -see5 %s -outerx 50000.0 -outers %s -zenith %s -wavelength %s -name %s' %(self.simseed, screen, self.rawseeing, low, self.zen, wav, atmoScreen)
-            sys.stderr.write('Running: %s\n'% cmd)
-            with WithTimer() as t:
-              subprocess.check_call(cmd, shell=True)
-            t.PrintWall('turb2d', sys.stderr)
-
-            shutil.move('%s_density_coarse.fits' %(atmoScreen), '../../')
-            shutil.move('%s_density_medium.fits' %(atmoScreen), '../../')
-            shutil.move('%s_density_fine.fits' %(atmoScreen), '../../')
-            shutil.move('%s_coarsex.fits' %(atmoScreen), '../../')
-            shutil.move('%s_coarsey.fits' %(atmoScreen), '../../')
-            shutil.move('%s_finex.fits' %(atmoScreen), '../../')
-            shutil.move('%s_finey.fits' %(atmoScreen), '../../')
-            shutil.move('%s_mediumx.fits' %(atmoScreen), '../../')
-            shutil.move('%s_mediumy.fits' %(atmoScreen), '../../')
-            with file('../../%s' %(self.atmoRaytraceFile), 'a') as parFile:
-                parFile.write('atmospherefile %s ../%s \n' %(screen, atmoScreen))
-        os.chdir('../../')
+            outputs = ['%s_%s.fits' %(atmoScreen, suffix) for suffix in
+                       ('density_coarse', 'density_medium', 'density_fine',
+                        'coarsex', 'coarsey', 'finex', 'finey',
+                        'mediumx', 'mediumy')]
+            jobs.append(('turb2d %s' %screen, srcDir, cmd, outputs, destDir))
+        self._runAncillaryJobs(jobs, 'screens')
+        if appendPars:
+            self.appendAtmosphereFiles()
         return wav
 
+    def appendAtmosphereFiles(self):
+        """
+        (3.1) Append the atmosphere screen names to the atmosphereraytrace file.
+
+        Lines are appended in layer order regardless of the order the
+        screens finished in.
+        """
+        with file(self.atmoRaytraceFile, 'a') as parFile:
+            for screen in [0,1,2,3,4,5,6]:
+                atmoScreen = 'atmospherescreen_%s_%s' %(self.obshistid, screen)
+                parFile.write('atmospherefile %s ../%s \n' %(screen, atmoScreen))
+        return
+
     def generateCloudScreen(self):
         """
         (4) Create the cloud screens.
@@ -650,23 +985,72 @@ class Focalplane(object):
         except:
             #print 'WARNING: No file %s to remove!' %(self.cloudRaytraceFile)
             pass
-        os.chdir('ancillary/atmosphere')
+        srcDir = os.path.abspath('ancillary/atmosphere')
+        destDir = os.getcwd()
+        atmoLines = open(self.atmoRaytraceFile).readlines()
         screenNumber = [0, 3]
+        jobs = []
         for screen in screenNumber:
-            for line in open('../../%s' %(self.atmoRaytraceFile)).readlines():
+            for line in atmoLines:
                 if line.startswith('height %s' %(screen)):
                     name, num, height = line.split()
             print 'Height: ', height
             cloudScreen = 'cloudscreen_%s_%s' %(self.obshistid, screen)
             cmd = 'time ./cloud -seed %s%s -height %s -name %s -pix 100' %(self.simseed, screen, height, cloudScreen)
-            sys.stderr.write('Running: %s\n'% cmd)
-            with WithTimer() as t:
-              subprocess.check_call(cmd, shell=True)
-            t.PrintWall('cloud', sys.stderr)
-            shutil.move('%s.fits' %(cloudScreen), '../../')
-            with file('../../%s' %(self.cloudRaytraceFile), 'a') as parFile:
+            jobs.append(('cloud %s' %screen, srcDir, cmd,
+                         ['%s.fits' %(cloudScreen)], destDir))
+        self._runAncillaryJobs(jobs, 'screens')
+        with file(self.cloudRaytraceFile, 'a') as parFile:
+            for screen in screenNumber:
+                cloudScreen = 'cloudscreen_%s_%s' %(self.obshistid, screen)
                 parFile.write('cloudfile %s ../%s \n' %(screen, cloudScreen))
-        os.chdir('../..')
+        return
+
+    def _runAncillaryJobs(self, jobs, label):
+        """Run ancillary program jobs, concurrently if self.nproc > 1.
+
+        With nproc == 1 the jobs run one after another in their source
+        directory, exactly as before.  Otherwise each job runs in its own
+        thread and temporary directory.  Every job holds one of the
+        self.nproc tokens of self.ancillarySlots while it runs, so at most
+        self.nproc ancillary programs run at once, even when several steps
+        of runPreprocessingCommands call this concurrently.  Per-job wall
+        and CPU times are written to stderr in job order.
+
+        Args:
+          jobs:   List of (name, srcDir, cmd, outputs, destDir) tuples.
+          label:  Name for the overall timing report.
+        """
+        nproc = min(self.nproc, len(jobs))
+        isolate = nproc > 1
+        jobs = [job + (isolate,) for job in jobs]
+        results = [None] * len(jobs)
+        errors = []
+
+        def runJob(i):
+            try:
+                with self.ancillarySlots:
+                    results[i] = runAncillaryJob(jobs[i])
+            except:
+                errors.append(sys.exc_info())
+
+        with WithTimer() as t:
+            if isolate:
+                threads = [threading.Thread(target=runJob, args=(i,))
+                           for i in range(len(jobs))]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                if errors:
+                    raise errors[0][0], errors[0][1], errors[0][2]
+            else:
+                for i in range(len(jobs)):
+                    with self.ancillarySlots:
+                        results[i] = runAncillaryJob(jobs[i])
+        for name, wall, cpu in results:
+            sys.stderr.write('TIMER[%s]: cpu: %f sec  wall: %f sec\n' %(name, cpu, wall))
+        t.PrintWall('%s (nproc=%d)' %(label, nproc), sys.stderr)
         return
 
     def generateControlParams(self):
@@ -682,14 +1066,13 @@ class Focalplane(object):
             parFile.write('zenith %s \n' %(self.zen))
             parFile.write('ranseed %s \n' %(self.simseed))
             parFile.write('optics_parameters \n')
-        os.chdir('ancillary/optics_parameters')
+        ancDir = 'ancillary/optics_parameters'
         cmd = 'time ./optics_parameters < ../../%s' %(self.controlParFile)
         sys.stderr.write('Running: %s\n'% cmd)
         with WithTimer() as t:
-          subprocess.check_call(cmd, shell=True)
+          subprocess.check_call(cmd, shell=True, cwd=ancDir)
         t.PrintWall('optics_parameters', sys.stderr)
-        shutil.move('%s' %(self.opticsParFile), '../../')
-        os.chdir('../../')
+        shutil.move(os.path.join(ancDir, self.opticsParFile), '.')
         return
 
     def generateTrackingParams(self):
@@ -711,42 +1094,101 @@ class Focalplane(object):
             parFile.write('starttime %s \n' %(self.starttime))
             parFile.write('endtime %s \n' %(self.endtime))
             parFile.write('tracking \n')
-        os.chdir('ancillary/tracking')
+        ancDir = 'ancillary/tracking'
         cmd = 'time ./tracking < ../../%s' %(self.trackParFile)
         sys.stderr.write('Running: %s\n'% cmd)
         with WithTimer() as t:
-          subprocess.check_call(cmd, shell=True)
+          subprocess.check_call(cmd, shell=True, cwd=ancDir)
         t.PrintWall('tracking', sys.stderr)
-        shutil.move('%s' %(self.trackingParFile), '../../')
-        os.chdir('../../')
+        shutil.move(os.path.join(ancDir, self.trackingParFile), '.')
         return
 
-    def writeSedManifest(self, trimCatFile, cid):
+    def compressTrimCatalog(self, trimCatFile, cid):
         """
-        (6.9)
-        Use the output of the 'trim' program, specifically trimcatalog_*.pars, to
-        figure out which SEDs are needed from the shared catalog for chip 'cid'.
-        Generate a manifest of these and write it to sedlist_*.txt.
+        (6.95)
+        Count the sources in trimCatFile and, if there are at least
+        self.minsource, write its SED manifest (sedlist_*.txt, the SEDs
+        needed from the shared catalog for chip 'cid') and replace it with
+        a gzipped copy.  The catalog is read only once, and nothing is
+        compressed for catalogs with too few sources.
+
+        The minimum length of trimCatFile at this stage is 2 lines.
+        (trim puts 1 line in there, and generateTrimCatalog() appended
+        a second line.)  Therefore, the number of sources in the trimCatFile
+        is its length - 2.
 
-        For the moment, just do this via a shell command rather than loading
-        everything into Python.
+        Returns:
+          (number of sources, name of the catalog file: trimCatFile or its
+           gzipped version)
+        """
+        gzFile = trimCatFile + '.gz'
+        tmpFile = gzFile + '.tmp'
+        sys.stdout.write('Scanning and gzipping %s...' %trimCatFile)
+        try:
+            nlines, seds = scanTrimCatalog(trimCatFile, tmpFile,
+                                           minLines=self.minsource + 2)
+        except:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+        sys.stdout.write('Done.\n')
+        nSources = nlines - 2
+        if nSources < self.minsource:
+            return nSources, trimCatFile
+        with file(ParsFilenames(self.obshistid).sedlist(cid), 'w') as sedFile:
+            for sed in seds:
+                sedFile.write('%s\n' %sed)
+        os.rename(tmpFile, gzFile)
+        os.remove(trimCatFile)
+        return nSources, gzFile
+
+    def filterCidListByFootprint(self):
         """
-        cmd = 'cat %s ' % trimCatFile
-        #cmd = cmd + '| egrep \'starSED|galaxySED|ssmSED|agnSED|flatSED|sky\' | awk \'{print "../data/"$6", \\\\"}\' '
-        cmd = cmd + '| egrep \'starSED|galaxySED|ssmSED|agnSED|flatSED|sky\' | awk \'{print $6 }\' '
-        cmd = cmd + '| sort | uniq > %s' % ParsFilenames(self.obshistid).sedlist(cid)
-        print 'Executing command:'
-        print '  ' + cmd
-        subprocess.check_call(cmd, shell=True)
+        (6.99)
+        Drop the chips from self.cidList on which the sources of the
+        trimfile and its includeobj catalogs cannot add up to
+        self.minsource, so that trim does not run for them.  Rafts with no
+        chips left are not trimmed at all.  See FootprintFilter.py.
+
+        Nothing is dropped for single-sensor runs, when minsource <= 0
+        (background images are wanted for every chip), or if the filter
+        cannot run (e.g. an includeobj catalog is missing).
+        """
+        if self.idonly or self.minsource <= 0:
+            return
+        instrDir = os.path.dirname(findSourceFile('lsst/focalplanelayout.txt'))
+        geometry = FocalplaneGeometry.GetGeometry(instrDir)
+        pointing = (float(self.pra), float(self.pdec), float(self.prot))
+        try:
+            keep = FootprintFilter.CandidateChips(
+                self.trimfileName, geometry, [elt[0] for elt in self.cidList],
+                self.minsource, pointing)
+        except (RuntimeError, IOError, ValueError), e:
+            print 'Not using the footprint filter: %s' %e
+            return
+        keep = set(keep)
+        print 'Footprint filter: trimming %d of %d chips.' %(len(keep),
+                                                             len(self.cidList))
+        self.footprintSkipped = [elt for elt in self.cidList if elt[0] not in keep]
+        self.cidList = [elt for elt in self.cidList if elt[0] in keep]
+        return
 
     def generateTrimCatalog(self):
         """
         (7)
         Run trim program to create trimcatalog_*.pars files for each chip.
+
+        One trim par file is written per raft.  The trim runs for the rafts
+        are independent, so with self.nproc > 1 they run concurrently, each
+        in its own copy of ancillary/trim.  Their outputs are gathered back
+        into ancillary/trim and then collected in cidList order.
         """
         raftid = ""
+        trimDir = os.path.abspath('ancillary/trim')
+        jobs = []
         # Progress through the list of cids.  For the first cid of every raft,
-        # create a trim par file.  For the last cid of every raft, run trim.
+        # create a trim par file.  For the last cid of every raft, queue a
+        # trim run.
         for i,elt in enumerate(self.cidList):
             cid = elt[0]
             if raftid != cid.split("_")[0]:
@@ -761,14 +1203,16 @@ class Focalplane(object):
                 cmd = 'cat %s >> %s' %(self.catListFile, trimParFile)
                 subprocess.check_call(cmd, shell=True)
                 chipcounter = 0
+                trimCatFiles = []
             print 'Submitting chip:', cid
             trimCatFile = 'trimcatalog_%s_%s.pars' %(self.obshistid, cid)
             with file(trimParFile, 'a') as parFile:
                 parFile.write('out_file %s %s \n' %(chipcounter, trimCatFile))
                 parFile.write('chip_id %s %s \n' %(chipcounter, cid))
+            trimCatFiles.append(trimCatFile)
             chipcounter += 1
             # If the next chip is in a different raft (or this is the last chip),
-            # run trim program
+            # queue the trim run
             if i == len(self.cidList) - 1:
                 print 'Last chipid =', cid
                 nextRaftid = ""
@@ -781,7 +1225,10 @@ class Focalplane(object):
                 else:
                     ntrims = chipcounter
                     #TODO This is an LSST-specific test.  Remove later.
-                    assert chipcounter == 9
+                    # Chips the footprint filter dropped still count.
+                    nSkipped = len([elt for elt in self.footprintSkipped
+                                    if elt[0].split("_")[0] == raftid])
+                    assert chipcounter + nSkipped == 9
                 with file(trimParFile, 'a') as parFile:
                     parFile.write('ntrim %s \n' %(ntrims))
                     parFile.write('point_ra %s \n' %(self.pra))
@@ -791,17 +1238,18 @@ class Focalplane(object):
                     parFile.write('straylight 0 \n')
                     #TODO: parFile.write('flatdir 1 \n')
                     parFile.write('trim \n')
-
-                print 'Running TRIM for cid %s.' %cid
-                os.chdir('ancillary/trim')
                 cmd = 'time ./trim < ../../%s' %(trimParFile)
-                sys.stderr.write('Running: %s\n'% cmd)
-                with WithTimer() as t:
-                  subprocess.check_call(cmd, shell=True)
-                t.PrintWall('trim', sys.stderr)
-                print 'Finished Running TRIM.'
-                os.chdir('../..')
-                os.remove(trimParFile)
+                jobs.append(('trim %s' %raftid, trimDir, cmd, trimCatFiles, trimDir))
+
+        print 'Running TRIM for %d rafts.' %len(jobs)
+        try:
+            self._runAncillaryJobs(jobs, 'trim')
+        finally:
+            for job in jobs:
+                trimParFile = 'trim_%s_%s.pars' %(self.obshistid, job[0].split()[1])
+                if os.path.isfile(trimParFile):
+                    os.remove(trimParFile)
+        print 'Finished Running TRIM.'
 
         # Now move the trimcatalog files
         for elt in self.cidList:
@@ -814,34 +1262,51 @@ class Focalplane(object):
             print 'Processed trimcatalog file %s.' %(trimCatFile)
         return
 
+    def generateChipParams(self, cid, chipParFile):
+        """
+        (7.5) Create the chip parameter file from the chip's offsets pars.
+        """
+        offsetsFile = 'data/focal_plane/sta_misalignments/offsets/pars_%s' %(cid)
+        with file(chipParFile, 'wb') as parFile:
+            parFile.write(self.fragments.read(offsetsFile))
+            #TODO: parFile.write('flatdir 1 \n')
+            parFile.write('chipid %s \n' %(cid))
+            parFile.write('chipheightfile ../data/focal_plane/sta_misalignments/height_maps/%s.fits.gz \n' %(cid))
+        return
+
     def generateRaytraceParams(self, id, chipParFile, seedchip, timeParFile, raytraceParFile,
                                extraidFilename=''):
 
         """
         (8) Create and return the LSST (Raytrace) parameter file.
+
+        The raytrace pars are the concatenation of the obs, atmosphereraytrace,
+        optics, time, cloudraytrace and chip pars.  The shared files come
+        from self.fragments.
         """
 
         with file(chipParFile, 'a') as parFile:
             parFile.write('outputfilename imsim_%s_%s \n' %(self.obshistid, id))
             parFile.write('seed %s \n' %(seedchip))
             parFile.write('trackingfile ../%s \n' %(self.trackingParFile))
-
-        # Adds contents of extra table to chipParFile.  Extra table
-        # parameters are used to turn parameters on and off (eg. clouds) in
-        # the simulator. Clouds are 'on' by default.
-        if extraidFilename:
-            cmd = 'cat %s >> %s' %(extraidFilename, chipParFile)
-            subprocess.check_call(cmd, shell=True)
-
-        cmd = 'cat %s %s %s %s %s %s > %s' %(self.obsParFile, self.atmoRaytraceFile,
-                                             self.opticsParFile, timeParFile,
-                                             self.cloudRaytraceFile, chipParFile,
-                                             raytraceParFile)
-        #JPG: Added the 'straylight' line because it's in the v-3.0 condor file:
-        with file(raytraceParFile, 'a') as parFile:
-          parFile.write('straylight 0 \n')
-        subprocess.check_call(cmd, shell=True)
-
+            # Adds contents of extra table to chipParFile.  Extra table
+            # parameters are used to turn parameters on and off (eg. clouds) in
+            # the simulator. Clouds are 'on' by default.
+            if extraidFilename:
+                parFile.write(self.fragments.read(extraidFilename))
+
+        # NOTE: Earlier versions wrote a 'straylight 0' line here (it is in
+        # the v-3.0 condor file), but it was immediately truncated by the
+        # 'cat >' that followed, so it never appeared in the output.
+        with file(raytraceParFile, 'wb') as parFile:
+            parFile.write(self.fragments.read(self.obsParFile))
+            parFile.write(self.fragments.read(self.atmoRaytraceFile))
+            parFile.write(self.fragments.read(self.opticsParFile))
+            with open(timeParFile, 'rb') as f:
+                parFile.write(f.read())
+            parFile.write(self.fragments.read(self.cloudRaytraceFile))
+            with open(chipParFile, 'rb') as f:
+                parFile.write(f.read())
         return
 
     def generateBackgroundParams(self, id, seedchip, cid, wav, backgroundParFile):
@@ -856,11 +1321,18 @@ class Focalplane(object):
             #print 'WARNING: No file %s to remove!' %(backgroundParFile)
             pass
 
-        for line in open(self.atmoRaytraceFile).readlines():
+        atmoLines = self.fragments.lines(self.atmoRaytraceFile)
+        for line in atmoLines:
             if line.startswith('relh2o'):
                 name, watervar = line.split()
 
         with file(backgroundParFile, 'a') as parFile:
+            # The cloudmean lines come first.  Earlier versions appended them
+            # with 'grep cloudmean >>' while the lines below were still
+            # sitting in this file's write buffer.
+            for line in atmoLines:
+                if 'cloudmean' in line:
+                    parFile.write(line)
             parFile.write('out_file imsim_%s_%s.fits \n' %(self.obshistid, id))
             parFile.write('point_alt %s \n' %(self.alt))
             parFile.write('point_az %s \n' %(self.az))
@@ -889,8 +1361,6 @@ class Focalplane(object):
             parFile.write('phase_ang %s \n' %(self.moonphaserad))
             parFile.write('seed %s \n' %(seedchip))
             parFile.write('wavelength %s \n' %(wav))
-            cmd = 'grep cloudmean %s >> %s' %(self.atmoRaytraceFile, backgroundParFile)
-            subprocess.check_call(cmd, shell=True)
             parFile.write('add_background \n')
 
         return
@@ -926,10 +1396,9 @@ class Focalplane(object):
         """
 
         e2adcParFile = ParsFilenames(self.obshistid).e2adc(id)
-        cmd = 'cat data/focal_plane/sta_misalignments/readout/readoutpars_%s >> %s' \
-              %(cid, e2adcParFile)
-        subprocess.check_call(cmd, shell=True)
+        readoutFile = 'data/focal_plane/sta_misalignments/readout/readoutpars_%s' %(cid)
         with file(e2adcParFile, 'a') as parFile:
+            parFile.write(self.fragments.read(readoutFile))
             parFile.write('inputfilename ../cosmic_rays/output_%s_%s.fits \n' %(self.obshistid, id))
             parFile.write('outputprefilename imsim_%s_ \n' % self.obshistid )
             parFile.write('outputpostfilename _%s \n' % expid)
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+"""Index of the chips and amplifiers of an instrument.
+
+FocalplaneGeometry parses an instrument's focalplanelayout.txt and
+segmentation.txt once into small per-chip records and answers the
+questions the rest of python_control asks of those files:
+  - which chips belong to a camconfig group string ('Group0|Group1')
+  - the device type and device value (readout time) of a chip
+  - the amplifier names of a chip
+  - the position and size of a chip in the focal plane (microns)
+
+GetGeometry() keeps one instance per instrument directory for the life of
+the process.  The parsed records are also pickled next to the instrument
+data (FocalplaneGeometry.CACHE_FN) so that other processes reading the
+same, unmodified files can skip the parse.
+"""
+
+from __future__ import with_statement
+import cPickle
+import logging
+import os
+import re
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_FN = 'focalplanelayout.txt'
+SEGMENTATION_FN = 'segmentation.txt'
+CACHE_FN = '.focalplanegeometry.pickle'
+# Bump this whenever the pickled layout changes.
+_CACHE_VERSION = 2
+
+_GROUP_CAMSTR_RE = re.compile(r'^Group\d+(\|Group\d+)*$')
+
+# abspath(instr_dir) -> FocalplaneGeometry
+_geometry_memo = {}
+
+
+class ChipRecord(object):
+  """One chip from focalplanelayout.txt.
+
+  x and y are the center of the chip in the focal plane and pixsize the
+  pixel size, all in microns; nx and ny are the number of pixels along x
+  and y.
+  """
+  __slots__ = ('cid', 'devtype', 'devvalue', 'group', 'line',
+               'x', 'y', 'pixsize', 'nx', 'ny')
+
+  def __init__(self, cid, devtype, devvalue, group, line,
+               x=0.0, y=0.0, pixsize=0.0, nx=0, ny=0):
+    self.cid = cid
+    self.devtype = devtype
+    self.devvalue = devvalue
+    self.group = group
+    self.line = line
+    self.x = x
+    self.y = y
+    self.pixsize = pixsize
+    self.nx = nx
+    self.ny = ny
+
+  def __getstate__(self):
+    return (self.cid, self.devtype, self.devvalue, self.group, self.line,
+            self.x, self.y, self.pixsize, self.nx, self.ny)
+
+  def __setstate__(self, state):
+    (self.cid, self.devtype, self.devvalue, self.group, self.line,
+     self.x, self.y, self.pixsize, self.nx, self.ny) = state
+
+  def CidTuple(self):
+    """Returns (cid, devtype, devvalue) as returned by Focalplane.readCidList()."""
+    return (self.cid, self.devtype, self.devvalue)
+
+  def Bounds(self, buffer_um=0.0):
+    """Returns (xmin, xmax, ymin, ymax) of the chip, grown by buffer_um."""
+    half_x = 0.5 * self.nx * self.pixsize + buffer_um
+    half_y = 0.5 * self.ny * self.pixsize + buffer_um
+    return (self.x - half_x, self.x + half_x, self.y - half_y, self.y + half_y)
+
+
+class FocalplaneGeometry(object):
+  """Chip and amplifier index for one instrument directory."""
+
+  def __init__(self, instr_dir, use_cache=True):
+    """Constructor.
+
+    Args:
+      instr_dir:  Directory containing focalplanelayout.txt and
+                  segmentation.txt (e.g. <data>/lsst).
+      use_cache:  Read and write the pickled cache in instr_dir.
+    """
+    self.instr_dir = instr_dir
+    self.layout_fn = os.path.join(instr_dir, LAYOUT_FN)
+    self.segmentation_fn = os.path.join(instr_dir, SEGMENTATION_FN)
+    self.cache_fn = os.path.join(instr_dir, CACHE_FN)
+    self.stamp = self._Stamp()
+    self.chips = None     # List of ChipRecords in file order
+    self.groups = None    # group name -> list of indices into self.chips
+    self.groups_exact = None  # Can camconfig groups be looked up in self.groups?
+    self.amps = None      # cid -> list of amp names
+    if not (use_cache and self._ReadCache()):
+      self._Parse()
+      if use_cache:
+        self._WriteCache()
+    self._by_cid = dict((chip.cid, chip) for chip in self.chips)
+
+  def _Stamp(self):
+    """Returns a key that changes whenever one of the input files changes."""
+    stamp = [_CACHE_VERSION]
+    for fn in (self.layout_fn, self.segmentation_fn):
+      st = os.stat(fn)
+      stamp.extend([st.st_size, st.st_mtime])
+    return tuple(stamp)
+
+  def IsCurrent(self):
+    """Returns True if neither input file has changed since it was read."""
+    try:
+      return self._Stamp() == self.stamp
+    except OSError:
+      return False
+
+  def _Parse(self):
+    logger.info('Parsing %s and %s.', self.layout_fn, self.segmentation_fn)
+    self.chips = []
+    self.groups = {}
+    self.groups_exact = True
+    with open(self.layout_fn, 'r') as f:
+      for line in f:
+        fields = line.split()
+        if len(fields) < 8 or fields[0].startswith('#'):
+          continue
+        group = None
+        group_fields = [field for field in fields if 'Group' in field]
+        if len(group_fields) == 1 and group_fields[0].startswith('Group'):
+          group = group_fields[0]
+        elif group_fields:
+          # 'Group' appears somewhere other than a single group column,
+          # so a group lookup might not agree with a regex search.
+          self.groups_exact = False
+        self.chips.append(ChipRecord(fields[0], fields[6], float(fields[7]),
+                                     group, line, x=float(fields[1]),
+                                     y=float(fields[2]),
+                                     pixsize=float(fields[3]),
+                                     nx=int(fields[4]), ny=int(fields[5])))
+        if group:
+          self.groups.setdefault(group, []).append(len(self.chips) - 1)
+    # Exposure.readAmpList() selects lines that start with '<cid>_', so
+    # file every amp under each of its '_'-separated prefixes.
+    self.amps = {}
+    with open(self.segmentation_fn, 'r') as f:
+      for line in f:
+        if not line.strip() or line[0].isspace():
+          continue
+        name = line.split()[0]
+        pos = name.find('_')
+        while pos > 0:
+          self.amps.setdefault(name[:pos], []).append(name)
+          pos = name.find('_', pos + 1)
+
+  def _ReadCache(self):
+    try:
+      with open(self.cache_fn, 'rb') as f:
+        stamp, chips, groups, groups_exact, amps = cPickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+      return False
+    if stamp != self.stamp:
+      return False
+    logger.info('Read focalplane geometry from %s.', self.cache_fn)
+    self.chips, self.groups, self.amps = chips, groups, amps
+    self.groups_exact = groups_exact
+    return True
+
+  def _WriteCache(self):
+    """Writes the pickled cache.  Failure (e.g. read-only data) is not an error."""
+    tmp_fn = '%s.%d.tmp' % (self.cache_fn, os.getpid())
+    try:
+      with open(tmp_fn, 'wb') as f:
+        cPickle.dump((self.stamp, self.chips, self.groups, self.groups_exact,
+                      self.amps), f,
+                     cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_fn, self.cache_fn)
+    except (IOError, OSError), e:
+      logger.debug('Could not write %s: %s', self.cache_fn, e)
+      try:
+        os.remove(tmp_fn)
+      except OSError:
+        pass
+
+  def CidList(self, camstr):
+    """Returns the chips selected by camstr.
+
+    Args:
+      camstr:  camconfig regex, e.g. 'Group0|Group2'.  Pure group
+               alternations are looked up in the group index (a group
+               matches if it contains the requested name, just as the
+               regex search would); anything else is matched against each
+               focalplanelayout line as before.
+
+    Returns:
+      List of (cid, devtype, devvalue) tuples in file order.
+    """
+    if self.groups_exact and _GROUP_CAMSTR_RE.match(camstr):
+      indices = []
+      for name in camstr.split('|'):
+        for group, group_indices in self.groups.iteritems():
+          if name in group:
+            indices.extend(group_indices)
+      return [self.chips[i].CidTuple() for i in sorted(set(indices))]
+    p = re.compile(camstr)
+    return [chip.CidTuple() for chip in self.chips if p.search(chip.line)]
+
+  def Chip(self, cid):
+    """Returns the ChipRecord for cid (KeyError if unknown)."""
+    return self._by_cid[cid]
+
+  def AmpList(self, cid):
+    """Returns the list of amp names for chip cid (empty if unknown)."""
+    return list(self.amps.get(cid, []))
+
+
+def GetGeometry(instr_dir):
+  """Returns the process-wide FocalplaneGeometry for instr_dir."""
+  key = os.path.abspath(instr_dir)
+  geometry = _geometry_memo.get(key)
+  if geometry is None or not geometry.IsCurrent():
+    geometry = FocalplaneGeometry(instr_dir)
+    _geometry_memo[key] = geometry
+  return geometry
@@ -0,0 +1,96 @@
+#!/usr/bin/python2.6
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import FocalplaneGeometry
+from Exposure import readAmpList
+from Focalplane import readCidList
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+LAYOUT = """# name x y pixsize nx ny devtype devvalue group
+R01_S00 -25400.0 -10480.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R01_S01 -25400.0 -5240.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R00_S22_C0 -31750.0 -31750.0 10.0 2000 4072 CCD 3.0 Group2 0 0 0
+R01_S02 -25400.0 0.0 10.0 4000 4072 CMOS 0.5 Group1 0 0 0
+R10_S10 -25400.0 0.0 10.0 4000 4072 CCD 3.0 Group10 0 0 0
+"""
+
+SEGMENTATION = """R01_S00 2 4000 4072
+R01_S00_C00 2000 4072 0 1999 0 4071 0
+R01_S00_C01 2000 4072 2000 3999 0 4071 0
+R01_S01 1 4000 4072
+R01_S01_C00 2000 4072 0 1999 0 4071 0
+R00_S22_C0 1 2000 4072
+R00_S22_C0_A0 2000 4072 0 1999 0 4071 0
+"""
+
+
+class FocalplaneGeometryTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self._Write('focalplanelayout.txt', LAYOUT)
+    self._Write('segmentation.txt', SEGMENTATION)
+    FocalplaneGeometry._geometry_memo.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Write(self, fn, contents):
+    with open(os.path.join(self.tmpdir, fn), 'w') as f:
+      f.write(contents)
+
+  def _ReadCidList(self, camstr):
+    with open(os.path.join(self.tmpdir, 'focalplanelayout.txt')) as f:
+      return readCidList(camstr, f)
+
+  def _ReadAmpList(self, cid):
+    with open(os.path.join(self.tmpdir, 'segmentation.txt')) as f:
+      return readAmpList(f, cid)
+
+  def testCidListMatchesReadCidList(self):
+    geometry = FocalplaneGeometry.GetGeometry(self.tmpdir)
+    for camstr in ('Group0', 'Group2', 'Group0|Group1', 'Group2|Group0', 'R01_S0'):
+      self.assertEqual(geometry.CidList(camstr), self._ReadCidList(camstr))
+
+  def testAmpListMatchesReadAmpList(self):
+    geometry = FocalplaneGeometry.GetGeometry(self.tmpdir)
+    for cid in ('R01_S00', 'R01_S01', 'R00_S22_C0', 'R01_S02'):
+      self.assertEqual(geometry.AmpList(cid), self._ReadAmpList(cid))
+    self.assertEqual(geometry.Chip('R01_S02').devtype, 'CMOS')
+    self.assertEqual(geometry.Chip('R01_S02').group, 'Group1')
+
+  def testChipPosition(self):
+    chip = FocalplaneGeometry.GetGeometry(self.tmpdir).Chip('R00_S22_C0')
+    self.assertEqual((chip.x, chip.y, chip.pixsize, chip.nx, chip.ny),
+                     (-31750.0, -31750.0, 10.0, 2000, 4072))
+    self.assertEqual(chip.Bounds(100.0),
+                     (-41850.0, -21650.0, -52210.0, -11290.0))
+
+  def testMemoAndPickleCache(self):
+    geometry = FocalplaneGeometry.GetGeometry(self.tmpdir)
+    self.assertTrue(FocalplaneGeometry.GetGeometry(self.tmpdir) is geometry)
+    self.assertTrue(os.path.isfile(os.path.join(self.tmpdir,
+                                                FocalplaneGeometry.CACHE_FN)))
+    # A new process-level instance reads the pickle instead of the text files.
+    os.chmod(os.path.join(self.tmpdir, 'segmentation.txt'), 0)
+    try:
+      if os.access(os.path.join(self.tmpdir, 'segmentation.txt'), os.R_OK):
+        return  # Running as root; permissions are not enforced.
+      cached = FocalplaneGeometry.FocalplaneGeometry(self.tmpdir)
+      self.assertEqual(cached.AmpList('R01_S00'), geometry.AmpList('R01_S00'))
+    finally:
+      os.chmod(os.path.join(self.tmpdir, 'segmentation.txt'), 0644)
+
+  def testReloadWhenChanged(self):
+    geometry = FocalplaneGeometry.GetGeometry(self.tmpdir)
+    self._Write('segmentation.txt', SEGMENTATION + 'R01_S01_C01 2000 4072\n')
+    geometry = FocalplaneGeometry.GetGeometry(self.tmpdir)
+    self.assertEqual(geometry.AmpList('R01_S01'), ['R01_S01_C00', 'R01_S01_C01'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,7 +1,20 @@
 #!/usr/bin/python2.6
+import gzip
 import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from Focalplane import *
+import FootprintFilter
+import FootprintFilter_test
+from Exposure import MetadataCallCounter
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
 
 class TestFocalplane(unittest.TestCase):
 
@@ -11,7 +24,424 @@ class TestFocalplane(unittest.TestCase):
   def test_Init(self):
     self.assertEqual(self.f.obsid, '12345678-fr')
     self.assertEqual(self.f.parsDictionary['track'], 'track_12345678.pars')
+    self.assertEqual(self.f.nproc, 1)
     return
 
+  def test_verifyInputFiles(self):
+    tmpdir = MakeTmpDir()
+    try:
+      os.makedirs(os.path.join(tmpdir, '12345678-fr', 'run12345678'))
+      counter = MetadataCallCounter()
+      stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+      try:
+        missing = self.f.verifyInputFiles(tmpdir, counter=counter)
+        output = sys.stdout.getvalue()
+      finally:
+        sys.stdout = stdout
+      self.assertEqual(len(missing), 1 + len(self.f.parsDictionary))
+      # One listing each of the stage and the run directory.
+      self.assertEqual(counter.count, 2)
+      self.assertEqual(output, '')
+    finally:
+      shutil.rmtree(tmpdir)
+
+
+class TestAncillaryJobs(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.srcdir = os.path.join(self.tmpdir, 'ancillary', 'atmosphere')
+    os.makedirs(self.srcdir)
+    # Fake screen generator: writes <name>.fits from an input file in its cwd.
+    with open(os.path.join(self.srcdir, 'input.txt'), 'w') as f:
+      f.write('input\n')
+    self.destdir = os.path.join(self.tmpdir, 'dest')
+    os.mkdir(self.destdir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Job(self, name):
+    cmd = 'cat input.txt > %s.fits && echo %s >> %s.fits' %(name, name, name)
+    return (name, self.srcdir, cmd, ['%s.fits' %name], self.destdir)
+
+  def _CheckOutput(self, name):
+    with open(os.path.join(self.destdir, '%s.fits' %name)) as f:
+      self.assertEqual(f.read(), 'input\n%s\n' %name)
+
+  def test_runAncillaryJobIsolated(self):
+    name, wall, cpu = runAncillaryJob(self._Job('screen_0') + (True,))
+    self.assertEqual(name, 'screen_0')
+    self.assertTrue(wall >= 0.0 and cpu >= 0.0)
+    self._CheckOutput('screen_0')
+    # Temporary directory was removed and the source dir was not touched.
+    self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'ancillary')),
+                     ['atmosphere'])
+    self.assertEqual(os.listdir(self.srcdir), ['input.txt'])
+
+  def test_runAncillaryJobInPlace(self):
+    runAncillaryJob(self._Job('screen_1') + (False,))
+    self._CheckOutput('screen_1')
+    self.assertEqual(os.listdir(self.srcdir), ['input.txt'])
+
+  def test_runAncillaryJobsPool(self):
+    f = Focalplane('12345678', 'r', nproc=3)
+    names = ['screen_%d' %i for i in range(5)]
+    f._runAncillaryJobs([self._Job(name) for name in names], 'screens')
+    for name in names:
+      self._CheckOutput(name)
+    self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'ancillary')),
+                     ['atmosphere'])
+
+  def test_runAncillaryJobSameDir(self):
+    job = ('trim', self.srcdir, 'echo out > out.pars', ['out.pars'],
+           self.srcdir, False)
+    runAncillaryJob(job)
+    self.assertTrue(os.path.isfile(os.path.join(self.srcdir, 'out.pars')))
+
+  def test_runAncillaryJobIsolatedStaleOutput(self):
+    # Outputs left in srcDir by an earlier run are not linked into the
+    # private dir: they are neither written through nor taken for output.
+    stale = os.path.join(self.srcdir, 'out.pars')
+    with open(stale, 'w') as f:
+      f.write('stale\n')
+    runAncillaryJob(('trim', self.srcdir, 'test ! -e out.pars', ['out.pars'],
+                     self.srcdir, True))
+    with open(stale) as f:
+      self.assertEqual(f.read(), 'stale\n')
+    runAncillaryJob(('trim', self.srcdir, 'echo new >> out.pars', ['out.pars'],
+                     self.srcdir, True))
+    self.assertFalse(os.path.islink(stale))
+    with open(stale) as f:
+      self.assertEqual(f.read(), 'new\n')
+
+  def test_runAncillaryJobsSharedBound(self):
+    # Three concurrent graph steps, each with three jobs, share nproc=2 slots.
+    f = Focalplane('12345678', 'r', nproc=2)
+    running = os.path.join(self.tmpdir, 'running')
+    os.mkdir(running)
+    counts = os.path.join(self.tmpdir, 'counts')
+    graph = TaskGraph()
+    for step in range(3):
+      jobs = []
+      for i in range(3):
+        name = 'screen_%d_%d' %(step, i)
+        cmd = ('touch %s/%s; ls %s | wc -l >> %s; sleep 0.2; rm %s/%s; '
+               'echo %s > %s.fits' %(running, name, running, counts, running,
+                                     name, name, name))
+        jobs.append((name, self.srcdir, cmd, ['%s.fits' %name], self.destdir))
+      graph.addStep('step%d' %step,
+                    lambda jobs=jobs: f._runAncillaryJobs(jobs, 'screens'),
+                    outputs=['step%d' %step])
+    graph.run(3)
+    with open(counts) as countsFile:
+      peak = max(int(line) for line in countsFile)
+    self.assertTrue(1 <= peak <= 2, peak)
+    self.assertEqual(len(os.listdir(self.destdir)), 9)
+
+  def test_runAncillaryJobFails(self):
+    f = Focalplane('12345678', 'r', nproc=2)
+    jobs = [self._Job('screen_0'), ('bad', self.srcdir, 'exit 3', [], self.destdir)]
+    self.assertRaises(subprocess.CalledProcessError, f._runAncillaryJobs, jobs,
+                      'screens')
+
+
+class TestGenerateTrimCatalog(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cwd = os.getcwd()
+    self.path = os.environ['PATH']
+    os.chdir(self.tmpdir)
+    # The trim command is run as 'time ./trim'; not every sh has 'time'.
+    os.mkdir('bin')
+    self._WriteScript('bin/time', '#!/bin/sh\nexec "$@"\n')
+    os.environ['PATH'] = '%s:%s' %(os.path.abspath('bin'), self.path)
+    os.makedirs('ancillary/trim')
+    # Fake trim that writes no catalog for S11 chips.
+    self._WriteScript('ancillary/trim/trim',
+                      '#!/bin/sh\n'
+                      'while read key n fn; do\n'
+                      '  if [ "$key" = out_file ]; then\n'
+                      '    case "$fn" in *S11*) ;; *) echo "header" > "$fn";; esac\n'
+                      '  fi\n'
+                      'done\n')
+    self.f = Focalplane('12345678', 'r', nproc=2)
+    self.f.cidList = [('R%s_S%d%d' %(raft, x, y), 'CCD', 3.0)
+                      for raft in ('01', '02') for x in range(3) for y in range(3)]
+    self.f.ncat = 1
+    self.f.pra, self.f.pdec, self.f.prot = '0', '0', '0'
+    with open(self.f.catListFile, 'w') as f:
+      f.write('catalog 0 ../../objectcatalog_12345678.pars \n')
+
+  def tearDown(self):
+    os.environ['PATH'] = self.path
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def _WriteScript(self, fn, contents):
+    with open(fn, 'w') as f:
+      f.write(contents)
+    os.chmod(fn, 0755)
+
+  def test_generateTrimCatalogMissingChip(self):
+    self.f.generateTrimCatalog()
+    for cid, devtype, devvalue in self.f.cidList:
+      with open('trimcatalog_12345678_%s.pars' %cid) as f:
+        if cid.endswith('S11'):
+          self.assertEqual(f.read(), 'lsst \n')
+        else:
+          self.assertEqual(f.read(), 'header\nlsst \n')
+
+
+class TestTrimCatalog(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    self.f = Focalplane('12345678','r')
+    self.f.minsource = 1
+    self.trimCatFile = 'trimcatalog_12345678_R22_S11.pars'
+    self.lines = [
+      'object 1 0.1 0.2 20.0 starSED/kurucz/km10_5750.fits_g40_5790 0 0 0\n',
+      'object 2 0.1 0.2 21.0 galaxySED/Exp.40E09.02Z.spec.gz 0 0 0\n',
+      'object 3 0.1 0.2 20.0 starSED/kurucz/km10_5750.fits_g40_5790 0 0 0\n',
+      'object 4 sky\n',
+      'object 5 0.1 0.2 20.0 flatSED/sed_flat.txt 0 0 0\n',
+      'trimmed 4\n',
+      'lsst \n']
+    with open(self.trimCatFile, 'w') as f:
+      f.writelines(self.lines)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def test_scanTrimCatalogMatchesShell(self):
+    cmd = ('cat %s | egrep \'starSED|galaxySED|ssmSED|agnSED|flatSED|sky\' '
+           '| awk \'{print $6 }\' | LC_ALL=C sort | uniq' %self.trimCatFile)
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    expected = p.communicate()[0].splitlines()
+    # Small block size to exercise lines split across reads.
+    nlines, seds = scanTrimCatalog(self.trimCatFile, blockSize=7)
+    self.assertEqual(nlines, len(self.lines))
+    self.assertEqual(seds, expected)
+
+  def test_scanTrimCatalogNoTrailingNewline(self):
+    with open(self.trimCatFile, 'a') as f:
+      f.write('object 6 0 0 0 agnSED/agn.spec')
+    nlines, seds = scanTrimCatalog(self.trimCatFile, blockSize=5)
+    self.assertEqual(nlines, len(self.lines) + 1)
+    self.assertTrue('agnSED/agn.spec' in seds)
+
+  def test_scanTrimCatalogMinLines(self):
+    gzFile = self.trimCatFile + '.gz'
+    nlines, seds = scanTrimCatalog(self.trimCatFile, gzFile, blockSize=7,
+                                   minLines=len(self.lines) + 1)
+    self.assertEqual(nlines, len(self.lines))
+    self.assertFalse(os.path.exists(gzFile))
+    # The threshold is crossed part way through the file.
+    nlines, seds = scanTrimCatalog(self.trimCatFile, gzFile, blockSize=7,
+                                   minLines=3)
+    self.assertEqual(nlines, len(self.lines))
+    self.assertEqual(gzip.open(gzFile).read(), ''.join(self.lines))
+
+  def test_compressTrimCatalog(self):
+    nSources, name = self.f.compressTrimCatalog(self.trimCatFile, 'R22_S11')
+    self.assertEqual(nSources, len(self.lines) - 2)
+    self.assertEqual(name, self.trimCatFile + '.gz')
+    self.assertFalse(os.path.exists(self.trimCatFile))
+    self.assertEqual(gzip.open(name).read(), ''.join(self.lines))
+    with open('sedlist_12345678_R22_S11.txt') as f:
+      self.assertEqual(f.read().splitlines(),
+                       ['', 'flatSED/sed_flat.txt',
+                        'galaxySED/Exp.40E09.02Z.spec.gz',
+                        'starSED/kurucz/km10_5750.fits_g40_5790'])
+
+  def test_compressTrimCatalogTooFewSources(self):
+    self.f.minsource = 100
+    nSources, name = self.f.compressTrimCatalog(self.trimCatFile, 'R22_S11')
+    self.assertEqual(name, self.trimCatFile)
+    self.assertEqual(os.listdir('.'), [self.trimCatFile])
+
+
+class TestFootprintFilter(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    os.mkdir('lsst')
+    FootprintFilter_test.WriteInstrDir('lsst')
+    self.f = Focalplane('99999999', 'r', footprintFilter=True)
+    self.f.trimfileName = FootprintFilter_test.TRIMFILE
+    self.f.pra, self.f.pdec, self.f.prot = '316.005131622', '-5.41989426304', '0'
+    self.f.minsource = 5
+    self.f.camstr = 'Group0'
+    self.f.generateCidList()
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def test_filterCidListByFootprint(self):
+    self.f.filterCidListByFootprint()
+    self.assertEqual([elt[0] for elt in self.f.cidList], ['R22_S11', 'R22_S01'])
+    self.assertEqual(len(self.f.footprintSkipped), 4)
+    self.assertEqual(self.f.generateCidList(), self.f.cidList)
+
+  def test_filterCidListByFootprintNoChipsLeft(self):
+    self.f.minsource = 100
+    self.f.filterCidListByFootprint()
+    self.assertEqual(self.f.cidList, [])
+    self.assertEqual(self.f.generateCidList(), [])
+
+  def test_filterCidListByFootprintMinsourceZero(self):
+    self.f.minsource = 0
+    self.f.filterCidListByFootprint()
+    self.assertEqual(len(self.f.cidList), 6)
+
+
+class TestParsFragments(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    self.f = Focalplane('12345678','r')
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def test_ParsFragmentCache(self):
+    with open('a.pars', 'w') as f:
+      f.write('cloudmean 0 1.0\nrelh2o 2.0')
+    cache = ParsFragmentCache()
+    self.assertEqual(cache.lines('a.pars'), ['cloudmean 0 1.0\n', 'relh2o 2.0\n'])
+    os.remove('a.pars')
+    self.assertEqual(cache.read('a.pars'), 'cloudmean 0 1.0\nrelh2o 2.0')
+    cache.clear()
+    self.assertRaises(IOError, cache.read, 'a.pars')
+
+  def test_generateChipAndRaytraceParams(self):
+    offsetsDir = 'data/focal_plane/sta_misalignments/offsets'
+    os.makedirs(offsetsDir)
+    with open(os.path.join(offsetsDir, 'pars_R22_S11'), 'w') as f:
+      f.write('body 0 0 0.0\n')
+    for name in (self.f.obsParFile, self.f.atmoRaytraceFile,
+                 self.f.opticsParFile, self.f.cloudRaytraceFile, 'time.pars',
+                 'extra'):
+      with open(name, 'w') as f:
+        f.write('%s \n' %name)
+    self.f.generateChipParams('R22_S11', 'chip.pars')
+    self.f.generateRaytraceParams('R22_S11_E000', 'chip.pars', 7, 'time.pars',
+                                  'raytrace.pars', 'extra')
+    chip = ('body 0 0 0.0\n'
+            'chipid R22_S11 \n'
+            'chipheightfile ../data/focal_plane/sta_misalignments/height_maps/R22_S11.fits.gz \n'
+            'outputfilename imsim_12345678_R22_S11_E000 \n'
+            'seed 7 \n'
+            'trackingfile ../tracking_12345678.pars \n'
+            'extra \n')
+    self.assertEqual(open('chip.pars').read(), chip)
+    self.assertEqual(open('raytrace.pars').read(),
+                     'obs_12345678.pars \n'
+                     'atmosphereraytrace_12345678.pars \n'
+                     'optics_12345678.pars \n'
+                     'time.pars \n'
+                     'cloudraytrace_12345678.pars \n' + chip)
+
+  def test_splitTrimfile(self):
+    with open('trim.dat', 'w') as f:
+      f.write('Opsim_filter 2\n'
+              'object 1 0.1 0.2 20.0 starSED/foo 0\n'
+              'includeobj pops/a.gz\n'
+              'object 2 0.1 0.2 20.0 starSED/bar 0')
+    self.f.trimfileName = 'trim.dat'
+    self.assertEqual(self.f._splitTrimfile(), 2)
+    self.assertEqual(open(self.f.obsCatFile).read(),
+                     'object 1 0.1 0.2 20.0 starSED/foo 0\n'
+                     'object 2 0.1 0.2 20.0 starSED/bar 0\n')
+    self.assertEqual(open(self.f.catListFile).read(),
+                     'catalog 0 ../../objectcatalog_12345678.pars \n'
+                     'catalog 1 ../../pops/a.gz\n')
+
+  def test_splitTrimfileNoObjects(self):
+    with open('trim.dat', 'w') as f:
+      f.write('Opsim_filter 2\nincludeobj pops/a.gz\nincludeobj pops/b.gz\n')
+    self.f.trimfileName = 'trim.dat'
+    self.assertEqual(self.f._splitTrimfile(), 2)
+    self.assertEqual(open(self.f.obsCatFile).read(),
+                     'objecttest_12345678.pars:object \n')
+    self.assertEqual(open(self.f.catListFile).read(),
+                     'catalog 0 ../../pops/a.gz\n'
+                     'catalog 1 ../../pops/b.gz\n')
+
+
+class TestTaskGraph(unittest.TestCase):
+
+  def _Graph(self, log):
+    def Step(name, value=None):
+      def Func():
+        log.append(name)
+        # Nonzero durations, so that the critical path has no ties.
+        time.sleep(0.01)
+        return value
+      return Func
+    g = TaskGraph()
+    g.addStep('obscat', Step('obscat'), inputs=['trim'], outputs=['catlist'])
+    g.addStep('atmo', Step('atmo'), outputs=['atmoraytrace'])
+    g.addStep('screens', Step('screens', 0.62), inputs=['atmoraytrace'],
+              outputs=['screen0'])
+    g.addStep('clouds', Step('clouds'), inputs=['atmoraytrace'],
+              outputs=['cloudraytrace'])
+    g.addStep('append', Step('append'), inputs=['screen0'],
+              outputs=['atmoraytrace'])
+    g.addStep('trimcat', Step('trimcat'), inputs=['catlist'],
+              outputs=['trimcatalog'])
+    return g
+
+  def test_Dependencies(self):
+    g = self._Graph([])
+    self.assertEqual(g.deps['obscat'], set())
+    self.assertEqual(g.deps['screens'], set(['atmo']))
+    self.assertEqual(g.deps['clouds'], set(['atmo']))
+    # RAW on screens, WAW on atmo, WAR on screens and clouds.
+    self.assertEqual(g.deps['append'], set(['atmo', 'screens', 'clouds']))
+    self.assertEqual(g.deps['trimcat'], set(['obscat']))
+
+  def test_RunSerial(self):
+    log = []
+    g = self._Graph(log)
+    results = g.run(1)
+    self.assertEqual(log, ['obscat', 'atmo', 'screens', 'clouds', 'append',
+                           'trimcat'])
+    self.assertEqual(results['screens'], 0.62)
+
+  def test_RunParallel(self):
+    log = []
+    g = self._Graph(log)
+    results = g.run(4)
+    self.assertEqual(sorted(log), sorted(g.deps.keys()))
+    for name, deps in g.deps.iteritems():
+      for dep in deps:
+        self.assertTrue(log.index(dep) < log.index(name))
+    self.assertEqual(results['screens'], 0.62)
+    path, total = g.criticalPath()
+    self.assertEqual(path[-1] in ('append', 'trimcat'), True)
+    self.assertTrue(total >= 0.0)
+
+  def test_RunRaises(self):
+    def Fail():
+      raise ValueError('boom')
+    g = TaskGraph()
+    g.addStep('a', Fail, outputs=['x'])
+    g.addStep('b', lambda: None, inputs=['x'])
+    self.assertRaises(ValueError, g.run, 2)
+    self.assertFalse('b' in g.results)
+
+
 if __name__ == '__main__':
     unittest.main()
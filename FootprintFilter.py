@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""Focal-plane footprint pre-filter for trim.
+
+trim scans every catalog of an observation once per raft, and only
+afterwards are chips with fewer than 'minsource' sources skipped.  For
+sparse fields most of that work produces chips that are thrown away.
+
+This module reads the RA/Dec of every source in an instance catalog (and
+in the catalogs named by its 'includeobj' lines), projects them onto the
+focal plane with the pointing and rotation of the observation, and
+counts the sources that fall on each chip of focalplanelayout.txt, grown
+by a buffer margin.  Chips whose count is below 'minsource' cannot
+produce an image and can be left out of the trim stage.
+
+The sources are projected about point_ra and point_dec, rotated by
+rot_ang (the same values Focalplane.generateTrimCatalog writes to the
+trim pars) and compared with the chip centers of focalplanelayout.txt,
+in microns (see Project()).  The projection is a plain gnomonic
+(tangent-plane) projection without optical distortion, so the counts are
+an upper bound on what trim will find only to within the buffer; the
+default margin is meant to absorb the distortion.
+
+UNVERIFIED: the axis orientation and rotation sense of Project() are
+assumed, not taken from trim.  If either differs from trim, sources near
+the edge of the field move by tens of mm and chips that trim would fill
+are dropped.  FootprintFilter_test.TrimAgreementTest runs trim on
+testdata/obsid99999999 and checks that every chip trim gives minsource
+sources is kept; it needs a phosim build in IMSIM_SOURCE_PATH.  Run it
+before turning on 'footprint_filter'.
+
+numpy is used if it is installed; otherwise the sources are projected
+and counted in plain Python, which is slower but gives the same counts.
+"""
+
+from __future__ import with_statement
+import bisect
+import logging
+import math
+import optparse
+import os
+import sys
+try:
+  import numpy
+except ImportError:
+  numpy = None
+import FocalplaneGeometry
+import InstanceCatalog
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+# Focal plane microns per degree on the sky (LSST: 10 micron pixels at
+# 0.2 arcsec).
+PLATESCALE = 180000.0
+# trim is run with 'buffer 100' (pixels).
+TRIM_BUFFER_PIXELS = 100
+# Additional margin (microns) for distortion and chip rotation.
+MARGIN_UM = 1000.0
+
+# Header keys of the pointing; phosim 3.x catalogs append '_deg'.
+POINTING_KEYS = ('Unrefracted_RA', 'Unrefracted_Dec', 'Opsim_rotskypos')
+
+
+def Pointing(header):
+  """Returns (ra, dec, rotation) in degrees from an instance catalog header."""
+  values = []
+  for key in POINTING_KEYS:
+    value = header.get(key, header.get(key + '_deg'))
+    if value is None:
+      raise ValueError('Instance catalog header has no %s.' % key)
+    values.append(float(value))
+  return tuple(values)
+
+
+def _ResolveInclude(name, catalog, catalog_dir):
+  """Returns the path of includeobj catalog name.
+
+  trim reads includeobj catalogs relative to the preprocessing working
+  directory, which is where the instance catalog is normally found as
+  well, so catalog_dir (default: cwd) is tried before the directory of
+  the instance catalog.
+  """
+  candidates = [os.path.join(catalog_dir or os.getcwd(), name),
+                os.path.join(os.path.dirname(catalog), name)]
+  for fn in candidates:
+    if os.path.isfile(fn):
+      return fn
+  raise IOError('Could not find includeobj catalog %s.' % name)
+
+
+def _ReadObjects(fn, ra, dec, includes=None):
+  """Appends the RA/Dec of the 'object' lines of fn to ra and dec.
+
+  The names on 'includeobj' lines are appended to includes, if given.
+  """
+  f = InstanceCatalog.OpenCatalog(fn)
+  try:
+    for line in f:
+      if line.startswith('object'):
+        fields = line.split(None, 4)
+        ra.append(float(fields[2]))
+        dec.append(float(fields[3]))
+      elif includes is not None and line.startswith('includeobj'):
+        fields = line.split()
+        if len(fields) > 1:
+          includes.append(fields[1])
+  finally:
+    f.close()
+
+
+def ReadSources(catalog, catalog_dir=None):
+  """Returns the RA and Dec (degrees) of every source of an observation.
+
+  Args:
+    catalog:      Instance catalog (trimfile), optionally gzipped.
+    catalog_dir:  Directory against which 'includeobj' names are resolved
+                  first (default: cwd).
+
+  Returns:
+    (ra, dec) numpy arrays, or lists without numpy.
+  """
+  ra = []
+  dec = []
+  includes = []
+  _ReadObjects(catalog, ra, dec, includes)
+  for name in includes:
+    _ReadObjects(_ResolveInclude(name, catalog, catalog_dir), ra, dec)
+  if numpy is None:
+    return ra, dec
+  return numpy.array(ra, dtype=float), numpy.array(dec, dtype=float)
+
+
+def Project(ra, dec, pointing_ra, pointing_dec, rotation=0.0,
+            platescale=PLATESCALE):
+  """Projects RA/Dec onto the focal plane (see UNVERIFIED above).
+
+  Gnomonic projection about the pointing, with x toward increasing RA
+  (east) and y toward increasing Dec (north) at zero rotation, then
+  rotated counterclockwise by rotation:
+    x = xi cos(rotation) - eta sin(rotation)
+    y = xi sin(rotation) + eta cos(rotation)
+  x and y are in the frame of the chip centers of focalplanelayout.txt,
+  so with rotation 0 a source 0.25 degrees north of the pointing lands
+  at about (0, 45000) microns and one east of it at positive x.
+
+  Args:
+    ra, dec:      Source positions (degrees), numpy arrays or lists.
+    pointing_ra, pointing_dec, rotation:  Pointing (degrees), i.e. trim's
+                  point_ra, point_dec and rot_ang.
+    platescale:   Focal plane microns per degree.
+
+  Returns:
+    (x, y) numpy arrays (lists without numpy) in microns.  Sources 90
+    degrees or more from the pointing are NaN.
+  """
+  if numpy is None:
+    return _ProjectLists(ra, dec, pointing_ra, pointing_dec, rotation,
+                         platescale)
+  ra = numpy.radians(ra)
+  dec = numpy.radians(dec)
+  ra0 = math.radians(pointing_ra)
+  dec0 = math.radians(pointing_dec)
+  cos_dec = numpy.cos(dec)
+  cos_dra = numpy.cos(ra - ra0)
+  cos_c = math.sin(dec0) * numpy.sin(dec) + math.cos(dec0) * cos_dec * cos_dra
+  cos_c = numpy.where(cos_c > 0.0, cos_c, numpy.nan)
+  scale = platescale * 180.0 / math.pi
+  xi = scale * cos_dec * numpy.sin(ra - ra0) / cos_c
+  eta = scale * (math.cos(dec0) * numpy.sin(dec) -
+                 math.sin(dec0) * cos_dec * cos_dra) / cos_c
+  rot = math.radians(rotation)
+  x = xi * math.cos(rot) - eta * math.sin(rot)
+  y = xi * math.sin(rot) + eta * math.cos(rot)
+  return x, y
+
+
+def _ProjectLists(ra, dec, pointing_ra, pointing_dec, rotation, platescale):
+  """Project() in plain Python."""
+  ra0 = math.radians(pointing_ra)
+  sin_dec0 = math.sin(math.radians(pointing_dec))
+  cos_dec0 = math.cos(math.radians(pointing_dec))
+  cos_rot = math.cos(math.radians(rotation))
+  sin_rot = math.sin(math.radians(rotation))
+  scale = platescale * 180.0 / math.pi
+  nan = float('nan')
+  x = []
+  y = []
+  for ra_deg, dec_deg in zip(ra, dec):
+    dra = math.radians(ra_deg) - ra0
+    dec_rad = math.radians(dec_deg)
+    cos_dec = math.cos(dec_rad)
+    cos_c = sin_dec0 * math.sin(dec_rad) + cos_dec0 * cos_dec * math.cos(dra)
+    if cos_c <= 0.0:
+      x.append(nan)
+      y.append(nan)
+      continue
+    xi = scale * cos_dec * math.sin(dra) / cos_c
+    eta = scale * (cos_dec0 * math.sin(dec_rad) -
+                   sin_dec0 * cos_dec * math.cos(dra)) / cos_c
+    x.append(xi * cos_rot - eta * sin_rot)
+    y.append(xi * sin_rot + eta * cos_rot)
+  return x, y
+
+
+def CountPerChip(x, y, chips, buffer_pixels=TRIM_BUFFER_PIXELS,
+                 margin_um=MARGIN_UM):
+  """Counts the sources on each chip.
+
+  Args:
+    x, y:           Focal plane positions from Project().
+    chips:          FocalplaneGeometry.ChipRecords.
+    buffer_pixels:  Grow each chip by this many of its pixels...
+    margin_um:      ...plus this many microns.
+
+  Returns:
+    Dict cid -> number of sources.
+  """
+  if numpy is None:
+    return _CountPerChipLists(x, y, chips, buffer_pixels, margin_um)
+  order = numpy.argsort(x)
+  xs = x[order]
+  ys = y[order]
+  counts = {}
+  for chip in chips:
+    xmin, xmax, ymin, ymax = chip.Bounds(buffer_pixels * chip.pixsize + margin_um)
+    lo = numpy.searchsorted(xs, xmin, side='left')
+    hi = numpy.searchsorted(xs, xmax, side='right')
+    band = ys[lo:hi]
+    counts[chip.cid] = int(numpy.count_nonzero((band >= ymin) & (band <= ymax)))
+  return counts
+
+
+def _CountPerChipLists(x, y, chips, buffer_pixels, margin_um):
+  """CountPerChip() in plain Python."""
+  # NaN (unprojected) sources would break the sort order.
+  points = sorted([(xi, yi) for xi, yi in zip(x, y) if xi == xi])
+  xs = [xi for xi, yi in points]
+  counts = {}
+  for chip in chips:
+    xmin, xmax, ymin, ymax = chip.Bounds(buffer_pixels * chip.pixsize + margin_um)
+    lo = bisect.bisect_left(xs, xmin)
+    hi = bisect.bisect_right(xs, xmax)
+    counts[chip.cid] = len([yi for xi, yi in points[lo:hi] if ymin <= yi <= ymax])
+  return counts
+
+
+def CandidateChips(catalog, geometry, cids, minsource, pointing,
+                   catalog_dir=None, platescale=PLATESCALE,
+                   buffer_pixels=TRIM_BUFFER_PIXELS, margin_um=MARGIN_UM):
+  """Returns the chips that may have at least minsource sources.
+
+  Args:
+    catalog:      Instance catalog (trimfile).
+    geometry:     FocalplaneGeometry of the instrument.
+    cids:         Chip ids to consider.
+    minsource:    Minimum number of sources of a chip.  If <= 0, every
+                  chip is returned.
+    pointing:     (ra, dec, rotation) in degrees, e.g. from Pointing().
+    catalog_dir, platescale, buffer_pixels, margin_um:  As above.
+
+  Returns:
+    The members of cids, in order, that may reach minsource.
+  """
+  if minsource <= 0:
+    return list(cids)
+  ra, dec = ReadSources(catalog, catalog_dir=catalog_dir)
+  x, y = Project(ra, dec, pointing[0], pointing[1], pointing[2],
+                 platescale=platescale)
+  counts = CountPerChip(x, y, [geometry.Chip(cid) for cid in cids],
+                        buffer_pixels=buffer_pixels, margin_um=margin_um)
+  candidates = [cid for cid in cids if counts[cid] >= minsource]
+  logger.info('Footprint filter: %d of %d sources, %d of %d chips can reach '
+              'minsource=%d.', sum(counts.values()), len(ra), len(candidates),
+              len(cids), minsource)
+  return candidates
+
+
+if __name__ == '__main__':
+  usage = 'usage: %prog [options] instance_catalog instr_dir [camstr]'
+  parser = optparse.OptionParser(usage=usage)
+  parser.add_option('-m', '--minsource', type='int', default=None,
+                    help='Minimum sources per chip (default: SIM_MINSOURCE'
+                    ' from the catalog header, else 1).')
+  parser.add_option('-d', '--catalog_dir', default=None,
+                    help='Directory of the includeobj catalogs (default: cwd).')
+  parser.add_option('-p', '--platescale', type='float', default=PLATESCALE,
+                    help='Focal plane microns per degree (default: %default).')
+  parser.add_option('-b', '--buffer_pixels', type='int',
+                    default=TRIM_BUFFER_PIXELS,
+                    help='Chip buffer in pixels (default: %default).')
+  parser.add_option('--margin_um', type='float', default=MARGIN_UM,
+                    help='Extra chip margin in microns (default: %default).')
+  options, args = parser.parse_args()
+  if len(args) not in (2, 3):
+    print 'Incorrect number of arguments.'
+    parser.print_help()
+    quit()
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s:%(name)s:  %(message)s')
+  header = InstanceCatalog.ReadHeader(args[0])
+  minsource = options.minsource
+  if minsource is None:
+    minsource = int(header.get('SIM_MINSOURCE', 1))
+  geometry = FocalplaneGeometry.GetGeometry(args[1])
+  if len(args) == 3:
+    cids = [cid for cid, devtype, devvalue in geometry.CidList(args[2])]
+  else:
+    cids = [chip.cid for chip in geometry.chips]
+  ra, dec = ReadSources(args[0], catalog_dir=options.catalog_dir)
+  pointing = Pointing(header)
+  x, y = Project(ra, dec, pointing[0], pointing[1], pointing[2],
+                 platescale=options.platescale)
+  counts = CountPerChip(x, y, [geometry.Chip(cid) for cid in cids],
+                        buffer_pixels=options.buffer_pixels,
+                        margin_um=options.margin_um)
+  for cid in cids:
+    print '%s %d%s' % (cid, counts[cid], counts[cid] < minsource and ' skip' or '')
+  sys.exit(0)
@@ -0,0 +1,204 @@
+#!/usr/bin/python2.6
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import FocalplaneGeometry
+import FootprintFilter
+import InstanceCatalog
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'testdata', 'obsid99999999')
+TRIMFILE = os.path.join(TESTDATA_DIR, 'metadata_99999999.dat')
+
+# A few chips of the central raft and one far corner chip.
+LAYOUT = """R22_S11 0.0 0.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R22_S12 0.0 42000.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R22_S21 42000.0 0.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R22_S10 0.0 -42000.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R22_S01 -42000.0 0.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+R40_S11 -254000.0 254000.0 10.0 4000 4072 CCD 3.0 Group0 0 0 0
+"""
+
+
+def WriteInstrDir(instr_dir):
+  with open(os.path.join(instr_dir, 'focalplanelayout.txt'), 'w') as f:
+    f.write(LAYOUT)
+  with open(os.path.join(instr_dir, 'segmentation.txt'), 'w') as f:
+    f.write('')
+
+
+class FootprintFilterTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    WriteInstrDir(self.tmpdir)
+    self.geometry = FocalplaneGeometry.FocalplaneGeometry(self.tmpdir,
+                                                          use_cache=False)
+    self.pointing = FootprintFilter.Pointing(InstanceCatalog.ReadHeader(TRIMFILE))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testProject(self):
+    x, y = FootprintFilter.Project([10.0, 10.0, 10.2], [-5.0, -4.9, -5.0],
+                                   10.0, -5.0)
+    self.assertAlmostEqual(x[0], 0.0)
+    self.assertAlmostEqual(y[0], 0.0)
+    self.assertAlmostEqual(x[1], 0.0)
+    self.assertAlmostEqual(y[1], 18000.0, -1)
+    self.assertTrue(x[2] > 0.0)
+    x, y = FootprintFilter.Project([10.0, 190.0], [-4.9, -5.0], 10.0, -5.0,
+                                   rotation=90.0)
+    self.assertAlmostEqual(x[0], -18000.0, -1)
+    self.assertAlmostEqual(y[0], 0.0, 6)
+    # The far side of the sky does not project.
+    self.assertTrue(x[1] != x[1])
+
+  def testProjectOntoChips(self):
+    # Sources 0.233 degrees (42000 microns) north and east of the pointing.
+    ra0, dec0 = 316.0, -5.4
+    offset = 42000.0 / FootprintFilter.PLATESCALE
+    north = (ra0, dec0 + offset)
+    east = (ra0 + offset / math.cos(math.radians(dec0)), dec0)
+    for (ra, dec), rotation, cid in [(north, 0.0, 'R22_S12'),
+                                     (east, 0.0, 'R22_S21'),
+                                     (north, 90.0, 'R22_S01'),
+                                     (east, 90.0, 'R22_S12'),
+                                     (north, 180.0, 'R22_S10'),
+                                     (east, -90.0, 'R22_S10')]:
+      x, y = FootprintFilter.Project([ra], [dec], ra0, dec0, rotation)
+      counts = FootprintFilter.CountPerChip(x, y, self.geometry.chips,
+                                            buffer_pixels=0, margin_um=0.0)
+      self.assertEqual([c for c in counts if counts[c]], [cid],
+                       (ra, dec, rotation, counts))
+
+  def testReadSources(self):
+    ra, dec = FootprintFilter.ReadSources(TRIMFILE)
+    # All sources are in the two includeobj catalogs.
+    self.assertEqual(len(ra), 40)
+    self.assertEqual(self.pointing, (316.005131622, -5.41989426304, 0.0))
+    trimfile = os.path.join(self.tmpdir, 'trim.dat')
+    with open(trimfile, 'w') as f:
+      f.write('object 1 10.0 -5.0 20.0 starSED/foo 0\n'
+              'includeobj pops/missing.gz\n')
+    self.assertRaises(IOError, FootprintFilter.ReadSources, trimfile)
+
+  def testCandidateChips(self):
+    cids = [chip.cid for chip in self.geometry.chips]
+    ra, dec = FootprintFilter.ReadSources(TRIMFILE)
+    x, y = FootprintFilter.Project(ra, dec, *self.pointing)
+    self.assertEqual(FootprintFilter.CountPerChip(x, y, self.geometry.chips),
+                     {'R22_S11': 7, 'R22_S12': 4, 'R22_S21': 3, 'R22_S10': 4,
+                      'R22_S01': 11, 'R40_S11': 0})
+    self.assertEqual(FootprintFilter.CandidateChips(TRIMFILE, self.geometry, cids,
+                                                    5, self.pointing),
+                     ['R22_S11', 'R22_S01'])
+    self.assertEqual(FootprintFilter.CandidateChips(TRIMFILE, self.geometry, cids,
+                                                    1, self.pointing), cids[:5])
+    # minsource 0 means every chip gets a (background) image.
+    self.assertEqual(FootprintFilter.CandidateChips(TRIMFILE, self.geometry, cids,
+                                                    0, self.pointing), cids)
+
+
+class PurePythonFootprintFilterTest(FootprintFilterTest):
+  """The same tests without numpy."""
+  def setUp(self):
+    self.numpy = FootprintFilter.numpy
+    FootprintFilter.numpy = None
+    FootprintFilterTest.setUp(self)
+
+  def tearDown(self):
+    FootprintFilter.numpy = self.numpy
+    FootprintFilterTest.tearDown(self)
+
+
+class TrimAgreementTest(unittest.TestCase):
+  """Checks the footprint filter against trim itself.
+
+  Needs a phosim build (ancillary/trim/trim and lsst/focalplanelayout.txt)
+  in IMSIM_SOURCE_PATH, and does nothing without one.
+  """
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.phosim_dir = os.getenv('IMSIM_SOURCE_PATH') or ''
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _RunTrim(self, cids, pointing):
+    """Runs trim on TRIMFILE for cids, one pass per raft as Focalplane does.
+
+    Returns:
+      Dict cid -> number of sources trim put on the chip.
+    """
+    work_dir = os.path.join(self.tmpdir, '%s_%s_%s' % pointing)
+    trim_dir = os.path.join(work_dir, 'ancillary', 'trim')
+    os.makedirs(trim_dir)
+    src_dir = os.path.join(self.phosim_dir, 'ancillary', 'trim')
+    for entry in os.listdir(src_dir):
+      os.symlink(os.path.join(src_dir, entry), os.path.join(trim_dir, entry))
+    for entry in ('lsst', 'data'):
+      if os.path.exists(os.path.join(self.phosim_dir, entry)):
+        os.symlink(os.path.join(self.phosim_dir, entry),
+                   os.path.join(work_dir, entry))
+    os.symlink(os.path.join(TESTDATA_DIR, 'pops'), os.path.join(work_dir, 'pops'))
+    catalogs = [line.split()[1] for line in open(TRIMFILE)
+                if line.startswith('includeobj')]
+    rafts = []
+    for cid in cids:
+      if not rafts or rafts[-1][0] != cid.split('_')[0]:
+        rafts.append((cid.split('_')[0], []))
+      rafts[-1][1].append(cid)
+    for raft, raft_cids in rafts:
+      par_fn = os.path.join(work_dir, 'trim_%s.pars' % raft)
+      with open(par_fn, 'w') as f:
+        f.write('ncatalog %d \n' % len(catalogs))
+        for i, catalog in enumerate(catalogs):
+          f.write('catalog %d ../../%s\n' % (i, catalog))
+        for i, cid in enumerate(raft_cids):
+          f.write('out_file %d trimcatalog_%s.pars \n' % (i, cid))
+          f.write('chip_id %d %s \n' % (i, cid))
+        f.write('ntrim %d \n' % len(raft_cids))
+        f.write('point_ra %s \npoint_dec %s \nrot_ang %s \n' % pointing)
+        f.write('buffer 100 \nstraylight 0 \ntrim \n')
+      subprocess.check_call('./trim < ../../trim_%s.pars' % raft, shell=True,
+                            cwd=trim_dir, stdout=open(os.devnull, 'w'))
+    counts = {}
+    for cid in cids:
+      # trim writes one line before the sources (see compressTrimCatalog).
+      counts[cid] = len(open(os.path.join(
+        trim_dir, 'trimcatalog_%s.pars' % cid)).readlines()) - 1
+    return counts
+
+  def testKeepsEveryChipTrimFills(self):
+    instr_dir = os.path.join(self.phosim_dir, 'lsst')
+    if not (os.path.isfile(os.path.join(self.phosim_dir, 'ancillary', 'trim', 'trim'))
+            and os.path.isfile(os.path.join(instr_dir, 'focalplanelayout.txt'))):
+      sys.stderr.write('TrimAgreementTest: no phosim build in IMSIM_SOURCE_PATH,'
+                       ' not checked. ')
+      return
+    geometry = FocalplaneGeometry.FocalplaneGeometry(instr_dir, use_cache=False)
+    cids = [cid for cid, devtype, devvalue in geometry.CidList('Group0')]
+    header = InstanceCatalog.ReadHeader(TRIMFILE)
+    minsource = int(header.get('SIM_MINSOURCE', 1))
+    ra, dec, rotation = FootprintFilter.Pointing(header)
+    # Nonzero rotations check the rotation sense as well.
+    for rot in (rotation, rotation + 30.0, rotation + 90.0):
+      counts = self._RunTrim(cids, (ra, dec, rot))
+      filled = [cid for cid in cids if counts[cid] >= minsource]
+      self.assertTrue(filled)
+      kept = FootprintFilter.CandidateChips(TRIMFILE, geometry, cids, minsource,
+                                            (ra, dec, rot),
+                                            catalog_dir=TESTDATA_DIR)
+      self.assertEqual([cid for cid in filled if cid not in kept], [],
+                       'rot_ang %s' % rot)
+
+
+if __name__ == '__main__':
+  unittest.main()
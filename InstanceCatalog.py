@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+"""Streaming parser for instance catalog (trimfile) headers.
+
+An instance catalog starts with a header of 'key value' lines and is
+followed by 'object' and 'includeobj' lines, of which there may be
+millions.  ReadHeader() stops at the first of those, so the cost of
+reading the header does not depend on the size of the catalog.
+
+Optionally, the header can be cached in a small sidecar file next to the
+catalog (<catalog>.header).  The sidecar records the size and mtime of
+the catalog and is ignored if either has changed.
+"""
+
+from __future__ import with_statement
+import gzip
+import logging
+import os
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+# First tokens that mark the end of the header.
+BODY_KEYS = ('object', 'includeobj')
+
+# Types of header values.  Keys that are not listed are returned as strings.
+HEADER_TYPES = {
+  'SIM_CAMCONFIG': int,
+  'SIM_VISTIME': float,
+  'SIM_NSNAP': int,
+  'isDithered': int,
+  'ditherRaOffset': float,
+  'ditherDecOffset': float,
+  }
+
+CACHE_SUFFIX = '.header'
+_CACHE_TAG = '#header_cache'
+
+# In-process copy of headers read with cache=True:
+#   abspath -> (stamp, raw header dict)
+_header_memo = {}
+
+
+def OpenCatalog(catalog):
+  """Opens an instance catalog for reading, decompressing if it ends in .gz."""
+  if catalog.endswith('.gz'):
+    return gzip.open(catalog, 'rb')
+  return open(catalog, 'r')
+
+
+def ParseHeader(lines):
+  """Parses 'key value' lines up to the first object/includeobj line.
+
+  Args:
+    lines:  Iterable of lines (e.g. an open file).
+
+  Returns:
+    Dictionary of key -> value string.  If a key appears more than once,
+    the last value wins.  Blank lines and keys without a value are skipped.
+  """
+  header = {}
+  for line in lines:
+    fields = line.split(None, 1)
+    if not fields:
+      continue
+    if fields[0] in BODY_KEYS:
+      break
+    if len(fields) < 2 or not fields[1].strip():
+      continue
+    header[fields[0]] = fields[1].strip()
+  return header
+
+
+def TypeHeader(header, types=HEADER_TYPES):
+  """Returns a copy of header with values converted according to types."""
+  typed = dict(header)
+  for key, value_type in types.iteritems():
+    if key in typed:
+      typed[key] = value_type(typed[key])
+  return typed
+
+
+def ReadHeader(catalog, types=HEADER_TYPES, cache=False):
+  """Reads the header of an instance catalog.
+
+  Args:
+    catalog:  Name of the instance catalog (may be gzipped).
+    types:    Dictionary of key -> type for values that are not strings.
+    cache:    Use (and create) the <catalog>.header sidecar file and keep
+              the header in memory for later calls in this process.
+
+  Returns:
+    Dictionary of key -> typed value.
+  """
+  header = None
+  if cache:
+    path = os.path.abspath(catalog)
+    st = os.stat(path)
+    stamp = '%s %d %r' % (_CACHE_TAG, st.st_size, st.st_mtime)
+    memo = _header_memo.get(path)
+    if memo and memo[0] == stamp:
+      header = memo[1]
+    else:
+      header = _ReadCache(path + CACHE_SUFFIX, stamp)
+  if header is None:
+    f = OpenCatalog(catalog)
+    try:
+      header = ParseHeader(f)
+    finally:
+      f.close()
+    if cache:
+      _WriteCache(path + CACHE_SUFFIX, stamp, header)
+  if cache:
+    _header_memo[path] = (stamp, header)
+  return TypeHeader(header, types)
+
+
+def _ReadCache(cache_fn, stamp):
+  """Returns the cached header in cache_fn if its stamp matches, else None."""
+  try:
+    with open(cache_fn, 'r') as f:
+      if f.readline().rstrip('\n') != stamp:
+        return None
+      return ParseHeader(f)
+  except IOError:
+    return None
+
+
+def _WriteCache(cache_fn, stamp, header):
+  """Writes header to cache_fn.  Failure (e.g. read-only dir) is not an error."""
+  tmp_fn = '%s.%d.tmp' % (cache_fn, os.getpid())
+  try:
+    with open(tmp_fn, 'w') as f:
+      f.write('%s\n' % stamp)
+      for key in sorted(header):
+        f.write('%s %s\n' % (key, header[key]))
+    os.rename(tmp_fn, cache_fn)
+  except (IOError, OSError), e:
+    logger.debug('Could not write header cache %s: %s', cache_fn, e)
+    try:
+      os.remove(tmp_fn)
+    except OSError:
+      pass
@@ -0,0 +1,74 @@
+#!/usr/bin/python2.6
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import InstanceCatalog
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+
+class InstanceCatalogTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.catalog = os.path.join(self.tmpdir, 'metadata_99999999.dat')
+    self.header_lines = ['Unrefracted_RA 316.005131622 \n',
+                         'Slalib_date 1996/10/25/0.091916 \n',
+                         'Opsim_filter 2\n',
+                         '\n',
+                         'Opsim_obshistid 99999999\n',
+                         'SIM_CAMCONFIG 1\n',
+                         'SIM_VISTIME 15.0\n']
+    self.body_lines = ['object 1 0.1 0.2 20.0 starSED/foo 0 0 0\n',
+                       'includeobj pops/trim_99999999_AGN.dat.gz\n',
+                       'Opsim_filter 5\n']
+    with open(self.catalog, 'w') as f:
+      f.writelines(self.header_lines + self.body_lines)
+    InstanceCatalog._header_memo.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _CheckHeader(self, header):
+    self.assertEqual(header['Opsim_filter'], '2')
+    self.assertEqual(header['Opsim_obshistid'], '99999999')
+    self.assertEqual(header['Unrefracted_RA'], '316.005131622')
+    self.assertEqual(header['Slalib_date'], '1996/10/25/0.091916')
+    self.assertEqual(header['SIM_CAMCONFIG'], 1)
+    self.assertEqual(header['SIM_VISTIME'], 15.0)
+    self.assertEqual(len(header), 6)
+
+  def testReadHeaderStopsAtBody(self):
+    self._CheckHeader(InstanceCatalog.ReadHeader(self.catalog))
+    self.assertFalse(os.path.exists(self.catalog + InstanceCatalog.CACHE_SUFFIX))
+
+  def testReadHeaderGzip(self):
+    gz_fn = self.catalog + '.gz'
+    f = gzip.open(gz_fn, 'wb')
+    f.writelines(self.header_lines + self.body_lines)
+    f.close()
+    self._CheckHeader(InstanceCatalog.ReadHeader(gz_fn))
+
+  def testReadHeaderCache(self):
+    self._CheckHeader(InstanceCatalog.ReadHeader(self.catalog, cache=True))
+    cache_fn = self.catalog + InstanceCatalog.CACHE_SUFFIX
+    self.assertTrue(os.path.isfile(cache_fn))
+    # The sidecar is used if the catalog is unchanged.
+    InstanceCatalog._header_memo.clear()
+    with open(cache_fn, 'a') as f:
+      f.write('Opsim_moonra 180\n')
+    header = InstanceCatalog.ReadHeader(self.catalog, cache=True)
+    self.assertEqual(header['Opsim_moonra'], '180')
+    # ...and ignored once the catalog changes size.
+    InstanceCatalog._header_memo.clear()
+    with open(self.catalog, 'a') as f:
+      f.write('object 2 0.1 0.2 20.0 starSED/foo 0 0 0\n')
+    header = InstanceCatalog.ReadHeader(self.catalog, cache=True)
+    self.assertFalse('Opsim_moonra' in header)
+    self._CheckHeader(header)
+
+
+if __name__ == '__main__':
+  unittest.main()
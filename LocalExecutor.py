@@ -0,0 +1,421 @@
+#!/usr/bin/python
+
+"""Runs raytrace exec scripts on the local machine.
+
+With 'scheduler2: csh', fullFocalplane.py writes one exec_raytrace_*.csh
+per fid to 'stage_path'/<observation_id>, along with
+execmanifest_raytrace_<observation_id>.txt listing them.  LocalExecutor
+runs these scripts as a pool of child processes:
+  - At most 'slots' scripts run at a time (default: one per core).
+  - Each script reserves 'mem_per_job_gb' of memory, and a script is only
+    started if its reservation fits into 'mem_total_gb' (default: the
+    memory of the machine), so that filling the cores does not
+    oversubscribe memory.
+  - Optionally, each script is pinned to its own CPU with taskset.
+  - Scripts that exit with non-zero status are rerun up to 'retries' times.
+  - The wall time, CPU time, max RSS and exit status of every attempt are
+    appended to a stats file, and the final exit status of every fid can
+    be written to an exit status file.
+
+PbsNodeRaytraceScriptWriter (ScriptWriter.py) uses LocalExecutor to run a
+bundle of fids inside a single PBS node allocation.
+
+Usage:
+  LocalExecutor.py [options] <execmanifest_raytrace_*.txt or manifest.txt>
+Run 'LocalExecutor.py -h' for options.  Defaults for the options can be
+set in the [general] section of the config file (see
+exampleConfig_workstation.cfg).
+"""
+
+from __future__ import with_statement
+import ConfigParser
+import csv
+import errno
+import logging
+from optparse import OptionParser
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import CostModel
+import PhosimUtil
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+STATS_FIELDS = ('fid', 'attempt', 'exit_status', 'wall_s', 'user_s', 'sys_s',
+                'maxrss_kb', 'script')
+
+
+class Job(object):
+  """One exec script to run."""
+  def __init__(self, script, fid=None, mem_gb=None):
+    """Constructor.
+
+    Args:
+      script:  Full path of the script.
+      fid:     Its fid (default: FidFromScriptName(script)).
+      mem_gb:  Memory to reserve for it (default: the executor's
+               mem_per_job_gb).
+    """
+    self.script = script
+    self.fid = fid if fid else FidFromScriptName(script)
+    self.mem_gb = mem_gb
+    self.attempts = 0
+    self.exit_status = None
+    self.proc = None
+    self.start_time = None
+    self.cpu = None
+
+  def __repr__(self):
+    return 'Job(%r, fid=%r)' % (self.script, self.fid)
+
+
+def FidFromScriptName(script):
+  """Returns <observation_id>_<cid>_<eid> from <exec_script_base>_<fid>.csh."""
+  name = os.path.basename(script).rsplit('.', 1)[0]
+  return '_'.join(name.split('_')[-4:])
+
+def JobsFromExecManifest(exec_manifest_fn):
+  """Returns a Job for each script listed in an execmanifest_raytrace file.
+
+  Relative script names are taken relative to the manifest's directory.
+  """
+  manifest_dir = os.path.dirname(os.path.abspath(exec_manifest_fn))
+  jobs = []
+  with open(exec_manifest_fn, 'r') as f:
+    for line in f:
+      script = line.strip()
+      if script and not script.startswith('#'):
+        jobs.append(Job(os.path.join(manifest_dir, script)))
+  return jobs
+
+def JobsFromManifest(manifest_fn, manifest_parser_class=PhosimUtil.ManifestParser):
+  """Returns a Job for each exposure_id in an observation's manifest.txt."""
+  manifest_dir = os.path.dirname(os.path.abspath(manifest_fn))
+  with manifest_parser_class(manifest_fn, 'r') as parser:
+    parser.Read()
+    observation_id = parser.GetLastByTags('param', 'observation_id')
+    exec_script_base = parser.GetLastByTags('param', 'exec_script_base')
+    return [Job(os.path.join(manifest_dir, '%s_%s_%s.csh' % (
+                  exec_script_base, observation_id, exposure_id)),
+                fid='%s_%s' % (observation_id, exposure_id))
+            for exposure_id in parser.GetAllByTags('set', 'exposure_id')]
+
+def ReadJobs(fn):
+  """Reads jobs from an exec manifest or, if fn is named manifest.txt, a manifest."""
+  if os.path.basename(fn) == 'manifest.txt':
+    return JobsFromManifest(fn)
+  return JobsFromExecManifest(fn)
+
+def OrderByCostModel(jobs, manifest_fn, model_fn):
+  """Returns jobs ordered by descending runtime predicted by a CostModel.
+
+  The features are read from manifest_fn (see CostModel.py).
+  """
+  model = CostModel.CostModel.Load(model_fn)
+  predictions = model.PredictAll(CostModel.ReadManifestFeatures(manifest_fn))
+  logger.info('Predicted runtimes for %d of %d jobs.',
+              len([job for job in jobs if job.fid in predictions]), len(jobs))
+  by_fid = dict((job.fid, job) for job in jobs)
+  return [by_fid[fid] for fid in CostModel.LongestFirst(
+            [job.fid for job in jobs], predictions)]
+
+def WriteExitStatus(jobs, fn):
+  """Writes '<fid> <exit status> <attempts>' for each job to fn."""
+  with open(fn, 'w') as f:
+    for job in jobs:
+      f.write('%s %s %d\n' % (job.fid, job.exit_status, job.attempts))
+
+def AllowedCpus():
+  """Returns the list of CPUs this process may run on.
+
+  Inside a batch allocation this is usually a subset of the machine's CPUs.
+  """
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('Cpus_allowed_list:'):
+          cpus = []
+          for cpu_range in line.split(':', 1)[1].strip().split(','):
+            first, sep, last = cpu_range.partition('-')
+            cpus.extend(range(int(first), int(last if sep else first) + 1))
+          return cpus
+  except (IOError, ValueError):
+    pass
+  return range(CpuCount())
+
+def CpuCount():
+  """Returns the number of online CPUs (1 if unknown)."""
+  try:
+    return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+  except (ValueError, OSError, AttributeError):
+    return 1
+
+def MachineMemoryGb():
+  """Returns the physical memory of this machine in GB (None if unknown)."""
+  try:
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') /
+            float(1 << 30))
+  except (ValueError, OSError, AttributeError):
+    return None
+
+
+class LocalExecutor(object):
+  """Runs Jobs as child processes, limited by slots and memory.
+
+  Jobs are reaped with os.wait4() (which also yields their CPU time and
+  RSS), so the process using this should not have other children.
+  """
+
+  def __init__(self, slots=None, mem_per_job_gb=0.0, mem_total_gb=None,
+               retries=1, stats_fn=None, log_dir=None, shell='csh',
+               script_args=None, pin_cpus=None):
+    """Constructor.
+
+    Args:
+      slots:           Max number of concurrent jobs (default: number of cores).
+      mem_per_job_gb:  Memory reserved for each job.  0 means no reservation.
+      mem_total_gb:    Memory available to jobs (default: MachineMemoryGb()).
+      retries:         Number of times to rerun a failed job.
+      stats_fn:        Append per-attempt stats (STATS_FIELDS) to this csv file.
+      log_dir:         Write the stdout and stderr of each attempt to
+                       <log_dir>/<fid>.<attempt>.out (default: inherit).
+      shell:           Interpreter for the scripts.
+      script_args:     List of extra arguments for each script.
+      pin_cpus:        List of CPUs.  If given, each job is pinned to one
+                       of them with taskset, and slots is limited to their
+                       number.
+    """
+    self.slots = slots if slots else CpuCount()
+    self.mem_per_job_gb = mem_per_job_gb
+    self.mem_total_gb = mem_total_gb
+    if self.mem_total_gb is None and mem_per_job_gb:
+      self.mem_total_gb = MachineMemoryGb()
+    self.retries = retries
+    self.stats_fn = stats_fn
+    self.log_dir = log_dir
+    self.shell = shell
+    self.script_args = script_args if script_args else []
+    self.free_cpus = list(pin_cpus) if pin_cpus else None
+    if self.free_cpus is not None:
+      self.slots = min(self.slots, len(self.free_cpus))
+    self.running = {}       # pid -> Job
+    self.reserved_gb = 0.0
+    self.max_running = 0
+    self.stats = []         # One dict per attempt
+    if self.mem_per_job_gb and self.mem_total_gb:
+      max_jobs = int(self.mem_total_gb // self.mem_per_job_gb)
+      if max_jobs < self.slots:
+        logger.info('Memory (%.1f GB at %.1f GB per job) limits concurrency to'
+                    ' %d jobs.', self.mem_total_gb, self.mem_per_job_gb, max_jobs)
+
+  def _JobMem(self, job):
+    return job.mem_gb if job.mem_gb is not None else self.mem_per_job_gb
+
+  def _Fits(self, job):
+    """Can job start now without exceeding slots or memory?"""
+    if len(self.running) >= self.slots:
+      return False
+    if not self.running:
+      # Always run at least one job, even if it reserves more than there is.
+      return True
+    if self.mem_total_gb is None:
+      return True
+    return self.reserved_gb + self._JobMem(job) <= self.mem_total_gb
+
+  def _Start(self, job):
+    job.attempts += 1
+    cmd = [self.shell, job.script] + list(self.script_args)
+    if self.free_cpus is not None:
+      job.cpu = self.free_cpus.pop(0)
+      cmd = ['taskset', '-c', str(job.cpu)] + cmd
+    stdout = None
+    if self.log_dir:
+      PhosimUtil.MakeDirs(self.log_dir)
+      stdout = open(os.path.join(self.log_dir,
+                                 '%s.%d.out' % (job.fid, job.attempts)), 'w')
+    logger.info('Starting %s (attempt %d): %s', job.fid, job.attempts, cmd)
+    try:
+      # Keep the Popen object until the job is reaped: subprocess polls
+      # (and so reaps) children whose Popen objects have been discarded.
+      job.proc = subprocess.Popen(cmd, stdout=stdout,
+                                  stderr=subprocess.STDOUT if stdout else None,
+                                  cwd=os.path.dirname(job.script) or None,
+                                  close_fds=True)
+    finally:
+      if stdout:
+        stdout.close()
+    job.start_time = time.time()
+    self.running[job.proc.pid] = job
+    self.reserved_gb += self._JobMem(job)
+    self.max_running = max(self.max_running, len(self.running))
+
+  def _Reap(self):
+    """Waits for a job to exit.  Returns (job, stats dict)."""
+    while True:
+      try:
+        pid, status, rusage = os.wait4(-1, 0)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      if pid in self.running:
+        break
+    job = self.running.pop(pid)
+    self.reserved_gb -= self._JobMem(job)
+    if job.cpu is not None:
+      self.free_cpus.append(job.cpu)
+      job.cpu = None
+    if os.WIFEXITED(status):
+      job.exit_status = os.WEXITSTATUS(status)
+    else:
+      job.exit_status = -os.WTERMSIG(status)
+    job.proc.returncode = job.exit_status
+    job.proc = None
+    stats = {'fid': job.fid, 'attempt': job.attempts,
+             'exit_status': job.exit_status,
+             'wall_s': '%.2f' % (time.time() - job.start_time),
+             'user_s': '%.2f' % rusage.ru_utime, 'sys_s': '%.2f' % rusage.ru_stime,
+             'maxrss_kb': rusage.ru_maxrss, 'script': job.script}
+    return job, stats
+
+  def _WriteStats(self, stats):
+    self.stats.append(stats)
+    if not self.stats_fn:
+      return
+    write_header = not os.path.exists(self.stats_fn)
+    with open(self.stats_fn, 'a') as f:
+      writer = csv.DictWriter(f, STATS_FIELDS)
+      if write_header:
+        writer.writerow(dict(zip(STATS_FIELDS, STATS_FIELDS)))
+      writer.writerow(stats)
+
+  def Run(self, jobs):
+    """Runs jobs until each has succeeded or used up its retries.
+
+    Returns:
+      List of the jobs that failed (empty upon success).
+    """
+    queue = list(jobs)
+    failed = []
+    logger.info('Running %d jobs in %d slots.', len(queue), self.slots)
+    try:
+      while queue or self.running:
+        while queue and self._Fits(queue[0]):
+          self._Start(queue.pop(0))
+        job, stats = self._Reap()
+        self._WriteStats(stats)
+        if job.exit_status == 0:
+          logger.info('%s succeeded in %s s.', job.fid, stats['wall_s'])
+        elif job.attempts <= self.retries:
+          logger.warning('%s exited with status %d; retrying.', job.fid,
+                         job.exit_status)
+          queue.append(job)
+        else:
+          logger.error('%s exited with status %d after %d attempts.', job.fid,
+                       job.exit_status, job.attempts)
+          failed.append(job)
+    except:
+      self.Kill()
+      raise
+    return failed
+
+  def Kill(self):
+    """Terminates and reaps all running jobs."""
+    for pid in self.running.keys():
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+    while self.running:
+      try:
+        self._Reap()
+      except OSError:
+        break
+
+
+def main(manifest_fn, options):
+  jobs = ReadJobs(manifest_fn)
+  if options.cost_model:
+    if os.path.basename(manifest_fn) != 'manifest.txt':
+      manifest_fn = os.path.join(os.path.dirname(os.path.abspath(manifest_fn)),
+                                 'manifest.txt')
+    jobs = OrderByCostModel(jobs, manifest_fn, options.cost_model)
+  executor = LocalExecutor(slots=options.slots,
+                           mem_per_job_gb=options.mem_per_job_gb,
+                           mem_total_gb=options.mem_total_gb,
+                           retries=options.retries, stats_fn=options.stats_fn,
+                           log_dir=options.log_dir, shell=options.shell,
+                           script_args=options.script_args.split(),
+                           pin_cpus=AllowedCpus() if options.pin_cpus else None)
+  failed = executor.Run(jobs)
+  if options.exit_status_fn:
+    WriteExitStatus(jobs, options.exit_status_fn)
+  if failed:
+    print 'Failed jobs: %s' % ' '.join(job.fid for job in failed)
+    return 1
+  return 0
+
+def _GetConfigDefault(policy, option, getter, default):
+  if policy and policy.has_option('general', option):
+    return getattr(policy, getter)('general', option)
+  return default
+
+if __name__ == '__main__':
+  usage = 'usage: %prog [options] execmanifest_raytrace_<obsid>.txt|manifest.txt'
+  parser = OptionParser(usage=usage)
+  parser.add_option('-c', '--config', dest='config', default=None,
+                    help='Read defaults for these options from this config file.')
+  parser.add_option('-n', '--slots', dest='slots', type='int', default=None,
+                    help='Max number of concurrent jobs (default: number of cores).')
+  parser.add_option('-m', '--mem_per_job_gb', dest='mem_per_job_gb', type='float',
+                    default=None, help='Memory to reserve for each job, in GB.')
+  parser.add_option('-M', '--mem_total_gb', dest='mem_total_gb', type='float',
+                    default=None, help='Memory available to jobs, in GB'
+                    ' (default: memory of this machine).')
+  parser.add_option('-r', '--retries', dest='retries', type='int', default=None,
+                    help='Number of times to rerun a failed job (default: 1).')
+  parser.add_option('-s', '--stats_file', dest='stats_fn', default=None,
+                    help='Append per-job wall/CPU/RSS stats to this csv file.')
+  parser.add_option('-l', '--log_dir', dest='log_dir', default=None,
+                    help='Write the output of each job to a file in this dir.')
+  parser.add_option('--shell', dest='shell', default='csh',
+                    help='Interpreter for the exec scripts.')
+  parser.add_option('-p', '--pin_cpus', dest='pin_cpus', action='store_true',
+                    default=False, help='Pin each job to one of the allowed CPUs.')
+  parser.add_option('-e', '--exit_status_file', dest='exit_status_fn',
+                    default=None, help='Write the final exit status of each'
+                    ' job to this file.')
+  parser.add_option('--cost_model', dest='cost_model', default=None,
+                    help='Start the jobs with the longest runtime predicted by'
+                    ' this model (see CostModel.py) first.')
+  parser.add_option('-a', '--script_args', dest='script_args', default='',
+                    help='Arguments to pass to each exec script (quote them).')
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    print 'Incorrect number of arguments.  Use -h or --help for help.'
+    print usage
+    quit()
+  policy = None
+  if options.config:
+    policy = ConfigParser.RawConfigParser()
+    policy.read(options.config)
+  if options.slots is None:
+    options.slots = _GetConfigDefault(policy, 'executor_slots', 'getint', None)
+  if options.mem_per_job_gb is None:
+    options.mem_per_job_gb = _GetConfigDefault(policy, 'executor_mem_per_job_gb',
+                                               'getfloat', 0.0)
+  if options.mem_total_gb is None:
+    options.mem_total_gb = _GetConfigDefault(policy, 'executor_mem_total_gb',
+                                             'getfloat', None)
+  if options.retries is None:
+    options.retries = _GetConfigDefault(policy, 'executor_retries', 'getint', 1)
+  if options.cost_model is None:
+    options.cost_model = _GetConfigDefault(policy, 'cost_model', 'get', None)
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s:%(name)s:  %(message)s')
+  sys.exit(main(args[0], options))
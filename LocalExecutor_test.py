@@ -0,0 +1,141 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+import CostModel
+import LocalExecutor
+import PhosimUtil
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+
+class LocalExecutorTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def WriteScript(self, fid, body):
+    script = os.path.join(self.tmpdir, 'exec_raytrace_%s.csh' % fid)
+    with open(script, 'w') as f:
+      f.write(body)
+    return script
+
+  def testFidFromScriptName(self):
+    self.assertEqual(LocalExecutor.FidFromScriptName(
+      '/a/exec_raytrace_99999999_R22_S11_E000.csh'), '99999999_R22_S11_E000')
+
+  def testReadJobs(self):
+    fids = ['1234_R22_S11_E000', '1234_R22_S11_E001']
+    exec_manifest = os.path.join(self.tmpdir, 'execmanifest_raytrace_1234.txt')
+    with open(exec_manifest, 'w') as f:
+      for fid in fids:
+        f.write('exec_raytrace_%s.csh\n' % fid)
+    jobs = LocalExecutor.ReadJobs(exec_manifest)
+    self.assertEqual([job.fid for job in jobs], fids)
+    self.assertEqual(jobs[0].script,
+                     os.path.join(self.tmpdir, 'exec_raytrace_%s.csh' % fids[0]))
+    manifest = os.path.join(self.tmpdir, 'manifest.txt')
+    with PhosimUtil.ManifestParser(manifest, 'w') as parser:
+      parser.Write([('param', 'observation_id', '1234'),
+                    ('param', 'exec_script_base', 'exec_raytrace'),
+                    ('set', 'exposure_id', 'R22_S11_E000'),
+                    ('set', 'exposure_id', 'R22_S11_E001')])
+    jobs = LocalExecutor.ReadJobs(manifest)
+    self.assertEqual([job.fid for job in jobs], fids)
+    self.assertEqual(jobs[1].script,
+                     os.path.join(self.tmpdir, 'exec_raytrace_%s.csh' % fids[1]))
+
+  def testRetriesAndStats(self):
+    marker = os.path.join(self.tmpdir, 'marker')
+    jobs = [
+      LocalExecutor.Job(self.WriteScript('1_R00_S00_E000', 'exit 0\n')),
+      # Fails the first time only.
+      LocalExecutor.Job(self.WriteScript(
+        '1_R00_S00_E001', 'if [ -f %s ]; then exit 0; fi\ntouch %s\nexit 3\n' %
+        (marker, marker))),
+      LocalExecutor.Job(self.WriteScript('1_R00_S00_E002', 'echo $1\nexit 2\n')),
+      ]
+    stats_fn = os.path.join(self.tmpdir, 'stats.csv')
+    log_dir = os.path.join(self.tmpdir, 'logs')
+    executor = LocalExecutor.LocalExecutor(slots=2, retries=1, stats_fn=stats_fn,
+                                           log_dir=log_dir, shell='sh',
+                                           script_args=['hello'])
+    failed = executor.Run(jobs)
+    self.assertEqual([job.fid for job in failed], ['1_R00_S00_E002'])
+    self.assertEqual(jobs[1].attempts, 2)
+    self.assertEqual(jobs[2].attempts, 2)
+    with open(stats_fn, 'r') as f:
+      rows = list(csv.DictReader(f))
+    self.assertEqual(len(rows), 5)
+    self.assertEqual(sorted((row['fid'], row['attempt'], row['exit_status'])
+                            for row in rows),
+                     [('1_R00_S00_E000', '1', '0'), ('1_R00_S00_E001', '1', '3'),
+                      ('1_R00_S00_E001', '2', '0'), ('1_R00_S00_E002', '1', '2'),
+                      ('1_R00_S00_E002', '2', '2')])
+    for row in rows:
+      float(row['wall_s'])
+      float(row['user_s'])
+      int(row['maxrss_kb'])
+    with open(os.path.join(log_dir, '1_R00_S00_E002.2.out'), 'r') as f:
+      self.assertEqual(f.read(), 'hello\n')
+
+  def testMemoryLimitsConcurrency(self):
+    jobs = [LocalExecutor.Job(self.WriteScript('1_R00_S00_E00%d' % i, 'sleep 0.2\n'))
+            for i in range(6)]
+    executor = LocalExecutor.LocalExecutor(slots=6, mem_per_job_gb=2.0,
+                                           mem_total_gb=5.0, shell='sh')
+    self.assertEqual(executor.Run(jobs), [])
+    self.assertEqual(executor.max_running, 2)
+    executor = LocalExecutor.LocalExecutor(slots=3, shell='sh')
+    self.assertEqual(executor.Run(jobs), [])
+    self.assertEqual(executor.max_running, 3)
+    # A job that reserves more than there is still runs, by itself.
+    big = LocalExecutor.Job(self.WriteScript('1_R00_S00_E010', 'exit 0\n'),
+                            mem_gb=10.0)
+    executor = LocalExecutor.LocalExecutor(slots=6, mem_per_job_gb=2.0,
+                                           mem_total_gb=5.0, shell='sh')
+    self.assertEqual(executor.Run([big] + jobs[:2]), [])
+
+  def testPinCpusAndExitStatus(self):
+    cpus = LocalExecutor.AllowedCpus()
+    self.assertTrue(cpus)
+    jobs = [LocalExecutor.Job(self.WriteScript('1_R00_S00_E00%d' % i, 'exit %d\n' % i))
+            for i in range(3)]
+    executor = LocalExecutor.LocalExecutor(slots=3, retries=0, shell='sh',
+                                           pin_cpus=cpus[:1])
+    self.assertEqual(executor.slots, 1)
+    self.assertEqual([job.fid for job in executor.Run(jobs)],
+                     ['1_R00_S00_E001', '1_R00_S00_E002'])
+    self.assertEqual(executor.max_running, 1)
+    self.assertEqual(executor.free_cpus, cpus[:1])
+    exit_status_fn = os.path.join(self.tmpdir, 'exit_status.txt')
+    LocalExecutor.WriteExitStatus(jobs, exit_status_fn)
+    with open(exit_status_fn, 'r') as f:
+      self.assertEqual(f.read(), '1_R00_S00_E000 0 1\n1_R00_S00_E001 1 1\n'
+                       '1_R00_S00_E002 2 1\n')
+
+  def testOrderByCostModel(self):
+    manifest_fn = os.path.join(self.tmpdir, 'manifest.txt')
+    with PhosimUtil.ManifestParser(manifest_fn, 'w') as parser:
+      parser.Write([('param', 'observation_id', '1234'),
+                    ('param', 'exec_script_base', 'exec_raytrace')])
+      parser.Write([('set', 'exposure_id', 'R22_S11_E00%d' % i) for i in range(3)])
+      CostModel.WriteFeatures(parser, {'R22_S11_E000': {'nsources': 10},
+                                       'R22_S11_E001': {'nsources': 3000},
+                                       'R22_S11_E002': {'nsources': 200}})
+    model_fn = os.path.join(self.tmpdir, 'model.txt')
+    CostModel.CostModel(['nsources'], [0.1], 5.0).Save(model_fn)
+    jobs = LocalExecutor.OrderByCostModel(LocalExecutor.ReadJobs(manifest_fn),
+                                          manifest_fn, model_fn)
+    self.assertEqual([job.fid for job in jobs],
+                     ['1234_R22_S11_E001', '1234_R22_S11_E002', '1234_R22_S11_E000'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,7 +14,12 @@ import sys
 import time
 import zipfile
 
+import CostModel
 import Exposure
+import FitsUtil
+import FocalplaneGeometry
+import FootprintFilter
+import InstanceCatalog
 import PhosimUtil
 import ScriptWriter
 import phosim
@@ -29,14 +34,16 @@ MANIFEST_FN = 'manifest.txt'
 def NotImplementedField(self):
   raise NotImplementedError
 
-def ObservationIdFromTrimfile(instance_catalog, extra_commands=None):
-  """Returns observation ID and filter_num as read from instance_catalog."""
-  obsid = None
-  for line in open(instance_catalog, 'r'):
-    if line.startswith('Opsim_obshistid'):
-      obsid = line.strip().split()[1]
-    elif line.startswith('Opsim_filter'):
-      filter_num = line.strip().split()[1]
+def ObservationIdFromTrimfile(instance_catalog, extra_commands=None,
+                              header_cache=False):
+  """Returns observation ID and filter_num as read from instance_catalog.
+
+  Only the header of instance_catalog is read.  If header_cache is True,
+  the InstanceCatalog sidecar header cache is used.
+  """
+  header = InstanceCatalog.ReadHeader(instance_catalog, cache=header_cache)
+  obsid = header.get('Opsim_obshistid')
+  filter_num = header.get('Opsim_filter')
   assert obsid
   if extra_commands:
     for line in open(extra_commands, 'r'):
@@ -44,6 +51,48 @@ def ObservationIdFromTrimfile(instance_catalog, extra_commands=None):
         obsid += line.split()[1]
   return obsid, filter_num
 
+def MinSourceFromTrimfile(header, extra_commands=None):
+  """Returns minsource for an instance catalog, or None if it is not set.
+
+  A 'minsource' line in extra_commands takes precedence over the
+  SIM_MINSOURCE (or minsource) entry of the instance catalog header.
+  """
+  minsource = header.get('SIM_MINSOURCE', header.get('minsource'))
+  if extra_commands:
+    for line in open(extra_commands, 'r'):
+      fields = line.split()
+      if len(fields) > 1 and fields[0] == 'minsource':
+        minsource = fields[1]
+  if minsource is None:
+    return None
+  return int(minsource)
+
+# Pars files that contain directory names (see UpdatePhosimDirsInPars()).
+FID_PARS_PREFIXES = ('raytrace_', 'e2adc_')
+
+# Attributes holding the new value for each dir in UpdatePhosimDirsInPars().
+PHOSIM_DIR_ATTRS = {
+  'bindir': 'phosim_bin_dir',
+  'datadir': 'phosim_data_dir',
+  'instrdir': 'phosim_instr_dir',
+  'outputdir': 'phosim_output_dir',
+  }
+
+def IsFidParsFile(fn):
+  """Is fn a per-fid pars file (raytrace_<fid>.pars or e2adc_<fid>.pars)?"""
+  return fn.startswith(FID_PARS_PREFIXES) and fn.endswith('.pars')
+
+def IsInputFileForFids(fn, fids=None):
+  """Is pars archive member fn needed to raytrace any of fids?
+
+  Per-fid pars files are only needed by their own fid.  Everything else
+  (tracking pars, atmosphere and cloud screens) is needed by every fid.
+  If fids is None, every file is needed.
+  """
+  if fids is None or not IsFidParsFile(fn):
+    return True
+  return fn[:-len('.pars')].split('_', 1)[1] in fids
+
 class PhosimManager(object):
   """Parent class for managing Phosim execution on distributed platforms.
 
@@ -70,6 +119,8 @@ class PhosimManager(object):
     self.python_control_dir = self.policy.get('general', 'python_control_dir')
     self.phosim_bin_dir = self.policy.get('general', 'phosim_binDir')
     self.manifest_parser_class = manifest_parser_class
+    # Reference on a DataDirCache entry, if phosim_data_dir links to one.
+    self.data_cache_ref = None
     # The following should be defined in subclasses
     self.phosim_data_dir = NotImplementedField
     self.phosim_output_dir = NotImplementedField
@@ -88,7 +139,7 @@ class PhosimManager(object):
 
   def UpdatePhosimDirsInPars(self, pars_path,
                              dirs_to_update=['datadir', 'instrdir', 'seddir']):
-    """Moves pars file to temp file and rewrites it with new dirs.
+    """Rewrites pars file with new dirs.
 
     One problem in wrapping the phosim execution environment the way we do
     is that phosim actually stores the names of directories in may of its
@@ -102,25 +153,72 @@ class PhosimManager(object):
       dirs_to_update: A list of dirs to update.  Possibilities are:
                       bindir, datadir, instrdir, outputdir, seddir
     """
-    pars_dir, pars_fn = os.path.split(pars_path)
-    tmp_path = os.path.join(pars_dir, '_tmp.pars')
-    shutil.move(pars_path, tmp_path)
-    with open(tmp_path, 'r') as pars_in:
-      with open(pars_path, 'w') as pars_out:
-        for line in pars_in:
-          if 'bindir' in dirs_to_update and line.startswith('bindir'):
-            pars_out.write('bindir %s\n' % self.phosim_bin_dir)
-          elif 'datadir' in dirs_to_update and line.startswith('datadir'):
-            pars_out.write('datadir %s\n' % self.phosim_data_dir)
-          elif 'instrdir' in dirs_to_update and line.startswith('instrdir'):
-            pars_out.write('instrdir %s\n' % self.phosim_instr_dir)
-          elif 'outputdir' in dirs_to_update and line.startswith('outputdir'):
-            pars_out.write('outputdir %s\n' % self.phosim_output_dir)
-          elif 'seddir' in dirs_to_update and line.startswith('seddir'):
-            pars_out.write('seddir %s\n' % os.path.join(self.phosim_data_dir, 'SEDs'))
+    with open(pars_path, 'r') as pars_in:
+      lines = list(self.RewritePhosimDirs(pars_in, dirs_to_update))
+    with open(pars_path, 'w') as pars_out:
+      pars_out.writelines(lines)
+
+  def RewritePhosimDirs(self, lines,
+                        dirs_to_update=['datadir', 'instrdir', 'seddir']):
+    """Yields lines of a pars file with dirs_to_update set to our dirs.
+
+    Args:
+      lines:          Iterable of lines of a .pars file (e.g. an open file).
+      dirs_to_update: As for UpdatePhosimDirsInPars().
+    """
+    new_lines = {}
+    for key in dirs_to_update:
+      if key == 'seddir':
+        new_lines[key] = 'seddir %s\n' % os.path.join(self.phosim_data_dir, 'SEDs')
+      else:
+        new_lines[key] = '%s %s\n' % (key, getattr(self, PHOSIM_DIR_ATTRS[key]))
+    for line in lines:
+      for key, new_line in new_lines.iteritems():
+        if line.startswith(key):
+          line = new_line
+          break
+      yield line
+
+  def _ExtractParsArchive(self, archive_path, fids=None):
+    """Extracts the input files for fids from archive_path to phosim_work_dir.
+
+    Only the raytrace/e2adc pars of fids are extracted, along with the
+    files every fid needs (see IsInputFileForFids()).  datadir, instrdir
+    and seddir in the raytrace/e2adc pars are rewritten as they are
+    extracted.
+
+    Args:
+      archive_path: Pars archive (.zip) written by the preprocessor.
+      fids:         List of fids to extract files for.  None extracts all.
+
+    Returns:
+      List of names of extracted files.
+    """
+    logger.info('Extracting input files for %s from %s to %s.',
+                fids if fids is not None else 'all fids', archive_path,
+                self.phosim_work_dir)
+    extracted = []
+    zipf = zipfile.ZipFile(archive_path, 'r')
+    try:
+      members = zipf.infolist()
+      for info in members:
+        fn = os.path.basename(info.filename)
+        if not fn or not IsInputFileForFids(fn, fids):
+          continue
+        # ZipFile.open() needs Python 2.6.  Members are single pars files
+        # and screens, so reading each into memory is fine.
+        data = zipf.read(info.filename)
+        with open(os.path.join(self.phosim_work_dir, fn), 'wb') as dest:
+          if IsFidParsFile(fn):
+            dest.writelines(self.RewritePhosimDirs(data.splitlines(True)))
           else:
-            pars_out.write(line)
-    os.remove(tmp_path)
+            dest.write(data)
+        extracted.append(fn)
+    finally:
+      zipf.close()
+    logger.info('Extracted %d of %d files from %s.', len(extracted),
+                len(members), archive_path)
+    return extracted
 
   def Cleanup(self):
     """Clean up execution directory."""
@@ -128,8 +226,11 @@ class PhosimManager(object):
       PhosimUtil.RemoveDirOrLink(self.phosim_work_dir)
     if os.path.exists(self.phosim_output_dir):
       PhosimUtil.RemoveDirOrLink(self.phosim_output_dir)
-    if os.path.exists(self.phosim_data_dir):
+    if os.path.lexists(self.phosim_data_dir):
       PhosimUtil.RemoveDirOrLink(self.phosim_data_dir)
+    if self.data_cache_ref:
+      PhosimUtil.DataDirCache.Release(self.data_cache_ref)
+      self.data_cache_ref = None
 
   def _BuildDataDir(self):
     """Makes a symlink to shared_data_path or unarchives data_tarball."""
@@ -142,14 +243,105 @@ class PhosimManager(object):
                   self.phosim_data_dir)
       os.symlink(self.shared_data_path, self.phosim_data_dir)
     else:
-      os.makedirs(self.phosim_data_dir)
       tarball_path = os.path.join(self.shared_data_path, self.data_tarball)
       if not os.path.isfile(tarball_path):
         raise RuntimeError('Data tarball %s does not exist.' % tarball_path)
+      cache = self._DataDirCache()
+      if cache:
+        cached_data_dir, self.data_cache_ref = cache.Acquire(tarball_path)
+        logger.info('_BuildDataDir() linking %s to %s.', cached_data_dir,
+                    self.phosim_data_dir)
+        os.symlink(cached_data_dir, self.phosim_data_dir)
+        return
+      os.makedirs(self.phosim_data_dir)
       cmd = 'tar -xf %s -C %s' % (tarball_path, self.phosim_data_dir)
       logger.info('_BuildDataDir() executing %s' % cmd)
       subprocess.check_call(cmd, shell=True)
 
+  def _DataDirCache(self):
+    """Returns the node-wide DataDirCache, or None if 'data_cache_dir' is unset."""
+    if (not self.policy.has_option('general', 'data_cache_dir') or
+        not self.policy.get('general', 'data_cache_dir')):
+      return None
+    max_bytes = None
+    if self.policy.has_option('general', 'data_cache_max_gb'):
+      max_bytes = int(self.policy.getfloat('general', 'data_cache_max_gb')
+                      * 2**30)
+    return PhosimUtil.DataDirCache(self.policy.get('general', 'data_cache_dir'),
+                                   max_bytes)
+
+  def _CheckAndDoAtmoscreens(self, observation_id, raytrace_pars):
+    """Checks for and generates atmosphere screen output if needed.
+
+    If 'atmoscreen_cache_dir' is set in the config file, screens are
+    shared through a NodeCache there: the first job on a node to need the
+    screens of an observation generates them and the others wait for and
+    link them.
+
+    Args:
+      observation_id: ImSim/PhoSim observation ID.
+      raytrace_pars:  raytrace_<fid>.pars to use as input for
+                      PhosimFocalplane.GenerateAtmosphere().
+
+    Returns:
+      True of atmoscreens existed, False if they had to be recalculated."""
+    if self._HaveAtmoscreens(observation_id):
+      logger.info('Found existing airglowscreen and atmospherescreen files.'
+                  ' Skipping atmosphere step.')
+      return True
+    cache = self._AtmoscreenCache()
+    if not cache:
+      self._GenerateAtmoscreens(raytrace_pars)
+      return False
+    with cache.Lock(observation_id):
+      if (cache.Get(observation_id, self.phosim_work_dir) is not None and
+          self._HaveAtmoscreens(observation_id)):
+        logger.info('Using cached atmosphere screens from %s.', cache.cache_dir)
+        return True
+      old_fns = set(os.listdir(self.phosim_work_dir))
+      self._GenerateAtmoscreens(raytrace_pars)
+      cache.Put(observation_id,
+                [os.path.join(self.phosim_work_dir, fn) for fn in
+                 sorted(set(os.listdir(self.phosim_work_dir)) - old_fns)])
+    return False
+
+  def _HaveAtmoscreens(self, observation_id):
+    if os.path.isfile(os.path.join(self.phosim_work_dir,
+                                   'airglowscreen_%s.fits' % observation_id)):
+      atmoscreen_glob = 'atmospherescreen_%s_*.fits' % observation_id
+      if len(glob.glob(os.path.join(self.phosim_work_dir, atmoscreen_glob))) == 70:
+        return True
+    return False
+
+  def _GenerateAtmoscreens(self, raytrace_pars):
+    logger.info('Could not find existing airglowscreen and atmospherescreen files.'
+                ' Running PhosimFocalplane.GenerateAtmosphere().')
+    os.chdir(self.phosim_work_dir)
+    focalplane = phosim.PhosimFocalplane(self.my_exec_path,
+                                         self.phosim_output_dir,
+                                         self.phosim_work_dir,
+                                         self.phosim_bin_dir,
+                                         self.phosim_data_dir,
+                                         self.phosim_instr_dir,
+                                         grid='cluster',
+                                         grid_opts={})
+    # Set input file for GenerateAtmosphere step:
+    focalplane.inputParams = os.path.basename(raytrace_pars)
+    focalplane.GenerateAtmosphere()
+    os.chdir(self.my_exec_path)
+
+  def _AtmoscreenCache(self):
+    """Returns the node-local atmosphere screen NodeCache, or None if unset."""
+    if (not self.policy.has_option('general', 'atmoscreen_cache_dir') or
+        not self.policy.get('general', 'atmoscreen_cache_dir')):
+      return None
+    max_bytes = None
+    if self.policy.has_option('general', 'atmoscreen_cache_max_gb'):
+      max_bytes = int(self.policy.getfloat('general', 'atmoscreen_cache_max_gb')
+                      * 2**30)
+    return PhosimUtil.NodeCache(self.policy.get('general', 'atmoscreen_cache_dir'),
+                                max_bytes)
+
   def _InitExecDirectories(self):
     """Initializes directories needed for phosim execution."""
     if not os.path.isdir(self.my_exec_path):
@@ -231,6 +423,21 @@ class Preprocessor(PhosimManager):
     self.focalplane = None
     self.pars_archive_name = None
     self.skip_atmoscreens = None
+    # Files written by script_writer.Finalize().
+    self.finalized_files = []
+    # <cid>_<eid> of each scheduled exposure.
+    self.exposure_ids = []
+    # Record per-fid cost features in the manifest and, given a fitted
+    # model, pass predicted runtimes to the script writer.
+    self.cost_features = (self.policy.has_option('general', 'cost_features') and
+                          self.policy.getboolean('general', 'cost_features'))
+    # Leave chips that cannot reach minsource out of the trim stage.
+    self.footprint_filter = (self.policy.has_option('general', 'footprint_filter') and
+                             self.policy.getboolean('general', 'footprint_filter'))
+    self.cost_model = None
+    if self.policy.has_option('general', 'cost_model'):
+      self.cost_model = CostModel.CostModel.Load(self.policy.get('general',
+                                                                 'cost_model'))
     staged_config_file = os.path.join(self.my_output_path,
                                       os.path.basename(self.imsim_config_file))
     self.script_writer = script_writer_class(
@@ -304,9 +511,12 @@ class Preprocessor(PhosimManager):
       PhosimUtil.RunWithWallTimer(self.focalplane.GenerateAtmosphere, name=name)
     name = 'GenerateInstrumentConfig' if log_timings else None
     PhosimUtil.RunWithWallTimer(self.focalplane.GenerateInstrumentConfig, name=name)
+    sensor = self.sensor
+    if self.footprint_filter:
+      sensor = self._FootprintSensors()
     name = 'GenerateTrimObjects' if log_timings else None
     PhosimUtil.RunWithWallTimer(
-      functools.partial(self.focalplane.GenerateTrimObjects, self.sensor), name=name)
+      functools.partial(self.focalplane.GenerateTrimObjects, sensor), name=name)
     name = 'ScheduleRaytrace' if log_timings else None
     self.script_writer.SetExecScriptBase(exec_script_base)
     if not pars_archive_name:
@@ -323,6 +533,8 @@ class Preprocessor(PhosimManager):
                              ('param', 'filter_num', self.filter_num),
                              ('param', 'instrument', self.instrument),
                              ('param', 'exec_script_base', exec_script_base),
+                             ('param', 'exec_script_mode',
+                              self.script_writer.exec_script_mode),
                              ('param', 'pars_archive_name', pars_archive_name),
                              ('param', 'run_e2adc', self.run_e2adc),
                              ('param', 'skip_atmoscreens', skip_atmoscreens)])
@@ -331,6 +543,9 @@ class Preprocessor(PhosimManager):
       PhosimUtil.RunWithWallTimer(
         functools.partial(self.focalplane.ScheduleRaytrace, self.instrument, self.run_e2adc),
         name=name)
+      if self.cost_features or self.cost_model:
+        self._RecordCostFeatures(manifest_parser)
+      self.finalized_files = self.script_writer.Finalize()
     logger.info('Closed %s', manifest_fn)
     os.chdir(self.my_exec_path)
     return True
@@ -393,8 +608,64 @@ class Preprocessor(PhosimManager):
     return
 
 
+  def _FootprintSensors(self):
+    """Returns the sensors of self.sensor that may reach minsource.
+
+    The sources of the instance catalog and its includeobj catalogs are
+    projected onto the focal plane (see FootprintFilter.py) and the chips
+    that cannot collect minsource of them are dropped, so that
+    GenerateTrimObjects() does not trim them.  self.sensor is returned
+    unchanged if minsource is not set or is <= 0, if the filter cannot
+    run, or if no chip would be left.
+    """
+    header = InstanceCatalog.ReadHeader(self.instance_catalog)
+    minsource = MinSourceFromTrimfile(header, self.extra_commands)
+    if not minsource or minsource <= 0:
+      return self.sensor
+    geometry = FocalplaneGeometry.GetGeometry(self.phosim_instr_dir)
+    if self.sensor == 'all':
+      cids = [chip.cid for chip in geometry.chips]
+    else:
+      cids = self.sensor.split('|')
+    try:
+      candidates = FootprintFilter.CandidateChips(
+        self.instance_catalog, geometry, cids, minsource,
+        FootprintFilter.Pointing(header),
+        catalog_dir=os.path.dirname(self.instance_catalog))
+    except (RuntimeError, IOError, ValueError, KeyError), e:
+      logger.warning('Not using the footprint filter: %s', e)
+      return self.sensor
+    if not candidates:
+      logger.warning('Footprint filter: no chip can reach minsource=%d.'
+                     '  Trimming %s anyway.', minsource, self.sensor)
+      return self.sensor
+    logger.info('Footprint filter: trimming %d of %d sensors.', len(candidates),
+                len(cids))
+    return '|'.join(candidates)
+
   def _AppendExposureId(self, parser, exposure_id):
-    parser.Write([('set', 'exposure_id', exposure_id)])
+    parser.Append([('set', 'exposure_id', exposure_id)])
+    self.exposure_ids.append(exposure_id)
+
+  def _RecordCostFeatures(self, parser):
+    """Writes the cost features of each exposure to the manifest.
+
+    With a cost model, also passes the predicted runtimes to the script writer.
+    """
+    features = {}
+    for exposure_id in self.exposure_ids:
+      cid, eid = exposure_id.rsplit('_', 1)
+      features[exposure_id] = CostModel.ExtractFeatures(
+        self.phosim_work_dir, self.observation_id, cid, eid)
+    CostModel.WriteFeatures(parser, features)
+    logger.info('Recorded cost features of %d exposures.', len(features))
+    if self.cost_model:
+      predictions = {}
+      for exposure_id in self.exposure_ids:
+        cid, eid = exposure_id.rsplit('_', 1)
+        predictions[phosim.BuildFid(self.observation_id, cid, eid)] = (
+          self.cost_model.Predict(features[exposure_id]))
+      self.script_writer.SetPredictedRuntimes(predictions)
 
   def _ArchiveParsByExt(self, archive_name, skip_atmoscreens):
     """Archives raytrace .pars files.
@@ -446,8 +717,93 @@ class Preprocessor(PhosimManager):
       for script in exec_list:
         exec_manifest.write('%s\n' % os.path.basename(script))
     exec_list.append(os.path.join(self.phosim_work_dir, archive_name))
+    # e.g. the index file of a job array.
+    exec_list.extend(fn for fn in self.finalized_files if fn not in exec_list)
     return exec_list
 
+class RaytraceEnvironment(PhosimManager):
+  """Raytrace execution environment shared by the fids of one observation.
+
+  Running several chips/exposures of an observation in one process
+  would otherwise rebuild the data dir, unpack the entire pars archive
+  and check (or regenerate) the atmosphere screens once per fid.
+  RaytraceEnvironment does this once in scratch_exec_path and Raytracer
+  instances created with shared_env=<this> link to its files:
+    __init__():            Reads the manifest once.
+    InitExecEnvironment(): Builds data dir, unpacks pars archive and
+                           generates atmosphere screens if needed.
+    Cleanup():             Deletes the shared directory.
+  """
+
+  def __init__(self, policy, observation_id, filter_num=None, instrument=None,
+               run_e2adc=None):
+    """Constructor.
+
+    Args:
+      policy:  ConfigParser object to python_control config file.
+      observation_id: ImSim/PhoSim observation ID.
+      filter_num:     Numeric identifier for filter.
+      instrument:     'lsst', 'subaru', etc.
+      run_e2adc:      Run e2adc step after raytrace?
+
+    filter_num, instrument, and run_e2adc are read from the manifest if None.
+    """
+    PhosimManager.__init__(self, policy)
+    self.observation_id = observation_id
+    self.my_input_path = os.path.join(self.stage_path, self.observation_id)
+    # Unique to this process so concurrent workers on a node do not collide.
+    self.my_exec_path = os.path.join(self.scratch_exec_path, '%s_shared_%d' %
+                                     (self.observation_id, os.getpid()))
+    self.manifest_fullpath = os.path.join(self.my_exec_path, MANIFEST_FN)
+    self.phosim_data_dir = os.path.join(self.my_exec_path, 'data')
+    self.phosim_output_dir = os.path.join(self.my_exec_path, 'output')
+    self.phosim_work_dir = os.path.join(self.my_exec_path, 'work')
+    self._InitExecDirectories()
+    # Keep a local copy of the manifest so that per-fid classes
+    # (e.g. RaytraceVerifier) do not go back to shared storage for it.
+    shutil.copy(os.path.join(self.my_input_path, MANIFEST_FN),
+                self.manifest_fullpath)
+    with self.manifest_parser_class(self.manifest_fullpath, 'r') as parser:
+      parser.Read()
+      obsid = parser.GetLastByTags('param', 'observation_id')
+      if obsid != self.observation_id:
+        raise RuntimeError('Observation ID in manifest (%s) does not match this'
+                           ' class instance (%s)' % (obsid, self.observation_id))
+      self.filter_num = (filter_num if filter_num is not None else
+                         parser.GetLastByTags('param', 'filter_num'))
+      self.instrument = (instrument if instrument is not None else
+                         parser.GetLastByTags('param', 'instrument'))
+      if run_e2adc is None:
+        run_e2adc = parser.GetLastByTags('param', 'run_e2adc') == 'True'
+      self.run_e2adc = run_e2adc
+      self.exposure_ids = parser.GetAllByTags('set', 'exposure_id')
+    self.phosim_instr_dir = os.path.join(self.phosim_data_dir, self.instrument)
+
+  def InitExecEnvironment(self, pars_archive_name='pars.zip', fids=None):
+    """Builds the data dir, unpacks the pars archive and checks atmoscreens.
+
+    Args:
+      pars_archive_name: Name of pars archive (no path).
+      fids:              Only extract the per-fid pars of these fids.
+    """
+    self.pars_archive_name = pars_archive_name
+    self._BuildDataDir()
+    self._ExtractParsArchive(
+      os.path.join(self.my_input_path, self.pars_archive_name), fids)
+    raytrace_pars = sorted(glob.glob(os.path.join(
+      self.phosim_work_dir, 'raytrace_%s_*.pars' % self.observation_id)))
+    if not raytrace_pars:
+      raise OSError('Could not find raytrace_%s_*.pars in %s.' %
+                    (self.observation_id, self.pars_archive_name))
+    self._CheckAndDoAtmoscreens(self.observation_id, raytrace_pars[0])
+
+  def Cleanup(self):
+    """Deletes the shared execution directory."""
+    PhosimManager.Cleanup(self)
+    if os.path.exists(self.my_exec_path):
+      shutil.rmtree(self.my_exec_path)
+
+
 class Raytracer(PhosimManager):
   """Manages Phosim raytracing stage.
 
@@ -463,16 +819,19 @@ class Raytracer(PhosimManager):
                     phosim_output_dir.
     CopyOutput():   Copies output to 'save_path'.
     Cleanup():      Cleans up 'scratch_exec_path'.
+
+  To raytrace several fids of one observation, pass the same initialized
+  RaytraceEnvironment to each instance as shared_env.
     """
 
   def __init__(self, policy, observation_id, cid, eid,
                filter_num=None, instrument=None, run_e2adc=None,
-               stdout_log_fn=None):
+               stdout_log_fn=None, shared_env=None):
     """Constructor.
 
     If filter_num, instrument, or run_e2adc are None,
-    the constructor will read these from the manifest, assumed to be
-    located in stage_path/manifest.txt.
+    the constructor will take these from shared_env or read them from the
+    manifest, assumed to be located in stage_path/manifest.txt.
 
     Args:
       policy:  ConfigParser object to python_control config file.
@@ -484,8 +843,20 @@ class Raytracer(PhosimManager):
       run_e2adc:      Run e2adc step after raytrace?
       stdout_log_fn:  Name of file to which to write phosim stdout. None
                       writes stdout to stdout.
+      shared_env:     Initialized RaytraceEnvironment for observation_id.  If
+                      given, the data dir, pars files and atmosphere screens
+                      are linked from it instead of being built again.
     """
     PhosimManager.__init__(self, policy)
+    self.shared_env = shared_env
+    if shared_env:
+      assert shared_env.observation_id == observation_id
+      if filter_num is None:
+        filter_num = shared_env.filter_num
+      if instrument is None:
+        instrument = shared_env.instrument
+      if run_e2adc is None:
+        run_e2adc = shared_env.run_e2adc
     self.cid = cid
     self.eid = eid
     self.observation_id = observation_id
@@ -494,6 +865,13 @@ class Raytracer(PhosimManager):
     self.instrument = instrument
     self.run_e2adc = run_e2adc
     self.stdout_log_fn = stdout_log_fn
+    self.stageout_threads = 0
+    if self.policy.has_option('general', 'stageout_threads'):
+      self.stageout_threads = self.policy.getint('general', 'stageout_threads')
+    self.stage_out = None
+    self.mef_rawfiles = False
+    if self.policy.has_option('general', 'mef_rawfiles'):
+      self.mef_rawfiles = self.policy.getboolean('general', 'mef_rawfiles')
     # Directory from which to grab input files
     self.my_input_path = os.path.join(self.stage_path, self.observation_id)
     self._ReadParamsFromManifestIfNeeded() # Needs my_input_path
@@ -503,7 +881,7 @@ class Raytracer(PhosimManager):
     self.phosim_data_dir = os.path.join(self.my_exec_path, 'data')
     self.phosim_output_dir = os.path.join(self.my_exec_path, 'output')
     self.phosim_work_dir = os.path.join(self.my_exec_path, 'work')
-    self.phosim_instr_dir = os.path.join(self.phosim_data_dir, instrument)
+    self.phosim_instr_dir = os.path.join(self.phosim_data_dir, self.instrument)
 
   def _ReadParamsFromManifestIfNeeded(self):
     if (self.observation_id is None or self.filter_num is None or
@@ -544,37 +922,28 @@ class Raytracer(PhosimManager):
 
     Returns:
       True of atmoscreens existed, False if they had to be recalculated."""
-    if os.path.isfile(os.path.join(self.phosim_work_dir,
-                                   'airglowscreen_%s.fits' % self.observation_id)):
-      atmoscreen_glob = 'atmospherescreen_%s_*.fits' % self.observation_id
-      if len(glob.glob(os.path.join(self.phosim_work_dir, atmoscreen_glob))) == 70:
-        logger.info('Found existing airglowscreen and atmospherescreen files.'
-                    ' Skipping atmosphere step.')
-        return True
-    logger.info('Could not find existing airglowscreen and atmospherescreen files.'
-                ' Running PhosimFocalplane.GenerateAtmosphere().')
-    os.chdir(self.phosim_work_dir)
-    focalplane = phosim.PhosimFocalplane(self.my_exec_path,
-                                         self.phosim_output_dir,
-                                         self.phosim_work_dir,
-                                         self.phosim_bin_dir,
-                                         self.phosim_data_dir,
-                                         self.phosim_instr_dir,
-                                         grid='cluster',
-                                         grid_opts={})
-    # Set input file for GenerateAtmosphere step:
-    focalplane.inputParams = os.path.basename(self.my_raytrace_pars)
-    focalplane.GenerateAtmosphere()
-    os.chdir(self.my_exec_path)
-    return False
+    return self._CheckAndDoAtmoscreens(self.observation_id, self.my_raytrace_pars)
 
-  def DoRaytrace(self, raytrace_func=phosim.jobchip):
+  def DoRaytrace(self, raytrace_func=phosim.jobchip, stage_out=False):
     """Perform raytrace step.
 
     Args:
       raytrace_func:  Function that performs the raytracing.  Takes arguments
                       like phosim.jobchip().
+      stage_out:      If 'stageout_threads' in the config file is non-zero,
+                      start copying output to save_path as soon as each file
+                      is complete.  CopyOutput() completes the copy.
     """
+    if stage_out and self.stageout_threads:
+      exposure = self._Exposure()
+      pairs = self._EimageOutputPairs(exposure)
+      if (self.run_e2adc and not self.mef_rawfiles and
+          not self.policy.getboolean('general', 'zip_rawfiles')):
+        pairs.extend(self._RawOutputPairs(exposure, self._LoadAmpList()))
+      logger.info('Staging out %d files with %d threads while raytracing.',
+                  len(pairs), self.stageout_threads)
+      self.stage_out = PhosimUtil.StageOutWatcher(
+        pairs, nthreads=self.stageout_threads).Start()
     os.chdir(self.phosim_work_dir)
     # Redirect stdout into a log file.
     # http://stackoverflow.com/questions/4675728/redirect-stdout-to-a-file-in-python
@@ -587,9 +956,13 @@ class Raytracer(PhosimManager):
                 raytrace_func.__name__, self.observation_id, self.cid, self.eid,
                 self.filter_num, self.phosim_output_dir, self.phosim_bin_dir,
                 self.phosim_data_dir, self.instrument, self.run_e2adc)
-    raytrace_func(self.observation_id, self.cid, self.eid, self.filter_num,
-                  self.phosim_output_dir, self.phosim_bin_dir, self.phosim_data_dir,
-                  instrument=self.instrument, run_e2adc=self.run_e2adc)
+    try:
+      raytrace_func(self.observation_id, self.cid, self.eid, self.filter_num,
+                    self.phosim_output_dir, self.phosim_bin_dir, self.phosim_data_dir,
+                    instrument=self.instrument, run_e2adc=self.run_e2adc)
+    except:
+      self.AbortStageOut()
+      raise
     sys.stdout.flush()
     # Un-redirect stdout
     if self.stdout_log_fn:
@@ -598,71 +971,141 @@ class Raytracer(PhosimManager):
       os.close(old)
     os.chdir(self.my_exec_path)
 
-  def CopyOutput(self, zip_rawfiles=False):
+  def CopyOutput(self, zip_rawfiles=False, mef_rawfiles=False):
     """Copies output for save_path.
 
+    Each file is written under a temporary name and renamed into place.
+    If DoRaytrace() started a stage-out, this waits for it to complete.
+
     Args:
       zip_rawfiles: Archive the e2adc output files for this exposure into
                     a single zip file?
+      mef_rawfiles: Merge the e2adc output files for this exposure into a
+                    single multi-extension FITS file?  Takes precedence
+                    over zip_rawfiles.
     """
     os.chdir(self.phosim_output_dir)
-    exposure = Exposure.Exposure(self.observation_id,
-                                 Exposure.filterToLetter(self.filter_num),
-                                 '%s_%s' % (self.cid, self.eid))
-    dest_path, dest_fn = exposure.generateEimageOutputName()
-    dest_path = self._PrependAndCreateFullSavePath(dest_path)
-    src_fn = exposure.generateEimageExecName()
-    logger.info('Copying %s to %s.', os.path.join(self.phosim_output_dir, src_fn),
-                os.path.join(dest_path, dest_fn))
-    shutil.copy(src_fn, os.path.join(dest_path, dest_fn))
+    exposure = self._Exposure()
+    pairs = self._EimageOutputPairs(exposure)
+    mef_rawfiles = mef_rawfiles or self.mef_rawfiles
+    zip_rawfiles = (not mef_rawfiles and
+                    (zip_rawfiles or self.policy.getboolean('general', 'zip_rawfiles')))
     if self.run_e2adc:
       amp_list = self._LoadAmpList()
-      if zip_rawfiles or self.policy.getboolean('general', 'zip_rawfiles'):
-        self._CopyZippedRawOutput(exposure, amp_list)
-      else:
-        self._CopyRawOutput(exposure, amp_list)
+      if not (zip_rawfiles or mef_rawfiles):
+        pairs.extend(self._RawOutputPairs(exposure, amp_list))
+    if self.stage_out:
+      stage_out, self.stage_out = self.stage_out, None
+      stage_out.Finish(pairs)
+    else:
+      for src, dest in pairs:
+        logger.info('Copying %s to %s.', src, dest)
+        PhosimUtil.AtomicCopy(src, dest)
+    if self.run_e2adc and zip_rawfiles:
+      self._CopyZippedRawOutput(exposure, amp_list)
+    if self.run_e2adc and mef_rawfiles:
+      self._CopyMefRawOutput(exposure, amp_list)
+
+  def AbortStageOut(self):
+    """Stops a stage-out started by DoRaytrace() and discards its copies."""
+    if self.stage_out:
+      stage_out, self.stage_out = self.stage_out, None
+      logger.info('Aborting stage-out.')
+      stage_out.Abort()
+
+  def _Exposure(self):
+    return Exposure.Exposure(self.observation_id,
+                             Exposure.filterToLetter(self.filter_num),
+                             '%s_%s' % (self.cid, self.eid))
+
+  def _EimageOutputPairs(self, exposure):
+    """Returns [(eimage in phosim_output_dir, its name in save_path)]."""
+    dest_path, dest_fn = exposure.generateEimageOutputName()
+    return [(os.path.join(self.phosim_output_dir, exposure.generateEimageExecName()),
+             os.path.join(self.save_path, dest_path, dest_fn))]
+
+  def _RawOutputPairs(self, exposure, amp_list):
+    """Returns (e2adc output in phosim_output_dir, name in save_path) pairs."""
+    dest_path, dest_fns = exposure.generateRawOutputNames(ampList=amp_list)
+    src_fns = exposure.generateRawExecNames(ampList=amp_list)
+    return [(os.path.join(self.phosim_output_dir, src_fn),
+             os.path.join(self.save_path, dest_path, dest_fn))
+            for src_fn, dest_fn in zip(src_fns, dest_fns)]
 
   def _LoadAmpList(self):
-    with open(os.path.join(self.phosim_instr_dir,
-                           'segmentation.txt'), 'r') as ampf:
-      logger.info('Reading amp_list from %s.', ampf.name)
-      amp_list = Exposure.readAmpList(ampf, self.cid)
+    geometry = FocalplaneGeometry.GetGeometry(self.phosim_instr_dir)
+    amp_list = geometry.AmpList(self.cid)
+    logger.info('Loaded %d amps for %s from %s.', len(amp_list), self.cid,
+                geometry.segmentation_fn)
     return amp_list
 
   def _CopyAndModifyParsFiles(self):
-    """Copy .pars files to phosim_work_dir and append proper dirs.
+    """Extract this fid's input files to phosim_work_dir with proper dirs.
 
-    After copy, corrects the values of seddir, datadir, and instrdir.
+    Only this fid's .pars files, tracking pars and screens are taken from
+    the pars archive.  The values of seddir, datadir, and instrdir are
+    corrected as the .pars files are extracted.
 
     Raises:
       OSError if file operation fails.
-      CalledProcessError if unarchive fails.
+      zipfile.BadZipfile if the pars archive is not a zip file.
+    """
+    self._ExtractParsArchive(
+      os.path.join(self.my_input_path, self.pars_archive_name), [self.fid])
+    self._SetParsFiles()
+
+  def _LinkSharedInputFiles(self):
+    """Links the data dir and pars files of shared_env into this fid's dirs.
+
+    raytrace_<fid>.pars and e2adc_<fid>.pars are copied, since their dirs
+    are rewritten for this fid.  Those of other fids are skipped.
+    """
+    shared_work_dir = self.shared_env.phosim_work_dir
+    logger.info('Linking %s to %s.', self.shared_env.phosim_data_dir,
+                self.phosim_data_dir)
+    os.symlink(self.shared_env.phosim_data_dir, self.phosim_data_dir)
+    logger.info('Linking input files from %s to %s.', shared_work_dir,
+                self.phosim_work_dir)
+    for fn in os.listdir(shared_work_dir):
+      if not IsInputFileForFids(fn, [self.fid]):
+        continue
+      if IsFidParsFile(fn):
+        shutil.copy(os.path.join(shared_work_dir, fn), self.phosim_work_dir)
+      else:
+        os.symlink(os.path.join(shared_work_dir, fn),
+                   os.path.join(self.phosim_work_dir, fn))
+    self._SetParsFiles(update_dirs=True)
+
+  def _SetParsFiles(self, update_dirs=False):
+    """Sets my_raytrace_pars and my_e2adc_pars.
+
+    Args:
+      update_dirs:  Correct seddir, datadir, and instrdir in the files.
+
+    Raises:
+      OSError if raytrace_<fid>.pars is missing.
     """
-    cmd = 'unzip -d %s %s' % (
-      self.phosim_work_dir, os.path.join(self.my_input_path, self.pars_archive_name))
-    if self.stdout_log_fn:
-      cmd += ' >> %s' % self.stdout_log_fn
-    logger.info('Executing %s' % cmd)
-    subprocess.check_call(cmd, shell=True)
     self.my_raytrace_pars = os.path.join(self.phosim_work_dir,
                                          'raytrace_%s.pars' % self.fid)
     self.my_e2adc_pars = os.path.join(self.phosim_work_dir,
                                       'e2adc_%s.pars' % self.fid)
-    if os.path.isfile(self.my_raytrace_pars):
-      logger.info('Updating directories in %s' % self.my_raytrace_pars)
-      self.UpdatePhosimDirsInPars(self.my_raytrace_pars)
-    else:
+    if not os.path.isfile(self.my_raytrace_pars):
       raise OSError('Could not find file %s.' % self.my_raytrace_pars)
-    if os.path.isfile(self.my_e2adc_pars):
-      logger.info('Updating directories in %s' % self.my_e2adc_pars)
-      self.UpdatePhosimDirsInPars(self.my_e2adc_pars)
-    else:
+    if not os.path.isfile(self.my_e2adc_pars):
       self.my_e2adc_pars = None
+    if update_dirs:
+      for pars in (self.my_raytrace_pars, self.my_e2adc_pars):
+        if pars:
+          logger.info('Updating directories in %s' % pars)
+          self.UpdatePhosimDirsInPars(pars)
 
   def _MoveInputFiles(self):
     """Manages any input files/data needed for phosim execution."""
-    self._BuildDataDir()
-    self._CopyAndModifyParsFiles()
+    if self.shared_env:
+      self._LinkSharedInputFiles()
+    else:
+      self._BuildDataDir()
+      self._CopyAndModifyParsFiles()
 
   def _InitOutputDirectories(self):
     if not os.path.exists(self.save_path):
@@ -680,25 +1123,34 @@ class Raytracer(PhosimManager):
       os.makedirs(dest_path)
     return dest_path
 
-  def _CopyRawOutput(self, exposure, amp_list):
-    """Copies e2adc output from phosim_output_dir to proper dir in save_path."""
-    dest_path, dest_fns = exposure.generateRawOutputNames(ampList=amp_list)
-    dest_path = self._PrependAndCreateFullSavePath(dest_path)
-    src_fns = exposure.generateRawExecNames(ampList=amp_list)
-    for src_fn, dest_fn in zip(src_fns, dest_fns):
-      logger.info('Copying %s to %s.', os.path.join(self.phosim_output_dir, src_fn),
-                  os.path.join(dest_path, dest_fn))
-      shutil.copy(src_fn, os.path.join(dest_path, dest_fn))
-
   def _CopyZippedRawOutput(self, exposure, amp_list):
     """Copies e2adc output from phosim_output_dir to zip in proper dir in save_path."""
     dest_path, dest_fns = exposure.generateRawOutputNames(ampList=amp_list)
     dest_path = self._PrependAndCreateFullSavePath(dest_path)
     src_fns = exposure.generateRawExecNames(ampList=amp_list)
     zip_name = os.path.join(dest_path, PhosimUtil.ZipNameFromRaw(dest_fns[0]))
-    zipf = zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_STORED)
-    for src_fn, dest_fn in zip(src_fns, dest_fns):
-      src = os.path.join(self.phosim_output_dir, src_fn)
-      logger.info('Adding %s as %s to %s.', src, dest_fn, zip_name)
-      zipf.write(src, dest_fn)
-    zipf.close()
+    zipf = zipfile.ZipFile(PhosimUtil.StagingName(zip_name), 'w', zipfile.ZIP_STORED)
+    try:
+      for src_fn, dest_fn in zip(src_fns, dest_fns):
+        src = os.path.join(self.phosim_output_dir, src_fn)
+        logger.info('Adding %s as %s to %s.', src, dest_fn, zip_name)
+        zipf.write(src, dest_fn)
+    finally:
+      zipf.close()
+    os.rename(PhosimUtil.StagingName(zip_name), zip_name)
+
+  def _CopyMefRawOutput(self, exposure, amp_list):
+    """Merges e2adc output from phosim_output_dir into one MEF in save_path.
+
+    Each amp becomes an extension named by its amp ID.  FitsUtil.py can
+    extract the per-amp files under their usual names.
+    """
+    dest_path, dest_fns = exposure.generateRawOutputNames(ampList=amp_list)
+    dest_path = self._PrependAndCreateFullSavePath(dest_path)
+    src_fns = exposure.generateRawExecNames(ampList=amp_list)
+    mef_name = os.path.join(dest_path, PhosimUtil.MefNameFromRaw(dest_fns[0]))
+    logger.info('Merging %d e2adc output files into %s.', len(src_fns), mef_name)
+    FitsUtil.MergeAmpFiles(
+      [os.path.join(self.phosim_output_dir, src_fn) for src_fn in src_fns],
+      amp_list, PhosimUtil.StagingName(mef_name), filenames=dest_fns)
+    os.rename(PhosimUtil.StagingName(mef_name), mef_name)
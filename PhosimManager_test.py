@@ -4,6 +4,9 @@ import os
 import tempfile
 import types
 import unittest
+import zipfile
+import FootprintFilter
+import FootprintFilter_test
 import PhosimManager
 import PhosimUtil
 import ScriptWriter
@@ -152,6 +155,160 @@ class PhosimPreprocessorTest(BasePhosimManagerTest):
     self.assertEquals(mgr.observation_id, '12345')
     self.assertEquals(mgr.filter_num, '1')
 
+  def testMinSourceFromTrimfile(self):
+    self.assertEquals(PhosimManager.MinSourceFromTrimfile({}), None)
+    self.assertEquals(PhosimManager.MinSourceFromTrimfile({'SIM_MINSOURCE': '3'}), 3)
+    extra_commands = os.path.join(self.tmpdir, 'extra_commands')
+    with open(extra_commands, 'w') as f:
+      f.write('extraid 3\nminsource 10\n')
+    self.assertEquals(PhosimManager.MinSourceFromTrimfile({'SIM_MINSOURCE': '3'},
+                                                          extra_commands), 10)
+
+  def testFootprintSensors(self):
+    mgr = PhosimManager.Preprocessor(self.imsim_config_file,
+                                     FootprintFilter_test.TRIMFILE,
+                                     script_writer_class=MockScriptWriter)
+    FootprintFilter_test.WriteInstrDir(self.tmpdir)
+    mgr.phosim_instr_dir = self.tmpdir
+    # SIM_MINSOURCE is 1: only the far corner chip has no sources.
+    self.assertEquals(mgr._FootprintSensors(),
+                      'R22_S11|R22_S12|R22_S21|R22_S10|R22_S01')
+    mgr.sensor = 'R40_S11|R22_S11'
+    self.assertEquals(mgr._FootprintSensors(), 'R22_S11')
+    # If no chip is left, all requested sensors are trimmed.
+    mgr.sensor = 'R40_S11'
+    self.assertEquals(mgr._FootprintSensors(), 'R40_S11')
+
+
+class RaytraceEnvironmentTest(BasePhosimManagerTest):
+
+  def setUp(self):
+    self.BaseSetup()
+    self.obsid = '12345'
+    self.fids = ['%s_R22_S11_E00%d' % (self.obsid, i) for i in range(2)]
+    input_path = os.path.join(self.cfg_dict['stage_path'], self.obsid)
+    os.makedirs(input_path)
+    os.makedirs(os.path.join(self.cfg_dict['shared_data_path'], 'lsst'))
+    with PhosimUtil.ManifestParser(os.path.join(input_path, 'manifest.txt'),
+                                   'w') as parser:
+      parser.Write([('param', 'observation_id', self.obsid),
+                    ('param', 'filter_num', '2'),
+                    ('param', 'instrument', 'lsst'),
+                    ('param', 'run_e2adc', 'True'),
+                    ('set', 'exposure_id', 'R22_S11_E000'),
+                    ('set', 'exposure_id', 'R22_S11_E001')])
+    zipf = zipfile.ZipFile(os.path.join(input_path, 'pars.zip'), 'w')
+    for fid in self.fids:
+      zipf.writestr('raytrace_%s.pars' % fid, 'datadir old\nfid %s\n' % fid)
+      zipf.writestr('e2adc_%s.pars' % fid, 'instrdir old\n')
+    zipf.writestr('tracking_%s.pars' % self.obsid, 'tracking\n')
+    zipf.writestr('airglowscreen_%s.fits' % self.obsid, '')
+    for i in range(70):
+      zipf.writestr('atmospherescreen_%s_%d.fits' % (self.obsid, i), '')
+    zipf.close()
+
+  def testSelectiveExtraction(self):
+    raytracer = PhosimManager.Raytracer(self.policy, self.obsid, 'R22_S11',
+                                        'E000')
+    raytracer.pars_archive_name = 'pars.zip'
+    raytracer.InitDirectories()
+    work_fns = os.listdir(raytracer.phosim_work_dir)
+    self.assertEquals(1 + 1 + 2 + 70, len(work_fns))
+    self.assertTrue('tracking_%s.pars' % self.obsid in work_fns)
+    self.assertFalse('raytrace_%s.pars' % self.fids[1] in work_fns)
+    self.assertFalse('e2adc_%s.pars' % self.fids[1] in work_fns)
+    with open(raytracer.my_raytrace_pars, 'r') as f:
+      self.assertEquals(['datadir %s\n' % raytracer.phosim_data_dir,
+                         'fid %s\n' % self.fids[0]], f.readlines())
+    with open(raytracer.my_e2adc_pars, 'r') as f:
+      self.assertEquals('instrdir %s\n' % raytracer.phosim_instr_dir, f.read())
+    self.assertTrue(raytracer.CheckAndDoAtmoscreens())
+
+  def testIsInputFileForFids(self):
+    fids = self.fids[:1]
+    self.assertTrue(PhosimManager.IsInputFileForFids(
+      'raytrace_%s.pars' % self.fids[0], fids))
+    self.assertFalse(PhosimManager.IsInputFileForFids(
+      'e2adc_%s.pars' % self.fids[1], fids))
+    self.assertTrue(PhosimManager.IsInputFileForFids(
+      'tracking_%s.pars' % self.obsid, fids))
+    self.assertTrue(PhosimManager.IsInputFileForFids(
+      'raytrace_%s.pars' % self.fids[1]))
+
+  def testSharedEnvironment(self):
+    env = PhosimManager.RaytraceEnvironment(self.policy, self.obsid)
+    self.assertEquals('2', env.filter_num)
+    self.assertEquals('lsst', env.instrument)
+    self.assertTrue(env.run_e2adc)
+    self.assertEquals(['R22_S11_E000', 'R22_S11_E001'], env.exposure_ids)
+    self.assertTrue(os.path.isfile(env.manifest_fullpath))
+    env.InitExecEnvironment('pars.zip')
+    raytracer = PhosimManager.Raytracer(self.policy, self.obsid, 'R22_S11',
+                                        'E001', shared_env=env)
+    self.assertEquals('2', raytracer.filter_num)
+    raytracer.InitDirectories()
+    self.assertEquals(os.path.realpath(env.phosim_data_dir),
+                      os.path.realpath(raytracer.phosim_data_dir))
+    work_fns = os.listdir(raytracer.phosim_work_dir)
+    self.assertTrue('raytrace_%s.pars' % self.fids[1] in work_fns)
+    self.assertFalse('raytrace_%s.pars' % self.fids[0] in work_fns)
+    self.assertFalse(os.path.islink(raytracer.my_raytrace_pars))
+    with open(raytracer.my_raytrace_pars, 'r') as f:
+      self.assertEquals('datadir %s\n' % raytracer.phosim_data_dir, f.readline())
+    self.assertTrue(os.path.islink(os.path.join(
+      raytracer.phosim_work_dir, 'airglowscreen_%s.fits' % self.obsid)))
+    self.assertTrue(raytracer.CheckAndDoAtmoscreens())
+    raytracer.Cleanup()
+    self.assertTrue(os.path.isdir(env.phosim_work_dir))
+    env.Cleanup()
+    self.assertFalse(os.path.exists(env.my_exec_path))
+
+
+class MockScreenManager(PhosimManager.PhosimManager):
+  """Makes fake atmosphere screens instead of calling phosim."""
+  def __init__(self, policy, work_dir):
+    PhosimManager.PhosimManager.__init__(self, policy)
+    self.phosim_work_dir = work_dir
+    self.ngenerated = 0
+
+  def _GenerateAtmoscreens(self, raytrace_pars):
+    self.ngenerated += 1
+    fns = ['airglowscreen_12345.fits']
+    fns.extend(['atmospherescreen_12345_%d.fits' % i for i in range(70)])
+    for fn in fns:
+      open(os.path.join(self.phosim_work_dir, fn), 'w').close()
+
+
+class AtmoscreenCacheTest(BasePhosimManagerTest):
+
+  def setUp(self):
+    self.BaseSetup()
+    self.policy.set('general', 'atmoscreen_cache_dir',
+                    os.path.join(self.tmpdir, 'atmoscreen_cache'))
+    self.policy.set('general', 'atmoscreen_cache_max_gb', '1')
+
+  def MakeManager(self, name):
+    work_dir = os.path.join(self.tmpdir, name)
+    os.makedirs(work_dir)
+    open(os.path.join(work_dir, 'raytrace_12345_R22_S11_E000.pars'), 'w').close()
+    return MockScreenManager(self.policy, work_dir)
+
+  def testScreensAreGeneratedOncePerNode(self):
+    first = self.MakeManager('work1')
+    self.assertFalse(first._CheckAndDoAtmoscreens('12345', 'raytrace.pars'))
+    second = self.MakeManager('work2')
+    self.assertTrue(second._CheckAndDoAtmoscreens('12345', 'raytrace.pars'))
+    self.assertEquals(1, first.ngenerated)
+    self.assertEquals(0, second.ngenerated)
+    self.assertEquals(sorted(os.listdir(first.phosim_work_dir)),
+                      sorted(os.listdir(second.phosim_work_dir)))
+
+  def testNoCache(self):
+    self.policy.remove_option('general', 'atmoscreen_cache_dir')
+    mgr = self.MakeManager('work1')
+    self.assertFalse(mgr._CheckAndDoAtmoscreens('12345', 'raytrace.pars'))
+    self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'atmoscreen_cache')))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,13 +5,27 @@
 from __future__ import with_statement
 import csv
 import datetime
+import errno
+import fcntl
 import getpass
 import glob
+import hashlib
 import logging
 import os
+import Queue
 import shutil
+import signal
+import stat
+import StringIO
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
 
 __author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
 
@@ -29,6 +43,10 @@ def ZipNameFromRaw(raw_fn):
       zip_base += '%s_' % s
   return zip_base.rstrip('_') + '.zip'
 
+def MefNameFromRaw(raw_fn):
+  """Returns the multi-extension FITS name for a raw (i.e. e2adc) fits output."""
+  return ZipNameFromRaw(raw_fn)[:-len('.zip')] + '.fits.gz'
+
 def RemoveDirOrLink(dir_name):
   """Recusively deletes a directory if it is hard,  or soft link."""
   if os.path.islink(dir_name):
@@ -204,6 +222,625 @@ def StageFiles(source_list, dest, decompress=False, unarchive=False,
       UnarchiveFileByExtAndDelete(dest_fn)
 
 
+def MakeDirs(path):
+  """os.makedirs() that does not mind if path exists (or is created meanwhile)."""
+  try:
+    os.makedirs(path)
+  except OSError:
+    if not os.path.isdir(path):
+      raise
+
+def StagingName(dest):
+  """Returns the name under which dest is written before it is renamed into place."""
+  dest_dir, fn = os.path.split(dest)
+  return os.path.join(dest_dir, '.%s.%d.tmp' % (fn, os.getpid()))
+
+def AtomicCopy(src, dest):
+  """Copies src to dest so that dest never exists partially written."""
+  MakeDirs(os.path.dirname(dest))
+  tmp = StagingName(dest)
+  shutil.copy(src, tmp)
+  os.rename(tmp, dest)
+
+def _StatKey(fn):
+  """Returns (size, mtime) of fn, or None if it does not exist."""
+  try:
+    st = os.stat(fn)
+  except OSError:
+    return None
+  return st.st_size, st.st_mtime
+
+class StageOutWatcher(object):
+  """Copies output files to shared storage in the background as they appear.
+
+  A typical use is:
+    watcher = StageOutWatcher([(src, dest), ...]).Start()
+    <run the code that writes the src files>
+    watcher.Finish()
+
+  While it runs, a watcher thread polls the src files.  A file that has
+  not changed size or mtime for settle_time seconds is handed to one of
+  nthreads copier threads, which copies it to StagingName(dest).  Since
+  that is only a heuristic for 'complete', Finish() copies again any file
+  that has changed since (or was never copied), and only then renames
+  the copies into place.  The result is the same as copying every file
+  with AtomicCopy() at the end, but most of the transfer overlaps with
+  the computation.
+  """
+
+  def __init__(self, pairs, nthreads=2, poll_interval=2.0, settle_time=5.0):
+    """Constructor.
+
+    Args:
+      pairs:         List of (src, dest) full path names.
+      nthreads:      Number of concurrent copies.
+      poll_interval: Seconds between polls of the src files.
+      settle_time:   Seconds a src file must be unchanged before it is copied.
+    """
+    self.pairs = list(pairs)
+    self.nthreads = max(1, nthreads)
+    self.poll_interval = poll_interval
+    self.settle_time = settle_time
+    self._queue = Queue.Queue()
+    self._stop = threading.Event()
+    self._lock = threading.Lock()
+    self._staged = {}   # src -> _StatKey(src) of the copy at StagingName(dest)
+    self._errors = {}   # src -> sys.exc_info() of its last failed copy
+    self._watcher = None
+    self._copiers = []
+
+  def Start(self):
+    """Starts the watcher and copier threads.  Returns self."""
+    for unused_i in range(self.nthreads):
+      copier = threading.Thread(target=self._CopyLoop)
+      copier.setDaemon(True)
+      copier.start()
+      self._copiers.append(copier)
+    self._watcher = threading.Thread(target=self._WatchLoop)
+    self._watcher.setDaemon(True)
+    self._watcher.start()
+    return self
+
+  def _WatchLoop(self):
+    seen = {}     # src -> (_StatKey(src), time it was first seen)
+    queued = set()
+    while len(queued) < len(self.pairs):
+      now = time.time()
+      for src, dest in self.pairs:
+        if src in queued:
+          continue
+        key = _StatKey(src)
+        if key is None:
+          continue
+        if src not in seen or seen[src][0] != key:
+          seen[src] = (key, now)
+        elif now - seen[src][1] >= self.settle_time:
+          logger.debug('Staging %s to %s.', src, dest)
+          queued.add(src)
+          self._queue.put((src, dest))
+      self._stop.wait(self.poll_interval)
+      if self._stop.isSet():
+        break
+
+  def _CopyLoop(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        src, dest = item
+        key = _StatKey(src)
+        MakeDirs(os.path.dirname(dest))
+        shutil.copy(src, StagingName(dest))
+        # If src changed during the copy, Finish() will copy it again.
+        self._lock.acquire()
+        try:
+          self._errors.pop(src, None)
+          if _StatKey(src) == key:
+            self._staged[src] = key
+        finally:
+          self._lock.release()
+      except Exception:
+        self._lock.acquire()
+        try:
+          self._errors[src] = sys.exc_info()
+        finally:
+          self._lock.release()
+      finally:
+        self._queue.task_done()
+
+  def _StopThreads(self):
+    self._stop.set()
+    if self._watcher:
+      self._watcher.join()
+      self._watcher = None
+    self._queue.join()
+    for unused_copier in self._copiers:
+      self._queue.put(None)
+    for copier in self._copiers:
+      copier.join()
+    self._copiers = []
+
+  def _Discard(self, pairs):
+    for unused_src, dest in pairs:
+      if os.path.exists(StagingName(dest)):
+        os.remove(StagingName(dest))
+
+  def Finish(self, pairs=None):
+    """Completes the stage-out and renames the copies into place.
+
+    Args:
+      pairs:  The (src, dest) pairs to complete (default: all).  Staged
+              copies of other pairs are discarded.
+
+    Returns:
+      Number of files whose background copy was current.
+
+    Raises:
+      Whatever the final copy of one of pairs raised, e.g. IOError if a
+      src file does not exist.  Failed background copies that Finish()
+      copied again successfully are not errors.
+    """
+    if pairs is None:
+      pairs = self.pairs
+    self._stop.set()
+    if self._watcher:
+      self._watcher.join()
+      self._watcher = None
+    nstaged = 0
+    self._queue.join()
+    for src, dest in pairs:
+      if self._staged.get(src) is not None and self._staged[src] == _StatKey(src):
+        nstaged += 1
+      else:
+        self._staged.pop(src, None)
+        self._errors.pop(src, None)
+        self._queue.put((src, dest))
+    self._StopThreads()
+    failed = [src for src, dest in pairs if src in self._errors]
+    if failed:
+      self._Discard(self.pairs)
+      exc_info = self._errors[failed[0]]
+      raise exc_info[0], exc_info[1], exc_info[2]
+    for src, dest in pairs:
+      logger.info('Staged %s to %s.', src, dest)
+      os.rename(StagingName(dest), dest)
+    self._Discard([pair for pair in self.pairs if pair not in pairs])
+    logger.info('Stage-out of %d files complete; %d were copied in the'
+                ' background.', len(pairs), nstaged)
+    return nstaged
+
+  def Abort(self):
+    """Stops the threads and discards all staged copies."""
+    self._StopThreads()
+    self._Discard(self.pairs)
+
+
+# ********************************************
+# FILE LOCKING AND NODE-LOCAL CACHE
+# ********************************************
+
+def LinkOrCopy(src, dest):
+  """Hard-links src to dest, or copies it if they are on different devices.
+
+  An existing dest is replaced.
+  """
+  if os.path.lexists(dest):
+    os.remove(dest)
+  try:
+    os.link(src, dest)
+  except OSError:
+    shutil.copy2(src, dest)
+
+class FileLock(object):
+  """Exclusive advisory lock on a file, for use with 'with'.
+
+  This uses fcntl.flock(), so the kernel drops the lock when its holder
+  exits, however it exits, and a lock can never be left stale.  flock()
+  is not reliable on NFS, so keep lock files on node-local storage.
+  """
+  def __init__(self, fn):
+    self.fn = fn
+    self.fd = None
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.Release()
+
+  def Acquire(self, blocking=True):
+    """Acquires the lock.
+
+    Returns:
+      True, or False if blocking is False and the lock is held elsewhere.
+    """
+    fd = os.open(self.fn, os.O_RDWR | os.O_CREAT, 0666)
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+      fcntl.flock(fd, flags)
+    except IOError, e:
+      os.close(fd)
+      if not blocking and e.errno in (errno.EAGAIN, errno.EACCES):
+        return False
+      raise
+    self.fd = fd
+    return True
+
+  def Release(self):
+    if self.fd is not None:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+      os.close(self.fd)
+      self.fd = None
+
+class NodeCache(object):
+  """Size-bounded LRU cache of sets of files, shared by the jobs on a node.
+
+  Each entry is a directory cache_dir/<key> holding the files and a
+  readiness marker that is written after the last file.  An entry without
+  the marker (its writer was killed) is discarded.  Callers hold Lock(key)
+  while they look an entry up and, on a miss, produce and Put() the files,
+  so that concurrent jobs wait for the first one instead of repeating its
+  work:
+    cache = NodeCache(cache_dir, max_bytes)
+    with cache.Lock(key):
+      if cache.Get(key, work_dir) is None:
+        <generate files in work_dir>
+        cache.Put(key, files)
+  """
+  READY_FN = '.ready'
+
+  def __init__(self, cache_dir, max_bytes=None):
+    """Constructor.
+
+    Args:
+      cache_dir:  Node-local directory for the cache.  Created if needed.
+      max_bytes:  Evict least-recently-used entries beyond this size.  None
+                  means no limit.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    try:
+      os.makedirs(cache_dir)
+    except OSError:
+      if not os.path.isdir(cache_dir):
+        raise
+
+  def _EntryDir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def Lock(self, key):
+    """Returns a FileLock for entry key."""
+    return FileLock(os.path.join(self.cache_dir, '%s.lock' % key))
+
+  def Get(self, key, dest_dir):
+    """Links the files of entry key into dest_dir.  Hold Lock(key).
+
+    Files are hard-linked (or copied), not symlinked, so that they survive
+    eviction of the entry.
+
+    Returns:
+      List of the names of the files, or None if there is no ready entry.
+    """
+    entry_dir = self._EntryDir(key)
+    ready_fn = os.path.join(entry_dir, self.READY_FN)
+    if not os.path.isfile(ready_fn):
+      if os.path.isdir(entry_dir):
+        logger.warning('Discarding incomplete cache entry %s.', entry_dir)
+        shutil.rmtree(entry_dir)
+      return None
+    fns = [fn for fn in os.listdir(entry_dir) if fn != self.READY_FN]
+    for fn in fns:
+      LinkOrCopy(os.path.join(entry_dir, fn), os.path.join(dest_dir, fn))
+    # The marker's mtime is the entry's last use.
+    os.utime(ready_fn, None)
+    logger.info('Linked %d cached files from %s to %s.', len(fns), entry_dir,
+                dest_dir)
+    return fns
+
+  def Put(self, key, paths):
+    """Stores the files in paths as entry key.  Hold Lock(key).
+
+    Any existing entry is replaced, then the cache is trimmed to max_bytes.
+    """
+    entry_dir = self._EntryDir(key)
+    if os.path.exists(entry_dir):
+      shutil.rmtree(entry_dir)
+    os.makedirs(entry_dir)
+    for path in paths:
+      LinkOrCopy(path, os.path.join(entry_dir, os.path.basename(path)))
+    open(os.path.join(entry_dir, self.READY_FN), 'w').close()
+    logger.info('Cached %d files in %s.', len(paths), entry_dir)
+    self.Evict(keep=key)
+
+  def Evict(self, keep=None):
+    """Deletes least-recently-used entries until the cache fits max_bytes.
+
+    Entries that are locked by another job, and the entry keep, are skipped.
+    """
+    if self.max_bytes is None:
+      return
+    entries = []
+    total_bytes = 0
+    for key in os.listdir(self.cache_dir):
+      ready_fn = os.path.join(self.cache_dir, key, self.READY_FN)
+      if not os.path.isfile(ready_fn):
+        continue
+      entry_dir = self._EntryDir(key)
+      nbytes = sum([os.path.getsize(os.path.join(entry_dir, fn))
+                    for fn in os.listdir(entry_dir)])
+      entries.append((os.path.getmtime(ready_fn), key, nbytes))
+      total_bytes += nbytes
+    entries.sort()
+    for unused_mtime, key, nbytes in entries:
+      if total_bytes <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      lock = self.Lock(key)
+      if not lock.Acquire(blocking=False):
+        continue
+      try:
+        logger.info('Evicting %s from cache.', self._EntryDir(key))
+        shutil.rmtree(self._EntryDir(key))
+      finally:
+        lock.Release()
+      total_bytes -= nbytes
+
+
+def IsProcessAlive(pid):
+  """Is there a process with this pid on this host?"""
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno == errno.EPERM
+  return True
+
+def SetTreeWritable(top, writable):
+  """Adds (or removes everybody's) write permission to top and its contents."""
+  no_write = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+  for dirpath, unused_dirnames, filenames in os.walk(top):
+    for path in [dirpath] + [os.path.join(dirpath, fn) for fn in filenames]:
+      if os.path.islink(path):
+        continue
+      mode = stat.S_IMODE(os.stat(path).st_mode)
+      os.chmod(path, mode | stat.S_IWUSR if writable else mode & no_write)
+
+def TreeSize(top):
+  """Returns the number of bytes in the files under top."""
+  nbytes = 0
+  for dirpath, unused_dirnames, filenames in os.walk(top):
+    for fn in filenames:
+      nbytes += os.lstat(os.path.join(dirpath, fn)).st_size
+  return nbytes
+
+class DataDirCache(object):
+  """Node-wide cache of extracted data tarballs, keyed by content hash.
+
+  Each tarball is extracted once per node into cache_dir/<sha1>/data,
+  which jobs link to as their phosim data dir and must not modify (it is
+  made read-only).  The tarball is hashed while it is streamed into tar,
+  so it is only read once; the hash is remembered per (path, size, mtime)
+  so that later jobs do not read it at all.
+
+  Every job that uses an entry holds a reference (a file named after its
+  pid) from Acquire() until Release().  Entries without live references
+  are evicted least-recently-used first once the cache exceeds max_bytes,
+  and as soon as a newer version of the same tarball has been extracted.
+  References of processes that have died are ignored, so a killed job
+  does not pin an entry forever.
+  """
+  DATA_DIR = 'data'
+  READY_FN = 'ready'
+  REFS_DIR = 'refs'
+  HASHES_DIR = '.hashes'
+  EXTRACT_PREFIX = '.extract_'
+
+  def __init__(self, cache_dir, max_bytes=None):
+    """Constructor.
+
+    Args:
+      cache_dir:  Node-local directory for the cache.  Created if needed.
+      max_bytes:  Evict unreferenced entries beyond this size.  None means
+                  no limit.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    for path in (cache_dir, os.path.join(cache_dir, self.HASHES_DIR)):
+      try:
+        os.makedirs(path)
+      except OSError:
+        if not os.path.isdir(path):
+          raise
+
+  def _EntryDir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def _Lock(self, name):
+    return FileLock(os.path.join(self.cache_dir, '%s.lock' % name))
+
+  def _IsReady(self, key):
+    return os.path.isfile(os.path.join(self._EntryDir(key), self.READY_FN))
+
+  def _ReadReady(self, key):
+    """Returns (tarball path, nbytes) from the entry's readiness marker."""
+    with open(os.path.join(self._EntryDir(key), self.READY_FN), 'r') as f:
+      tarball_path, nbytes = f.read().splitlines()[:2]
+    return tarball_path, int(nbytes)
+
+  def Acquire(self, tarball_path):
+    """Returns the data dir for tarball_path, extracting it if needed.
+
+    Returns:
+      (data dir, reference) where reference must be passed to Release()
+      when the data dir is no longer used.
+    """
+    tarball_path = os.path.abspath(tarball_path)
+    source_id = hashlib.md5(tarball_path).hexdigest()
+    st = os.stat(tarball_path)
+    stamp = '%s %d %r' % (tarball_path, st.st_size, st.st_mtime)
+    hash_fn = os.path.join(self.cache_dir, self.HASHES_DIR, source_id)
+    # Jobs that need the same tarball wait here for the first to extract it.
+    with self._Lock('source_%s' % source_id):
+      key = None
+      if os.path.isfile(hash_fn):
+        with open(hash_fn, 'r') as f:
+          lines = f.read().splitlines()
+        if len(lines) == 2 and lines[0] == stamp:
+          key = lines[1]
+      ref = None
+      if key:
+        with self._Lock(key):
+          if self._IsReady(key):
+            ref = self._AddRef(key)
+      if not ref:
+        key, ref = self._Extract(tarball_path)
+        with open(hash_fn, 'w') as f:
+          f.write('%s\n%s\n' % (stamp, key))
+      else:
+        logger.info('Using cached data dir %s for %s.', self._EntryDir(key),
+                    tarball_path)
+    self.Evict(keep=key, superseded=(tarball_path, key))
+    return os.path.join(self._EntryDir(key), self.DATA_DIR), ref
+
+  def _AddRef(self, key):
+    """Adds a reference to entry key and marks it used.  Hold its lock."""
+    refs_dir = os.path.join(self._EntryDir(key), self.REFS_DIR)
+    fd, ref = tempfile.mkstemp(prefix='%d_' % os.getpid(), dir=refs_dir)
+    os.close(fd)
+    os.utime(os.path.join(self._EntryDir(key), self.READY_FN), None)
+    return ref
+
+  @staticmethod
+  def Release(ref):
+    """Releases a reference returned by Acquire()."""
+    if os.path.exists(ref):
+      os.remove(ref)
+
+  def _Extract(self, tarball_path):
+    """Extracts tarball_path into a new entry and references it.
+
+    Returns:
+      (key, reference)
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='%s%d_' % (self.EXTRACT_PREFIX, os.getpid()),
+                               dir=self.cache_dir)
+    data_dir = os.path.join(tmp_dir, self.DATA_DIR)
+    os.makedirs(data_dir)
+    os.makedirs(os.path.join(tmp_dir, self.REFS_DIR))
+    cmd = ['tar', '-x', '-C', data_dir, '-f', '-']
+    if tarball_path.endswith('.gz') or tarball_path.endswith('.tgz'):
+      cmd.insert(1, '--use-compress-program=pigz' if FindExecutable('pigz') else '-z')
+    elif tarball_path.endswith('.bz2'):
+      cmd.insert(1, '--use-compress-program=pbzip2' if FindExecutable('pbzip2') else '-j')
+    logger.info('Extracting %s to %s with %s.', tarball_path, data_dir,
+                ' '.join(cmd))
+    sha1 = hashlib.sha1()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+      with open(tarball_path, 'rb') as tarball:
+        while True:
+          block = tarball.read(1 << 20)
+          if not block:
+            break
+          sha1.update(block)
+          proc.stdin.write(block)
+    except IOError, e:
+      # tar exiting early shows up as EPIPE here; report its status instead.
+      if e.errno != errno.EPIPE:
+        # Popen.kill() needs Python 2.6.
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.wait()
+        shutil.rmtree(tmp_dir)
+        raise
+    proc.stdin.close()
+    if proc.wait():
+      shutil.rmtree(tmp_dir)
+      raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+    SetTreeWritable(data_dir, False)
+    with open(os.path.join(tmp_dir, self.READY_FN), 'w') as f:
+      f.write('%s\n%d\n' % (tarball_path, TreeSize(data_dir)))
+    key = sha1.hexdigest()
+    with self._Lock(key):
+      if self._IsReady(key):
+        logger.info('%s is already cached as %s.', tarball_path, key)
+        self._RemoveTree(tmp_dir)
+      else:
+        if os.path.exists(self._EntryDir(key)):
+          self._RemoveTree(self._EntryDir(key))
+        os.rename(tmp_dir, self._EntryDir(key))
+      return key, self._AddRef(key)
+
+  def _RemoveTree(self, path):
+    SetTreeWritable(path, True)
+    shutil.rmtree(path)
+
+  def _HasLiveRefs(self, key):
+    """Are there references from running processes?  Drops the others."""
+    refs_dir = os.path.join(self._EntryDir(key), self.REFS_DIR)
+    live = False
+    for ref in os.listdir(refs_dir):
+      if IsProcessAlive(int(ref.split('_', 1)[0])):
+        live = True
+      else:
+        logger.info('Dropping stale reference %s.', os.path.join(refs_dir, ref))
+        os.remove(os.path.join(refs_dir, ref))
+    return live
+
+  def Evict(self, keep=None, superseded=None):
+    """Deletes unreferenced entries.
+
+    Entries built from the same tarball path as superseded=(path, key),
+    other than key itself, are always deleted.  Then entries are deleted
+    least-recently-used first while the cache exceeds max_bytes.  Leftovers
+    of extractions by dead processes are deleted, too.
+    """
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(self.cache_dir):
+      path = os.path.join(self.cache_dir, name)
+      if name.startswith(self.EXTRACT_PREFIX):
+        if not IsProcessAlive(int(name[len(self.EXTRACT_PREFIX):].split('_', 1)[0])):
+          logger.info('Removing abandoned extraction %s.', path)
+          self._RemoveTree(path)
+        continue
+      if not os.path.isdir(path) or name == self.HASHES_DIR or not self._IsReady(name):
+        continue
+      tarball_path, nbytes = self._ReadReady(name)
+      old = (superseded and tarball_path == superseded[0] and
+             name != superseded[1])
+      last_used = os.path.getmtime(os.path.join(path, self.READY_FN))
+      entries.append((not old, last_used, name, nbytes))
+      total_bytes += nbytes
+    # Superseded versions first, then least recently used.
+    entries.sort()
+    for current, unused_last_used, key, nbytes in entries:
+      if current and (self.max_bytes is None or total_bytes <= self.max_bytes):
+        break
+      if key == keep:
+        continue
+      lock = self._Lock(key)
+      if not lock.Acquire(blocking=False):
+        continue
+      try:
+        if self._HasLiveRefs(key):
+          continue
+        logger.info('Evicting %s from data dir cache.', self._EntryDir(key))
+        self._RemoveTree(self._EntryDir(key))
+        total_bytes -= nbytes
+      finally:
+        lock.Release()
+
+def FindExecutable(name):
+  """Returns the full path of executable name in PATH, or None."""
+  for path in os.environ.get('PATH', '').split(os.pathsep):
+    fn = os.path.join(path, name)
+    if os.path.isfile(fn) and os.access(fn, os.X_OK):
+      return fn
+  return None
+
+
 # ********************************************
 # TIMERS
 # ********************************************
@@ -302,6 +939,15 @@ def WriteLogHeader(name, params_str='', stream=None):
 # ********************************************
 # FILE AND PARAM MANFEST
 # ********************************************
+def _ManifestField(value):
+  """Returns value as csv.writer writes it, i.e. as Read() will return it."""
+  if value is None:
+    return ''
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
 class ManifestParser(object):
   """Class for reading and writing file/param manifest.
 
@@ -311,11 +957,22 @@ class ManifestParser(object):
       manifest = parser.Get()
 
   One can also supply file pointers as manifest_fp.
+
+  Read() indexes the values (3rd column) of each row by its (major, minor)
+  tags, so GetAllByTags() and GetLastByTags() do not scan the manifest.
+  IterRows() streams rows without keeping them in memory.  Rows passed to
+  Append() are buffered and written FLUSH_ROWS at a time.
   """
+  # Number of rows Append() buffers before writing them.
+  FLUSH_ROWS = 256
+
   def __init__(self, fn=None, filemode=None):
     self.fn = fn
     self.filemode = filemode
     self.manfp = None
+    self.list_2d = []
+    self.index = {}
+    self.pending = []
 
   def __enter__(self):
     self.Open()
@@ -335,8 +992,20 @@ class ManifestParser(object):
 
   def Close(self):
     if self.manfp:
+      self.Flush()
       self.manfp.close()
 
+  def IterRows(self, manifest_fp=None, matcher=None):
+    """Yields each row of manifest_fp (as a tuple) for which matcher is True.
+
+    Rows are read one at a time and are not stored.
+    """
+    if not manifest_fp:
+      manifest_fp = self.manfp
+    for row in csv.reader(manifest_fp):
+      if not matcher or matcher(row):
+        yield tuple(row)
+
   def Read(self, manifest_fp=None, matcher=None):
     """Reads 2d list from manifest_fp.
 
@@ -347,15 +1016,18 @@ class ManifestParser(object):
     Returns:
       2d list
     """
-    if not manifest_fp:
-      manifest_fp = self.manfp
-    reader = csv.reader(manifest_fp)
     self.list_2d = []
-    for row in reader:
-      if not matcher or matcher(row):
-        self.list_2d.append(tuple(row))
+    self.index = {}
+    for row in self.IterRows(manifest_fp, matcher):
+      self.list_2d.append(row)
+      self._IndexRow(row)
     return self.list_2d
 
+  def _IndexRow(self, row):
+    # Index values as they will read back, whatever their type in Write().
+    if len(row) > 2:
+      self.index.setdefault((row[0], row[1]), []).append(_ManifestField(row[2]))
+
   def Get(self):
     return self.list_2d
 
@@ -365,13 +1037,18 @@ class ManifestParser(object):
 
   def GetAllByTags(self, major_tag, minor_tag):
     """Return data in all rows that match major_tag and minor_tag."""
-    return self.GetByMatcher(lambda row: row[2] if row[0] == major_tag and
-                             row[1] == minor_tag else None)
+    return list(self.index.get((major_tag, minor_tag), []))
 
   def GetLastByTags(self, major_tag, minor_tag):
-    """Return data in the last row that matches major_tag and minor_tag."""
-    return self.GetByMatcher(lambda row: row[2] if row[0] in major_tag and
-                             row[1] in minor_tag else None)[-1]
+    """Return data in the last row that matches major_tag and minor_tag.
+
+    Raises:
+      IndexError if there is no such row.
+    """
+    values = self.index.get((major_tag, minor_tag))
+    if not values:
+      raise IndexError('No (%s, %s) row in manifest.' % (major_tag, minor_tag))
+    return values[-1]
 
   def GetByMatcher(self, matcher):
     """Return a list from manifest filtered by the function matcher.
@@ -382,8 +1059,9 @@ class ManifestParser(object):
     """
     filtered_list = []
     for row in self.list_2d:
-      if matcher(row):
-        filtered_list.append(matcher(row))
+      result = matcher(row)
+      if result:
+        filtered_list.append(result)
     return filtered_list
 
   def ManifestFileTypeByExt(self, fn):
@@ -400,13 +1078,153 @@ class ManifestParser(object):
 
   def Write(self, list_2d, manifest_fp=None):
     """Writes a 2d list to manifest.
+
+    Rows queued by Append() are written first, so rows keep their order.
+    Rows written to the manifest opened by Open() can be looked up by tag
+    right away.
+
     Args:
       list_2d:     A 2d list to write to manifest_fp.
       manifest_fp: Optional pointer to manifest file
     """
     for line in list_2d:
       logger.debug('Writing to manifest: %s', line)
+    if not manifest_fp or manifest_fp is self.manfp:
+      self.Flush()
+      for row in list_2d:
+        self._IndexRow(row)
     if not manifest_fp:
       manifest_fp = self.manfp
     writer = csv.writer(manifest_fp)
     writer.writerows(list_2d)
+
+  def Append(self, list_2d):
+    """Queues rows to be written to the manifest opened by Open().
+
+    The rows are written once FLUSH_ROWS have accumulated and by Flush()
+    or Close(), in the order they were appended.  They can be looked up by
+    tag right away.
+    """
+    for row in list_2d:
+      self._IndexRow(row)
+    self.pending.extend(list_2d)
+    if len(self.pending) >= self.FLUSH_ROWS:
+      self.Flush()
+
+  def Flush(self):
+    """Writes the rows queued by Append()."""
+    if self.pending:
+      pending, self.pending = self.pending, []
+      logger.debug('Writing %d rows to manifest.', len(pending))
+      csv.writer(self.manfp).writerows(pending)
+    if self.manfp and not self.manfp.closed and self.manfp.mode[0] != 'r':
+      self.manfp.flush()
+
+
+class SqliteManifestParser(ManifestParser):
+  """ManifestParser that keeps the manifest in an SQLite database.
+
+  Rows are stored with an index on (major, minor), so tag lookups are
+  answered by the database without reading the whole manifest.  This is
+  meant for campaign-scale manifests; the file is not a text manifest and
+  cannot be read by ManifestParser.  Filemode 'w' starts a new manifest,
+  'a' adds to an existing one, and 'r' only reads.
+  """
+  def __init__(self, fn=None, filemode=None):
+    ManifestParser.__init__(self, fn, filemode)
+    self.db = None
+
+  def Open(self, fn=None, filemode=None):
+    if sqlite3 is None:
+      raise RuntimeError('SqliteManifestParser requires the sqlite3 module.')
+    if not fn or not filemode:
+      if not (self.fn and self.filemode):
+        raise RuntimeError('Not enough information to open manifest.')
+      fn = self.fn
+      filemode = self.filemode
+    if filemode.startswith('r') and not os.path.isfile(fn):
+      raise IOError(errno.ENOENT, 'No such manifest', fn)
+    self.db = sqlite3.connect(fn)
+    self.db.text_factory = str
+    if filemode.startswith('w'):
+      self.db.execute('DROP TABLE IF EXISTS manifest')
+    if not filemode.startswith('r'):
+      self.db.execute('CREATE TABLE IF NOT EXISTS manifest ('
+                      'id INTEGER PRIMARY KEY, major TEXT, minor TEXT, '
+                      'value TEXT, rest TEXT)')
+      self.db.execute('CREATE INDEX IF NOT EXISTS manifest_tags '
+                      'ON manifest (major, minor)')
+      self.db.commit()
+    return self.db
+
+  def Close(self):
+    if self.db:
+      self.Flush()
+      self.db.close()
+      self.db = None
+
+  def _RowToRecord(self, row):
+    row = tuple(map(_ManifestField, row)) + (None,) * (3 - len(row))
+    rest = None
+    if len(row) > 3:
+      # csv-encoded, so that the columns may contain any character.
+      buf = StringIO.StringIO()
+      csv.writer(buf).writerow(row[3:])
+      rest = buf.getvalue()
+    return row[:3] + (rest,)
+
+  def _IndexRow(self, row):
+    # The database is the index.
+    pass
+
+  def _RecordToRow(self, record):
+    row = tuple([field for field in record[:3] if field is not None])
+    if record[3] is not None:
+      row += tuple(csv.reader([record[3]]).next())
+    return row
+
+  def IterRows(self, manifest_fp=None, matcher=None):
+    """Yields each row (as a tuple) for which matcher is True."""
+    cursor = self.db.execute('SELECT major, minor, value, rest FROM manifest '
+                             'ORDER BY id')
+    for record in cursor:
+      row = self._RecordToRow(record)
+      if not matcher or matcher(row):
+        yield row
+
+  def GetAllByTags(self, major_tag, minor_tag):
+    """Return data in all rows that match major_tag and minor_tag."""
+    self.Flush()
+    return [record[0] for record in self.db.execute(
+      'SELECT value FROM manifest WHERE major = ? AND minor = ? ORDER BY id',
+      (major_tag, minor_tag))]
+
+  def GetLastByTags(self, major_tag, minor_tag):
+    """Return data in the last row that matches major_tag and minor_tag.
+
+    Raises:
+      IndexError if there is no such row.
+    """
+    self.Flush()
+    record = self.db.execute(
+      'SELECT value FROM manifest WHERE major = ? AND minor = ? '
+      'ORDER BY id DESC LIMIT 1', (major_tag, minor_tag)).fetchone()
+    if record is None:
+      raise IndexError('No (%s, %s) row in manifest.' % (major_tag, minor_tag))
+    return record[0]
+
+  def Write(self, list_2d, manifest_fp=None):
+    """Writes a 2d list to manifest, after the rows queued by Append()."""
+    self.Flush()
+    for line in list_2d:
+      logger.debug('Writing to manifest: %s', line)
+    self.db.executemany('INSERT INTO manifest (major, minor, value, rest) '
+                        'VALUES (?, ?, ?, ?)', map(self._RowToRecord, list_2d))
+    self.db.commit()
+
+  def Flush(self):
+    """Writes the rows queued by Append()."""
+    if self.pending:
+      pending, self.pending = self.pending, []
+      logger.debug('Writing %d rows to manifest.', len(pending))
+      self.Write(pending)
@@ -1,6 +1,11 @@
 #!/usr/bin/python2.6
 import os
+import shutil
+import stat
+import subprocess
+import tarfile
 import tempfile
+import time
 import unittest
 import PhosimUtil
 
@@ -66,7 +71,377 @@ class ManifestParserTest(unittest.TestCase):
     parser.Read()
     self.assertEquals(parser.GetLastByTags('file', 'pars'),
                       self.pars_files[-1][2])
+    # Tags are matched exactly, not as substrings.
+    self.assertRaises(IndexError, parser.GetLastByTags, 'file', 'par')
+    self.assertRaises(IndexError, parser.GetLastByTags, 'param', 'nonexistent')
     parser.Close()
 
+  def testIterRows(self):
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'r') as parser:
+      rows = parser.IterRows(matcher=lambda row: row[0] == 'param')
+      self.assertEquals(rows.next(), self.params[0])
+      self.assertEquals(list(rows), self.params[1:])
+      self.assertEquals(parser.Get(), [])
+
+  def testAppend(self):
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'a') as parser:
+      parser.FLUSH_ROWS = 3
+      for i in range(5):
+        parser.Append([('set', 'exposure_id', 'R22_S11_E00%d' % i)])
+      # The first three rows have been written, the rest are still queued.
+      with PhosimUtil.ManifestParser(self.manifest_fn, 'r') as reader:
+        reader.Read()
+        self.assertEquals(len(reader.GetAllByTags('set', 'exposure_id')), 3)
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'r') as parser:
+      parser.Read()
+      self.assertEquals(parser.GetAllByTags('set', 'exposure_id'),
+                        ['R22_S11_E00%d' % i for i in range(5)])
+      self.assertEquals(parser.GetLastByTags('param', 'instrument'),
+                        self.instrument)
+
+  def testAppendThenWriteKeepsOrder(self):
+    rows = [('set', 'exposure_id', 'R22_S11_E000'),
+            ('param', 'a', '1'),
+            ('set', 'exposure_id', 'R22_S11_E001'),
+            ('param', 'b', '2')]
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'w') as parser:
+      parser.Append(rows[:1])
+      parser.Write(rows[1:2])
+      parser.Append(rows[2:3])
+      parser.Write(rows[3:])
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'r') as parser:
+      self.assertEquals(list(parser.IterRows()), rows)
+
+  def testLookupAfterWriteAndAppend(self):
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'w') as parser:
+      parser.Write([('param', 'filter_num', '1')])
+      parser.Append([('set', 'exposure_id', 'R22_S11_E000'),
+                     ('param', 'filter_num', '2')])
+      self.assertEquals(parser.GetAllByTags('set', 'exposure_id'),
+                        ['R22_S11_E000'])
+      self.assertEquals(parser.GetLastByTags('param', 'filter_num'), '2')
+
+  def testLookupMatchesReadForNonStrings(self):
+    rows = [('param', 'run_e2adc', True), ('param', 'filter_num', 2),
+            ('param', 'exptime', 15.1)]
+    expected = [('run_e2adc', 'True'), ('filter_num', '2'), ('exptime', '15.1')]
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'w') as parser:
+      parser.Write(rows[:1])
+      parser.Append(rows[1:])
+      for minor, value in expected:
+        self.assertEquals(parser.GetLastByTags('param', minor), value)
+    with PhosimUtil.ManifestParser(self.manifest_fn, 'r') as parser:
+      parser.Read()
+      for minor, value in expected:
+        self.assertEquals(parser.GetLastByTags('param', minor), value)
+
+
+class SqliteManifestParserTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.manifest_fn = os.path.join(self.tmpdir, 'manifest.db')
+    self.params = [('param', 'observation_id', '12345'),
+                   ('param', 'filter_num', '1'),
+                   ('param', 'filter_num', '2')]
+    self.exposures = [('set', 'exposure_id', 'R22_S11_E00%d' % i) for i in range(4)]
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'w') as parser:
+      parser.Write(self.params)
+      parser.FLUSH_ROWS = 3
+      parser.Append(self.exposures)
+      parser.Append([('file', 'data', 'extra', 'columns')])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testLookups(self):
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'r') as parser:
+      self.assertEquals(parser.GetLastByTags('param', 'filter_num'), '2')
+      self.assertEquals(parser.GetAllByTags('set', 'exposure_id'),
+                        [row[2] for row in self.exposures])
+      self.assertRaises(IndexError, parser.GetLastByTags, 'param', 'filter')
+      self.assertEquals(list(parser.IterRows(matcher=lambda row: row[0] == 'file')),
+                        [('file', 'data', 'extra', 'columns')])
+      parser.Read()
+      self.assertEquals(parser.GetByMajor(['param']), self.params)
+
+  def testAppendThenWriteKeepsOrder(self):
+    rows = [('set', 'exposure_id', 'R22_S11_E004'), ('param', 'a', '1')]
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'a') as parser:
+      parser.Append(rows[:1])
+      parser.Write(rows[1:])
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'r') as parser:
+      self.assertEquals(list(parser.IterRows())[-2:], rows)
+
+  def testLookupAfterWriteAndAppend(self):
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'a') as parser:
+      parser.Write([('param', 'filter_num', '3')])
+      parser.Append([('set', 'exposure_id', 'R22_S11_E004'),
+                     ('param', 'filter_num', '4')])
+      self.assertEquals(parser.GetAllByTags('set', 'exposure_id')[-1],
+                        'R22_S11_E004')
+      self.assertEquals(parser.GetLastByTags('param', 'filter_num'), '4')
+
+  def testNonStringValuesReadLikeText(self):
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'a') as parser:
+      parser.Write([('param', 'run_e2adc', True), ('param', 'exptime', 15.1)])
+      self.assertEquals(parser.GetLastByTags('param', 'run_e2adc'), 'True')
+      self.assertEquals(parser.GetLastByTags('param', 'exptime'), '15.1')
+
+  def testExtraColumnsRoundTrip(self):
+    rows = [('file', 'data', 'a\tb', 'c\td', 'e,"f"', 'g\nh', ''),
+            ('file', 'data', 'x', '')]
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'a') as parser:
+      parser.Write(rows)
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'r') as parser:
+      self.assertEquals(list(parser.IterRows())[-2:], rows)
+
+  def testAppendMode(self):
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'a') as parser:
+      parser.Append([('set', 'exposure_id', 'R22_S11_E004')])
+      self.assertEquals(len(parser.GetAllByTags('set', 'exposure_id')), 5)
+    with PhosimUtil.SqliteManifestParser(self.manifest_fn, 'w') as parser:
+      self.assertEquals(parser.GetAllByTags('set', 'exposure_id'), [])
+
+class NodeCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cache_dir = os.path.join(self.tmpdir, 'cache')
+    self.work_dir = os.path.join(self.tmpdir, 'work')
+    os.makedirs(self.work_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def MakeFiles(self, key, nbytes=10):
+    paths = []
+    for i in range(2):
+      path = os.path.join(self.work_dir, '%s_%d.fits' % (key, i))
+      with open(path, 'w') as f:
+        f.write('x' * nbytes)
+      paths.append(path)
+    return paths
+
+  def testFileLock(self):
+    fn = os.path.join(self.tmpdir, 'test.lock')
+    with PhosimUtil.FileLock(fn):
+      # flock() locks belong to the open file, so a second one conflicts.
+      self.assertFalse(PhosimUtil.FileLock(fn).Acquire(blocking=False))
+    lock = PhosimUtil.FileLock(fn)
+    self.assertTrue(lock.Acquire(blocking=False))
+    lock.Release()
+
+  def testPutAndGet(self):
+    cache = PhosimUtil.NodeCache(self.cache_dir)
+    dest_dir = os.path.join(self.tmpdir, 'dest')
+    os.makedirs(dest_dir)
+    with cache.Lock('123'):
+      self.assertEquals(None, cache.Get('123', dest_dir))
+      cache.Put('123', self.MakeFiles('123'))
+    with cache.Lock('123'):
+      self.assertEquals(['123_0.fits', '123_1.fits'],
+                        sorted(cache.Get('123', dest_dir)))
+    self.assertEquals(['123_0.fits', '123_1.fits'], sorted(os.listdir(dest_dir)))
+    self.assertFalse(os.path.islink(os.path.join(dest_dir, '123_0.fits')))
+
+  def testIncompleteEntryIsDiscarded(self):
+    cache = PhosimUtil.NodeCache(self.cache_dir)
+    os.makedirs(os.path.join(self.cache_dir, '123'))
+    with cache.Lock('123'):
+      self.assertEquals(None, cache.Get('123', self.work_dir))
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '123')))
+
+  def testEvictLeastRecentlyUsed(self):
+    cache = PhosimUtil.NodeCache(self.cache_dir, max_bytes=50)
+    for key in ('1', '2'):
+      with cache.Lock(key):
+        cache.Put(key, self.MakeFiles(key))
+    # Make '1' the most recently used entry.
+    os.utime(os.path.join(self.cache_dir, '2', cache.READY_FN), (0, 0))
+    with cache.Lock('3'):
+      cache.Put('3', self.MakeFiles('3'))
+    self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, '1')))
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '2')))
+    self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, '3')))
+
+  def testEvictSkipsLockedEntries(self):
+    cache = PhosimUtil.NodeCache(self.cache_dir)
+    for key in ('1', '2'):
+      with cache.Lock(key):
+        cache.Put(key, self.MakeFiles(key))
+    os.utime(os.path.join(self.cache_dir, '1', cache.READY_FN), (0, 0))
+    cache.max_bytes = 30
+    with cache.Lock('1'):
+      cache.Evict()
+    self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, '1')))
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '2')))
+
+
+class DataDirCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+  def tearDown(self):
+    PhosimUtil.SetTreeWritable(self.tmpdir, True)
+    shutil.rmtree(self.tmpdir)
+
+  def MakeTarball(self, name, contents):
+    src_dir = tempfile.mkdtemp(dir=self.tmpdir)
+    os.makedirs(os.path.join(src_dir, 'SEDs'))
+    with open(os.path.join(src_dir, 'SEDs', 'sed.txt'), 'w') as f:
+      f.write(contents)
+    tarball = os.path.join(self.tmpdir, name)
+    tarf = tarfile.open(tarball, 'w')
+    tarf.add(os.path.join(src_dir, 'SEDs'), 'SEDs')
+    tarf.close()
+    return tarball
+
+  def Entries(self):
+    return [fn for fn in os.listdir(self.cache_dir) if
+            os.path.isdir(os.path.join(self.cache_dir, fn)) and
+            not fn.startswith('.')]
+
+  def testExtractOnceAndShare(self):
+    tarball = self.MakeTarball('data.tar', 'sed')
+    cache = PhosimUtil.DataDirCache(self.cache_dir)
+    data_dir1, ref1 = cache.Acquire(tarball)
+    data_dir2, ref2 = cache.Acquire(tarball)
+    self.assertEquals(data_dir1, data_dir2)
+    self.assertNotEquals(ref1, ref2)
+    with open(os.path.join(data_dir1, 'SEDs', 'sed.txt'), 'r') as f:
+      self.assertEquals('sed', f.read())
+    self.assertFalse(os.stat(data_dir1).st_mode & stat.S_IWUSR)
+    self.assertEquals(1, len(self.Entries()))
+
+  def testOldVersionIsCollected(self):
+    tarball = self.MakeTarball('data.tar', 'old')
+    cache = PhosimUtil.DataDirCache(self.cache_dir)
+    old_dir, old_ref = cache.Acquire(tarball)
+    os.remove(tarball)
+    self.MakeTarball('data.tar', 'new version')
+    os.utime(tarball, (0, 0))
+    new_dir, new_ref = cache.Acquire(tarball)
+    self.assertNotEquals(old_dir, new_dir)
+    # The old version is still referenced.
+    self.assertTrue(os.path.isdir(old_dir))
+    PhosimUtil.DataDirCache.Release(old_ref)
+    cache.Evict(superseded=(tarball, os.path.basename(os.path.dirname(new_dir))))
+    self.assertFalse(os.path.exists(old_dir))
+    self.assertTrue(os.path.isdir(new_dir))
+
+  def testEvictUnreferencedOverBudget(self):
+    cache = PhosimUtil.DataDirCache(self.cache_dir, max_bytes=4)
+    dir_a, ref_a = cache.Acquire(self.MakeTarball('a.tar', 'aaa'))
+    dir_b, ref_b = cache.Acquire(self.MakeTarball('b.tar', 'bbb'))
+    # Both are referenced, so neither may be evicted.
+    self.assertEquals(2, len(self.Entries()))
+    PhosimUtil.DataDirCache.Release(ref_a)
+    cache.Evict()
+    self.assertFalse(os.path.exists(dir_a))
+    self.assertTrue(os.path.isdir(dir_b))
+
+  def testStaleReferencesAreDropped(self):
+    cache = PhosimUtil.DataDirCache(self.cache_dir, max_bytes=0)
+    data_dir, ref = cache.Acquire(self.MakeTarball('data.tar', 'sed'))
+    # Pretend the reference belongs to a process that has exited.
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    pid = proc.pid
+    os.rename(ref, os.path.join(os.path.dirname(ref), '%d_stale' % pid))
+    cache.Evict()
+    self.assertFalse(os.path.exists(data_dir))
+
+
+class StageOutWatcherTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.src_dir = os.path.join(self.tmpdir, 'output')
+    self.dest_dir = os.path.join(self.tmpdir, 'save', 'eimage')
+    os.makedirs(self.src_dir)
+    self.pairs = [(os.path.join(self.src_dir, 'f%d.fits.gz' % i),
+                   os.path.join(self.dest_dir, 'g%d.fits.gz' % i))
+                  for i in range(3)]
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def Write(self, fn, contents):
+    with open(fn, 'w') as f:
+      f.write(contents)
+
+  def Read(self, fn):
+    with open(fn, 'r') as f:
+      return f.read()
+
+  def testCopiesCompleteFilesInBackground(self):
+    watcher = PhosimUtil.StageOutWatcher(self.pairs, nthreads=2,
+                                         poll_interval=0.01, settle_time=0.0)
+    watcher.Start()
+    for src, unused_dest in self.pairs:
+      self.Write(src, os.path.basename(src))
+    deadline = time.time() + 10
+    while (time.time() < deadline and
+           len(os.listdir(self.dest_dir) if os.path.isdir(self.dest_dir) else []) < 3):
+      time.sleep(0.01)
+    # Nothing appears under its final name before Finish().
+    for unused_src, dest in self.pairs:
+      self.assertFalse(os.path.exists(dest))
+    self.assertEquals(3, watcher.Finish())
+    for src, dest in self.pairs:
+      self.assertEquals(os.path.basename(src), self.Read(dest))
+    self.assertEquals(3, len(os.listdir(self.dest_dir)))
+
+  def testFinishRecopiesChangedFiles(self):
+    watcher = PhosimUtil.StageOutWatcher(self.pairs[:1], poll_interval=0.01,
+                                         settle_time=0.0).Start()
+    src, dest = self.pairs[0]
+    self.Write(src, 'partial')
+    deadline = time.time() + 10
+    while (time.time() < deadline and
+           not os.path.exists(PhosimUtil.StagingName(dest))):
+      time.sleep(0.01)
+    self.Write(src, 'complete contents')
+    watcher.Finish()
+    self.assertEquals('complete contents', self.Read(dest))
+
+  def testFinishSubsetDiscardsOthers(self):
+    for src, unused_dest in self.pairs:
+      self.Write(src, 'x')
+    watcher = PhosimUtil.StageOutWatcher(self.pairs).Start()
+    watcher.Finish(self.pairs[:1])
+    self.assertEquals([os.path.basename(self.pairs[0][1])],
+                      os.listdir(self.dest_dir))
+
+  def testMissingFileRaises(self):
+    watcher = PhosimUtil.StageOutWatcher(self.pairs).Start()
+    self.assertRaises(IOError, watcher.Finish)
+    self.assertFalse(os.path.isdir(self.dest_dir) and os.listdir(self.dest_dir))
+
+  def testFinishRecoversFailedBackgroundCopy(self):
+    src, dest = self.pairs[0]
+    # A file in place of the dest directory makes the background copy fail.
+    os.makedirs(os.path.dirname(self.dest_dir))
+    self.Write(self.dest_dir, 'in the way')
+    self.Write(src, 'contents')
+    watcher = PhosimUtil.StageOutWatcher(self.pairs[:1], poll_interval=0.01,
+                                         settle_time=0.0).Start()
+    deadline = time.time() + 10
+    while time.time() < deadline and src not in watcher._errors:
+      time.sleep(0.01)
+    self.assertTrue(src in watcher._errors)
+    os.remove(self.dest_dir)
+    self.assertEquals(0, watcher.Finish())
+    self.assertEquals('contents', self.Read(dest))
+
+  def testAbort(self):
+    for src, unused_dest in self.pairs:
+      self.Write(src, 'x')
+    watcher = PhosimUtil.StageOutWatcher(self.pairs, poll_interval=0.01,
+                                         settle_time=0.0).Start()
+    time.sleep(0.1)
+    watcher.Abort()
+    self.assertFalse(os.path.isdir(self.dest_dir) and os.listdir(self.dest_dir))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,14 +13,25 @@ import os
 import zipfile
 
 import Exposure
+import FitsUtil
+import FocalplaneGeometry
 import PhosimManager
 import PhosimUtil
+import ScriptWriter
 import phosim
 
 __author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
 
 logger = logging.getLogger(__name__)
 
+# abspath(zip file) -> ((size, mtime), names, set of names without '.gz')
+_zip_index_memo = {}
+
+def StripGz(fn):
+  if fn.endswith('.gz'):
+    return fn[:-len('.gz')]
+  return fn
+
 
 class PhosimVerifier(object):
   """Verifies Phosim input and/or output."""
@@ -32,22 +43,78 @@ class PhosimVerifier(object):
     self.stage_path = self.policy.get('general','stage_path')
     self.save_path = self.policy.get('general','save_path')
     self.manifest_parser_class = manifest_parser_class
+    self.fits_verify_threads = 4
+    if self.policy.has_option('general', 'fits_verify_threads'):
+      self.fits_verify_threads = self.policy.getint('general', 'fits_verify_threads')
+    self.use_fitsverify = False
+    if self.policy.has_option('general', 'fits_verifier'):
+      self.use_fitsverify = self.policy.get('general', 'fits_verifier') == 'fitsverify'
+    # Existence checks are answered from one listing per directory, taken
+    # the first time a directory is queried in each verification pass.
+    self.metadata_calls = Exposure.MetadataCallCounter()
+    self.snapshots = None
 
   def IsFile(self, fn):
+    self.metadata_calls.add()
     return os.path.isfile(fn)
 
   def Exists(self, fn):
+    self.metadata_calls.add()
     return os.path.exists(fn)
 
   def IsDir(self, fn):
+    self.metadata_calls.add()
     return os.path.isdir(fn)
 
+  def ListDir(self, dirname):
+    self.metadata_calls.add()
+    return os.listdir(dirname)
+
+  def MetadataCalls(self):
+    """Returns the number of filesystem metadata calls made in this pass."""
+    return self.metadata_calls.count
+
+  def ResetSnapshots(self):
+    """Starts a verification pass.
+
+    Discards the directory listings of the last pass and zeroes the count
+    of metadata calls.
+    """
+    self.metadata_calls = Exposure.MetadataCallCounter()
+    self.snapshots = Exposure.DirectorySnapshots(listdir=self.ListDir)
+
+  def IsFileInSnapshot(self, fn):
+    """Like IsFile(), but looks fn up in a listing of its directory."""
+    if self.snapshots is None:
+      self.ResetSnapshots()
+    return self.snapshots.isfile(fn)
+
   def _ReadZipIndex(self, zip_fn):
-    # 'with' does not work with ZipFile in 2.5
-    zipf = zipfile.ZipFile(zip_fn, 'r')
-    contents = zipf.namelist()
-    zipf.close()
-    return contents
+    return list(self._ZipIndexEntry(zip_fn)[1])
+
+  def _ZipNameSet(self, zip_fn):
+    """Returns the names in zip_fn, with '.gz' stripped, as a set."""
+    return self._ZipIndexEntry(zip_fn)[2]
+
+  def _ZipIndexEntry(self, zip_fn):
+    """Returns the memoized central directory of zip_fn.
+
+    It is reread only if the size or mtime of zip_fn has changed.
+    """
+    key = os.path.abspath(zip_fn)
+    self.metadata_calls.add()
+    stamp = PhosimUtil._StatKey(zip_fn)
+    entry = _zip_index_memo.get(key)
+    if entry is None or entry[0] != stamp:
+      # 'with' does not work with ZipFile in 2.5
+      zipf = zipfile.ZipFile(zip_fn, 'r')
+      try:
+        names = tuple(zipf.namelist())
+      finally:
+        zipf.close()
+      entry = (stamp, names, frozenset(map(StripGz, names)))
+      _zip_index_memo[key] = entry
+    return entry
 
   def _StripExt(self, fn, ext):
     """If 'fn' has extension 'ext', strip it.  Returns fn with ext removed."""
@@ -55,11 +122,21 @@ class PhosimVerifier(object):
       return fn.rsplit(ext, 1)[0]
     return fn
 
+  def _FindFileInDir(self, dirname, fn):
+    """Returns the path of 'fn' (or its gzipped or gunzipped form) in 'dirname'.
+
+    Returns None if none of them is there.
+    """
+    if self.snapshots is None:
+      self.ResetSnapshots()
+    name = self.snapshots.get(dirname).findVariant(fn)
+    if name is None:
+      return None
+    return os.path.join(dirname, name)
+
   def _VerifyFileInDir(self, dirname, fn):
     """Verifies 'fn' is in directory 'dirname' (can also be gzipped)"""
-    if (self.IsFile(os.path.join(dirname, fn)) or
-        self.IsFile(os.path.join(dirname, self._StripExt(fn, '.gz'))) or
-        self.IsFile(os.path.join(dirname, '%s.gz' % fn))):
+    if self._FindFileInDir(dirname, fn):
       return []
     logging.warning('Verification failure: File %s is not in directory %s.',
                     fn, dirname)
@@ -77,25 +154,34 @@ class PhosimVerifier(object):
 
     Returns:
       List of missing files."""
-    if (self._StripExt(fn, '.gz') not in
-        map(lambda fn: self._StripExt(fn, '.gz'), fn_list)):
-      logging.warning('Verification failure: File %s is not in list %s.',
-                      fn, fn_list)
-      return [fn]
-    if dirname:
-      return self._VerifyFileInDir(dirname, fn)
-    return []
+    return self._VerifyFilesInListAndDir([fn], fn_list, dirname=dirname)
 
-  def _VerifyFitsInDir(self, dirname, fn):
-    missing = self._VerifyFileInDir(dirname, fn)
-    if missing:
-      return missing
-    corrupt_files = []
-    if Exposure.verifyFitsContents(corrupt_files, dirname, fn):
-      return []
-    logging.error('verifyFitsContents failed %s with message %s',
-                  corrupt_files[0], corrupt_files[1])
-    return [corrupt_files[0]]
+  def _VerifyFilesInListAndDir(self, fns, fn_list, dirname=None, name=None):
+    """Verifies each of 'fns' is in 'fn_list' and optionally 'dirname'.
+
+    Strips '.gz' extensions before comparison.
+
+    Args:
+      fns:     List of filenames.
+      fn_list: List of filenames, or a set of filenames with '.gz' stripped.
+      dirname: Name of directory.
+      name:    Name of fn_list (e.g. an archive) for log messages.
+
+    Returns:
+      List of missing files, in the order of fns.
+    """
+    if not isinstance(fn_list, (set, frozenset)):
+      fn_list = frozenset(map(StripGz, fn_list))
+    absent = set(map(StripGz, fns)) - fn_list
+    missing_files = [fn for fn in fns if StripGz(fn) in absent]
+    if missing_files:
+      logging.warning('Verification failure: %d files are not in %s: %s',
+                      len(missing_files), name or 'list', missing_files)
+    if dirname:
+      for fn in fns:
+        if StripGz(fn) not in absent:
+          missing_files.extend(self._VerifyFileInDir(dirname, fn))
+    return missing_files
 
 
 
@@ -163,26 +249,45 @@ class RaytraceVerifier(PhosimVerifier):
   def VerifyScratchOutput(self, fitsverify=True):
     """Verifies raytrace output in phosim_output_dir.
 
-    In addition to testing for existence, runs fitsverify on all .fits output.
+    In addition to testing for existence, verifies the contents of all .fits
+    output with FitsUtil.VerifyFiles().  This runs in-process on
+    'fits_verify_threads' threads, or calls the fitsverify executable on
+    batches of files if 'fits_verifier' is 'fitsverify' in the config file.
 
     Returns:
-      None upon success or list of missing or corrupt files.  fitsverify
-      output is written to logging.ERROR.
+      None upon success or list of missing or corrupt files.  Verification
+      errors are written to logging.ERROR.
     """
     logger.info('Verifying output files in %s.', self.phosim_output_dir)
-    if fitsverify:
-      logger.info('Verifying FITS contents with fitsverify.')
-      verify_func = self._VerifyFitsInDir
-    else:
-      logger.info('Verifying existence of FITS files and not their contents.')
-      verify_func = self._VerifyFileInDir
-    missing_files = verify_func(self.phosim_output_dir,
-                                self.exposure.generateEimageExecName())
+    self.ResetSnapshots()
+    fns = [self.exposure.generateEimageExecName()]
     if self.run_e2adc:
       amp_list = self._LoadAmpList()
-      raw_fns = self.exposure.generateRawExecNames(ampList=amp_list)
-      for fn in raw_fns:
-        missing_files.extend(verify_func(self.phosim_output_dir, fn))
+      fns.extend(self.exposure.generateRawExecNames(ampList=amp_list))
+    missing_files = []
+    found = []
+    for fn in fns:
+      fullpath = self._FindFileInDir(self.phosim_output_dir, fn)
+      if fullpath:
+        found.append(fullpath)
+      else:
+        logging.warning('Verification failure: File %s is not in directory %s.',
+                        fn, self.phosim_output_dir)
+        missing_files.append(os.path.join(self.phosim_output_dir, fn))
+    logger.info('Verified existence of %d files with %d filesystem metadata calls.',
+                len(fns), self.MetadataCalls())
+    if not fitsverify:
+      logger.info('Verifying existence of FITS files and not their contents.')
+      return missing_files
+    logger.info('Verifying FITS contents of %d files with %s on %d threads.',
+                len(found), 'fitsverify' if self.use_fitsverify else 'FitsUtil',
+                self.fits_verify_threads)
+    for result in FitsUtil.VerifyFiles(found, nthreads=self.fits_verify_threads,
+                                       use_fitsverify=self.use_fitsverify):
+      if not result.IsOk():
+        logging.error('FITS verification failed for %s: %s', result.fn,
+                      '  '.join(result.errors))
+        missing_files.append(result.fn)
     return missing_files
 
   def VerifySharedOutput(self):
@@ -193,6 +298,7 @@ class RaytraceVerifier(PhosimVerifier):
       list of missing files).
     """
     logger.info('Verifying output files in %s.', self.my_save_path)
+    self.ResetSnapshots()
     dest_path, dest_fn = self.exposure.generateEimageOutputName()
     missing_files = self._VerifyFileInDir(os.path.join(self.my_save_path, dest_path),
                                           dest_fn)
@@ -200,23 +306,42 @@ class RaytraceVerifier(PhosimVerifier):
       amp_list = self._LoadAmpList()
       dest_path, dest_fns = self.exposure.generateRawOutputNames(ampList=amp_list)
       save_path = os.path.join(self.my_save_path, dest_path)
+      mef_fullpath = os.path.join(save_path, PhosimUtil.MefNameFromRaw(dest_fns[0]))
       zip_fullpath = os.path.join(save_path, PhosimUtil.ZipNameFromRaw(dest_fns[0]))
-      if self.IsFile(zip_fullpath):
+      if self.IsFileInSnapshot(mef_fullpath):
+        logger.info('Found raw MEF file %s', mef_fullpath)
+        missing_files.extend(self._VerifyRawInMef(mef_fullpath, amp_list, dest_fns))
+      elif self.IsFileInSnapshot(zip_fullpath):
         logger.info('Found raw zip file %s', zip_fullpath)
-        missing_files = self._VerifyRawInZip(zip_fullpath, dest_fns)
+        missing_files.extend(self._VerifyRawInZip(zip_fullpath, dest_fns))
       else:
-        logger.info('Did not find raw zip file %s', zip_fullpath)
-        missing_files = self._VerifyRaw(save_path, dest_fns)
+        logger.info('Did not find raw MEF or zip file in %s', save_path)
+        missing_files.extend(self._VerifyRaw(save_path, dest_fns))
+    logger.info('Verification made %d filesystem metadata calls.',
+                self.MetadataCalls())
     return missing_files
 
-  def _VerifyRawInZip(self, zip_fullpath, dest_fns):
-    logger.info('Verifying e2adc output files in %s.', zip_fullpath)
+  def _VerifyRawInMef(self, mef_fullpath, amp_list, dest_fns):
+    """Verifies the extension index of a MEF written by FitsUtil.MergeAmpFiles()."""
+    logger.info('Verifying e2adc output extensions in %s.', mef_fullpath)
+    try:
+      extnames = [extname for extname, offset in FitsUtil.ReadIndex(mef_fullpath)]
+    except (IOError, ValueError), e:
+      logging.error('Could not read index of %s: %s', mef_fullpath, e)
+      return [mef_fullpath]
     missing_files = []
-    zip_index = self._ReadZipIndex(zip_fullpath)
-    for fn in dest_fns:
-      missing_files.extend(self._VerifyFileInListAndDir(fn, zip_index))
+    for amp, fn in zip(amp_list, dest_fns):
+      if amp not in extnames:
+        logging.warning('Verification failure: Amp %s is not in %s.',
+                        amp, mef_fullpath)
+        missing_files.append(fn)
     return missing_files
 
+  def _VerifyRawInZip(self, zip_fullpath, dest_fns):
+    logger.info('Verifying e2adc output files in %s.', zip_fullpath)
+    return self._VerifyFilesInListAndDir(dest_fns, self._ZipNameSet(zip_fullpath),
+                                         name=zip_fullpath)
+
   def _VerifyRaw(self, path, dest_fns):
     logger.info('Verifying e2adc output files in %s.', path)
     missing_files = []
@@ -225,10 +350,10 @@ class RaytraceVerifier(PhosimVerifier):
     return missing_files
 
   def _LoadAmpList(self):
-    with open(os.path.join(self.phosim_instr_dir,
-                           'segmentation.txt'), 'r') as ampf:
-      logger.info('Reading amp_list from %s.', ampf.name)
-      amp_list = Exposure.readAmpList(ampf, self.cid)
+    geometry = FocalplaneGeometry.GetGeometry(self.phosim_instr_dir)
+    amp_list = geometry.AmpList(self.cid)
+    logger.info('Loaded %d amps for %s from %s.', len(amp_list), self.cid,
+                geometry.segmentation_fn)
     return amp_list
 
 
@@ -264,7 +389,8 @@ class PreprocVerifier(PhosimVerifier):
     """
     if not manifest_fullpath:
       manifest_fullpath = os.path.join(self.my_output_path, PhosimManager.MANIFEST_FN)
-    if not self.IsFile(manifest_fullpath):
+    self.ResetSnapshots()
+    if not self.IsFileInSnapshot(manifest_fullpath):
       return [manifest_fullpath]
     with self.manifest_parser_class(manifest_fullpath, 'r') as parser:
       parser.Read()
@@ -278,6 +404,8 @@ class PreprocVerifier(PhosimVerifier):
       missing_list = self._VerifyExecScripts(parser, exposure_ids)
       missing_list.extend(self._VerifyParsFiles(parser, exposure_ids))
       missing_list.extend(self._VerifyConfigFiles(parser))
+    logger.info('Verification made %d filesystem metadata calls.',
+                self.MetadataCalls())
     return missing_list
 
   def _VerifyConfigFiles(self, parser):
@@ -286,7 +414,7 @@ class PreprocVerifier(PhosimVerifier):
     if not config_list:
       return ['imsim_config_file']
     assert len(config_list) == 1
-    if not self.IsFile(os.path.join(self.my_output_path, config_list[0])):
+    if not self.IsFileInSnapshot(os.path.join(self.my_output_path, config_list[0])):
       return [os.path.join(self.my_output_path, config_list[0])]
     return []
 
@@ -295,33 +423,26 @@ class PreprocVerifier(PhosimVerifier):
     pars_archive_name = parser.GetLastByTags('param', 'pars_archive_name')
     pars_archive_path = os.path.join(self.my_output_path, pars_archive_name)
     if (pars_archive_name not in parser.GetAllByTags('file', 'archive') or
-        not self.IsFile(pars_archive_path)):
+        not self.IsFileInSnapshot(pars_archive_path)):
       return [pars_archive_name]
-    pars_list = self._ReadZipIndex(pars_archive_path)
-    missing_files = []
-    missing_files.extend(self._VerifyFileInListAndDir(
-      'tracking_%s.pars' % self.observation_id, pars_list))
+    expected = ['tracking_%s.pars' % self.observation_id]
     if parser.GetLastByTags('param', 'skip_atmoscreens') != 'True':
-      missing_files.extend(self._VerifyFileInListAndDir(
-        'airglowscreen_%s.fits' % self.observation_id, pars_list))
-      missing_files.extend(self._VerifyFileInListAndDir(
-        'cloudscreen_%s_0.fits' % self.observation_id, pars_list))
-      missing_files.extend(self._VerifyFileInListAndDir(
-        'cloudscreen_%s_3.fits' % self.observation_id, pars_list))
+      expected.append('airglowscreen_%s.fits' % self.observation_id)
+      expected.append('cloudscreen_%s_0.fits' % self.observation_id)
+      expected.append('cloudscreen_%s_3.fits' % self.observation_id)
       for i in range(7):
         for suffix in ['coarsex', 'coarsey', 'density_coarse', 'density_diff',
                        'density_fine', 'density_medium', 'finex', 'finey',
                        'mediumx', 'mediumy']:
-          missing_files.extend(self._VerifyFileInListAndDir(
-            'atmospherescreen_%s_%d_%s.fits' % (self.observation_id, i, suffix),
-            pars_list))
+          expected.append('atmospherescreen_%s_%d_%s.fits' %
+                          (self.observation_id, i, suffix))
+    run_e2adc = parser.GetLastByTags('param', 'run_e2adc') == 'True'
     for exposure in exposure_ids:
-      missing_files.extend(self._VerifyFileInListAndDir(
-        'raytrace_%s_%s.pars' % (self.observation_id, exposure), pars_list))
-      if parser.GetLastByTags('param', 'run_e2adc') == 'True':
-        missing_files.extend(self._VerifyFileInListAndDir(
-          'e2adc_%s_%s.pars' % (self.observation_id, exposure), pars_list))
-    return missing_files
+      expected.append('raytrace_%s_%s.pars' % (self.observation_id, exposure))
+      if run_e2adc:
+        expected.append('e2adc_%s_%s.pars' % (self.observation_id, exposure))
+    return self._VerifyFilesInListAndDir(
+      expected, self._ZipNameSet(pars_archive_path), name=pars_archive_path)
 
 
   def _VerifyExecScripts(self, parser, exposure_ids):
@@ -329,10 +450,18 @@ class PreprocVerifier(PhosimVerifier):
     exec_script_base = parser.GetLastByTags('param', 'exec_script_base')
     exec_files = parser.GetByMatcher(
       lambda row: row[2] if row[0] == 'file' and row[1] == 'exec' else None)
-    missing_files = []
-    for exposure in exposure_ids:
-      exec_fn = '%s_%s_%s.csh' % (exec_script_base, self.observation_id,
-                                  exposure)
-      missing_files.extend(self._VerifyFileInListAndDir(exec_fn, exec_files,
-                                                        dirname=self.my_output_path))
-    return missing_files
+    exec_script_mode = parser.GetAllByTags('param', 'exec_script_mode')
+    if exec_script_mode and exec_script_mode[-1] == 'array':
+      array_script, array_index = ScriptWriter.ArrayScriptNames(
+        exec_script_base, self.observation_id)
+      missing = self._VerifyFilesInListAndDir([array_script], exec_files,
+                                              dirname=self.my_output_path,
+                                              name='exec files in manifest')
+      if not self.IsFileInSnapshot(os.path.join(self.my_output_path, array_index)):
+        missing.append(os.path.join(self.my_output_path, array_index))
+      return missing
+    exec_fns = ['%s_%s_%s.csh' % (exec_script_base, self.observation_id, exposure)
+                for exposure in exposure_ids]
+    return self._VerifyFilesInListAndDir(exec_fns, exec_files,
+                                         dirname=self.my_output_path,
+                                         name='exec files in manifest')
@@ -0,0 +1,112 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import ConfigParser
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+import PhosimManager
+import PhosimUtil
+import PhosimVerifier
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+
+class PreprocVerifierTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    config = ConfigParser.RawConfigParser()
+    config.add_section('general')
+    for option in ['scratch_exec_path', 'stage_path', 'save_path']:
+      config.set('general', option, os.path.join(self.tmpdir, option))
+    self.config_fn = os.path.join(self.tmpdir, 'config.cfg')
+    with open(self.config_fn, 'w') as f:
+      config.write(f)
+    self.trimfile = os.path.join(self.tmpdir, 'trimfile')
+    with open(self.trimfile, 'w') as f:
+      f.write('Opsim_obshistid 1234\nOpsim_filter 2\n')
+    self.verifier = PhosimVerifier.PreprocVerifier(self.config_fn, self.trimfile,
+                                                   None)
+    self.output_path = self.verifier.my_output_path
+    os.makedirs(self.output_path)
+    self.exposures = ['R22_S11_E000', 'R22_S11_E001', 'R01_S00_E000']
+    self.pars_fn = os.path.join(self.output_path, 'pars.zip')
+    self.members = (['tracking_1234.pars'] +
+                    ['raytrace_1234_%s.pars' % e for e in self.exposures] +
+                    ['e2adc_1234_%s.pars.gz' % e for e in self.exposures])
+    self.WriteZip(self.pars_fn, self.members)
+    with PhosimUtil.ManifestParser(os.path.join(self.output_path, 'manifest.txt'),
+                                   'w') as parser:
+      parser.Write([('param', 'observation_id', '1234'),
+                    ('param', 'pars_archive_name', 'pars.zip'),
+                    ('param', 'run_e2adc', 'True'),
+                    ('param', 'skip_atmoscreens', 'True'),
+                    ('file', 'archive', 'pars.zip')])
+      parser.Write([('set', 'exposure_id', e) for e in self.exposures])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def WriteZip(self, zip_fn, members):
+    zipf = zipfile.ZipFile(zip_fn, 'w')
+    try:
+      for member in members:
+        zipf.writestr(member, member)
+    finally:
+      zipf.close()
+
+  def VerifyParsFiles(self):
+    with PhosimUtil.ManifestParser(os.path.join(self.output_path, 'manifest.txt'),
+                                   'r') as parser:
+      parser.Read()
+      return self.verifier._VerifyParsFiles(
+        parser, parser.GetAllByTags('set', 'exposure_id'))
+
+  def testVerifyParsFiles(self):
+    self.assertEqual(self.VerifyParsFiles(), [])
+    # Remove two members; exactly those are reported, in order.
+    self.WriteZip(self.pars_fn, [m for m in self.members
+                                 if m not in ('raytrace_1234_R22_S11_E001.pars',
+                                              'e2adc_1234_R01_S00_E000.pars.gz')])
+    # Make sure the rewrite is seen even if it lands in the same second.
+    os.utime(self.pars_fn, (time.time() + 10, time.time() + 10))
+    self.assertEqual(self.VerifyParsFiles(),
+                     ['raytrace_1234_R22_S11_E001.pars',
+                      'e2adc_1234_R01_S00_E000.pars'])
+
+  def testZipIndexMemo(self):
+    names = self.verifier._ZipNameSet(self.pars_fn)
+    self.assertTrue('e2adc_1234_R22_S11_E000.pars' in names)
+    self.assertTrue(self.verifier._ZipNameSet(self.pars_fn) is names)
+    self.assertEqual(self.verifier._ReadZipIndex(self.pars_fn), self.members)
+
+  def testVerifyFilesInListAndDir(self):
+    open(os.path.join(self.output_path, 'a.csh'), 'w').close()
+    missing = self.verifier._VerifyFilesInListAndDir(
+      ['a.csh', 'b.csh', 'c.csh.gz'], ['a.csh', 'c.csh'], dirname=self.output_path)
+    self.assertEqual(missing, ['b.csh', os.path.join(self.output_path, 'c.csh.gz')])
+
+  def testVerifyArrayExecScripts(self):
+    manifest_fn = os.path.join(self.output_path, 'manifest.txt')
+    with PhosimUtil.ManifestParser(manifest_fn, 'a') as parser:
+      parser.Append([('param', 'exec_script_base', 'exec_raytrace'),
+                     ('param', 'exec_script_mode', 'array'),
+                     ('file', 'exec', 'exec_raytrace_1234_array.csh')])
+    for fn in ['exec_raytrace_1234_array.csh', 'exec_raytrace_1234_array.txt']:
+      open(os.path.join(self.output_path, fn), 'w').close()
+    with PhosimUtil.ManifestParser(manifest_fn, 'r') as parser:
+      parser.Read()
+      exposure_ids = parser.GetAllByTags('set', 'exposure_id')
+      self.assertEqual(self.verifier._VerifyExecScripts(parser, exposure_ids), [])
+      os.remove(os.path.join(self.output_path, 'exec_raytrace_1234_array.txt'))
+      self.verifier.ResetSnapshots()
+      self.assertEqual(self.verifier._VerifyExecScripts(parser, exposure_ids),
+                       [os.path.join(self.output_path, 'exec_raytrace_1234_array.txt')])
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -9,6 +9,7 @@ import logging
 import os
 import stat
 
+import CostModel
 import phosim
 
 __author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
@@ -16,8 +17,23 @@ __author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
 logger = logging.getLogger(__name__)
 
 
+def ArrayScriptNames(exec_script_base, observation_id):
+  """Returns (array script, index file) names for PbsArrayRaytraceScriptWriter."""
+  base = '%s_%s_array' % (exec_script_base, observation_id)
+  return base + '.csh', base + '.txt'
+
+def NodeScriptNames(exec_script_base, observation_id, node):
+  """Returns (node script, bundle manifest) names for PbsNodeRaytraceScriptWriter."""
+  base = '%s_%s_node%03d' % (exec_script_base, observation_id, node)
+  return base + '.pbs', base + '.txt'
+
+
 class ScriptWriter(object):
   """Writes scripts for various ImSim/PhoSim stages."""
+
+  # Recorded in the manifest as the 'exec_script_mode' param.
+  exec_script_mode = 'per_fid'
+
   def __init__(self, phosim_bin_dir, phosim_data_dir, phosim_output_dir,
                phosim_work_dir, debug_level=0, python_exec='python',
                python_control_dir='.', imsim_config_file=None,
@@ -42,6 +58,7 @@ class ScriptWriter(object):
     self._exec_script_base = exec_script_base
     self._pars_archive_fullpath = pars_archive_fullpath
     self._extra_write_op = extra_write_op
+    self._predicted_runtimes = {}
 
   def SetExecScriptBase(self, exec_script_base):
     self._exec_script_base = exec_script_base
@@ -61,6 +78,25 @@ class ScriptWriter(object):
   def GetExtraWriteOp(self):
     return self._extra_write_op
 
+  def SetPredictedRuntimes(self, predicted_runtimes):
+    """Sets {fid: predicted runtime in seconds} (see CostModel.py).
+
+    Scheduler-specific subclasses use these in Finalize() to order fids
+    longest-first and to size walltimes.
+    """
+    self._predicted_runtimes = predicted_runtimes
+
+  def Finalize(self):
+    """Called after the last call to WriteScript().
+
+    Subclasses that write one script for many fids write it here.
+
+    Returns:
+      List of absolute paths of files written in addition to the exec
+      scripts named by WriteScript().
+    """
+    return []
+
 
 class RaytraceScriptWriter(ScriptWriter):
   """ScriptWriter for running raytrace stage.
@@ -150,6 +186,14 @@ class RaytraceScriptWriter(ScriptWriter):
                'else\n'
                '   setenv PYTHONPATH %s\n'
                'endif\n' % (self.phosim_bin_dir, self.phosim_bin_dir))
+    cmd = self._ExecCommand(observation_id, cid, eid, filter_num, instrument,
+                            run_e2adc)
+    logger.info('Script Exec command: %s', cmd)
+    outf.write('%s\n\n' % cmd)
+
+  def _ExecCommand(self, observation_id, cid, eid, filter_num, instrument,
+                   run_e2adc):
+    """Returns the onechip.py command line."""
     cmd = ('%s %s %s %s %s %s %s --instrument=%s' %
            (self.python_exec, os.path.join(self.python_control_dir, 'onechip.py'),
             self.imsim_config_file, observation_id, cid, eid, filter_num,
@@ -159,8 +203,7 @@ class RaytraceScriptWriter(ScriptWriter):
     if self._pars_archive_fullpath:
       cmd += ' --pars_archive=%s' % self._pars_archive_fullpath
     cmd += ' $extra_args'
-    logger.info('Script Exec command: %s', cmd)
-    outf.write('%s\n\n' % cmd)
+    return cmd
 
   def _WriteStageOut(self, outf, observation_id, cid, eid, filter_num, instrument,
                      run_e2adc):
@@ -178,8 +221,17 @@ class PbsRaytraceScriptWriter(RaytraceScriptWriter):
 
   This is a skeleton example of how one would implement their own
   scheduler-specific script writer.
+
+  The runtimes predicted by the cost model are only known once all fids
+  are scheduled, so Finalize() rewrites the walltime of each script
+  written so far from its prediction.
   """
 
+  def __init__(self, *args, **kwargs):
+    RaytraceScriptWriter.__init__(self, *args, **kwargs)
+    # (fid, absolute path) of each per-fid script written.
+    self._scripts = []
+
   def ParsePbsConfig(self, policy):
     """Parses PBS-specific variables from config file.
 
@@ -195,6 +247,47 @@ class PbsRaytraceScriptWriter(RaytraceScriptWriter):
     self.job_name = self.policy.get('pbs','job_name')
     self.n_cores = self.policy.get('pbs', 'cores_per_node')
     self.walltime = self.policy.get('pbs', 'walltime')
+    # Overrides walltime for the header being written, if set.
+    self._job_walltime = None
+
+  def WriteScript(self, observation_id, cid, eid, filter_num, output_dir,
+                  bin_dir, data_dir, instrument='lsst', run_e2adc=True):
+    """Writes the per-fid script and records it for Finalize()."""
+    RaytraceScriptWriter.WriteScript(self, observation_id, cid, eid,
+                                     filter_num, output_dir, bin_dir,
+                                     data_dir, instrument, run_e2adc)
+    fid = phosim.BuildFid(observation_id, cid, eid)
+    self._scripts.append(
+      (fid, os.path.abspath('%s_%s.csh' % (self._exec_script_base, fid))))
+
+  def Finalize(self):
+    """Sets the walltime of each script written from its predicted runtime.
+
+    Scripts of fids without a prediction keep the configured walltime.
+
+    Returns:
+      [], since the scripts were already named by WriteScript().
+    """
+    for fid, script_name in self._scripts:
+      walltime = self._PredictedWalltime([fid])
+      if not walltime:
+        continue
+      with open(script_name, 'r') as f:
+        lines = f.readlines()
+      lines = ['#PBS -l walltime=%s\n' % walltime
+               if line.startswith('#PBS -l walltime=') else line
+               for line in lines]
+      with open(script_name, 'w') as f:
+        f.writelines(lines)
+    self._scripts = []
+    return []
+
+  def _PredictedWalltime(self, fids, slots=1):
+    """Walltime for running fids on slots cores, or None if not all are predicted."""
+    if not fids or [fid for fid in fids if fid not in self._predicted_runtimes]:
+      return None
+    return CostModel.Walltime(CostModel.Makespan(
+      [self._predicted_runtimes[fid] for fid in fids], slots))
 
   def _WriteHeader(self, outf, observation_id, cid, eid, filter_num,
                    instrument, run_e2adc):
@@ -218,6 +311,266 @@ class PbsRaytraceScriptWriter(RaytraceScriptWriter):
     outf.write('#PBS -j oe\n')
     outf.write('#PBS -m a\n')
     outf.write('#PBS -o %s\n' % log_fn)
-    outf.write('#PBS -l walltime=%s\n' % self.walltime)
+    outf.write('#PBS -l walltime=%s\n' % (self._job_walltime or self.walltime))
     outf.write('#PBS -l nodes=1:ppn=%s\n' % self.n_cores)
     outf.write('\n')
+
+
+class PbsArrayRaytraceScriptWriter(PbsRaytraceScriptWriter):
+  """Writes one PBS job array per observation instead of one script per fid.
+
+  WriteScript() only records the chip and exposure IDs.  Finalize() then
+  writes the array script and an index file (see ArrayScriptNames())
+  whose lines map PBS_ARRAYID to 'cid eid'.  The whole observation is
+  thus submitted with a single qsub.  The stdout of each task goes to
+  'log_dir'/<observation_id>/raytrace_<fid>_stdout.log.
+
+  The index is read from the directory of imsim_config_file, i.e. from
+  where the preprocessing output is staged.
+  """
+
+  exec_script_mode = 'array'
+
+  def __init__(self, *args, **kwargs):
+    PbsRaytraceScriptWriter.__init__(self, *args, **kwargs)
+    self._tasks = []
+    self._task_params = None
+
+  def WriteScript(self, observation_id, cid, eid, filter_num, output_dir,
+                  bin_dir, data_dir, instrument='lsst', run_e2adc=True):
+    """Records cid and eid as the next task of the array.
+
+    Args are the same as for RaytraceScriptWriter.WriteScript().
+    """
+    assert self._exec_script_base
+    assert output_dir == self.phosim_output_dir
+    assert bin_dir == self.phosim_bin_dir
+    assert data_dir == self.phosim_data_dir
+    task_params = (observation_id, filter_num, instrument, run_e2adc)
+    assert self._task_params in (None, task_params)
+    self._task_params = task_params
+    self._tasks.append((cid, eid))
+    if self._extra_write_op:
+      # Write cid_eid to manifest file.
+      self._extra_write_op('%s_%s' % (cid, eid))
+
+  def Finalize(self):
+    """Writes the array script and index file to the current directory.
+
+    Returns:
+      [array script, index file], with absolute paths.  [] if no tasks
+      were recorded.
+    """
+    if not self._tasks:
+      return []
+    observation_id, filter_num, instrument, run_e2adc = self._task_params
+    script_name, index_name = ArrayScriptNames(self._exec_script_base,
+                                               observation_id)
+    # Schedulers start array tasks in index order, so put the longest first.
+    fids = dict((phosim.BuildFid(observation_id, cid, eid), (cid, eid))
+                for cid, eid in self._tasks)
+    self._tasks = [fids[fid] for fid in CostModel.LongestFirst(
+                     [phosim.BuildFid(observation_id, cid, eid)
+                      for cid, eid in self._tasks], self._predicted_runtimes)]
+    # The walltime of an array applies to each task, so size it for the
+    # longest one.
+    self._job_walltime = self._PredictedWalltime(fids.keys(), slots=len(fids))
+    logger.info('Generating raytrace array script %s with %d tasks.',
+                script_name, len(self._tasks))
+    with open(index_name, 'w') as outf:
+      for i, (cid, eid) in enumerate(self._tasks):
+        outf.write('%d %s %s\n' % (i, cid, eid))
+    with open(script_name, 'w') as outf:
+      self._WriteHeader(outf, observation_id, 'array', 'array', filter_num,
+                        instrument, run_e2adc)
+      self._WriteTaskLookup(outf, observation_id, index_name)
+      self._WriteStageIn(outf, observation_id, '${cid}', '${eid}', filter_num,
+                         instrument, run_e2adc)
+      self._WriteExec(outf, observation_id, '${cid}', '${eid}', filter_num,
+                      instrument, run_e2adc)
+      self._WriteStageOut(outf, observation_id, '${cid}', '${eid}', filter_num,
+                          instrument, run_e2adc)
+    self._ChmodPlusX(script_name)
+    self._tasks = []
+    self._task_params = None
+    self._job_walltime = None
+    return [os.path.abspath(script_name), os.path.abspath(index_name)]
+
+  def _WriteHeader(self, outf, observation_id, cid, eid, filter_num,
+                   instrument, run_e2adc):
+    """Write PBS-specific header, plus the array range."""
+    PbsRaytraceScriptWriter._WriteHeader(self, outf, observation_id, cid, eid,
+                                         filter_num, instrument, run_e2adc)
+    outf.write('#PBS -t 0-%d\n' % (len(self._tasks) - 1))
+    outf.write('\n')
+
+  def _WriteTaskLookup(self, outf, observation_id, index_name):
+    """Sets $cid and $eid from the index entry for $PBS_ARRAYID."""
+    index_fn = os.path.join(os.path.dirname(self.imsim_config_file or ''),
+                            index_name)
+    outf.write('### ---------------------------------------\n')
+    outf.write('### Array Task Section\n')
+    outf.write('### ---------------------------------------\n\n')
+    outf.write("set task = (`awk -v id=$PBS_ARRAYID '$1 == id {print $2, $3}' %s`)\n"
+               % index_fn)
+    outf.write('if ($#task != 2) then\n'
+               '   echo "No task $PBS_ARRAYID in %s"\n'
+               '   exit 1\n'
+               'endif\n'
+               'set cid = $task[1]\n'
+               'set eid = $task[2]\n\n' % index_fn)
+
+  def _ExecCommand(self, observation_id, cid, eid, filter_num, instrument,
+                   run_e2adc):
+    """Returns the onechip.py command line, with stdout to the task log."""
+    log_fn = os.path.join(self.policy.get('general', 'log_dir'), observation_id,
+                          'raytrace_%s_%s_%s_stdout.log' % (observation_id, cid, eid))
+    cmd = PbsRaytraceScriptWriter._ExecCommand(self, observation_id, cid, eid,
+                                               filter_num, instrument, run_e2adc)
+    return '%s >& %s' % (cmd, log_fn)
+
+
+class PbsNodeRaytraceScriptWriter(PbsRaytraceScriptWriter):
+  """Packs the fids of an observation into PBS jobs of one node each.
+
+  WriteScript() writes the usual per-fid exec script (without a PBS
+  header).  Finalize() then groups the fids into bundles of
+  'fids_per_node' and writes for each bundle
+    - a manifest listing its exec scripts, and
+    - a PBS script that requests one node with 'cores_per_node' cores
+      and runs the bundle there with LocalExecutor.py,
+  see NodeScriptNames().  LocalExecutor keeps at most 'cores_per_node'
+  fids running, admits a fid only if its 'mem_per_fid_gb' fits into the
+  node's memory and, with 'pin_cpus', pins each fid to its own core.  So
+  the node stays busy regardless of how the site packs jobs.  Per-fid
+  output goes to 'log_dir'/<observation_id>/<fid>.<attempt>.out; the
+  final exit status of each fid to
+  'log_dir'/<observation_id>/exit_status_<observation_id>_node<N>.txt.
+  The node script exits non-zero if any fid failed.
+
+  Finalize() also writes <exec_script_base>_<observation_id>_nodes.txt,
+  the list of node scripts for Submitter.py.  Like the per-fid scripts,
+  they are expected to run from the directory of imsim_config_file.
+  """
+
+  exec_script_mode = 'node'
+
+  def __init__(self, *args, **kwargs):
+    PbsRaytraceScriptWriter.__init__(self, *args, **kwargs)
+    self._fids = []
+
+  def ParsePbsConfig(self, policy):
+    """Also parses 'fids_per_node', 'mem_per_fid_gb' and 'pin_cpus'."""
+    PbsRaytraceScriptWriter.ParsePbsConfig(self, policy)
+    self.fids_per_node = int(self.n_cores)
+    if policy.has_option('pbs', 'fids_per_node'):
+      self.fids_per_node = policy.getint('pbs', 'fids_per_node')
+    self.mem_per_fid_gb = 0.0
+    if policy.has_option('pbs', 'mem_per_fid_gb'):
+      self.mem_per_fid_gb = policy.getfloat('pbs', 'mem_per_fid_gb')
+    self.pin_cpus = False
+    if policy.has_option('pbs', 'pin_cpus'):
+      self.pin_cpus = policy.getboolean('pbs', 'pin_cpus')
+
+  def WriteScript(self, observation_id, cid, eid, filter_num, output_dir,
+                  bin_dir, data_dir, instrument='lsst', run_e2adc=True):
+    """Writes the per-fid script and records it for bundling."""
+    RaytraceScriptWriter.WriteScript(self, observation_id, cid, eid,
+                                     filter_num, output_dir, bin_dir,
+                                     data_dir, instrument, run_e2adc)
+    self._fids.append((observation_id, cid, eid, instrument))
+
+  def Finalize(self):
+    """Writes the node scripts and bundle manifests to the current directory.
+
+    Returns:
+      Absolute paths of the node scripts, the bundle manifests and the
+      list of node scripts.  [] if no fids were recorded.
+    """
+    if not self._fids:
+      return []
+    observation_id = self._fids[0][0]
+    stage_dir = os.path.dirname(self.imsim_config_file or '')
+    log_dir = os.path.join(self.policy.get('general', 'log_dir'), observation_id)
+    written = []
+    node_list = []
+    for node, bundle in enumerate(self._Bundles()):
+      script_name, bundle_name = NodeScriptNames(self._exec_script_base,
+                                                 observation_id, node)
+      logger.info('Generating raytrace node script %s with %d fids.',
+                  script_name, len(bundle))
+      with open(bundle_name, 'w') as outf:
+        for obsid, cid, eid, instrument in bundle:
+          outf.write('%s_%s.csh\n' % (self._exec_script_base,
+                                      phosim.BuildFid(obsid, cid, eid)))
+      self._job_walltime = self._PredictedWalltime(
+        [phosim.BuildFid(obsid, cid, eid) for obsid, cid, eid, instrument in bundle],
+        int(self.n_cores))
+      with open(script_name, 'w') as outf:
+        PbsRaytraceScriptWriter._WriteHeader(self, outf, observation_id,
+                                             'node%03d' % node, 'node%03d' % node,
+                                             None, bundle[0][3], None)
+        self._WriteNodeExec(outf, stage_dir, log_dir, observation_id, node,
+                            bundle_name)
+      self._ChmodPlusX(script_name)
+      written.extend([os.path.abspath(script_name), os.path.abspath(bundle_name)])
+      node_list.append(os.path.join(stage_dir, script_name))
+    node_list_name = '%s_%s_nodes.txt' % (self._exec_script_base, observation_id)
+    with open(node_list_name, 'w') as outf:
+      for script in node_list:
+        outf.write('%s\n' % script)
+    written.append(os.path.abspath(node_list_name))
+    self._fids = []
+    self._job_walltime = None
+    return written
+
+  def _Bundles(self):
+    """Splits the fids into bundles of at most fids_per_node.
+
+    With predicted runtimes, the fids are dealt longest-first to the
+    bundles in snake order, so that the bundles take about equally long
+    and LocalExecutor starts the longest fid of each bundle first.
+    """
+    nbundles = (len(self._fids) + self.fids_per_node - 1) // self.fids_per_node
+    fids = dict((phosim.BuildFid(*fid[:3]), fid) for fid in self._fids)
+    if not self._predicted_runtimes:
+      return [self._fids[i * self.fids_per_node:(i + 1) * self.fids_per_node]
+              for i in range(nbundles)]
+    bundles = [[] for i in range(nbundles)]
+    ordered = CostModel.LongestFirst([phosim.BuildFid(*fid[:3]) for fid in self._fids],
+                                     self._predicted_runtimes)
+    for i, fid in enumerate(ordered):
+      sweep, pos = divmod(i, nbundles)
+      bundles[pos if sweep % 2 == 0 else nbundles - 1 - pos].append(fids[fid])
+    return bundles
+
+  def _WriteHeader(self, outf, observation_id, cid, eid, filter_num,
+                   instrument, run_e2adc):
+    """Per-fid scripts run inside a node script, so they get no PBS header."""
+    RaytraceScriptWriter._WriteHeader(self, outf, observation_id, cid, eid,
+                                      filter_num, instrument, run_e2adc)
+
+  def _WriteNodeExec(self, outf, stage_dir, log_dir, observation_id, node,
+                     bundle_name):
+    """Runs the bundle with LocalExecutor.py."""
+    cmd = ('%s %s -n %s -m %s -l %s -s %s -e %s' %
+           (self.python_exec,
+            os.path.join(self.python_control_dir, 'LocalExecutor.py'),
+            self.n_cores, self.mem_per_fid_gb, log_dir,
+            os.path.join(log_dir, 'executor_%s_node%03d.csv' % (observation_id, node)),
+            os.path.join(log_dir, 'exit_status_%s_node%03d.txt' % (observation_id, node))))
+    if self.pin_cpus:
+      cmd += ' -p'
+    cmd += ' %s' % os.path.join(stage_dir, bundle_name)
+    logger.info('Node script exec command: %s', cmd)
+    outf.write('### ---------------------------------------\n')
+    outf.write('### Executable Section\n')
+    outf.write('### ---------------------------------------\n\n')
+    outf.write('%s\n' % cmd)
+    outf.write('exit $status\n')
+
+
+# Writer classes for the 'exec_script_mode' option in the [pbs] section.
+PBS_SCRIPT_WRITERS = {'per_fid': PbsRaytraceScriptWriter,
+                      'array': PbsArrayRaytraceScriptWriter,
+                      'node': PbsNodeRaytraceScriptWriter}
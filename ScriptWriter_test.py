@@ -1,5 +1,8 @@
 #!/usr/bin/python2.6
+from __future__ import with_statement
+import ConfigParser
 import os
+import shutil
 import tempfile
 import unittest
 import ScriptWriter
@@ -23,5 +26,176 @@ class ScriptWriterTest(unittest.TestCase):
     self.assertEquals(self.phosim_work_dir, writer.phosim_work_dir)
 
 
+class PbsRaytraceScriptWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    policy = ConfigParser.RawConfigParser()
+    policy.add_section('general')
+    policy.set('general', 'scheduler2', 'pbs')
+    policy.set('general', 'log_dir', '/logs')
+    policy.add_section('pbs')
+    for option, value in [('email', 'a@b.c'), ('job_name', 'test'),
+                          ('cores_per_node', '1'), ('walltime', '1:00:00')]:
+      policy.set('pbs', option, value)
+    self.writer = ScriptWriter.PbsRaytraceScriptWriter(
+      'bin', 'data', 'output', 'work', imsim_config_file='/stage/1234/my.cfg',
+      exec_script_base='exec_raytrace')
+    self.writer.ParsePbsConfig(policy)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def _Walltimes(self):
+    walltimes = []
+    for eid in ['E000', 'E001']:
+      with open('exec_raytrace_1234_R22_S11_%s.csh' % eid, 'r') as f:
+        walltimes.append([line.strip() for line in f if 'walltime' in line])
+    return walltimes
+
+  def testPredictedWalltime(self):
+    for eid in ['E000', 'E001']:
+      self.writer.WriteScript('1234', 'R22_S11', eid, 2, 'output', 'bin', 'data')
+    # Only the fid with a prediction gets its own walltime.
+    self.writer.SetPredictedRuntimes({'1234_R22_S11_E001': 3000.0})
+    self.assertEqual(self.writer.Finalize(), [])
+    self.assertEqual(self._Walltimes(), [['#PBS -l walltime=1:00:00'],
+                                         ['#PBS -l walltime=1:15:00']])
+
+
+class PbsArrayRaytraceScriptWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    policy = ConfigParser.RawConfigParser()
+    policy.add_section('general')
+    policy.set('general', 'scheduler2', 'pbs')
+    policy.set('general', 'log_dir', '/logs')
+    policy.add_section('pbs')
+    for option, value in [('email', 'a@b.c'), ('job_name', 'test'),
+                          ('cores_per_node', '1'), ('walltime', '1:00:00')]:
+      policy.set('pbs', option, value)
+    self.written = []
+    self.writer = ScriptWriter.PbsArrayRaytraceScriptWriter(
+      'bin', 'data', 'output', 'work', imsim_config_file='/stage/1234/my.cfg',
+      exec_script_base='exec_raytrace', extra_write_op=self.written.append)
+    self.writer.ParsePbsConfig(policy)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def testFinalize(self):
+    self.assertEqual(self.writer.Finalize(), [])
+    fids = [('R22_S11', 'E000'), ('R22_S11', 'E001'), ('R01_S00', 'E000')]
+    for cid, eid in fids:
+      self.writer.WriteScript('1234', cid, eid, 2, 'output', 'bin', 'data')
+    self.assertEqual(self.written, ['R22_S11_E000', 'R22_S11_E001', 'R01_S00_E000'])
+    self.assertEqual(os.listdir(self.tmpdir), [])
+    script, index = ScriptWriter.ArrayScriptNames('exec_raytrace', '1234')
+    self.assertEqual(self.writer.Finalize(),
+                     [os.path.join(self.tmpdir, script),
+                      os.path.join(self.tmpdir, index)])
+    with open(index, 'r') as f:
+      self.assertEqual(f.read(), '0 R22_S11 E000\n1 R22_S11 E001\n2 R01_S00 E000\n')
+    with open(script, 'r') as f:
+      lines = f.read().splitlines()
+    self.assertTrue('#PBS -t 0-2' in lines)
+    self.assertTrue([l for l in lines if l.startswith('set task = ') and
+                     '/stage/1234/%s' % index in l])
+    self.assertTrue([l for l in lines if 'onechip.py /stage/1234/my.cfg 1234 ${cid} ${eid} 2'
+                     in l and l.endswith('>& /logs/1234/raytrace_1234_${cid}_${eid}_stdout.log')])
+    self.assertTrue(os.access(script, os.X_OK))
+    # The writer can be reused for another observation.
+    self.assertEqual(self.writer.Finalize(), [])
+
+  def testPredictedWalltime(self):
+    eids = ['E%03d' % i for i in range(3)]
+    for eid in eids:
+      self.writer.WriteScript('1234', 'R22_S11', eid, 2, 'output', 'bin', 'data')
+    self.writer.SetPredictedRuntimes(dict(
+      ('1234_R22_S11_%s' % eid, 1000.0 * (i + 1)) for i, eid in enumerate(eids)))
+    script, index = self.writer.Finalize()
+    with open(index, 'r') as f:
+      self.assertEqual(f.read(), '0 R22_S11 E002\n1 R22_S11 E001\n2 R22_S11 E000\n')
+    # Each task gets its own walltime: 1.5 * the longest prediction.
+    with open(script, 'r') as f:
+      self.assertTrue('#PBS -l walltime=1:15:00' in f.read().splitlines())
+
+
+class PbsNodeRaytraceScriptWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.tmpdir)
+    policy = ConfigParser.RawConfigParser()
+    policy.add_section('general')
+    policy.set('general', 'scheduler2', 'pbs')
+    policy.set('general', 'log_dir', '/logs')
+    policy.add_section('pbs')
+    for option, value in [('email', 'a@b.c'), ('job_name', 'test'),
+                          ('cores_per_node', '2'), ('walltime', '1:00:00'),
+                          ('fids_per_node', '3'), ('mem_per_fid_gb', '2.5'),
+                          ('pin_cpus', 'true')]:
+      policy.set('pbs', option, value)
+    self.writer = ScriptWriter.PbsNodeRaytraceScriptWriter(
+      'bin', 'data', 'output', 'work', imsim_config_file='/stage/1234/my.cfg',
+      exec_script_base='exec_raytrace')
+    self.writer.ParsePbsConfig(policy)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def testFinalize(self):
+    eids = ['E%03d' % i for i in range(4)]
+    for eid in eids:
+      self.writer.WriteScript('1234', 'R22_S11', eid, 2, 'output', 'bin', 'data')
+    with open('exec_raytrace_1234_R22_S11_E000.csh', 'r') as f:
+      self.assertFalse('#PBS' in f.read())
+    written = self.writer.Finalize()
+    names = [ScriptWriter.NodeScriptNames('exec_raytrace', '1234', node)
+             for node in range(2)]
+    self.assertEqual(written, [os.path.join(self.tmpdir, fn) for fn in
+                               list(names[0]) + list(names[1]) +
+                               ['exec_raytrace_1234_nodes.txt']])
+    with open(names[1][1], 'r') as f:
+      self.assertEqual(f.read(), 'exec_raytrace_1234_R22_S11_E003.csh\n')
+    with open('exec_raytrace_1234_nodes.txt', 'r') as f:
+      self.assertEqual(f.read(), '/stage/1234/%s\n/stage/1234/%s\n' %
+                       (names[0][0], names[1][0]))
+    with open(names[0][0], 'r') as f:
+      lines = f.read().splitlines()
+    self.assertTrue('#PBS -l nodes=1:ppn=2' in lines)
+    self.assertTrue([l for l in lines if 'LocalExecutor.py -n 2 -m 2.5 -l /logs/1234' in l
+                     and ' -p /stage/1234/%s' % names[0][1] in l])
+    self.assertTrue(os.access(names[0][0], os.X_OK))
+
+  def testPredictedRuntimes(self):
+    eids = ['E%03d' % i for i in range(6)]
+    for eid in eids:
+      self.writer.WriteScript('1234', 'R22_S11', eid, 2, 'output', 'bin', 'data')
+    # E005 is longest, E000 shortest.
+    self.writer.SetPredictedRuntimes(dict(
+      ('1234_R22_S11_%s' % eid, 1000.0 * (i + 1)) for i, eid in enumerate(eids)))
+    self.writer.Finalize()
+    bundles = []
+    for node in range(2):
+      script, bundle = ScriptWriter.NodeScriptNames('exec_raytrace', '1234', node)
+      with open(bundle, 'r') as f:
+        bundles.append([line.split('_')[-1].split('.')[0] for line in f])
+      with open(script, 'r') as f:
+        bundles[-1].append([line.strip() for line in f if 'walltime' in line][0])
+    # Dealt longest-first in snake order; 2 cores per node.
+    self.assertEqual(bundles, [['E005', 'E002', 'E001', '#PBS -l walltime=2:30:00'],
+                               ['E004', 'E003', 'E000', '#PBS -l walltime=2:05:00']])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+"""Submits batch scripts to a scheduler while keeping its queue at a target depth.
+
+Submitter replaces the fixed-sleep polling loop of submitPbs.py:
+  - The queue is polled with a single scheduler command per cycle.
+  - Whenever there is room, up to 'batch_size' scripts are submitted
+    back to back, without sleeping between them.
+  - When the queue is full (or a submission fails), the poll interval
+    doubles, up to 'max_sleep'.  It drops back to 'min_sleep' as soon as
+    there is room again.
+  - Every submission is recorded in a Journal before the next one is made,
+    so a restarted Submitter skips scripts that were already submitted.
+
+The scheduler commands are supplied by a Scheduler object.  PbsScheduler
+runs qsub and showq; both commands can be replaced, e.g. by local
+stand-ins for testing.
+
+Usage:
+  Submitter.py [options] <script or list of scripts> [...]
+Run 'Submitter.py -h' for options.
+"""
+
+from __future__ import with_statement
+import logging
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+  """Interface to the batch scheduler.  Subclass this for each scheduler."""
+
+  def CountQueued(self):
+    """Returns the number of our jobs that are queued or running."""
+    raise NotImplementedError()
+
+  def Submit(self, script):
+    """Submits script.  Returns the job ID.
+
+    Raises:
+      CalledProcessError or OSError if submission fails.
+    """
+    raise NotImplementedError()
+
+
+class PbsScheduler(Scheduler):
+  """PBS/Moab: submits with qsub and counts queued jobs with showq."""
+
+  def __init__(self, username, qsub_cmd='qsub', showq_cmd='showq',
+               queued_states=('Running', 'Idle')):
+    """Constructor.
+
+    Args:
+      username:      Count jobs of this user.
+      qsub_cmd:      Submission command.  Called as '<qsub_cmd> <script>'
+                     and prints the job ID.
+      showq_cmd:     Queue listing command.  Jobs are the lines of its
+                     output that contain username and one of queued_states.
+      queued_states: Job states that count towards the queue depth.
+    """
+    self.username = username
+    self.qsub_cmd = qsub_cmd
+    self.showq_cmd = showq_cmd
+    self.queued_states = queued_states
+
+  def CountQueued(self):
+    p = subprocess.Popen(self.showq_cmd, shell=True, stdout=subprocess.PIPE,
+                         close_fds=True)
+    output = p.communicate()[0]
+    if p.returncode:
+      raise subprocess.CalledProcessError(p.returncode, self.showq_cmd)
+    nqueued = 0
+    for line in output.splitlines():
+      fields = line.split()
+      if self.username in fields and [s for s in self.queued_states if s in fields]:
+        nqueued += 1
+    return nqueued
+
+  def Submit(self, script):
+    p = subprocess.Popen('%s %s' % (self.qsub_cmd, script), shell=True,
+                         stdout=subprocess.PIPE, close_fds=True)
+    output = p.communicate()[0]
+    if p.returncode:
+      raise subprocess.CalledProcessError(p.returncode, self.qsub_cmd)
+    return output.strip()
+
+
+class Journal(object):
+  """Append-only record of submitted scripts.
+
+  Each line is '<script> [<job ID>]'.  This is compatible with the
+  submittedFiles.lis written by older versions of submitPbs.py.
+  """
+
+  def __init__(self, fn):
+    self.fn = fn
+    self.submitted = {}
+    if os.path.exists(fn):
+      with open(fn, 'r') as f:
+        for line in f:
+          fields = line.split(None, 1)
+          if fields:
+            self.submitted[fields[0]] = fields[1].strip() if len(fields) > 1 else ''
+      logger.info('Journal %s lists %d submitted scripts.', fn, len(self.submitted))
+
+  def Has(self, script):
+    return script in self.submitted
+
+  def Record(self, script, job_id):
+    """Records a submission.  The record is on disk when this returns."""
+    self.submitted[script] = job_id
+    with open(self.fn, 'a') as f:
+      f.write('%s %s\n' % (script, job_id))
+      f.flush()
+      os.fsync(f.fileno())
+
+
+class Submitter(object):
+  """Keeps up to target_depth jobs in the queue until all are submitted."""
+
+  def __init__(self, scheduler, journal, target_depth, batch_size=None,
+               min_sleep=5.0, max_sleep=300.0, max_failures=10,
+               on_submit=None, sleep_func=time.sleep):
+    """Constructor.
+
+    Args:
+      scheduler:     Scheduler instance.
+      journal:       Journal instance.
+      target_depth:  Number of our jobs to keep queued or running.
+      batch_size:    Max number of scripts to submit per poll (default:
+                     whatever fits).
+      min_sleep:     Poll interval while scripts are being submitted.
+      max_sleep:     Max poll interval while the queue is full.
+      max_failures:  Give up after this many consecutive failed polls or
+                     submissions.
+      on_submit:     Called as on_submit(script, job_id) after each submission.
+      sleep_func:    Function used to sleep (for testing).
+    """
+    self.scheduler = scheduler
+    self.journal = journal
+    self.target_depth = target_depth
+    self.batch_size = batch_size
+    self.min_sleep = min_sleep
+    self.max_sleep = max_sleep
+    self.max_failures = max_failures
+    self.on_submit = on_submit
+    self.sleep_func = sleep_func
+    self.npolls = 0
+
+  def Run(self, scripts):
+    """Submits every script in scripts that is not in the journal.
+
+    Returns:
+      Number of scripts submitted.
+
+    Raises:
+      RuntimeError after max_failures consecutive failures.
+    """
+    pending = [script for script in scripts if not self.journal.Has(script)]
+    if len(pending) < len(scripts):
+      logger.info('Skipping %d scripts that were already submitted.',
+                  len(scripts) - len(pending))
+    nsubmitted = 0
+    sleep = self.min_sleep
+    failures = 0
+    while pending:
+      try:
+        self.npolls += 1
+        room = self.target_depth - self.scheduler.CountQueued()
+        if self.batch_size:
+          room = min(room, self.batch_size)
+        for i in range(max(room, 0)):
+          script = pending[0]
+          job_id = self.scheduler.Submit(script)
+          self.journal.Record(script, job_id)
+          pending.pop(0)
+          nsubmitted += 1
+          logger.info('Submitted %s as %s (%d left).', script, job_id, len(pending))
+          if self.on_submit:
+            self.on_submit(script, job_id)
+          if not pending:
+            break
+        failures = 0
+      except (subprocess.CalledProcessError, OSError), e:
+        failures += 1
+        room = 0
+        logger.warning('Scheduler command failed (%d in a row): %s', failures, e)
+        if failures >= self.max_failures:
+          raise RuntimeError('Giving up after %d scheduler failures: %s' %
+                             (failures, e))
+      if not pending:
+        break
+      if room > 0:
+        sleep = self.min_sleep
+      else:
+        sleep = min(2 * sleep, self.max_sleep)
+      logger.debug('Sleeping for %.1f s.', sleep)
+      self.sleep_func(sleep)
+    logger.info('Submitted %d scripts in %d polls.', nsubmitted, self.npolls)
+    return nsubmitted
+
+
+def ReadScriptList(fn):
+  """Returns the scripts listed in fn, one per line."""
+  with open(fn, 'r') as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+  usage = 'usage: %prog [options] script_list [script_list ...]'
+  parser = OptionParser(usage=usage)
+  parser.add_option('-u', '--username', dest='username',
+                    default=os.environ.get('USER'),
+                    help='Count queued jobs of this user (default: $USER).')
+  parser.add_option('-d', '--depth', dest='depth', type='int', default=100,
+                    help='Number of jobs to keep queued or running.')
+  parser.add_option('-b', '--batch_size', dest='batch_size', type='int',
+                    default=None, help='Max scripts to submit per poll.')
+  parser.add_option('-j', '--journal', dest='journal', default='submittedFiles.lis',
+                    help='Journal of submitted scripts.')
+  parser.add_option('--min_sleep', dest='min_sleep', type='float', default=5.0,
+                    help='Poll interval while submitting, in seconds.')
+  parser.add_option('--max_sleep', dest='max_sleep', type='float', default=300.0,
+                    help='Max poll interval while the queue is full, in seconds.')
+  parser.add_option('--qsub', dest='qsub_cmd', default='qsub',
+                    help='Submission command.')
+  parser.add_option('--showq', dest='showq_cmd', default='showq',
+                    help='Queue listing command.')
+  (options, args) = parser.parse_args()
+  if not args:
+    print 'Incorrect number of arguments.  Use -h or --help for help.'
+    print usage
+    quit()
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s:%(name)s:  %(message)s')
+  scripts = []
+  for fn in args:
+    scripts.extend(ReadScriptList(fn))
+  submitter = Submitter(PbsScheduler(options.username, options.qsub_cmd,
+                                     options.showq_cmd),
+                        Journal(options.journal), options.depth,
+                        batch_size=options.batch_size,
+                        min_sleep=options.min_sleep, max_sleep=options.max_sleep)
+  submitter.Run(scripts)
+  sys.exit(0)
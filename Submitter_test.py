@@ -0,0 +1,131 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import Submitter
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+
+class SubmitterTest(unittest.TestCase):
+  """Runs Submitter against local stand-ins for qsub and showq.
+
+  The fake qsub appends a 'Idle' line to a queue file and prints a job ID;
+  the fake showq prints the queue file.
+  """
+
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.queue_fn = os.path.join(self.tmpdir, 'queue')
+    open(self.queue_fn, 'w').close()
+    self.qsub = self.WriteCommand(
+      'qsub', 'n=`wc -l < %s`\necho "$n testuser Idle $1" >> %s\necho "$n.fake"\n' %
+      (self.queue_fn, self.queue_fn))
+    self.showq = self.WriteCommand('showq', 'echo "JOBID USERNAME STATE"\ncat %s\n' %
+                                   self.queue_fn)
+    self.scheduler = Submitter.PbsScheduler('testuser', qsub_cmd=self.qsub,
+                                            showq_cmd=self.showq)
+    self.journal_fn = os.path.join(self.tmpdir, 'submittedFiles.lis')
+    self.scripts = [os.path.join(self.tmpdir, 'pbs_%d.pbs' % i) for i in range(7)]
+    self.sleeps = []
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def WriteCommand(self, name, body):
+    fn = os.path.join(self.tmpdir, name)
+    with open(fn, 'w') as f:
+      f.write('#!/bin/sh\n' + body)
+    os.chmod(fn, stat.S_IRWXU)
+    return fn
+
+  def DrainQueue(self, nleft=0):
+    """Stand-in for sleep_func: all but nleft jobs leave the queue."""
+    def Sleep(seconds):
+      self.sleeps.append(seconds)
+      with open(self.queue_fn, 'r') as f:
+        lines = f.readlines()
+      with open(self.queue_fn, 'w') as f:
+        f.writelines(lines[len(lines) - nleft:] if nleft else [])
+    return Sleep
+
+  def ReadQueueScripts(self):
+    with open(self.queue_fn, 'r') as f:
+      return [line.split()[3] for line in f]
+
+  def testCountQueued(self):
+    with open(self.queue_fn, 'w') as f:
+      f.write('1 testuser Running a\n2 testuser Idle b\n3 otheruser Idle c\n'
+              '4 testuser Completed d\n')
+    self.assertEqual(self.scheduler.CountQueued(), 2)
+    self.assertEqual(self.scheduler.Submit('e'), '4.fake')
+
+  def testBatchesAndBackoff(self):
+    submitted = []
+    submitter = Submitter.Submitter(
+      self.scheduler, Submitter.Journal(self.journal_fn), 3, min_sleep=1.0,
+      max_sleep=4.0, on_submit=lambda s, j: submitted.append((s, j)),
+      sleep_func=self.DrainQueue(nleft=3))
+    # Everything fits: a single poll, no sleeping between submissions.
+    self.assertEqual(submitter.Run(self.scripts[:3]), 3)
+    self.assertEqual([s for s, j in submitted], self.scripts[:3])
+    self.assertEqual([j for s, j in submitted], ['0.fake', '1.fake', '2.fake'])
+    self.assertEqual(submitter.npolls, 1)
+    self.assertEqual(self.sleeps, [])
+
+    open(self.queue_fn, 'w').close()
+    self.sleeps = []
+    # The remaining four go in batches of two.
+    submitter = Submitter.Submitter(
+      self.scheduler, Submitter.Journal(self.journal_fn), 3, batch_size=2,
+      min_sleep=1.0, max_sleep=4.0, sleep_func=self.DrainQueue())
+    self.assertEqual(submitter.Run(self.scripts), 4)
+    self.assertEqual(self.sleeps, [1.0])
+
+  def testBackoffWhenFull(self):
+    with open(self.queue_fn, 'w') as f:
+      f.write('1 testuser Running a\n2 testuser Running b\n')
+    def Sleep(seconds):
+      self.sleeps.append(seconds)
+      if len(self.sleeps) >= 4:
+        open(self.queue_fn, 'w').close()
+    submitter = Submitter.Submitter(
+      self.scheduler, Submitter.Journal(self.journal_fn), 2, min_sleep=1.0,
+      max_sleep=5.0, sleep_func=Sleep)
+    self.assertEqual(submitter.Run(self.scripts[:3]), 3)
+    self.assertEqual(self.sleeps, [2.0, 4.0, 5.0, 5.0, 1.0])
+
+  def testRestartIsIdempotent(self):
+    # An older submittedFiles.lis, without job IDs.
+    with open(self.journal_fn, 'w') as f:
+      f.write('%s \n%s \n' % (self.scripts[0], self.scripts[2]))
+    submitter = Submitter.Submitter(
+      self.scheduler, Submitter.Journal(self.journal_fn), 10,
+      sleep_func=self.DrainQueue())
+    self.assertEqual(submitter.Run(self.scripts), 5)
+    self.assertEqual(self.ReadQueueScripts(),
+                     [self.scripts[1]] + self.scripts[3:])
+    journal = Submitter.Journal(self.journal_fn)
+    self.assertEqual(journal.submitted[self.scripts[6]], '4.fake')
+    self.assertTrue(journal.Has(self.scripts[0]))
+    submitter = Submitter.Submitter(self.scheduler, journal, 10,
+                                    sleep_func=self.DrainQueue())
+    self.assertEqual(submitter.Run(self.scripts), 0)
+    self.assertEqual(submitter.npolls, 0)
+
+  def testFailures(self):
+    self.scheduler.qsub_cmd = self.WriteCommand('badqsub', 'exit 1\n')
+    submitter = Submitter.Submitter(
+      self.scheduler, Submitter.Journal(self.journal_fn), 10, max_failures=3,
+      sleep_func=self.DrainQueue())
+    self.assertRaises(RuntimeError, submitter.Run, self.scripts)
+    self.assertEqual(len(self.sleeps), 2)
+    self.assertFalse(os.path.exists(self.journal_fn))
+
+
+if __name__ == '__main__':
+  unittest.main()
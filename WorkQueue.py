@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+"""Pull-based queue of raytrace tasks on a shared filesystem.
+
+Instead of pushing one job per fid through the scheduler, a WorkQueue is
+filled with one task file per fid, and long-lived Workers (e.g. one per
+core of each allocated node) pull the next task as soon as they are free.
+Slow chips therefore do not hold up the rest of the observation.
+
+The queue is a directory with one subdirectory per state:
+  pending/<fid>.<attempts>             Waiting to be run.
+  claimed/<fid>.<attempt>.<worker_id>  Being run; the mtime is the lease.
+  done/<fid>                           Succeeded.
+  failed/<fid>                         Failed 'max_attempts' times.
+Every state change is a single rename(), which is atomic on POSIX
+filesystems (including NFS), so no two workers ever claim the same task.
+New tasks are written to tmp/ and renamed into pending/.  A worker renews
+its lease by touching its claimed file; claimed files whose lease is older
+than 'lease_s' (measured with the filesystem's clock, so the clocks of
+the nodes need not agree) are put back into pending/ by whichever worker
+notices first.  There is no server: all state lives in the directory.
+
+Usage:
+  WorkQueue.py add <queue_dir> <manifest.txt> [<manifest.txt> ...]
+  WorkQueue.py work <queue_dir> <imsim_config_file>
+  WorkQueue.py status <queue_dir>
+Run 'WorkQueue.py -h' for options.
+"""
+
+from __future__ import with_statement
+import errno
+import logging
+from optparse import OptionParser
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import PhosimUtil
+
+__author__ = 'Jeff Gardner (gardnerj@phys.washington.edu)'
+
+logger = logging.getLogger(__name__)
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+TASK_FIELDS = ('observation_id', 'cid', 'eid', 'filter_num', 'instrument',
+               'pars_archive_name', 'run_e2adc')
+
+
+class Task(object):
+  """A claimed task."""
+  def __init__(self, path, params, attempt, worker_id):
+    """Constructor.
+
+    Args:
+      path:      Path of the claimed file.
+      params:    Dict of TASK_FIELDS.
+      attempt:   1 for the first attempt, etc.
+      worker_id: ID of the worker holding the lease.
+    """
+    self.path = path
+    self.params = params
+    self.attempt = attempt
+    self.worker_id = worker_id
+    self.fid = TaskName(params['observation_id'], params['cid'], params['eid'])
+
+  def __repr__(self):
+    return 'Task(%r, attempt=%d, worker_id=%r)' % (self.fid, self.attempt,
+                                                    self.worker_id)
+
+
+def TaskName(observation_id, cid, eid):
+  return '%s_%s_%s' % (observation_id, cid, eid)
+
+def DefaultWorkerId():
+  """Returns <hostname>-<pid> ('.' is reserved as a separator)."""
+  return '%s-%d' % (socket.gethostname().replace('.', '-'), os.getpid())
+
+def _ReadTaskFile(path):
+  params = {}
+  with open(path, 'r') as f:
+    for line in f:
+      fields = line.split(None, 1)
+      if fields:
+        params[fields[0]] = fields[1].strip() if len(fields) > 1 else ''
+  return params
+
+def _Touch(path):
+  """Sets the mtime of path to now.  Returns False if path is gone."""
+  try:
+    os.utime(path, None)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return False
+    raise
+  return True
+
+def _Rename(src, dest):
+  """rename() that returns False if src is gone (e.g. taken by another worker)."""
+  try:
+    os.rename(src, dest)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return False
+    raise
+  return True
+
+
+class WorkQueue(object):
+  """A task queue in a directory on a shared filesystem."""
+
+  def __init__(self, queue_dir, lease_s=600.0, max_attempts=3):
+    """Constructor.
+
+    Args:
+      queue_dir:     Queue directory.  Created if needed.
+      lease_s:       A claimed task whose lease has not been renewed for
+                     this long is put back into pending/.
+      max_attempts:  A task that fails (or whose lease expires) this many
+                     times is moved to failed/.
+    """
+    self.queue_dir = queue_dir
+    self.lease_s = lease_s
+    self.max_attempts = max_attempts
+    for state in STATES + ('tmp',):
+      PhosimUtil.MakeDirs(self._Dir(state))
+
+  def _Dir(self, state):
+    return os.path.join(self.queue_dir, state)
+
+  def _FsNow(self):
+    """Returns the current time according to the filesystem's clock."""
+    clock_fn = os.path.join(self.queue_dir, 'tmp', 'clock')
+    try:
+      os.utime(clock_fn, None)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      open(clock_fn, 'a').close()
+    return os.stat(clock_fn).st_mtime
+
+  def TaskNames(self):
+    """Returns the set of fids in the queue, in any state."""
+    names = set()
+    for state in STATES:
+      names.update(fn.split('.', 1)[0] for fn in os.listdir(self._Dir(state)))
+    return names
+
+  def Add(self, params, task_names=None):
+    """Adds a task.
+
+    Args:
+      params:      Dict with at least 'observation_id', 'cid' and 'eid'.
+      task_names:  TaskNames(), if already known.  It is updated.
+
+    Returns:
+      True if the task was added, False if it is already in the queue.
+    """
+    name = TaskName(params['observation_id'], params['cid'], params['eid'])
+    if task_names is None:
+      task_names = self.TaskNames()
+    if name in task_names:
+      return False
+    task_names.add(name)
+    tmp_fn = os.path.join(self._Dir('tmp'), '%s.%s' % (name, DefaultWorkerId()))
+    with open(tmp_fn, 'w') as f:
+      for field in TASK_FIELDS:
+        if params.get(field) is not None:
+          f.write('%s %s\n' % (field, params[field]))
+    os.rename(tmp_fn, os.path.join(self._Dir('pending'), '%s.0' % name))
+    return True
+
+  def AddFromManifest(self, manifest_fn,
+                      manifest_parser_class=PhosimUtil.ManifestParser):
+    """Adds a task for every exposure_id in an observation's manifest.txt.
+
+    Returns:
+      Number of tasks added.
+    """
+    with manifest_parser_class(manifest_fn, 'r') as parser:
+      parser.Read()
+      params = {}
+      for field in ('observation_id', 'filter_num', 'instrument',
+                    'pars_archive_name', 'run_e2adc'):
+        values = parser.GetAllByTags('param', field)
+        if values:
+          params[field] = values[-1]
+      exposure_ids = parser.GetAllByTags('set', 'exposure_id')
+    nadded = 0
+    task_names = self.TaskNames()
+    for exposure_id in exposure_ids:
+      params['cid'], params['eid'] = exposure_id.rsplit('_', 1)
+      if self.Add(params, task_names):
+        nadded += 1
+    logger.info('Added %d of %d tasks from %s.', nadded, len(exposure_ids),
+                manifest_fn)
+    return nadded
+
+  def Claim(self, worker_id):
+    """Claims the next pending task.
+
+    Returns:
+      Task, or None if there are no pending tasks.
+    """
+    for fn in sorted(os.listdir(self._Dir('pending'))):
+      name, attempts = fn.rsplit('.', 1)
+      attempt = int(attempts) + 1
+      path = os.path.join(self._Dir('claimed'), '%s.%d.%s' % (name, attempt,
+                                                              worker_id))
+      # rename() keeps the mtime, which for a task added long ago would
+      # already look expired to RequeueExpired().  So start the lease
+      # before the task shows up in claimed/.
+      pending = os.path.join(self._Dir('pending'), fn)
+      if _Touch(pending) and _Rename(pending, path):
+        task = Task(path, _ReadTaskFile(path), attempt, worker_id)
+        logger.info('%s claimed %s (attempt %d).', worker_id, name, attempt)
+        return task
+    return None
+
+  def Heartbeat(self, task):
+    """Renews the lease on task.
+
+    Returns:
+      False if the lease was lost (the task expired and was requeued).
+    """
+    return _Touch(task.path)
+
+  def Complete(self, task):
+    """Marks task as done.  Returns False if the lease was lost."""
+    return _Rename(task.path, os.path.join(self._Dir('done'), task.fid))
+
+  def Fail(self, task):
+    """Requeues task, or moves it to failed/ after max_attempts.
+
+    Returns:
+      False if the lease was lost.
+    """
+    return self._Release(task.path, task.fid, task.attempt)
+
+  def _Release(self, path, name, attempt):
+    if attempt >= self.max_attempts:
+      logger.error('%s failed %d times.', name, attempt)
+      return _Rename(path, os.path.join(self._Dir('failed'), name))
+    return _Rename(path, os.path.join(self._Dir('pending'), '%s.%d' % (name, attempt)))
+
+  def RequeueExpired(self):
+    """Releases claimed tasks whose lease has expired.
+
+    Returns:
+      Number of tasks released.
+    """
+    now = self._FsNow()
+    nreleased = 0
+    for fn in os.listdir(self._Dir('claimed')):
+      path = os.path.join(self._Dir('claimed'), fn)
+      try:
+        mtime = os.stat(path).st_mtime
+      except OSError, e:
+        if e.errno == errno.ENOENT:
+          continue
+        raise
+      if now - mtime <= self.lease_s:
+        continue
+      name, attempt, worker_id = fn.split('.', 2)
+      if self._Release(path, name, int(attempt)):
+        logger.warning('Lease of %s on %s expired %.0f s ago.', worker_id, name,
+                       now - mtime - self.lease_s)
+        nreleased += 1
+    return nreleased
+
+  def Counts(self):
+    """Returns {state: number of tasks}."""
+    return dict((state, len(os.listdir(self._Dir(state)))) for state in STATES)
+
+  def Failed(self):
+    """Returns the fids of failed tasks."""
+    return sorted(os.listdir(self._Dir('failed')))
+
+
+def RaytraceCommand(imsim_config_file, python_exec='python',
+                    python_control_dir=None, extra_args=None):
+  """Returns a function that maps a Task to its onechip.py command line."""
+  if not python_control_dir:
+    python_control_dir = os.path.dirname(os.path.abspath(__file__))
+  def Command(task):
+    params = task.params
+    cmd = [python_exec, os.path.join(python_control_dir, 'onechip.py'),
+           imsim_config_file, params['observation_id'], params['cid'],
+           params['eid'], params.get('filter_num', '')]
+    if params.get('instrument'):
+      cmd.append('--instrument=%s' % params['instrument'])
+    if params.get('pars_archive_name'):
+      cmd.append('--pars_archive=%s' % params['pars_archive_name'])
+    if params.get('run_e2adc') == 'False':
+      cmd.append('--no_e2adc')
+    return cmd + list(extra_args or [])
+  return Command
+
+def TemplateCommand(template):
+  """Returns a function that maps a Task to template % task.params, run by sh."""
+  def Command(task):
+    return ['sh', '-c', template % task.params]
+  return Command
+
+
+class Worker(object):
+  """Pulls tasks from a WorkQueue and runs them until the queue is drained."""
+
+  def __init__(self, queue, command_func, worker_id=None, heartbeat_s=None,
+               poll_s=10.0):
+    """Constructor.
+
+    Args:
+      queue:         WorkQueue instance.
+      command_func:  Maps a Task to the argv that runs it (e.g.
+                     RaytraceCommand()).  Exit status 0 means success.
+      worker_id:     Default: DefaultWorkerId().
+      heartbeat_s:   Lease renewal interval (default: queue.lease_s / 4).
+      poll_s:        Wait this long for tasks of other workers to finish or
+                     expire when nothing is pending.
+    """
+    self.queue = queue
+    self.command_func = command_func
+    self.worker_id = worker_id if worker_id else DefaultWorkerId()
+    self.heartbeat_s = heartbeat_s if heartbeat_s else queue.lease_s / 4.0
+    self.poll_s = poll_s
+    self.ndone = 0
+    self.nfailed = 0
+
+  def RunTask(self, task):
+    """Runs task, renewing its lease.  Returns True upon success.
+
+    The command runs in its own session, so that if the lease is lost the
+    whole process group (e.g. onechip.py and the raytrace and e2adc
+    programs it started) is killed.
+    """
+    cmd = self.command_func(task)
+    logger.info('%s running %s: %s', self.worker_id, task.fid, cmd)
+    proc = subprocess.Popen(cmd, close_fds=True, preexec_fn=os.setsid)
+    last_heartbeat = time.time()
+    while proc.poll() is None:
+      time.sleep(min(1.0, self.heartbeat_s))
+      if time.time() - last_heartbeat >= self.heartbeat_s:
+        last_heartbeat = time.time()
+        if not self.queue.Heartbeat(task):
+          logger.error('%s lost its lease on %s; killing it.', self.worker_id,
+                       task.fid)
+          try:
+            os.killpg(proc.pid, signal.SIGKILL)
+          except OSError, e:
+            if e.errno != errno.ESRCH:
+              raise
+          proc.wait()
+          return False
+    if proc.returncode:
+      logger.warning('%s: %s exited with status %d.', self.worker_id, task.fid,
+                     proc.returncode)
+      self.queue.Fail(task)
+      self.nfailed += 1
+      return False
+    if not self.queue.Complete(task):
+      logger.warning('%s finished %s after its lease expired.', self.worker_id,
+                     task.fid)
+      return False
+    self.ndone += 1
+    return True
+
+  def Run(self):
+    """Runs tasks until none are pending or claimed.
+
+    Returns:
+      Number of tasks this worker completed.
+    """
+    while True:
+      task = self.queue.Claim(self.worker_id)
+      if task:
+        self.RunTask(task)
+        continue
+      if self.queue.RequeueExpired():
+        continue
+      if not self.queue.Counts()['claimed']:
+        break
+      time.sleep(self.poll_s)
+    logger.info('%s done: %d tasks completed, %d attempts failed.',
+                self.worker_id, self.ndone, self.nfailed)
+    return self.ndone
+
+
+if __name__ == '__main__':
+  usage = ('usage: %prog add <queue_dir> <manifest.txt> [...]\n'
+           '       %prog work <queue_dir> <imsim_config_file> [options]\n'
+           '       %prog status <queue_dir>')
+  parser = OptionParser(usage=usage)
+  parser.add_option('-L', '--lease_s', dest='lease_s', type='float', default=600.0,
+                    help='Requeue tasks whose lease is older than this.')
+  parser.add_option('-r', '--max_attempts', dest='max_attempts', type='int',
+                    default=3, help='Give up on a task after this many attempts.')
+  parser.add_option('-P', '--poll_s', dest='poll_s', type='float', default=10.0,
+                    help='Poll interval while other workers finish.')
+  parser.add_option('--python_exec', dest='python_exec', default='python',
+                    help='Python for running onechip.py.')
+  parser.add_option('--command', dest='command', default=None,
+                    help='Run this shell command instead of onechip.py, with'
+                    ' %(observation_id)s, %(cid)s, %(eid)s etc. substituted.')
+  (options, args) = parser.parse_args()
+  if (len(args) < 2 or args[0] not in ('add', 'work', 'status') or
+      (args[0] == 'add' and len(args) < 3) or
+      (args[0] == 'work' and len(args) != 3 and not options.command)):
+    print 'Incorrect number of arguments.  Use -h or --help for help.'
+    print usage
+    quit()
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s:%(name)s:  %(message)s')
+  queue = WorkQueue(args[1], lease_s=options.lease_s,
+                    max_attempts=options.max_attempts)
+  if args[0] == 'add':
+    for manifest_fn in args[2:]:
+      queue.AddFromManifest(manifest_fn)
+  elif args[0] == 'work':
+    if options.command:
+      command_func = TemplateCommand(options.command)
+    else:
+      command_func = RaytraceCommand(args[2], python_exec=options.python_exec)
+    Worker(queue, command_func, poll_s=options.poll_s).Run()
+  counts = queue.Counts()
+  print ' '.join('%s: %d' % (state, counts[state]) for state in STATES)
+  sys.exit(0)
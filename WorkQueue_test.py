@@ -0,0 +1,185 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import PhosimUtil
+import WorkQueue
+
+def MakeTmpDir():
+  return tempfile.mkdtemp()
+
+def ProcessIsRunning(pid):
+  """Is pid a live (not zombie) process?"""
+  try:
+    with open('/proc/%d/stat' % pid) as f:
+      return f.read().split(')')[-1].split()[0] != 'Z'
+  except IOError:
+    return False
+
+
+class WorkQueueTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = MakeTmpDir()
+    self.queue_dir = os.path.join(self.tmpdir, 'queue')
+    self.queue = WorkQueue.WorkQueue(self.queue_dir, lease_s=60, max_attempts=2)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def AddTasks(self, n, observation_id='1234'):
+    for i in range(n):
+      self.assertTrue(self.queue.Add({'observation_id': observation_id,
+                                      'cid': 'R22_S11', 'eid': 'E%03d' % i,
+                                      'filter_num': '2'}))
+
+  def testAddFromManifest(self):
+    manifest_fn = os.path.join(self.tmpdir, 'manifest.txt')
+    with PhosimUtil.ManifestParser(manifest_fn, 'w') as parser:
+      parser.Write([('param', 'observation_id', '1234'),
+                    ('param', 'filter_num', '2'),
+                    ('param', 'run_e2adc', 'False'),
+                    ('set', 'exposure_id', 'R22_S11_E000'),
+                    ('set', 'exposure_id', 'R01_S00_E001')])
+    self.assertEqual(self.queue.AddFromManifest(manifest_fn), 2)
+    # Adding again is a no-op.
+    self.assertEqual(self.queue.AddFromManifest(manifest_fn), 0)
+    task = self.queue.Claim('w1')
+    self.assertEqual(task.fid, '1234_R01_S00_E001')
+    self.assertEqual(task.attempt, 1)
+    self.assertEqual(WorkQueue.RaytraceCommand('my.cfg', python_control_dir='/pc')(task),
+                     ['python', '/pc/onechip.py', 'my.cfg', '1234', 'R01_S00', 'E001',
+                      '2', '--no_e2adc'])
+    self.assertTrue(self.queue.Complete(task))
+    self.assertEqual(self.queue.AddFromManifest(manifest_fn), 0)
+    self.assertEqual(self.queue.Counts(),
+                     {'pending': 1, 'claimed': 0, 'done': 1, 'failed': 0})
+
+  def testClaimIsExclusive(self):
+    self.AddTasks(1)
+    other = WorkQueue.WorkQueue(self.queue_dir)
+    task = self.queue.Claim('w1')
+    self.assertTrue(task)
+    self.assertEqual(other.Claim('w2'), None)
+
+  def testBoundedRetries(self):
+    self.AddTasks(1)
+    task = self.queue.Claim('w1')
+    self.assertTrue(self.queue.Fail(task))
+    task = self.queue.Claim('w1')
+    self.assertEqual(task.attempt, 2)
+    self.assertTrue(self.queue.Fail(task))
+    self.assertEqual(self.queue.Claim('w1'), None)
+    self.assertEqual(self.queue.Failed(), ['1234_R22_S11_E000'])
+
+  def testExpiredLeaseIsRequeued(self):
+    self.AddTasks(2)
+    stale = self.queue.Claim('dead')
+    live = self.queue.Claim('w1')
+    self.assertEqual(self.queue.RequeueExpired(), 0)
+    old = time.time() - 120
+    os.utime(stale.path, (old, old))
+    self.assertTrue(self.queue.Heartbeat(live))
+    self.assertEqual(self.queue.RequeueExpired(), 1)
+    self.assertFalse(self.queue.Heartbeat(stale))
+    self.assertFalse(self.queue.Complete(stale))
+    task = self.queue.Claim('w2')
+    self.assertEqual((task.fid, task.attempt), (stale.fid, 2))
+    # An expired last attempt fails the task.
+    os.utime(task.path, (old, old))
+    self.assertEqual(self.queue.RequeueExpired(), 1)
+    self.assertEqual(self.queue.Failed(), [stale.fid])
+    self.assertTrue(self.queue.Complete(live))
+
+  def testClaimOfOldTaskIsNotExpired(self):
+    self.AddTasks(1)
+    old = time.time() - 120
+    pending_dir = os.path.join(self.queue_dir, 'pending')
+    for fn in os.listdir(pending_dir):
+      os.utime(os.path.join(pending_dir, fn), (old, old))
+    # Another worker looks for expired leases right after the claim.
+    other = WorkQueue.WorkQueue(self.queue_dir, lease_s=60)
+    rename = WorkQueue._Rename
+    requeued = []
+    def RenameThenRequeue(src, dest):
+      renamed = rename(src, dest)
+      requeued.append(other.RequeueExpired())
+      return renamed
+    WorkQueue._Rename = RenameThenRequeue
+    try:
+      task = self.queue.Claim('w1')
+    finally:
+      WorkQueue._Rename = rename
+    self.assertEqual(requeued, [0])
+    self.assertEqual(task.attempt, 1)
+    self.assertTrue(self.queue.Heartbeat(task))
+
+  def testWorkerLosesLease(self):
+    self.AddTasks(1)
+    queue = WorkQueue.WorkQueue(self.queue_dir, lease_s=0.5)
+    worker = WorkQueue.Worker(queue, WorkQueue.TemplateCommand('sleep 30'),
+                              worker_id='w1', heartbeat_s=0.1)
+    task = queue.Claim('w1')
+    os.rename(task.path, os.path.join(self.queue_dir, 'pending', task.fid + '.1'))
+    start = time.time()
+    self.assertFalse(worker.RunTask(task))
+    self.assertTrue(time.time() - start < 10)
+
+  def testLostLeaseKillsGrandchildren(self):
+    self.AddTasks(1)
+    queue = WorkQueue.WorkQueue(self.queue_dir, lease_s=0.5)
+    pid_fn = os.path.join(self.tmpdir, 'grandchild.pid')
+    worker = WorkQueue.Worker(
+      queue, WorkQueue.TemplateCommand('sleep 30 & echo $! > %s; wait' % pid_fn),
+      worker_id='w1', heartbeat_s=0.1)
+    task = queue.Claim('w1')
+    os.rename(task.path, os.path.join(self.queue_dir, 'pending', task.fid + '.1'))
+    self.assertFalse(worker.RunTask(task))
+    with open(pid_fn) as f:
+      pid = int(f.read())
+    deadline = time.time() + 10
+    while time.time() < deadline and ProcessIsRunning(pid):
+      time.sleep(0.05)
+    self.assertFalse(ProcessIsRunning(pid))
+
+  def testManyWorkers(self):
+    """Runs WorkQueue.py workers in parallel against one queue."""
+    ntasks = 40
+    self.AddTasks(ntasks)
+    runs_dir = os.path.join(self.tmpdir, 'runs')
+    os.mkdir(runs_dir)
+    marker = os.path.join(self.tmpdir, 'marker')
+    # E007 always fails; E011 fails the first time only.
+    command = ('touch %s/%%(eid)s.$$; '
+               'if [ %%(eid)s = E007 ]; then exit 1; fi; '
+               'if [ %%(eid)s = E011 -a ! -f %s ]; then touch %s; exit 1; fi' %
+               (runs_dir, marker, marker))
+    workers = [subprocess.Popen([sys.executable,
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'WorkQueue.py'),
+                                 'work', self.queue_dir, '--command=%s' % command,
+                                 '--max_attempts=2', '--poll_s=0.1'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+               for i in range(8)]
+    for worker in workers:
+      worker.communicate()
+      self.assertEqual(worker.returncode, 0)
+    self.assertEqual(self.queue.Counts(),
+                     {'pending': 0, 'claimed': 0, 'done': ntasks - 1, 'failed': 1})
+    self.assertEqual(self.queue.Failed(), ['1234_R22_S11_E007'])
+    runs = {}
+    for fn in os.listdir(runs_dir):
+      eid = fn.split('.')[0]
+      runs[eid] = runs.get(eid, 0) + 1
+    expected = dict(('E%03d' % i, 1) for i in range(ntasks))
+    expected['E007'] = 2
+    expected['E011'] = 2
+    self.assertEqual(runs, expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
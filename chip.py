@@ -51,7 +51,7 @@ import string
 import gzip
 from optparse import OptionParser
 from Exposure import findSourceFile
-from Exposure import readAmpList
+import FocalplaneGeometry
 from Focalplane import filterToLetter
 from Focalplane import Focalplane
 from Focalplane import WithTimer
@@ -149,8 +149,8 @@ def makeChipImage(obshistid, filterNum, cid, expid, datadir,
 
 
     # RUN E2ADC CONVERTER
-    with open(findSourceFile('lsst/segmentation.txt'), 'r') as ampFile:
-        ampList = readAmpList(ampFile, cid)
+    instrDir = os.path.dirname(findSourceFile('lsst/segmentation.txt'))
+    ampList = FocalplaneGeometry.GetGeometry(instrDir).AmpList(cid)
     os.chdir('ancillary/e2adc')
     eadc = 'e2adc_%s_%s.pars' %(obshistid, id)
     cmd = 'time ./e2adc < ../../%s' %(eadc)
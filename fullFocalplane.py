@@ -107,13 +107,20 @@ def DoPreproc(trimfile, imsim_config_file, extra_commands, scheduler,
     preprocessor = PhosimManager.Preprocessor(imsim_config_file,
                                               trimfile, extra_commands)
   elif scheduler == 'pbs':
-    # Construct PhosimPreprocessor with PBS-specific ScriptWriter
-    preprocessor = PhosimManager.Preprocessor(
-      imsim_config_file, trimfile, extra_commands,
-      script_writer_class=ScriptWriter.PbsRaytraceScriptWriter)
     # Read in PBS-specific config
     policy = ConfigParser.RawConfigParser()
     policy.read(imsim_config_file)
+    exec_script_mode = 'per_fid'
+    if policy.has_option('pbs', 'exec_script_mode'):
+      exec_script_mode = policy.get('pbs', 'exec_script_mode')
+    if exec_script_mode not in ScriptWriter.PBS_SCRIPT_WRITERS:
+      logger.critical('Unknown exec_script_mode: %s', exec_script_mode)
+      return 1
+    script_writer_class = ScriptWriter.PBS_SCRIPT_WRITERS[exec_script_mode]
+    # Construct PhosimPreprocessor with PBS-specific ScriptWriter
+    preprocessor = PhosimManager.Preprocessor(
+      imsim_config_file, trimfile, extra_commands,
+      script_writer_class=script_writer_class)
     preprocessor.script_writer.ParsePbsConfig(policy)
 
   else:
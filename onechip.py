@@ -16,6 +16,13 @@ Parameters are set using the command line, or the config file.
 PhosimRaytracer can accomodate the nonexistance of atmosphere screens.
 If they do not exist, it simply runs phosim.GenerateAtmosphere().
 
+onechip.py can also raytrace several chips/exposures of one observation
+in a single invocation (see --exposures and --exposure_file).  The data
+dir, pars archive and atmosphere screens are then set up only once, in a
+PhosimManager.RaytraceEnvironment, and --nproc fids are raytraced
+concurrently.  Each fid is verified, copied to shared storage and logged
+exactly as if it had been run on its own.
+
 A few notes on options:
   --logtostderr: (only v3.2.x and higher) By default, log output from python_controls
                  is done via the python logging module, and directed to either
@@ -24,6 +31,11 @@ A few notes on options:
                  and prints logging information to stdout.  Note: handling of stdout
                  from phosim.py and the phosim binaries is done through the
                  'log_stdout' flag in the config file.
+  --exposures:   Comma-separated list of <cid>_<eid> exposure IDs to raytrace
+                 (e.g. R22_S11_E000,R22_S11_E001), or 'all' for every
+                 exposure in the observation's manifest.
+  --exposure_file: File listing the exposures to raytrace, either one
+                 <cid>_<eid> (or '<cid> <eid>') per line or a manifest.txt.
 
 """
 from __future__ import with_statement
@@ -33,6 +45,7 @@ import logging
 from optparse import OptionParser  # Can't use argparse yet, since we must work in 2.5
 import os
 import sys
+import traceback
 import PhosimManager
 import PhosimUtil
 import PhosimVerifier
@@ -46,15 +59,22 @@ logger = logging.getLogger(__name__)
 def ConfigureLogging(observation_id, fid, policy, log_to_stdout):
   """Configure logger and return name of file to write phosim stdout.
 
+  Any previous logging configuration is replaced, so this may be called
+  once per fid in the same process.
+
   Returns:
     Name of file to which to write phosim stdout or None if log_to_stdout.
   """
+  root_logger = logging.getLogger()
+  for handler in root_logger.handlers[:]:
+    root_logger.removeHandler(handler)
+    handler.close()
   # Figure out what to do with 'logging' output.
   if log_to_stdout:
     log_fn = None
   else:
     if policy.has_option('general', 'log_dir'):
-      log_dir = os.path.join(policy.get('general', 'log_dir'), obsid)
+      log_dir = os.path.join(policy.get('general', 'log_dir'), observation_id)
       log_fn = os.path.join(log_dir, 'onechip_%s.log' % fid)
     else:
       log_fn = '/tmp/onechip.log'
@@ -62,7 +82,7 @@ def ConfigureLogging(observation_id, fid, policy, log_to_stdout):
                               logfile_fullpath=log_fn)
   PhosimUtil.WriteLogHeader(__file__, params_str='fid: %s' % fid)
   # Figure out what to do with phosim stdout
-  if policy.getboolean('general', 'log_stdout'):
+  if policy.getboolean('general', 'log_stdout') and log_fn:
     stdout_log_fn = log_fn.rsplit('.', 1)[0] + '_stdout.log'
     logger.info('Redirecting stdout to %s.', stdout_log_fn)
     with open(stdout_log_fn, 'w') as outl:
@@ -92,16 +112,19 @@ def DoRaytrace(raytracer, pars_archive_name, keep_scratch_dirs=False,
     raytracer.InitExecEnvironment(pars_archive_name=pars_archive_name)
   t.LogWall('InitExecEnvironment')
   with PhosimUtil.WithTimer() as t:
-    raytracer.DoRaytrace()
+    raytracer.DoRaytrace(stage_out=copy_output)
   t.LogWall('Raytrace')
   if verifier:
     missing_files = verifier.VerifyScratchOutput(fitsverify=fitsverify)
     if missing_files:
       LogMissingFiles(missing_files)
+      raytracer.AbortStageOut()
       return 1
     logger.info('Scratch output files verified successfully.')
   if copy_output:
-    raytracer.CopyOutput(zip_rawfiles=zip_rawfiles)
+    with PhosimUtil.WithTimer() as t:
+      raytracer.CopyOutput(zip_rawfiles=zip_rawfiles)
+    t.LogWall('CopyOutput')
     if verifier:
       missing_files = verifier.VerifySharedOutput()
       if missing_files:
@@ -127,8 +150,9 @@ def main(imsim_config_file, observation_id, cid, eid, filter_num,
     filter_num:     Numeric identifier for filter.
     pars_archive_name: Name of archive containing preprocessing output
                        .pars files.
-    instrument:     'lsst', 'subaru', etc.
-    run_e2adc:      Run e2adc step after raytrace?
+    instrument:     'lsst', 'subaru', etc.  Read from the manifest if None.
+    run_e2adc:      Run e2adc step after raytrace?  Read from the manifest
+                    if None.
     keep_scratch_dirs: Do not delete the working directories at the end of
                        execution.
     log_to_stdout:  Write python_controls logging to stdout?
@@ -163,18 +187,160 @@ def main(imsim_config_file, observation_id, cid, eid, filter_num,
                     copy_output=copy_output, fitsverify=fitsverify)
 
 
+def SplitExposureId(exposure_id):
+  """Splits '<cid>_<eid>' (e.g. 'R22_S11_E000') into (cid, eid)."""
+  cid, eid = exposure_id.strip().rsplit('_', 1)
+  return cid, eid
+
+def ReadExposureFile(exposure_file):
+  """Reads a list of (cid, eid) pairs from exposure_file.
+
+  exposure_file is either a manifest.txt (exposures are taken from its
+  'set,exposure_id,<cid>_<eid>' rows) or has one exposure per line, as
+  '<cid>_<eid>' or '<cid> <eid>'.  Blank lines and lines starting with
+  '#' are ignored.
+  """
+  with open(exposure_file, 'r') as f:
+    lines = [line.strip() for line in f]
+  lines = [line for line in lines if line and not line.startswith('#')]
+  if lines and ',' in lines[0]:
+    with PhosimUtil.ManifestParser(exposure_file, 'r') as parser:
+      parser.Read()
+      return map(SplitExposureId, parser.GetAllByTags('set', 'exposure_id'))
+  exposures = []
+  for line in lines:
+    fields = line.split()
+    if len(fields) == 2:
+      exposures.append(tuple(fields))
+    else:
+      exposures.append(SplitExposureId(fields[0]))
+  return exposures
+
+def _RaytraceSharedFid(args):
+  """Raytraces one fid in a RaytraceEnvironment (multiprocessing worker).
+
+  Returns:
+    (fid, return code)
+  """
+  (imsim_config_file, shared_env, cid, eid, pars_archive_name,
+   keep_scratch_dirs, log_to_stdout, zip_rawfiles, copy_output, fitsverify) = args
+  observation_id = shared_env.observation_id
+  fid = phosim.BuildFid(observation_id, cid, eid)
+  try:
+    stdout_log_fn = ConfigureLogging(observation_id, fid, shared_env.policy,
+                                     log_to_stdout)
+    logger.info('Running onechip with imsim_config_file=%s  fid=%s'
+                ' filter_num=%s, instrument=%s run_e2adc=%s shared_env=%s',
+                imsim_config_file, fid, shared_env.filter_num,
+                shared_env.instrument, shared_env.run_e2adc,
+                shared_env.my_exec_path)
+    raytracer = PhosimManager.Raytracer(shared_env.policy, observation_id,
+                                        cid, eid, stdout_log_fn=stdout_log_fn,
+                                        shared_env=shared_env)
+    verifier = PhosimVerifier.RaytraceVerifier(
+      imsim_config_file, observation_id, cid, eid,
+      manifest_fullpath=shared_env.manifest_fullpath)
+    return fid, DoRaytrace(raytracer, pars_archive_name, keep_scratch_dirs,
+                           zip_rawfiles=zip_rawfiles, verifier=verifier,
+                           copy_output=copy_output, fitsverify=fitsverify)
+  except Exception:
+    logger.critical('Raytrace of %s failed:\n%s', fid, traceback.format_exc())
+    sys.stderr.write('Raytrace of %s failed:\n%s' % (fid, traceback.format_exc()))
+    return fid, 1
+
+def main_multi(imsim_config_file, observation_id, exposures, filter_num=None,
+               pars_archive_name='pars.zip', instrument=None, run_e2adc=None,
+               keep_scratch_dirs=False, log_to_stdout=False, zip_rawfiles=False,
+               copy_output=True, fitsverify=True, nproc=1):
+  """Run raytrace step for several fids of one observation.
+
+  The data dir, pars files and atmosphere screens are set up once in a
+  PhosimManager.RaytraceEnvironment and shared by all fids.  Each fid is
+  then raytraced, verified and copied to shared storage as in main(), by
+  a pool of nproc worker processes (one fid at a time per worker, since
+  the Raytracer changes directory and redirects stdout).  With nproc=1,
+  or on Python 2.5, which has no multiprocessing, the fids are raytraced
+  one after another in this process.
+
+  Args:
+    exposures:  List of (cid, eid) pairs or None for every exposure in
+                the observation's manifest.
+    nproc:      Number of fids to raytrace concurrently.
+    Other args are as for main().  filter_num, instrument, and run_e2adc
+    are read from the manifest if None.
+
+  Returns:
+    0 if every fid succeeded.
+  """
+  policy = ConfigParser.RawConfigParser()
+  policy.read(imsim_config_file)
+  assert policy.has_option('general', 'phosim_version')
+  assert (version.LooseVersion(policy.get('general', 'phosim_version'))
+          > version.LooseVersion('3.2.0'))
+  ConfigureLogging(observation_id, observation_id, policy, log_to_stdout)
+  shared_env = PhosimManager.RaytraceEnvironment(policy, observation_id,
+                                                 filter_num, instrument,
+                                                 run_e2adc)
+  if exposures is None:
+    exposures = map(SplitExposureId, shared_env.exposure_ids)
+  logger.info('Running onechip with imsim_config_file=%s  observation_id=%s'
+              ' nproc=%d exposures=%s', imsim_config_file, observation_id,
+              nproc, exposures)
+  with PhosimUtil.WithTimer() as t:
+    shared_env.InitExecEnvironment(
+      pars_archive_name=pars_archive_name,
+      fids=[phosim.BuildFid(observation_id, cid, eid) for cid, eid in exposures])
+  t.LogWall('RaytraceEnvironment.InitExecEnvironment')
+  tasks = [(imsim_config_file, shared_env, cid, eid, pars_archive_name,
+            keep_scratch_dirs, log_to_stdout, zip_rawfiles, copy_output,
+            fitsverify) for cid, eid in exposures]
+  pool = None
+  nworkers = min(nproc, len(tasks))
+  if nworkers > 1:
+    try:
+      # Python 2.6 and later.
+      import multiprocessing
+      pool = multiprocessing.Pool(nworkers)
+    except ImportError:
+      logger.warning('No multiprocessing module: raytracing %d fids one at a'
+                     ' time.', len(tasks))
+  with PhosimUtil.WithTimer() as t:
+    if pool:
+      try:
+        results = pool.map(_RaytraceSharedFid, tasks, 1)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = map(_RaytraceSharedFid, tasks)
+  t.LogWall('Raytrace of %d fids' % len(tasks))
+  failed = [fid for fid, rc in results if rc]
+  if failed:
+    logger.critical('Raytrace failed for: %s', ' '.join(failed))
+    return 1
+  # Per-fid scratch dirs link into shared_env, so keep it as long as they are.
+  if copy_output and not keep_scratch_dirs:
+    shared_env.Cleanup()
+  return 0
+
+
 if __name__ == '__main__':
 
-  usage = 'usage: %prog imsim_config_file observation_id cid eid filter_num [options]'
+  usage = ('usage: %prog imsim_config_file observation_id cid eid filter_num [options]\n'
+           '       %prog imsim_config_file observation_id [filter_num]'
+           ' --exposures=<cid>_<eid>,... | --exposure_file=<file> [options]')
   parser = OptionParser(usage=usage)
   parser.add_option('-c', '--no_copy_output', dest='copy_output', action='store_false',
                     default=True, help='Do no copy output to shared storage')
   parser.add_option('-e', '--no_e2adc', dest='run_e2adc', action='store_false',
-                    default=True, help='Do not run e2adc step.')
+                    default=None, help='Do not run e2adc step (default: as'
+                    ' preprocessed, from the manifest).')
   parser.add_option('-f', '--no_fitsverify', dest='fitsverify', action='store_false',
                     default=True, help='Do not verify FITS file contents'
                     ' with fitsverify.')
-  parser.add_option('-i', '--instrument', dest='instrument', default='lsst')
+  parser.add_option('-i', '--instrument', dest='instrument', default=None,
+                    help='Instrument (default: as preprocessed, from the'
+                    ' manifest).')
   parser.add_option('-k', '--keep_scratch', dest='keep_scratch_dirs',
                     action='store_true', default=False,
                     help='Do not cleanup working directories if we are copying'
@@ -184,13 +350,40 @@ if __name__ == '__main__':
                     help='Write logging output to stdout instead of log file'
                     ' (Note: this does not effect redirection of phosim stdout, which'
                     ' is done via the config file).')
+  parser.add_option('-n', '--nproc', dest='nproc', type='int', default=1,
+                    help='Number of exposures to raytrace concurrently with'
+                    ' --exposures or --exposure_file.')
   parser.add_option('-p', '--pars_archive', dest='pars_archive_name',
                     default='pars.zip', help='Name of pars archive')
+  parser.add_option('-x', '--exposures', dest='exposures', default=None,
+                    help='Comma-separated list of <cid>_<eid> to raytrace in one'
+                    ' shared environment, or "all" for every exposure in the'
+                    ' manifest.')
+  parser.add_option('-X', '--exposure_file', dest='exposure_file', default=None,
+                    help='File listing exposures to raytrace in one shared'
+                    ' environment (one <cid>_<eid> per line, or a manifest.txt).')
   parser.add_option('-z', '--zip_rawfiles', dest='zip_rawfiles',
                     action='store_true', default=False,
                     help='Archive e2adc output into single zip file ("true" overrides'
                     ' setting in config file).')
   (options, args) = parser.parse_args()
+  if options.exposures or options.exposure_file:
+    if len(args) not in (2, 3):
+      print 'Incorrect number of arguments.  Use -h or --help for help.'
+      print usage
+      quit()
+    if options.exposure_file:
+      exposures = ReadExposureFile(options.exposure_file)
+    elif options.exposures == 'all':
+      exposures = None
+    else:
+      exposures = map(SplitExposureId, options.exposures.split(','))
+    filter_num = args[2] if len(args) == 3 else None
+    sys.exit(main_multi(args[0], args[1], exposures, filter_num,
+                        options.pars_archive_name, options.instrument,
+                        options.run_e2adc, options.keep_scratch_dirs,
+                        options.log_to_stdout, options.zip_rawfiles,
+                        options.copy_output, options.fitsverify, options.nproc))
   if len(args) != 5:
     print 'Incorrect number of arguments.  Use -h or --help for help.'
     print usage
@@ -27,20 +27,21 @@ import os, re, sys
 import time, datetime
 import subprocess
 import lsst.pex.policy as pexPolicy
+import Submitter
 
 def submit(file, policy):
 
     """
 
-    The code submits one file at a time with appropriate wait times
-    between job (CCD) submissions so as not to flood the scheduler's
-    queue.  A job monitor database is updated upon each submission and
-    at the beginning of each job.  
+    The code submits the PBS files in batches, keeping at most maxJobs
+    jobs queued or running so as not to flood the scheduler's queue.
+    A job monitor database is updated upon each submission and at the
+    beginning of each job.
     
     """
 
     # Read the PBS files from your file list
-    myFiles = '%s' %(infile)
+    myFiles = '%s' %(file)
     files = open(myFiles).readlines()
 
     # Get necessary policy file info
@@ -62,94 +63,63 @@ def submit(file, policy):
     return
 
 def submitCcds(pbs, username, sleep, wait, nJobsMax, catGen, useDb, files, submittedFileList):
-    pbsFiles = open(pbs).readlines()
-    x = 1
-    y = 0
-    while len(pbsFiles):
-        print 'Total Number of PBS Files:', len(pbsFiles)
-        #cmd = 'qstat | grep %s' %(username)
-	cmd = "showq | grep %s | grep Running" %(username)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, close_fds=True)
-        results = p.stdout.readlines()
-        p.stdout.close()
-        #nJobs = len(results)
-        nJobsRunning = len(results)       
-        cmd = "showq | grep %s | grep Idle" %(username)	
-	p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, close_fds=True)
-        results = p.stdout.readlines()
-        p.stdout.close()
-        nJobsIdle = len(results)
-        #nToSubmit = nJobsMax - nJobs
-        nToSubmit = nJobsMax - (nJobsRunning + nJobsIdle)
-        print 'Max Number to submit: ', nToSubmit
-        done = 'False'
-        jobMonitor = 'python/lsst/sims/catalogs/generation/jobAllocator' 
-        catgenDir = os.path.join(catGen, jobMonitor)        
-        
-        for i in range(nToSubmit):
-
-            try:
-                myfile = pbsFiles.pop(0)
-                myfile = myfile.strip()
-                pfile = os.path.basename(myfile)
-                if pfile.startswith('pbs_'):
-                    #pf, obshistid, filt, raft, sensor, snapext = pfile.split('_')
-                    #filter = filt.strip('f')
-                    pf, obshistid, raft, sensor, snapext = pfile.split('_')
-
-                if pfile.startswith('8'):
-                    obshistid, filterext = pfile.split('_')
-                    useDb = 2
-
-                print 'Obshistid:', obshistid
-                sensorId = '%s_genJob_%i' %(obshistid, x)
-                for line in open(myfile).readlines(): 
-                    if line.startswith('### myJobId'):
-                        pd, name, sensorId = line.split()
-                        
-                print 'sensorId:', sensorId
-                
-                cmd  = 'qsub %s' %(myfile)
-                subprocess.check_call(cmd, shell=True)
-                print '%i: Submitted PBS File: %s' %(x, myfile)
-                
-                with file(submittedFileList, 'a') as subFile:
-                    subFile.write('%s \n' %(myfile))
-
-                if useDb == 1:
-                    #cmd = 'python %s/myJobTracker.py %s qsubbed %s %s' %(catgenDir, obshistid, sensorId, username, filter)
-                    cmd = 'python %s/myJobTracker.py %s qsubbed %s %s' %(catgenDir, obshistid, sensorId, username)
-                    try:
-                        print 'Updating jobTracker.'
-                        subprocess.check_call(cmd, shell=True)
-                    except OSError:
-                        print OSError
-                        print 'Job Monitor Database NOT Updated.'
-                        pass
-                else:
-                    print 'Not Updating Job Monitor Database.'
-                    
-                x += 1
-                print 'Waiting for %s seconds to submit next job.' %(wait)
-                print ''
-                time.sleep(wait)
-                done = 'False'         
-            except:
-                # out of files!
-                print 'Finished submitting all requested PBS jobs in list %s.' %(pbs)
-                done = 'True'
-                y += 1
-                break
-        if done == 'True':
-            break
-        else:
-            print 'Waiting for some jobs to clear out of the queue.'
-            print 'Sleeping for %s seconds.' %(sleep)
-            time.sleep(sleep)
+
+    """
+
+    Keeps up to nJobsMax of username's jobs in the queue until every
+    PBS script listed in pbs is submitted.  Scripts are submitted in
+    batches; 'wait' is the poll interval while submitting and 'sleep'
+    the longest poll interval while the queue is full.  Scripts already
+    listed in submittedFileList are skipped, so an interrupted run can
+    simply be restarted.
+
+    """
+
+    pbsFiles = Submitter.ReadScriptList(pbs)
+    print 'Total Number of PBS Files:', len(pbsFiles)
+    jobMonitor = 'python/lsst/sims/catalogs/generation/jobAllocator'
+    catgenDir = os.path.join(catGen, jobMonitor)
+    counter = [0]
+
+    def onSubmit(myfile, jobId):
+        counter[0] += 1
+        x = counter[0]
+        print '%i: Submitted PBS File: %s (%s)' %(x, myfile, jobId)
+        dbMode = useDb
+        obshistid = None
+        pfile = os.path.basename(myfile)
+        if pfile.startswith('pbs_'):
+            pf, obshistid, raft, sensor, snapext = pfile.split('_')
+        if pfile.startswith('8'):
+            obshistid, filterext = pfile.split('_')
+            dbMode = 2
+        if dbMode != 1:
+            print 'Not Updating Job Monitor Database.'
+            return
+        sensorId = '%s_genJob_%i' %(obshistid, x)
+        for line in open(myfile).readlines():
+            if line.startswith('### myJobId'):
+                pd, name, sensorId = line.split()
+        print 'Obshistid:', obshistid
+        print 'sensorId:', sensorId
+        cmd = 'python %s/myJobTracker.py %s qsubbed %s %s' %(catgenDir, obshistid, sensorId, username)
+        try:
+            print 'Updating jobTracker.'
+            subprocess.check_call(cmd, shell=True)
+        except (OSError, subprocess.CalledProcessError), e:
+            print e
+            print 'Job Monitor Database NOT Updated.'
+
+    submitter = Submitter.Submitter(Submitter.PbsScheduler(username),
+                                    Submitter.Journal(submittedFileList),
+                                    nJobsMax, min_sleep=wait,
+                                    max_sleep=max(sleep, wait),
+                                    on_submit=onSubmit)
+    submitter.Run(pbsFiles)
 
     now = datetime.datetime.now()
     print 'Finished submitting all jobs in list %s on %s: ' %(pbs, now.ctime())
-        
+
     return
 
 if __name__ == "__main__":
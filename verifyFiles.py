@@ -43,7 +43,8 @@ def WriteErrors(output_stream, missing_list, corrupt_list):
       add_to_returncode += 4
   return add_to_returncode
 
-def main(stage, obshistid, filterid, path, id_list, exp_list, camstr, outfilename, no_stderr):
+def main(stage, obshistid, filterid, path, id_list, exp_list, camstr, outfilename, no_stderr,
+         nthreads=4, use_fitsverify=False):
   missing_list = []
   corrupt_list = []
   fp = Focalplane(obshistid, filterid)
@@ -53,7 +54,8 @@ def main(stage, obshistid, filterid, path, id_list, exp_list, camstr, outfilenam
     if not id_list or not len(id_list)==1:
       raise RuntimeError("IDLIST must be set to exactly 1 id in raytrace_exec mode")
     exposure = Exposure(obshistid, filterid, id_list[0])
-    missing_list, corrupt_list = exposure.verifyExecFiles(path)
+    missing_list, corrupt_list = exposure.verifyExecFiles(path, nthreads=nthreads,
+                                                          useFitsverify=use_fitsverify)
   elif stage == 'raytrace_output':
     if not id_list:
       for cidTuple in fp.generateCidList(camstr, id_list):
@@ -95,6 +97,12 @@ if __name__ == "__main__":
   parser.add_option("-n", "--no_stderr", dest="no_stderr", action="store_true",
                     default=False, help="Do not output to stderr (default is to" +
                     " output to stderr and OUTFILENAME if specified)")
+  parser.add_option("-t", "--threads", dest="nthreads", type="int", default=4,
+                    help="Number of threads verifying FITS contents in stage" +
+                    " 'raytrace_exec' (default: %default)")
+  parser.add_option("-f", "--fitsverify", dest="use_fitsverify", action="store_true",
+                    default=False, help="Verify FITS contents with batched fitsverify" +
+                    " calls instead of in python")
   (options, args) = parser.parse_args()
 
   if len(args) != 3:
@@ -110,6 +118,7 @@ if __name__ == "__main__":
     raise RuntimeError("Unrecognized explist")
   exp_list = options.explist.split(",")
   result = main(options.stage, obshistid, filterid, path, id_list, exp_list, options.camstr,
-                options.outfilename, options.no_stderr)
+                options.outfilename, options.no_stderr, options.nthreads,
+                options.use_fitsverify)
   sys.exit(result)
         